@@ -9,9 +9,10 @@ __commands__ = []
 
 # built-ins
 import argparse
+import collections
 import logging
+import queue
 import random
-import numpy
 import os
 import os.path
 import shutil
@@ -20,6 +21,8 @@ import functools
 import operator
 import concurrent.futures
 import csv
+import threading
+import time
 
 from itertools import zip_longest    # pylint: disable=E0611
 
@@ -27,7 +30,6 @@ from itertools import zip_longest    # pylint: disable=E0611
 import util.cmd
 import util.file
 import util.misc
-import util.vcf
 import read_utils
 import tools
 import tools.picard
@@ -42,10 +44,7 @@ import tools.mummer
 import tools.muscle
 import tools.gap2seq
 
-# third-party
-import Bio.AlignIO
-import Bio.SeqIO
-import Bio.Data.IUPACData
+# third-party modules (numpy, pysam, Bio) are imported where they are used
 
 log = logging.getLogger(__name__)
 
@@ -59,147 +58,274 @@ class DenovoAssemblyError(RuntimeError):
         super(DenovoAssemblyError, self).__init__(reason)
 
 
-def trim_rmdup_subsamp_reads(inBam, clipDb, outBam, n_reads=100000, trim_opts=None):
-    ''' Take reads through Trimmomatic, Prinseq, and subsampling.
-        This should probably move over to read_utils.
+class ReadReservoir(object):
+    ''' A uniform random sample of at most `size` items from a stream of
+        unknown length, kept in a single pass (reservoir sampling). The
+        random generator is seeded so that results are reproducible.
     '''
 
-    downsamplesam = tools.picard.DownsampleSamTool()
-    samtools = tools.samtools.SamtoolsTool()
-
-    if n_reads < 1:
-        raise Exception()
-
-    # BAM -> fastq
-    infq = list(map(util.file.mkstempfname, ['.in.1.fastq', '.in.2.fastq']))
-    tools.picard.SamToFastqTool().execute(inBam, infq[0], infq[1])
-    n_input = util.file.count_fastq_reads(infq[0])
-
-    # --- Trimmomatic ---
-    trimfq = list(map(util.file.mkstempfname, ['.trim.1.fastq', '.trim.2.fastq']))
-    trimfq_unpaired = list(map(util.file.mkstempfname, ['.trim.unpaired.1.fastq', '.trim.unpaired.2.fastq']))
-    if n_input == 0:
-        for i in range(2):
-            shutil.copyfile(infq[i], trimfq[i])
-    else:
-        tools.trimmomatic.TrimmomaticTool().execute(
-            infq[0],
-            infq[1],
-            trimfq[0],
-            trimfq[1],
-            clipDb,
-            unpairedOutFastq1=trimfq_unpaired[0],
-            unpairedOutFastq2=trimfq_unpaired[1],
-            **(trim_opts or {})
-        )
-
-    n_trim = max(map(util.file.count_fastq_reads, trimfq))    # count is pairs
-    n_trim_unpaired = sum(map(util.file.count_fastq_reads, trimfq_unpaired))    # count is individual reads
+    def __init__(self, size, seed=0):
+        self.size = size
+        self.n_seen = 0
+        self._items = []
+        self._random = random.Random(seed)
 
-    # --- Prinseq duplicate removal ---
-    # the paired reads from trim, de-duplicated
-    rmdupfq = list(map(util.file.mkstempfname, ['.rmdup.1.fastq', '.rmdup.2.fastq']))
+    def add(self, item):
+        self.n_seen += 1
+        if len(self._items) < self.size:
+            self._items.append((self.n_seen, item))
+        else:
+            j = self._random.randrange(self.n_seen)
+            if j < self.size:
+                self._items[j] = (self.n_seen, item)
 
-    # the unpaired reads from rmdup, de-duplicated with the other singleton files later on
-    rmdupfq_unpaired_from_paired_rmdup = list(
-        map(util.file.mkstempfname, ['.rmdup.unpaired.1.fastq', '.rmdup.unpaired.2.fastq'])
-    )
+    def sample(self, size=None):
+        ''' Return at most size of the sampled items (all of them by default),
+            in the order they were added.
+        '''
+        items = self._items
+        if size is not None and size < len(items):
+            items = self._random.sample(items, size)
+        return [item for i, item in sorted(items, key=operator.itemgetter(0))]
+
+
+def _bam_paired_mode(inBam):
+    ''' Whether the first primary read of inBam is paired, or None if it has no reads. '''
+    import pysam
+    with pysam.AlignmentFile(inBam, 'rb', check_sq=False) as inb:
+        for read in inb.fetch(until_eof=True):
+            if not (read.is_secondary or read.is_supplementary):
+                return read.is_paired
+    return None
+
+
+def _write_bam_fastqs(inBam, outFastqs, paired, counts):
+    ''' Write the reads of inBam to one FASTQ (unpaired) or two FASTQs of
+        mates (paired), which may be named pipes. '''
+    import pysam
+    def record(read):
+        quals = read.get_forward_qualities()
+        seq = read.get_forward_sequence() or ''
+        qual = ''.join(chr(q + 33) for q in quals) if quals is not None else 'I' * len(seq)
+        return '@{}\n{}\n+\n{}\n'.format(read.query_name, seq, qual)
+
+    outfs = [open(fn, 'wt') for fn in outFastqs]
+    try:
+        with pysam.AlignmentFile(inBam, 'rb', check_sq=False) as inb:
+            pending = {}
+            for read in inb.fetch(until_eof=True):
+                if read.is_secondary or read.is_supplementary:
+                    continue
+                if not paired:
+                    counts['input'] += 1
+                    outfs[0].write(record(read))
+                    continue
+                if not read.is_paired:
+                    counts['input_skipped'] += 1
+                    continue
+                mates = pending.setdefault(read.query_name, [None, None])
+                mates[0 if read.is_read1 else 1] = read
+                if mates[0] is not None and mates[1] is not None:
+                    del pending[read.query_name]
+                    counts['input'] += 1
+                    for outf, mate in zip(outfs, mates):
+                        outf.write(record(mate))
+            counts['input_skipped'] += len(pending)
+    except BrokenPipeError:
+        # the reader failed, and will report its own error
+        pass
+    finally:
+        for outf in outfs:
+            try:
+                outf.close()
+            except BrokenPipeError:
+                pass
+
+
+def _read_fastq(inFastq):
+    ''' Yield (name, seq, qual) tuples from a FASTQ file or named pipe. '''
+    with open(inFastq, 'rt') as inf:
+        for header in inf:
+            seq = inf.readline().rstrip('\n')
+            inf.readline()
+            qual = inf.readline().rstrip('\n')
+            yield (header[1:].split()[0], seq, qual)
+
+
+def _release_fifos(paths):
+    ''' Wake any thread still blocked opening one of these named pipes
+        (e.g. after the process on the other end died without opening it). '''
+    for path in paths:
+        for flags in (os.O_RDONLY | os.O_NONBLOCK, os.O_WRONLY | os.O_NONBLOCK):
+            try:
+                os.close(os.open(path, flags))
+            except OSError:
+                pass
+
+
+def trim_rmdup_subsamp_reads(inBam, clipDb, outBam, n_reads=100000, trim_opts=None, seed=0):
+    ''' Take reads through Trimmomatic, duplicate removal, and subsampling.
+        This should probably move over to read_utils.
 
-    prinseq = tools.prinseq.PrinseqTool()
-    prinseq.rmdup_fastq_paired(
-        trimfq[0],
-        trimfq[1],
-        rmdupfq[0],
-        rmdupfq[1],
-        includeUnmated=False,
-        unpairedOutFastq1=rmdupfq_unpaired_from_paired_rmdup[0],
-        unpairedOutFastq2=rmdupfq_unpaired_from_paired_rmdup[1]
-    )
+        Everything happens in one pass over the reads: the BAM is streamed
+        to Trimmomatic over named pipes, and Trimmomatic's paired output
+        streams straight into duplicate removal (exact duplicates and reads
+        with more than one N are removed, as with prinseq -derep 1 -ns_max_n 1)
+        and into reservoir samplers of read pairs and of unpaired reads
+        (mates of pairs that lost a read to the N filter, then Trimmomatic's
+        unpaired outputs, which are spooled to temporary files and read in
+        order once Trimmomatic is done). Reads reach each sampler in the same
+        order on every run and the samplers use a fixed seed, so output is
+        reproducible. Only the sampled reads are held in memory.
+    '''
+    import pysam
+    if n_reads < 1:
+        raise Exception()
 
-    n_rmdup_paired = max(map(util.file.count_fastq_reads, rmdupfq))    # count is pairs
+    counts = collections.Counter()
+    pair_index = read_utils.DuplicateKeyIndex()
+    unpaired_index = read_utils.DuplicateKeyIndex()
+    pair_reservoir = ReadReservoir(n_reads // 2, seed=seed)
+    unpaired_reservoir = ReadReservoir(n_reads, seed=seed + 1)
+
+    def add_unpaired(read, from_trim):
+        if from_trim:
+            counts['trim_unpaired'] += 1
+        if read[1].upper().count('N') > 1:
+            return
+        counts['unpaired_seen'] += 1
+        if unpaired_index.find_or_add(read[1], counts['unpaired_seen']) == counts['unpaired_seen']:
+            counts['rmdup_unpaired'] += 1
+            unpaired_reservoir.add(read)
+
+    def add_pair(read1, read2):
+        counts['trim'] += 1
+        passed = [read[1].upper().count('N') <= 1 for read in (read1, read2)]
+        if all(passed):
+            if pair_index.find_or_add(read1[1] + '\t' + read2[1], counts['trim']) == counts['trim']:
+                counts['rmdup'] += 1
+                pair_reservoir.add((read1, read2))
+        else:
+            for read, ok in zip((read1, read2), passed):
+                if ok:
+                    add_unpaired(read, False)
+
+    paired = _bam_paired_mode(inBam)
+    if paired is not None:
+        errors = []
+
+        def run(target, *args):
+            def wrapped():
+                try:
+                    target(*args)
+                except Exception as e:
+                    errors.append(e)
+                    raise
+            thread = threading.Thread(target=wrapped)
+            thread.daemon = True
+            thread.start()
+            return thread
+
+        def spool(fastq, spool_fastq):
+            with open(fastq, 'rb') as inf, open(spool_fastq, 'wb') as outf:
+                shutil.copyfileobj(inf, outf)
+
+        def read_to_queue(fastq, q):
+            try:
+                for read in _read_fastq(fastq):
+                    q.put(read)
+            finally:
+                q.put(None)
+
+        def read_pairs(q1, q2):
+            while True:
+                read1, read2 = q1.get(), q2.get()
+                if read1 is None or read2 is None:
+                    if read1 is not None or read2 is not None:
+                        raise Exception('Trimmomatic paired outputs have different numbers of reads')
+                    return
+                add_pair(read1, read2)
+
+        names = ('in.1.fastq', 'in.2.fastq', 'trim.1.fastq', 'trim.2.fastq',
+                 'trim.unpaired.1.fastq', 'trim.unpaired.2.fastq')
+        spool_suffixes = ('.unpaired.1.fastq', '.unpaired.2.fastq')
+        with util.file.fifo(names=names) as pipes, util.file.tempfnames(spool_suffixes) as spooled:
+            infq, trimfq, trimfq_unpaired = pipes[0:2], pipes[2:4], pipes[4:6]
+            threads = []
+            if paired:
+                threads.append(run(_write_bam_fastqs, inBam, infq, True, counts))
+                queues = (queue.Queue(), queue.Queue())
+                for fastq, q in zip(trimfq, queues):
+                    threads.append(run(read_to_queue, fastq, q))
+                threads.append(run(read_pairs, *queues))
+                for fastq, spool_fastq in zip(trimfq_unpaired, spooled):
+                    threads.append(run(spool, fastq, spool_fastq))
+            else:
+                threads.append(run(_write_bam_fastqs, inBam, infq[:1], False, counts))
+                threads.append(run(spool, trimfq_unpaired[0], spooled[0]))
+            try:
+                tools.trimmomatic.TrimmomaticTool().execute(
+                    infq[0],
+                    infq[1] if paired else None,
+                    trimfq[0],
+                    trimfq[1],
+                    clipDb,
+                    unpairedOutFastq1=trimfq_unpaired[0],
+                    unpairedOutFastq2=trimfq_unpaired[1] if paired else None,
+                    **(trim_opts or {})
+                )
+            finally:
+                # threads may still be blocked on pipes Trimmomatic never opened
+                while any(thread.is_alive() for thread in threads):
+                    _release_fifos(pipes)
+                    for thread in threads:
+                        thread.join(0.1)
+            if errors:
+                raise errors[0]
+            for spool_fastq in spooled[:2 if paired else 1]:
+                for read in _read_fastq(spool_fastq):
+                    add_unpaired(read, True)
+        if counts['input_skipped']:
+            log.warning("skipped %d input reads without a mate", counts['input_skipped'])
+
+    n_input = counts['input']
+    n_trim = counts['trim']    # count is pairs
+    n_trim_unpaired = counts['trim_unpaired']    # count is individual reads
+    n_rmdup_paired = counts['rmdup']    # count is pairs
     n_rmdup = n_rmdup_paired    # count is pairs
-
-    tmp_header = util.file.mkstempfname('.header.sam')
-    tools.samtools.SamtoolsTool().dumpHeader(inBam, tmp_header)
-
-    # convert paired reads to bam
-    # stub out an empty file if the input fastqs are empty
-    tmp_bam_paired = util.file.mkstempfname('.paired.bam')
-    if all(os.path.getsize(x) > 0 for x in rmdupfq):
-        tools.picard.FastqToSamTool().execute(rmdupfq[0], rmdupfq[1], 'Dummy', tmp_bam_paired)
-    else:
-        opts = ['INPUT=' + tmp_header, 'OUTPUT=' + tmp_bam_paired, 'VERBOSITY=ERROR']
-        tools.picard.PicardTools().execute('SamFormatConverter', opts, JVMmemory='50m')
-
-    n_paired_subsamp = 0
-    n_unpaired_subsamp = 0
     n_rmdup_unpaired = 0
 
     # --- subsampling ---
-
     # if we have too few paired reads after trimming and de-duplication, we can incorporate unpaired reads to reach the desired count
     if n_rmdup_paired * 2 < n_reads:
-        # the unpaired reads from the trim operation, and the singletons from Prinseq
-        unpaired_concat = util.file.mkstempfname('.unpaired.fastq')
-
-        # merge unpaired reads from trimmomatic and singletons left over from paired-mode prinseq
-        util.file.cat(unpaired_concat, trimfq_unpaired + rmdupfq_unpaired_from_paired_rmdup)
-
-        # remove the earlier singleton files
-        for f in trimfq_unpaired + rmdupfq_unpaired_from_paired_rmdup:
-            os.unlink(f)
-
-        # the de-duplicated singletons
-        unpaired_concat_rmdup = util.file.mkstempfname('.unpaired.rumdup.fastq')
-        prinseq.rmdup_fastq_single(unpaired_concat, unpaired_concat_rmdup)
-        os.unlink(unpaired_concat)
-
-        n_rmdup_unpaired = util.file.count_fastq_reads(unpaired_concat_rmdup)
-
         did_include_subsampled_unpaired_reads = True
-        # if there are no unpaired reads, simply output the paired reads
-        if n_rmdup_unpaired == 0:
-            shutil.copyfile(tmp_bam_paired, outBam)
-            n_output = samtools.count(outBam)
-        else:
-            # take pooled unpaired reads and convert to bam
-            tmp_bam_unpaired = util.file.mkstempfname('.unpaired.bam')
-            tools.picard.FastqToSamTool().execute(unpaired_concat_rmdup, None, 'Dummy', tmp_bam_unpaired)
-
-            tmp_bam_unpaired_subsamp = util.file.mkstempfname('.unpaired.subsamp.bam')
-            reads_to_add = (n_reads - (n_rmdup_paired * 2))
-
-            downsamplesam.downsample_to_approx_count(tmp_bam_unpaired, tmp_bam_unpaired_subsamp, reads_to_add)
-            n_unpaired_subsamp = samtools.count(tmp_bam_unpaired_subsamp)
-            os.unlink(tmp_bam_unpaired)
-
-            # merge the subsampled unpaired reads into the bam to be used as
-            tmp_bam_merged = util.file.mkstempfname('.merged.bam')
-            tools.picard.MergeSamFilesTool().execute([tmp_bam_paired, tmp_bam_unpaired_subsamp], tmp_bam_merged)
-            os.unlink(tmp_bam_unpaired_subsamp)
-
-            tools.samtools.SamtoolsTool().reheader(tmp_bam_merged, tmp_header, outBam)
-            os.unlink(tmp_bam_merged)
-
-            n_paired_subsamp = n_rmdup_paired    # count is pairs
-            n_output = n_rmdup_paired * 2 + n_unpaired_subsamp    # count is individual reads
-
+        n_rmdup_unpaired = counts['rmdup_unpaired']
+        out_pairs = pair_reservoir.sample()
+        out_unpaired = unpaired_reservoir.sample(n_reads - n_rmdup_paired * 2)
     else:
         did_include_subsampled_unpaired_reads = False
         log.info("PRE-SUBSAMPLE COUNT: %s read pairs", n_rmdup_paired)
-
-        tmp_bam_paired_subsamp = util.file.mkstempfname('.unpaired.subsamp.bam')
-        downsamplesam.downsample_to_approx_count(tmp_bam_paired, tmp_bam_paired_subsamp, n_reads)
-        n_paired_subsamp = samtools.count(tmp_bam_paired_subsamp) // 2    # count is pairs
-        n_output = n_paired_subsamp * 2    # count is individual reads
-
-        tools.samtools.SamtoolsTool().reheader(tmp_bam_paired_subsamp, tmp_header, outBam)
-        os.unlink(tmp_bam_paired_subsamp)
-
-    os.unlink(tmp_bam_paired)
-    os.unlink(tmp_header)
-
-    n_final_individual_reads = samtools.count(outBam)
+        out_pairs = pair_reservoir.sample()
+        out_unpaired = []
+    n_paired_subsamp = len(out_pairs)    # count is pairs
+    n_unpaired_subsamp = len(out_unpaired)
+    n_output = n_paired_subsamp * 2 + n_unpaired_subsamp    # count is individual reads
+
+    with pysam.AlignmentFile(inBam, 'rb', check_sq=False) as inb:
+        with pysam.AlignmentFile(outBam, 'wb', template=inb) as outb:
+            def write(read, flag):
+                name, seq, qual = read
+                out = pysam.AlignedSegment()
+                out.query_name = name
+                out.flag = flag
+                out.query_sequence = seq
+                out.query_qualities = pysam.qualitystring_to_array(qual)
+                outb.write(out)
+            for read1, read2 in out_pairs:
+                write(read1, 0x1 | 0x4 | 0x8 | 0x40)
+                write(read2, 0x1 | 0x4 | 0x8 | 0x80)
+            for read in out_unpaired:
+                write(read, 0x4)
 
     log.info("Pre-DeNovoAssembly read filters: ")
     log.info("    {} read pairs at start ".format(n_input))
@@ -209,8 +335,8 @@ def trim_rmdup_subsamp_reads(inBam, clipDb, outBam, n_reads=100000, trim_opts=No
         )
     )
     log.info(
-        "    {} read pairs after Prinseq rmdup {} ".format(
-            n_rmdup, "(and {} unpaired from Trimmomatic+Prinseq)".format(n_rmdup_unpaired)
+        "    {} read pairs after rmdup {} ".format(
+            n_rmdup, "(and {} unpaired from Trimmomatic+rmdup)".format(n_rmdup_unpaired)
             if n_rmdup_unpaired > 0 else ""
         )
     )
@@ -230,20 +356,13 @@ def trim_rmdup_subsamp_reads(inBam, clipDb, outBam, n_reads=100000, trim_opts=No
             if did_include_subsampled_unpaired_reads else ""
         )
     )
-    log.info("    {} individual reads".format(n_final_individual_reads))
 
     if did_include_subsampled_unpaired_reads:
-        if n_final_individual_reads < n_reads:
+        if n_output < n_reads:
             log.warning(
                 "NOTE: Even with unpaired reads included, there are fewer unique trimmed reads than requested for de novo assembly input."
             )
 
-    # clean up temp files
-    for i in range(2):
-        for f in infq, trimfq, rmdupfq:
-            if os.path.exists(f[i]):
-                os.unlink(f[i])
-
     # multiply counts so all reflect individual reads
     return (n_input * 2, n_trim * 2, n_rmdup * 2, n_output, n_paired_subsamp * 2, n_unpaired_subsamp)
 
@@ -493,18 +612,72 @@ def _order_and_orient_orig(inFasta, inReference, outFasta,
 def _call_order_and_orient_orig(inReference, outFasta, outAlternateContigs, **kwargs):
     return _order_and_orient_orig(inReference=inReference, outFasta=outFasta, outAlternateContigs=outAlternateContigs, **kwargs)
 
+def _call_order_and_orient_timed(inReference, outFasta, outAlternateContigs, **kwargs):
+    ''' Scaffold against one reference, returning the elapsed wall time in seconds. '''
+    start_time = time.time()
+    assert _call_order_and_orient_orig(inReference, outFasta, outAlternateContigs, **kwargs) == 0
+    return time.time() - start_time
+
+
+SKETCH_KMER_SIZE = 21
+SKETCH_SCALE = 10
+
+def _kmer_sketch(seqs, k=SKETCH_KMER_SIZE, scale=SKETCH_SCALE):
+    ''' A FracMinHash sketch of the canonical k-mers (k <= 31) of some
+        sequences: the sorted unique hashes that fall in the lowest
+        1/scale of the hash space. K-mers with non-ACGT bases are skipped.
+    '''
+    import numpy
+    codes = numpy.full(256, 4, dtype=numpy.uint8)
+    for i, base in enumerate('ACGT'):
+        codes[ord(base)] = codes[ord(base.lower())] = i
+    hashes = []
+    for seq in seqs:
+        seq = codes[numpy.frombuffer(str(seq).encode('ascii'), dtype=numpy.uint8)]
+        n = len(seq) - k + 1
+        if n < 1:
+            continue
+        fwd = numpy.zeros(n, dtype=numpy.uint64)
+        rev = numpy.zeros(n, dtype=numpy.uint64)
+        invalid = numpy.zeros(n, dtype=bool)
+        for i in range(k):
+            window = seq[i:i + n]
+            invalid |= window > 3
+            fwd = (fwd << numpy.uint64(2)) | window.astype(numpy.uint64)
+            rev |= (3 - window.astype(numpy.uint64)) << numpy.uint64(2 * i)
+        kmers = numpy.minimum(fwd, rev)[~invalid] & numpy.uint64((1 << (2 * k)) - 1)
+        # multiplicative hashing spreads k-mers over the 64-bit space
+        hashes.append(kmers * numpy.uint64(0x9E3779B97F4A7C15))
+    if not hashes:
+        return numpy.zeros(0, dtype=numpy.uint64)
+    hashes = numpy.concatenate(hashes)
+    return numpy.unique(hashes[hashes <= numpy.uint64((2**64 - 1) // scale)])
+
+def _kmer_containment(query_sketch, ref_sketch):
+    ''' Estimated fraction of the query's k-mers found in the reference. '''
+    import numpy
+    if len(query_sketch) == 0:
+        return 0.0
+    return float(len(numpy.intersect1d(query_sketch, ref_sketch, assume_unique=True))) / len(query_sketch)
+
 def order_and_orient(inFasta, inReference, outFasta,
         outAlternateContigs=None, outReference=None,
         breaklen=None, # aligner='nucmer', circular=False, trimmed_contigs=None,
         maxgap=200, minmatch=10, mincluster=None,
         min_pct_id=0.6, min_contig_len=200, min_pct_contig_aligned=0.3, n_genome_segments=0, 
-        outStats=None, threads=None):
+        outStats=None, top_refs=None, threads=None):
     ''' This step cleans up the de novo assembly with a known reference genome.
         Uses MUMmer (nucmer or promer) to create a reference-based consensus
         sequence of aligned contigs (with runs of N's in between the de novo
         contigs).
+
+        If top_refs is given, references are first ranked by the fraction of
+        contig k-mers they contain (from FracMinHash sketches), and only the
+        top_refs best are scaffolded with MUMmer.
     '''
 
+    import numpy
+    import Bio.SeqIO
     chk = util.cmd.check_input
 
     ref_segments_all = [tuple(Bio.SeqIO.parse(inRef, 'fasta')) for inRef in util.misc.make_seq(inReference)]
@@ -534,23 +707,36 @@ def order_and_orient(inFasta, inReference, outFasta,
             ref_ids.append(this_ref_segs[0].id)
             Bio.SeqIO.write(this_ref_segs, refs_fasta[ref_num], 'fasta')
 
+        containments = None
+        ref_nums = list(range(n_refs))
+        if top_refs and top_refs < n_refs:
+            # cheap k-mer containment screen to pick which references to scaffold
+            contigs_sketch = _kmer_sketch(seq.seq for seq in Bio.SeqIO.parse(inFasta, 'fasta'))
+            containments = [_kmer_containment(contigs_sketch,
+                                _kmer_sketch(seg.seq for seg in ref_segments_all[ref_num*n_genome_segments : (ref_num+1)*n_genome_segments]))
+                            for ref_num in range(n_refs)]
+            ref_nums = sorted(sorted(ref_nums, key=lambda ref_num: -containments[ref_num])[:top_refs])
+            log.info('k-mer containment screen selected refs {} of {}'.format(ref_nums, n_refs))
+
         with concurrent.futures.ProcessPoolExecutor(max_workers=util.misc.sanitize_thread_count(threads)) as executor:
-            retvals = executor.map(functools.partial(_call_order_and_orient_orig, inFasta=inFasta,
+            retvals = executor.map(functools.partial(_call_order_and_orient_timed, inFasta=inFasta,
                 breaklen=breaklen, maxgap=maxgap, minmatch=minmatch, mincluster=mincluster, min_pct_id=min_pct_id,
                 min_contig_len=min_contig_len, min_pct_contig_aligned=min_pct_contig_aligned),
-                refs_fasta, scaffolds_fasta, alt_contigs_fasta)
-        for r in retvals:
+                [refs_fasta[ref_num] for ref_num in ref_nums],
+                [scaffolds_fasta[ref_num] for ref_num in ref_nums],
+                [alt_contigs_fasta[ref_num] for ref_num in ref_nums])
             # if an exception is raised by _call_order_and_orient_contig, the
             # concurrent.futures.Executor.map function documentations states
             # that the same exception will be raised when retrieving that entry
-            # of the retval iterator. This for loop is intended to reveal any
+            # of the retval iterator. This is intended to reveal any
             # CalledProcessErrors from mummer itself.
-            assert r==0
+            ref_seconds = dict(zip(ref_nums, retvals))
 
-        scaffolds = [tuple(Bio.SeqIO.parse(scaffolds_fasta[ref_num], 'fasta')) for ref_num in range(n_refs)]
+        scaffolds = [tuple(Bio.SeqIO.parse(scaffolds_fasta[ref_num], 'fasta')) if ref_num in ref_seconds else ()
+                     for ref_num in range(n_refs)]
         base_counts = [sum([len(seg.seq.ungap('N')) for seg in scaffold]) \
             if len(scaffold)==n_genome_segments else 0 for scaffold in scaffolds]
-        best_ref_num = numpy.argmax(base_counts)
+        best_ref_num = max(ref_nums, key=lambda ref_num: base_counts[ref_num])
         if len(scaffolds[best_ref_num]) != n_genome_segments:
             raise IncompleteAssemblyError(len(scaffolds[best_ref_num]), n_genome_segments)
         log.info('base_counts={} best_ref_num={}'.format(base_counts, best_ref_num))
@@ -561,11 +747,19 @@ def order_and_orient(inFasta, inReference, outFasta,
             shutil.copyfile(refs_fasta[best_ref_num], outReference)
         if outStats:
             ref_ranks = (-numpy.array(base_counts)).argsort().argsort()
+            fieldnames = 'ref_num ref_name base_count rank'.split()
+            if containments is not None:
+                fieldnames += 'kmer_containment scaffolded seconds'.split()
             with open(outStats, 'w') as stats_f:
-                stats_w = csv.DictWriter(stats_f, fieldnames='ref_num ref_name base_count rank'.split(), delimiter='\t')
+                stats_w = csv.DictWriter(stats_f, fieldnames=fieldnames, delimiter='\t')
                 stats_w.writeheader()
                 for ref_num, (ref_id, base_count, rank) in enumerate(zip(ref_ids, base_counts, ref_ranks)):
-                    stats_w.writerow({'ref_num': ref_num, 'ref_name': ref_id, 'base_count': base_count, 'rank': rank})
+                    row = {'ref_num': ref_num, 'ref_name': ref_id, 'base_count': base_count, 'rank': rank}
+                    if containments is not None:
+                        row.update({'kmer_containment': '{:.4f}'.format(containments[ref_num]),
+                                    'scaffolded': int(ref_num in ref_seconds),
+                                    'seconds': '{:.2f}'.format(ref_seconds[ref_num]) if ref_num in ref_seconds else ''})
+                    stats_w.writerow(row)
 
 
 def parser_order_and_orient(parser=argparse.ArgumentParser()):
@@ -595,6 +789,10 @@ def parser_order_and_orient(parser=argparse.ArgumentParser()):
 
     parser.add_argument('--outReference', help='Output the reference chosen for scaffolding to this file')
     parser.add_argument('--outStats', help='Output stats used in reference selection')
+    parser.add_argument('--topRefs', dest='top_refs', type=int, default=None,
+                        help="""Rank references by k-mer containment of the contigs and only scaffold
+                        against this many of the best (default: scaffold against all references).
+                        With this option, outStats also reports containment and scaffolding time per reference.""")
     #parser.add_argument('--aligner',
     #                    help='nucmer (nucleotide) or promer (six-frame translations) [default: %(default)s]',
     #                    choices=['nucmer', 'promer'],
@@ -689,6 +887,44 @@ class PoorAssemblyError(Exception):
         )
 
 
+def _impute_segment(refSeqObj, asmSeqObj, name, aligner, replaceLength):
+    ''' Align one assembled segment to its reference and impute from it,
+        returning the (name, sequence) of the modified segment.
+    '''
+    import Bio.AlignIO
+    import Bio.SeqIO
+    with util.file.tempfnames(('.ref_and_actual.fasta', '.ref.fasta', '.actual.fasta', '.'+aligner+'.fasta')) \
+         as (concat_file, ref_file, actual_file, aligned_file):
+        with open(concat_file, 'wt') as outf:
+            Bio.SeqIO.write([refSeqObj, asmSeqObj], outf, "fasta")
+        with open(ref_file, 'wt') as outf:
+            Bio.SeqIO.write([refSeqObj], outf, "fasta")
+        with open(actual_file, 'wt') as outf:
+            Bio.SeqIO.write([asmSeqObj], outf, "fasta")
+
+        # align scaffolded genome to reference (choose one of three aligners)
+        if aligner == 'mafft':
+            tools.mafft.MafftTool().execute(
+                [ref_file, actual_file], aligned_file, False, True, True, False, False, None
+            )
+        elif aligner == 'muscle':
+            if len(refSeqObj) > 40000:
+                tools.muscle.MuscleTool().execute(
+                    concat_file, aligned_file, quiet=False,
+                    maxiters=2, diags=True
+                )
+            else:
+                tools.muscle.MuscleTool().execute(concat_file, aligned_file, quiet=False)
+        elif aligner == 'mummer':
+            tools.mummer.MummerTool().align_one_to_one(ref_file, actual_file, aligned_file)
+
+        return modified_contig(
+            Bio.AlignIO.read(aligned_file, 'fasta'), refSeqObj.id, name=name,
+            call_reference_ns=True, trim_ends=True, replace_5ends=True, replace_3ends=True,
+            replace_length=replaceLength, replace_end_gaps=True
+        )
+
+
 def impute_from_reference(
     inFasta,
     inReference,
@@ -698,7 +934,8 @@ def impute_from_reference(
     replaceLength,
     newName=None,
     aligner='muscle',
-    index=False
+    index=False,
+    threads=None
 ):
     '''
         This takes a de novo assembly, aligns against a reference genome, and
@@ -718,16 +955,16 @@ def impute_from_reference(
             positions with two steps of read-based refinement (below), and
             revert positions back to Ns where read support is lacking.
         FASTA indexing: output assembly is indexed for Picard, Samtools, Novoalign.
+        Segments are aligned and modified in parallel.
     '''
-    tempFastas = []
-
-    pmc = parser_modify_contig(argparse.ArgumentParser())
+    import Bio.SeqIO
     assert aligner in ('muscle', 'mafft', 'mummer')
 
     with open(inFasta, 'r') as asmFastaFile:
         with open(inReference, 'r') as refFastaFile:
             asmFasta = Bio.SeqIO.parse(asmFastaFile, 'fasta')
             refFasta = Bio.SeqIO.parse(refFastaFile, 'fasta')
+            segments = []
             for idx, (refSeqObj, asmSeqObj) in enumerate(zip_longest(refFasta, asmFasta)):
                 # our zip fails if one file has more seqs than the other
                 if not refSeqObj or not asmSeqObj:
@@ -752,58 +989,17 @@ def impute_from_reference(
                 if seq_len < minLength or non_n_count < seq_len * minUnambig:
                     raise PoorAssemblyError(idx + 1, seq_len, non_n_count, minLength, len(refSeqObj))
 
-                # prepare temp input and output files
-                tmpOutputFile = util.file.mkstempfname(prefix='seq-out-{idx}-'.format(idx=idx), suffix=".fasta")
-                concat_file = util.file.mkstempfname('.ref_and_actual.fasta')
-                ref_file = util.file.mkstempfname('.ref.fasta')
-                actual_file = util.file.mkstempfname('.actual.fasta')
-                aligned_file = util.file.mkstempfname('.'+aligner+'.fasta')
-                refName = refSeqObj.id
-                with open(concat_file, 'wt') as outf:
-                    Bio.SeqIO.write([refSeqObj, asmSeqObj], outf, "fasta")
-                with open(ref_file, 'wt') as outf:
-                    Bio.SeqIO.write([refSeqObj], outf, "fasta")
-                with open(actual_file, 'wt') as outf:
-                    Bio.SeqIO.write([asmSeqObj], outf, "fasta")
-
-                # align scaffolded genome to reference (choose one of three aligners)
-                if aligner == 'mafft':
-                    tools.mafft.MafftTool().execute(
-                        [ref_file, actual_file], aligned_file, False, True, True, False, False, None
-                    )
-                elif aligner == 'muscle':
-                    if len(refSeqObj) > 40000:
-                        tools.muscle.MuscleTool().execute(
-                            concat_file, aligned_file, quiet=False,
-                            maxiters=2, diags=True
-                        )
-                    else:
-                        tools.muscle.MuscleTool().execute(concat_file, aligned_file, quiet=False)
-                elif aligner == 'mummer':
-                    tools.mummer.MummerTool().align_one_to_one(ref_file, actual_file, aligned_file)
-
-                # run modify_contig
-                args = [
-                    aligned_file, tmpOutputFile, refName, '--call-reference-ns', '--trim-ends', '--replace-5ends',
-                    '--replace-3ends', '--replace-length', str(replaceLength), '--replace-end-gaps'
-                ]
-                if newName:
-                    # renames the segment name "sampleName-idx" where idx is the segment number
-                    args.extend(['--name', newName + "-" + str(idx + 1)])
-                args = pmc.parse_args(args)
-                args.func_main(args)
-
-                # clean up
-                os.unlink(concat_file)
-                os.unlink(ref_file)
-                os.unlink(actual_file)
-                os.unlink(aligned_file)
-                tempFastas.append(tmpOutputFile)
-
-    # merge outputs
-    util.file.concat(tempFastas, outFasta)
-    for tmpFile in tempFastas:
-        os.unlink(tmpFile)
+                # renames the segment name "sampleName-idx" where idx is the segment number
+                segments.append((refSeqObj, asmSeqObj, newName + "-" + str(idx + 1) if newName else None))
+
+    # align and modify all segments concurrently
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(len(segments), util.misc.sanitize_thread_count(threads)) or 1) as executor:
+        futures = [executor.submit(_impute_segment, refSeqObj, asmSeqObj, name, aligner, replaceLength)
+                   for refSeqObj, asmSeqObj, name in segments]
+        with open(outFasta, 'wt') as outf:
+            for future in futures:
+                for line in util.file.fastaMaker([future.result()]):
+                    outf.write(line)
 
     # Index final output FASTA for Picard/GATK, Samtools, and Novoalign
     if index:
@@ -855,7 +1051,7 @@ def parser_impute_from_reference(parser=argparse.ArgumentParser()):
         action="store_true",
         dest="index"
     )
-    util.cmd.common_args(parser, (('loglevel', None), ('version', None), ('tmp_dir', None)))
+    util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None), ('tmp_dir', None)))
     util.cmd.attach_main(parser, impute_from_reference, split_args=True)
     return parser
 
@@ -1075,6 +1271,7 @@ def parser_filter_short_seqs(parser=argparse.ArgumentParser()):
 
 def main_filter_short_seqs(args):
     '''Check sequences in inFile, retaining only those that are at least minLength'''
+    import Bio.SeqIO
     # orig by rsealfon, edited by dpark
     # TO DO: make this more generalized to accept multiple minLengths (for multiple chromosomes/segments)
     with util.file.open_or_gzopen(args.inFile) as inf:
@@ -1172,165 +1369,229 @@ def parser_modify_contig(parser=argparse.ArgumentParser()):
     return parser
 
 
-def main_modify_contig(args):
-    ''' Modifies an input contig. Depending on the options
-        selected, can replace N calls with reference calls, replace ambiguous
-        calls with reference calls, trim to the length of the reference, replace
-        contig ends with reference calls, and trim leading and trailing Ns.
-        Author: rsealfon.
+def modified_contig(aln, ref, name=None, call_reference_ns=False, call_reference_ambiguous=False,
+                    trim_ends=False, replace_5ends=False, replace_3ends=False, replace_length=10,
+                    replace_end_gaps=False, remove_end_ns=False):
+    ''' Apply ContigModifier operations to a two-sequence Bio.Align alignment of
+        a reference (named ref) and a contig, and return the modified contig as a
+        (name, ungapped sequence) tuple.  The contig keeps its own name unless
+        one is given.
     '''
-    aln = Bio.AlignIO.read(args.input, args.format)
-
-    # TODO?: take list of alignments in, one per chromosome, rather than
-    #       single alignment
-
     if len(aln) != 2:
         raise Exception("alignment does not contain exactly 2 sequences, %s found" % len(aln))
-    elif aln[0].name == args.ref:
+    elif aln[0].name == ref:
         ref_idx = 0
         consensus_idx = 1
-    elif aln[1].name == args.ref:
+    elif aln[1].name == ref:
         ref_idx = 1
         consensus_idx = 0
     else:
-        raise NameError("reference name '%s' not in alignment" % args.ref)
+        raise NameError("reference name '%s' not in alignment" % ref)
 
     mc = ContigModifier(str(aln[ref_idx].seq), str(aln[consensus_idx].seq))
-    if args.remove_end_ns:
+    if remove_end_ns:
         mc.remove_end_ns()
-    if args.call_reference_ns:
+    if call_reference_ns:
         mc.call_reference_ns()
-    if args.call_reference_ambiguous:
+    if call_reference_ambiguous:
         mc.call_reference_ambiguous()
-    if args.trim_ends:
+    if trim_ends:
         mc.trim_ends()
-    if args.replace_end_gaps:
+    if replace_end_gaps:
         mc.replace_end_gaps()
-    if args.replace_5ends:
-        mc.replace_5ends(args.replace_length)
-    if args.replace_3ends:
-        mc.replace_3ends(args.replace_length)
-
-    with open(args.output, "wt") as f:
-        if hasattr(args, "name"):
-            name = args.name
-        else:
-            name = aln[consensus_idx].name
-        for line in util.file.fastaMaker([(name, mc.get_stripped_consensus())]):
+    if replace_5ends:
+        mc.replace_5ends(replace_length)
+    if replace_3ends:
+        mc.replace_3ends(replace_length)
+
+    return (name or aln[consensus_idx].name, mc.get_stripped_consensus())
+
+
+def modify_contig(inAlignment, outFasta, ref, name=None, aln_format='fasta', **kwargs):
+    ''' Write the contig of a two-sequence alignment file to outFasta,
+        modified as described by modified_contig's keyword arguments.
+    '''
+    import Bio.AlignIO
+    # TODO?: take list of alignments in, one per chromosome, rather than
+    #       single alignment
+    aln = Bio.AlignIO.read(inAlignment, aln_format)
+    with open(outFasta, "wt") as f:
+        for line in util.file.fastaMaker([modified_contig(aln, ref, name=name, **kwargs)]):
             f.write(line)
     return 0
 
 
+def main_modify_contig(args):
+    ''' Modifies an input contig. Depending on the options
+        selected, can replace N calls with reference calls, replace ambiguous
+        calls with reference calls, trim to the length of the reference, replace
+        contig ends with reference calls, and trim leading and trailing Ns.
+        Author: rsealfon.
+    '''
+    return modify_contig(
+        args.input, args.output, args.ref, name=args.name, aln_format=args.format,
+        call_reference_ns=args.call_reference_ns, call_reference_ambiguous=args.call_reference_ambiguous,
+        trim_ends=args.trim_ends, replace_5ends=args.replace_5ends, replace_3ends=args.replace_3ends,
+        replace_length=args.replace_length, replace_end_gaps=args.replace_end_gaps,
+        remove_end_ns=args.remove_end_ns
+    )
+
+
 __commands__.append(('modify_contig', parser_modify_contig))
 
 
+@functools.lru_cache(maxsize=None)
+def _ambiguous_dna_values():
+    ''' IUPAC ambiguity code -> the bases it stands for '''
+    import Bio.Data.IUPACData
+    return Bio.Data.IUPACData.ambiguous_dna_values
+
+
+@functools.lru_cache(maxsize=None)
+def _ambiguous_ref_table():
+    ''' table[c, r]: whether base r is one of the bases that ambiguity code c stands for (any case) '''
+    import numpy
+    table = numpy.zeros((256, 256), dtype=bool)
+    for code, bases in _ambiguous_dna_values().items():
+        for c in (code, code.lower()):
+            for r in bases:
+                table[ord(c), ord(r)] = table[ord(c), ord(r.lower())] = True
+    return table
+
+
 class ContigModifier(object):
     ''' Initial modifications to Trinity+MUMmer assembly output based on
-        MUSCLE alignment to known reference genome
+        MUSCLE alignment to known reference genome.
+        The aligned sequences are held as NumPy byte arrays, and each
+        modification is applied as a vectorized mask.
         author: rsealfon
     '''
 
     def __init__(self, ref, consensus):
+        import numpy
         if len(ref) != len(consensus):
             raise Exception("improper alignment")
-        self.ref = list(ref)
-        self.consensus = list(consensus)
+        self.ref = numpy.frombuffer(str(ref).encode('ascii'), dtype=numpy.uint8).copy()
+        self.consensus = numpy.frombuffer(str(consensus).encode('ascii'), dtype=numpy.uint8).copy()
         self.len = len(ref)
 
+    _GAP = ord('-')
+
+    def _first_last(self, mask):
+        ''' Index of the first True in mask and one past the last (len, 0 if none). '''
+        import numpy
+        idx = numpy.flatnonzero(mask)
+        if not idx.size:
+            return (self.len, 0)
+        return (idx[0], idx[-1] + 1)
+
     def get_stripped_consensus(self):
-        return ''.join(self.consensus).replace('-', '')
+        return self.consensus.tobytes().decode('ascii').replace('-', '')
 
     def call_reference_ns(self):
         log.debug("populating N's from reference...")
-        for i in range(self.len):
-            if self.consensus[i].upper() == "N":
-                self.consensus[i] = self.ref[i]
+        mask = (self.consensus == ord('N')) | (self.consensus == ord('n'))
+        self.consensus[mask] = self.ref[mask]
 
     def call_reference_ambiguous(self):
         ''' This is not normally used by default in our pipeline '''
         log.debug("populating ambiguous bases from reference...")
-        for i in range(self.len):
-            if self.ref[i].upper() in Bio.Data.IUPACData.ambiguous_dna_values.get(self.consensus[i].upper(), []):
-                self.consensus[i] = self.ref[i]
+        mask = _ambiguous_ref_table()[self.consensus, self.ref]
+        self.consensus[mask] = self.ref[mask]
 
     def trim_ends(self):
         ''' This trims down the consensus so it cannot go beyond the given reference genome '''
         log.debug("trimming ends...")
-        for end_iterator in (range(self.len), reversed(range(self.len))):
-            for i in end_iterator:
-                if self.ref[i] != "-":
-                    break
-                else:
-                    self.consensus[i] = "-"
+        first, last = self._first_last(self.ref != self._GAP)
+        self.consensus[:first] = self._GAP
+        self.consensus[last:] = self._GAP
 
     def replace_end_gaps(self):
         ''' This fills out the ends of the consensus with reference sequence '''
         log.debug("populating leading and trailing gaps from reference...")
-        for end_iterator in (range(self.len), reversed(range(self.len))):
-            for i in end_iterator:
-                if self.consensus[i] != "-":
-                    break
-                self.consensus[i] = self.ref[i]
+        first, _ = self._first_last(self.consensus != self._GAP)
+        self.consensus[:first] = self.ref[:first]
+        _, last = self._first_last(self.consensus != self._GAP)
+        self.consensus[last:] = self.ref[last:]
 
     def replace_5ends(self, replace_length):
         ''' This replaces everything within <replace_length> of the ends of the
             reference genome with the reference genome.
         '''
+        import numpy
         log.debug("replacing 5' ends...")
-        ct = 0
-        for i in range(self.len):
-            if self.ref[i] != "-":
-                ct = ct + 1
-            if ct == replace_length:
-                for j in range(i + 1):
-                    self.consensus[j] = self.ref[j]
-                break
+        if replace_length == 0:
+            # nothing to replace, except a leading gap in the reference
+            if self.len and self.ref[0] == self._GAP:
+                self.consensus[0] = self.ref[0]
+            return
+        ref_bases = numpy.flatnonzero(self.ref != self._GAP)
+        if 0 < replace_length <= len(ref_bases):
+            i = ref_bases[replace_length - 1]
+            self.consensus[:i + 1] = self.ref[:i + 1]
 
     def replace_3ends(self, replace_length):
+        import numpy
         log.debug("replacing 3' ends...")
-        ct = 0
-        for i in reversed(range(self.len)):
-            if self.ref[i] != "-":
-                ct = ct + 1
-            if ct == replace_length:
-                for j in range(i, self.len):
-                    self.consensus[j] = self.ref[j]
-                break
+        if replace_length == 0:
+            # nothing to replace, except a trailing gap in the reference
+            if self.len and self.ref[-1] == self._GAP:
+                self.consensus[-1] = self.ref[-1]
+            return
+        ref_bases = numpy.flatnonzero(self.ref != self._GAP)
+        if 0 < replace_length <= len(ref_bases):
+            i = ref_bases[-replace_length]
+            self.consensus[i:] = self.ref[i:]
 
     def remove_end_ns(self):
         ''' This clips off any N's that begin or end the consensus.
             Not normally used in our pipeline
         '''
         log.debug("removing leading and trailing N's...")
-        for end_iterator in (range(self.len), reversed(range(self.len))):
-            for i in end_iterator:
-                if (self.consensus[i].upper() == "N" or self.consensus[i] == "-"):
-                    self.consensus[i] = "-"
-                else:
-                    break
+        for _ in range(2):
+            first, last = self._first_last((self.consensus != ord('N')) & (self.consensus != ord('n')) &
+                                           (self.consensus != self._GAP))
+            self.consensus[:first] = self._GAP
+            self.consensus[last:] = self._GAP
 
 
 class MutableSequence(object):
+    ''' A sequence that can be edited in place using reference coordinates.
+        Bases are held in a NumPy byte array (which may be a row of a larger
+        matrix shared between samples); positions that hold anything other
+        than exactly one base (insertions, deletions) are kept in a
+        separate edit table until emit.
+    '''
 
-    def __init__(self, name, start, stop, init_seq=None):
+    def __init__(self, name, start, stop, init_seq=None, bases=None):
+        import numpy
         if not (stop >= start >= 1):
             raise IndexError("coords out of bounds")
-        if init_seq is None:
-            self.seq = list('N' * (stop - start + 1))
+        if bases is not None:
+            self.bases = bases
+        elif init_seq is None:
+            self.bases = numpy.full(stop - start + 1, ord('N'), dtype=numpy.uint8)
         else:
-            self.seq = list(init_seq)
-        if stop - start + 1 != len(self.seq):
+            self.bases = numpy.frombuffer(init_seq.encode('ascii'), dtype=numpy.uint8).copy()
+        if stop - start + 1 != len(self.bases):
             raise Exception("wrong length")
         self.start = start
         self.stop = stop
         self.name = name
+        self.edits = {}
         self.deletions = []
 
+    def _set(self, i, new_seq):
+        if len(new_seq) == 1 and ord(new_seq) < 128:
+            self.bases[i] = ord(new_seq)
+            self.edits.pop(i, None)
+        else:
+            self.edits[i] = new_seq
+
     def modify(self, p, new_base):
         if not (self.start <= p <= self.stop):
             raise IndexError("position out of bounds")
-        i = p - self.start
-        self.seq[i] = new_base
+        self._set(p - self.start, new_base)
 
     def replace(self, start, stop, new_seq):
         if stop > start:
@@ -1342,26 +1603,27 @@ class MutableSequence(object):
             raise IndexError("positions out of bounds")
         start -= self.start
         stop -= self.start
-        if start == stop:
-            self.seq[start] = new_seq
-        for i in range(max(stop - start + 1, len(new_seq))):
-            if start + i <= stop:
-                if i < len(new_seq):
-                    if start + i == stop:
-                        # new allele is >= ref length, fill out the rest of the bases
-                        self.seq[start + i] = new_seq[i:]
-                    else:
-                        self.seq[start + i] = new_seq[i]
-                else:
-                    # new allele is shorter than ref, so delete extra bases
-                    self.seq[start + i] = ''
+        # one base of the new allele per reference position, the remainder
+        # of a longer allele at the last position, and blanks if it is shorter
+        for i in range(stop - start):
+            self._set(start + i, new_seq[i] if i < len(new_seq) else '')
+        self._set(stop, new_seq[stop - start:])
 
     def replay_deletions(self):
         for start, stop, new_seq in self.deletions:
             self.__change__(start, stop, new_seq)
 
     def emit(self):
-        return (self.name, ''.join(self.seq))
+        if not self.edits:
+            return (self.name, self.bases.tobytes().decode('ascii'))
+        seq = []
+        prev = 0
+        for i in sorted(self.edits):
+            seq.append(self.bases[prev:i].tobytes().decode('ascii'))
+            seq.append(self.edits[i])
+            prev = i + 1
+        seq.append(self.bases[prev:].tobytes().decode('ascii'))
+        return (self.name, ''.join(seq))
 
 
 def alleles_to_ambiguity(allelelist):
@@ -1373,111 +1635,202 @@ def alleles_to_ambiguity(allelelist):
     if len(allelelist) == 1:
         return allelelist[0]
     else:
-        convert = dict([(tuple(sorted(v)), k) for k, v in Bio.Data.IUPACData.ambiguous_dna_values.items() if k != 'X'])
+        convert = dict([(tuple(sorted(v)), k) for k, v in _ambiguous_dna_values().items() if k != 'X'])
         key = tuple(sorted(set(a.upper() for a in allelelist)))
         return convert[key]
 
 
-def vcfrow_parse_and_call_snps(vcfrow, samples, min_dp=0, major_cutoff=0.5, min_dp_ratio=0.0):
-    ''' Parse a single row of a VCF file, emit an iterator over each sample,
-        call SNP genotypes using custom viral method based on read counts.
+# one VCF row with the per-sample depths needed for calling:
+#   dp is an array of per-sample DP (used for invariant sites), ad is a
+#   samples x alleles array of allele depths (used for variant sites)
+VcfSite = collections.namedtuple('VcfSite', ['chrom', 'start', 'alleles', 'info_dp', 'dp', 'ad'])
+
+
+def _vcf_int(x):
+    return int(x) if x not in ('.', '', None) else 0
+
+
+def _vcf_ints(values):
+    ''' Convert a list of integer strings (where '.' means missing) to an array. '''
+    import numpy
+    return numpy.array([x if x != '.' else '0' for x in values]).astype(numpy.int64)
+
+
+def parse_vcf_site(vcfrow, n_samples):
+    ''' Parse a VCF row (a list of text fields, or a pysam VariantRecord)
+        into a VcfSite.
     '''
-    # process this row
-    c = vcfrow[0]
+    import numpy
+    import pysam
+    if isinstance(vcfrow, pysam.VariantRecord):
+        alleles = [vcfrow.ref] + [a for a in (vcfrow.alts or ()) if a not in '.']
+        try:
+            info_dp = vcfrow.info.get('DP') or 0
+        except ValueError:
+            info_dp = 0
+        samples = list(vcfrow.samples.values())
+        assert len(samples) == n_samples
+        dp, ad = None, None
+        if len(alleles) == 1:
+            dp = numpy.array([_vcf_int(s.get('DP')) for s in samples], dtype=numpy.int64)
+        else:
+            assert 'AD' in vcfrow.format
+            ad = [tuple(_vcf_int(n) for n in (s.get('AD') or ())) for s in samples]
+            ad = numpy.array([x if len(x) == len(alleles) else (0,) * len(alleles) for x in ad],
+                             dtype=numpy.int64).reshape(n_samples, len(alleles))
+        return VcfSite(vcfrow.chrom, vcfrow.pos, alleles, info_dp, dp, ad)
+
     alleles = [vcfrow[3]] + [a for a in vcfrow[4].split(',') if a not in '.']
-    start = int(vcfrow[1])
-    stop = start + len(vcfrow[3]) - 1
     format_col = vcfrow[8].split(':')
     format_col = dict((format_col[i], i) for i in range(len(format_col)))
     assert 'GT' in format_col and format_col['GT'] == 0    # required by VCF spec
-    assert len(vcfrow) == 9 + len(samples)
+    assert len(vcfrow) == 9 + n_samples
     info = [x.split('=') for x in vcfrow[7].split(';') if x != '.']
     info = dict(x for x in info if len(x) == 2)
-    info_dp = int(info.get('DP', 0))
-
-    # process each sample
-    for i in range(len(samples)):
-        sample = samples[i]
-        rec = vcfrow[i + 9].split(':')
-
-        # require a minimum read coverage
-        if len(alleles) == 1:
-            # simple invariant case
-            dp = ('DP' in format_col and len(rec) > format_col['DP']) and int(rec[format_col['DP']]) or 0
-            if dp < min_dp:
-                continue
-            geno = alleles
-            if info_dp and float(dp) / info_dp < min_dp_ratio:
+    recs = [rec.split(':') for rec in vcfrow[9:]]
+    dp, ad = None, None
+    if len(alleles) == 1:
+        i = format_col.get('DP')
+        if i is None:
+            dp = numpy.zeros(n_samples, dtype=numpy.int64)
+        else:
+            dp = _vcf_ints([rec[i] if len(rec) > i else '0' for rec in recs])
+    else:
+        i = format_col.get('AD')
+        assert i is not None and all(len(rec) > i for rec in recs)
+        ad = _vcf_ints(','.join(rec[i] for rec in recs).split(','))
+        assert len(ad) == n_samples * len(alleles)
+        ad = ad.reshape(n_samples, len(alleles))
+    return VcfSite(vcfrow[0], int(vcfrow[1]), alleles, int(info.get('DP', 0)), dp, ad)
+
+
+def call_vcf_site(site, samples, min_dp=0, major_cutoff=0.5, min_dp_ratio=0.0):
+    ''' Call genotypes for all samples at a VcfSite at once, using the
+        custom viral method based on read counts.  Returns a tuple of
+        per-sample arrays (called, single, top, ad):
+          called -- whether the sample has a call at this site
+          single -- whether one allele is a clear winner (else several are called)
+          top    -- index of the allele with the most reads
+          ad     -- allele depths that pass min_dp (None for invariant sites)
+    '''
+    import numpy
+    if site.ad is None:
+        # simple invariant case
+        called = site.dp >= min_dp
+        if site.info_dp and min_dp_ratio:
+            low_ratio = called & (site.dp < min_dp_ratio * site.info_dp)
+            for i in numpy.flatnonzero(low_ratio):
                 log.warning(
-                    "dropping invariant call at %s:%s-%s %s (%s) due to low DP ratio (%s / %s = %s < %s)", c, start,
-                    stop, sample, geno, dp, info_dp, float(dp) / info_dp, min_dp_ratio
+                    "dropping invariant call at %s:%s-%s %s (%s) due to low DP ratio (%s / %s = %s < %s)",
+                    site.chrom, site.start, site.start + len(site.alleles[0]) - 1, samples[i], site.alleles,
+                    site.dp[i], site.info_dp, float(site.dp[i]) / site.info_dp, min_dp_ratio
                 )
-                continue
-        else:
-            # variant: manually call the highest read count allele if it exceeds a threshold
-            assert ('AD' in format_col and len(rec) > format_col['AD'])
-            allele_depths = list(map(int, rec[format_col['AD']].split(',')))
-            assert len(allele_depths) == len(alleles)
-            allele_depths = [(allele_depths[i], alleles[i]) for i in range(len(alleles)) if allele_depths[i] > 0]
-            allele_depths = list(reversed(sorted((n, a) for n, a in allele_depths if n >= min_dp)))
-            if not allele_depths:
-                continue
-            dp = sum(n for n, a in allele_depths)
+            called &= ~low_ratio
+        n = len(site.dp)
+        return (called, numpy.ones(n, dtype=bool), numpy.zeros(n, dtype=numpy.int64), None)
 
-            if allele_depths[0][0] > (dp * major_cutoff):
-                # call a single allele at this position if it is a clear winner
-                geno = [allele_depths[0][1]]
-            else:
-                # call multiple alleles at this position if there is no clear winner
-                geno = [a for _, a in allele_depths]
-        if geno:
-            yield (c, start, stop, sample, geno)
+    # variant: call the highest read count allele if it exceeds a threshold,
+    # breaking ties in read count by allele (as a reverse sort of (count, allele) would)
+    ad = numpy.where(site.ad >= max(min_dp, 1), site.ad, 0)
+    dp = ad.sum(axis=1)
+    allele_rank = numpy.argsort(numpy.argsort(site.alleles))
+    top = numpy.argmax(ad * len(site.alleles) + allele_rank, axis=1)
+    top_n = ad[numpy.arange(len(top)), top]
+    return (dp > 0, top_n > dp * major_cutoff, top, ad)
+
+
+def vcfrow_parse_and_call_snps(vcfrow, samples, min_dp=0, major_cutoff=0.5, min_dp_ratio=0.0):
+    ''' Parse a single row of a VCF file, emit an iterator over each sample,
+        call SNP genotypes using custom viral method based on read counts.
+    '''
+    import numpy
+    site = parse_vcf_site(vcfrow, len(samples))
+    stop = site.start + len(site.alleles[0]) - 1
+    called, single, top, ad = call_vcf_site(site, samples, min_dp=min_dp, major_cutoff=major_cutoff,
+                                            min_dp_ratio=min_dp_ratio)
+    for i in numpy.flatnonzero(called):
+        if single[i]:
+            geno = [site.alleles[top[i]]]
+        else:
+            # call multiple alleles at this position if there is no clear winner
+            geno = [a for n, a in sorted(((ad[i, j], a) for j, a in enumerate(site.alleles) if ad[i, j]), reverse=True)]
+        yield (site.chrom, site.start, stop, samples[i], geno)
 
 
 def vcf_to_seqs(vcfIter, chrlens, samples, min_dp=0, major_cutoff=0.5, min_dp_ratio=0.0):
-    ''' Take a VCF iterator and produce an iterator of chromosome x sample full sequences.'''
-    seqs = {}
+    ''' Take a VCF iterator (of text rows or pysam VariantRecords) and
+        produce an iterator of chromosome x sample full sequences.
+
+        Genotypes are called for all samples of a row at once, and single
+        base calls are written straight into a samples x positions byte
+        matrix; only indels go through per-sample edits.
+    '''
+    import numpy
+    seqs = []
     cur_c = None
+    n_samples = len(samples)
     for vcfrow in vcfIter:
         try:
-            for c, start, stop, s, alleles in vcfrow_parse_and_call_snps(
-                vcfrow, samples, min_dp=min_dp,
-                major_cutoff=major_cutoff,
-                min_dp_ratio=min_dp_ratio
-            ):
-                # changing chromosome?
-                if c != cur_c:
-                    if cur_c is not None:
-                        # dump the previous chromosome before starting a new one
-                        for s in samples:
-                            seqs[s].replay_deletions()    # because of the order of VCF rows with indels
-                            yield seqs[s].emit()
-
-                    # prepare base sequences for this chromosome
-                    cur_c = c
-                    for s in samples:
-                        name = len(samples) > 1 and ("%s-%s" % (c, s)) or c
-                        seqs[s] = MutableSequence(name, 1, chrlens[c])
-
-                # modify sequence for this chromosome/sample/position
-                if len(alleles) == 1:
-                    # call a single allele
-                    seqs[s].replace(start, stop, alleles[0])
-                elif all(len(a) == 1 for a in alleles):
-                    # call an ambiguous SNP
-                    seqs[s].replace(start, stop, alleles_to_ambiguity(alleles))
-                else:
-                    # mix of indels with no clear winner... force the most popular one
-                    seqs[s].replace(start, stop, alleles[0])
+            site = parse_vcf_site(vcfrow, n_samples)
+            called, single, top, ad = call_vcf_site(site, samples, min_dp=min_dp, major_cutoff=major_cutoff,
+                                                    min_dp_ratio=min_dp_ratio)
+            if not called.any():
+                continue
+
+            # changing chromosome?
+            c = site.chrom
+            if c != cur_c:
+                if cur_c is not None:
+                    # dump the previous chromosome before starting a new one
+                    for seq in seqs:
+                        seq.replay_deletions()    # because of the order of VCF rows with indels
+                        yield seq.emit()
+
+                # prepare base sequences for this chromosome
+                cur_c = c
+                bases = numpy.full((n_samples, chrlens[c]), ord('N'), dtype=numpy.uint8)
+                edited = set()    # positions that any sample may hold in its edit table
+                seqs = [MutableSequence(len(samples) > 1 and ("%s-%s" % (c, s)) or c, 1, chrlens[c], bases=bases[i])
+                        for i, s in enumerate(samples)]
+
+            # the allele to write for each called sample, as a string and
+            # (for single ASCII bases) as a byte code
+            alleles = numpy.array(site.alleles, dtype=object)
+            allele_codes = numpy.array([ord(a) if len(a) == 1 and ord(a) < 128 else -1 for a in site.alleles])
+            calls = alleles[top]
+            codes = allele_codes[top]
+            if ad is not None and not single[called].all():
+                # call an ambiguous SNP when there is no clear winner among single bases;
+                # with a mix of indels and no clear winner, force the most popular one
+                present = ad > 0
+                ambig = called & ~single & ~(present & (allele_codes < 0)).any(axis=1)
+                for i in numpy.flatnonzero(ambig):
+                    calls[i] = alleles_to_ambiguity([a for a, p in zip(site.alleles, present[i]) if p])
+                    codes[i] = ord(calls[i])
+
+            # modify sequences for this chromosome/position
+            start, stop = site.start, site.start + len(site.alleles[0]) - 1
+            if start == stop:
+                if not (1 <= start <= chrlens[c]):
+                    raise IndexError("position out of bounds")
+                snp = called & (codes >= 0)
+                if start - 1 in edited:
+                    for i in numpy.flatnonzero(snp):
+                        seqs[i].edits.pop(start - 1, None)
+                bases[snp, start - 1] = codes[snp]
+                called = called & ~snp
+            for i in numpy.flatnonzero(called):
+                seqs[i].replace(start, stop, calls[i])
+                edited.update(range(start - 1, stop))
         except:
             log.exception("Exception occurred while parsing VCF file.  Row: '%s'", vcfrow)
             raise
 
     # at the end, dump the last chromosome
     if cur_c is not None:
-        for s in samples:
-            seqs[s].replay_deletions()    # because of the order of VCF rows with indels
-            yield seqs[s].emit()
+        for seq in seqs:
+            seq.replay_deletions()    # because of the order of VCF rows with indels
+            yield seq.emit()
 
 
 def parser_vcf_to_fasta(parser=argparse.ArgumentParser()):
@@ -1541,12 +1894,13 @@ def main_vcf_to_fasta(args):
         Uncalled positions will be emitted as N's.
         Author: dpark.
     '''
+    import pysam
     assert args.min_dp >= 0
     assert 0.0 <= args.major_cutoff < 1.0
 
-    with util.vcf.VcfReader(args.inVcf) as vcf:
-        chrlens = dict(vcf.chrlens())
-        samples = vcf.samples()
+    with pysam.VariantFile(args.inVcf) as vcf:
+        chrlens = dict((c, vcf.header.contigs[c].length) for c in vcf.header.contigs)
+        samples = list(vcf.header.samples)
 
     assert len(
         samples
@@ -1554,11 +1908,11 @@ def main_vcf_to_fasta(args):
         of the refine_assembly step, suggesting multiple sample names are present
         upstream in the BAM file. Please correct this so there is only one sample in the BAM file."""
 
-    with open(args.outFasta, 'wt') as outf:
+    with open(args.outFasta, 'wt') as outf, pysam.VariantFile(args.inVcf) as vcf:
         chr_idx = 0
         for chr_idx, (header, seq) in enumerate(
             vcf_to_seqs(
-                util.file.read_tabfile(args.inVcf),
+                vcf,
                 chrlens,
                 samples,
                 min_dp=args.min_dp,
@@ -1593,6 +1947,7 @@ def trim_fasta(inFasta, outFasta):
     ''' Take input sequences (fasta) and trim any continuous sections of
         N's from the ends of them.  Write trimmed sequences to an output fasta file.
     '''
+    import Bio.SeqIO
     with open(outFasta, 'wt') as outf:
         with open(inFasta, 'rt') as inf:
             for record in Bio.SeqIO.parse(inf, 'fasta'):
@@ -1608,7 +1963,7 @@ __commands__.append(('trim_fasta', parser_trim_fasta))
 def deambig_base(base):
     ''' Take a single base (possibly a IUPAC ambiguity code) and return a random
         non-ambiguous base from among the possibilities '''
-    return random.choice(Bio.Data.IUPACData.ambiguous_dna_values[base.upper()])
+    return random.choice(_ambiguous_dna_values()[base.upper()])
 
 
 def deambig_fasta(inFasta, outFasta):
@@ -1616,6 +1971,7 @@ def deambig_fasta(inFasta, outFasta):
         random unambiguous base from among the possibilities described by the ambiguity
         code.  Write output to fasta file.
     '''
+    import Bio.SeqIO
     with util.file.open_or_gzopen(outFasta, 'wt') as outf:
         with util.file.open_or_gzopen(inFasta, 'rt') as inf:
             for record in Bio.SeqIO.parse(inf, 'fasta'):
@@ -1636,6 +1992,7 @@ __commands__.append(('deambig_fasta', parser_deambig_fasta))
 
 
 def vcf_dpdiff(vcfs):
+    import util.vcf
     for vcf in vcfs:
         with util.vcf.VcfReader(vcf) as v:
             samples = v.samples()
@@ -8,7 +8,9 @@ __commands__ = []
 
 import argparse
 import logging
+import os
 
+import tools
 import util.cmd
 import util.file
 
@@ -55,6 +57,30 @@ def parser_merge_tarballs(parser=argparse.ArgumentParser()):
 __commands__.append(('merge_tarballs', parser_merge_tarballs))
 
 
+
+# ==============================
+# ***  invalidate_tool_cache   ***
+# ==============================
+
+def invalidate_tool_cache(env_path=None, cache_path=None):
+    ''' Forget cached conda tool resolutions (installed versions and
+        executable paths), so tools are verified with conda again on next use.
+    '''
+    cache = tools.ToolResolutionCache(cache_path) if cache_path else tools.resolution_cache
+    cache.invalidate(os.path.realpath(os.path.expanduser(env_path)) if env_path else None)
+    return 0
+def parser_invalidate_tool_cache(parser=argparse.ArgumentParser()):
+    parser.add_argument('--envPath',
+                        dest="env_path",
+                        help='Only forget tools resolved in this conda environment (default: all environments).')
+    parser.add_argument('--cachePath',
+                        dest="cache_path",
+                        help='Tool resolution cache file (default: $VIRAL_NGS_TOOL_CACHE or tools/conda-cache/tool_resolution_cache.json).')
+    util.cmd.common_args(parser, (('loglevel', None), ('version', None)))
+    util.cmd.attach_main(parser, invalidate_tool_cache, split_args=True)
+    return parser
+__commands__.append(('invalidate_tool_cache', parser_invalidate_tool_cache))
+
 # =======================
 def full_parser():
     return util.cmd.make_parser(__commands__, __doc__)
@@ -17,8 +17,9 @@ import shutil
 import subprocess
 import tempfile
 import xml.etree.ElementTree
-from collections import defaultdict
 import concurrent.futures
+import functools
+import heapq
 
 import arrow
 
@@ -328,6 +329,15 @@ def parser_common_barcodes(parser=argparse.ArgumentParser()):
     parser.add_argument('--outMetrics',
                         help='Output ExtractIlluminaBarcodes metrics file. Default is to dump to a temp file.',
                         default=None)
+    parser.add_argument('--outGuessedBarcodes',
+                        help='''If specified, also write the guess_barcodes report of likely barcodes for
+                                samples with anomalously low read counts, from the same barcode tally.''',
+                        default=None)
+    parser.add_argument('--maxDistinctBarcodes',
+                        help='''If specified, cap memory use by holding at most this many distinct barcodes
+                                while tallying; the rarest barcodes are pruned (default: no cap).''',
+                        type=int,
+                        default=None)
     parser.add_argument('--sampleSheet',
                         default=None,
                         help='''Override SampleSheet. Input tab or CSV file w/header and four named columns:
@@ -347,7 +357,7 @@ def parser_common_barcodes(parser=argparse.ArgumentParser()):
     parser.add_argument('--JVMmemory',
                         help='JVM virtual memory size (default: %(default)s)',
                         default=tools.picard.ExtractIlluminaBarcodesTool.jvmMemDefault)
-    util.cmd.common_args(parser, (('loglevel', None), ('version', None), ('tmp_dir', None)))
+    util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None), ('tmp_dir', None)))
     util.cmd.attach_main(parser, main_common_barcodes)
     return parser
 
@@ -390,7 +400,9 @@ def main_common_barcodes(args):
         picardOptions=picardOpts,
         JVMmemory=args.JVMmemory)
 
-    count_and_sort_barcodes(barcodes_tmpdir, args.outSummary, args.truncateToLength, args.includeNoise, args.omitHeader)
+    count_and_sort_barcodes(barcodes_tmpdir, args.outSummary, args.truncateToLength, args.includeNoise, args.omitHeader,
+                            picardMetrics=out_metrics, outGuessedBarcodes=args.outGuessedBarcodes,
+                            maxDistinctBarcodes=args.maxDistinctBarcodes, threads=args.threads)
 
     # clean up
     os.unlink(barcode_file)
@@ -400,44 +412,172 @@ def main_common_barcodes(args):
 
 __commands__.append(('common_barcodes', parser_common_barcodes))
 
-def count_and_sort_barcodes(barcodes_dir, outSummary, truncateToLength=None, includeNoise=False, omitHeader=False):
+# Barcodes are tallied as packed integers: each base takes 3 bits (code 0
+# pads barcodes shorter than _BARCODE_MAX_LEN), left-aligned in a uint64.
+_BARCODE_ALPHABET = b'ACGTN.'
+_BARCODE_MAX_LEN = 21
+
+
+@functools.lru_cache(maxsize=None)
+def _barcode_tables():
+    ''' The code of each byte value (7 for bytes outside the alphabet) and the
+        shift of each barcode position.
+    '''
+    import numpy
+    byte_codes = numpy.full(256, 7, dtype=numpy.uint64)
+    byte_codes[0] = 0
+    byte_codes[numpy.frombuffer(_BARCODE_ALPHABET, dtype=numpy.uint8)] = numpy.arange(1, len(_BARCODE_ALPHABET) + 1)
+    shifts = numpy.array([3 * (_BARCODE_MAX_LEN - 1 - i) for i in range(_BARCODE_MAX_LEN)], dtype=numpy.uint64)
+    return byte_codes, shifts
+
+
+def _encode_barcodes(barcodes):
+    ''' Pack a numpy bytes array of barcodes into uint64 codes. Returns the
+        codes and a mask of the barcodes that could be packed (those of at most
+        _BARCODE_MAX_LEN characters from _BARCODE_ALPHABET).
+    '''
+    import numpy
+    if not len(barcodes):
+        return numpy.zeros(0, dtype=numpy.uint64), numpy.zeros(0, dtype=bool)
+    byte_codes, shifts = _barcode_tables()
+    width = barcodes.dtype.itemsize
+    digits = byte_codes[barcodes.view(numpy.uint8).reshape(len(barcodes), width)]
+    packable = (digits[:, :_BARCODE_MAX_LEN] != 7).all(axis=1) & (digits[:, _BARCODE_MAX_LEN:] == 0).all(axis=1)
+    width = min(width, _BARCODE_MAX_LEN)
+    codes = numpy.bitwise_or.reduce(digits[packable, :width] << shifts[:width], axis=1)
+    return codes, packable
+
+
+def _decode_barcodes(codes):
+    ''' Unpack uint64 barcode codes into a numpy unicode array. '''
+    import numpy
+    byte_codes, shifts = _barcode_tables()
+    letters = numpy.zeros(8, dtype=numpy.uint8)
+    letters[1:len(_BARCODE_ALPHABET) + 1] = numpy.frombuffer(_BARCODE_ALPHABET, dtype=numpy.uint8)
+    digits = (numpy.asarray(codes, dtype=numpy.uint64)[:, None] >> shifts) & numpy.uint64(7)
+    chars = numpy.ascontiguousarray(letters[digits.astype(numpy.intp)])
+    return chars.view('S%d' % _BARCODE_MAX_LEN).reshape(len(codes)).astype(str)
+
+
+def _reduce_tallies(tallies, max_distinct=None):
+    ''' k-way merge of (sorted codes, counts) tallies into one sorted tally,
+        keeping only the max_distinct most abundant codes if given.
+    '''
+    import numpy
+    codes = numpy.concatenate([t[0] for t in tallies])
+    counts = numpy.concatenate([t[1] for t in tallies])
+    order = numpy.argsort(codes, kind='mergesort')
+    codes, counts = codes[order], counts[order]
+    if len(codes):
+        starts = numpy.concatenate(([0], numpy.flatnonzero(codes[1:] != codes[:-1]) + 1))
+        codes, counts = codes[starts], numpy.add.reduceat(counts, starts)
+    if max_distinct and len(codes) > max_distinct:
+        keep = numpy.sort(numpy.argpartition(-counts, max_distinct - 1)[:max_distinct])
+        codes, counts = codes[keep], counts[keep]
+    return codes, counts
+
+
+def _prune_counts(counts, max_distinct=None):
+    ''' Keep only the max_distinct most abundant entries of a dict of counts,
+        if given.
+    '''
+    if max_distinct and len(counts) > max_distinct:
+        counts = dict(heapq.nlargest(max_distinct, counts.items(), key=lambda item: item[1]))
+    return counts
+
+
+def _tally_barcode_file(filePath, include_noise=False, max_distinct=None, noise_chr=b'.'):
+    ''' Count the barcodes in the first column of one Picard tile barcode file.
+        Returns a (sorted codes, counts) tally of the packed barcodes, plus a
+        dict of counts for any barcodes that could not be packed, each holding
+        at most max_distinct barcodes if given.
+    '''
+    import numpy
+    with open(filePath, 'rb') as inf:
+        barcodes = [line.split(b'\t', 1)[0].rstrip(b'\r\n') for line in inf if line.strip()]
+    barcodes = numpy.array(barcodes, dtype=bytes) if barcodes else numpy.zeros(0, dtype='S1')
+    if not include_noise:
+        barcodes = barcodes[numpy.char.find(barcodes, noise_chr) < 0]
+
+    packed, packable = _encode_barcodes(barcodes)
+    codes, counts = numpy.unique(packed, return_counts=True)
+    other_counts = {}
+    for barcode in barcodes[~packable]:
+        barcode = barcode.decode('latin-1')
+        other_counts[barcode] = other_counts.get(barcode, 0) + 1
+    return (_reduce_tallies([(codes, counts.astype(numpy.int64))], max_distinct),
+            _prune_counts(other_counts, max_distinct))
+
+
+def count_and_sort_barcodes(barcodes_dir, outSummary, truncateToLength=None, includeNoise=False, omitHeader=False,
+                            picardMetrics=None, outGuessedBarcodes=None, maxDistinctBarcodes=None, threads=None):
+    '''
+        Tally the barcodes of all Picard tile barcode files in barcodes_dir and
+        write them to outSummary in descending order of count.
+
+        Each worker tallies a tile file as packed integer codes and the parent
+        merges partial tallies in k-way batches. Barcodes too long to pack are
+        counted separately by string. If maxDistinctBarcodes is set, no more
+        than that many distinct barcodes of either kind are held at once and
+        reported: the rarest are pruned, so counts near the cutoff become lower
+        bounds.
+        If picardMetrics and outGuessedBarcodes are given, the barcode guesses
+        for outlier samples (see guess_barcodes) are written from the same tally.
+    '''
+    import numpy
     # collect the barcode file paths for all tiles
     tile_barcode_files = [os.path.join(barcodes_dir, filename) for filename in os.listdir(barcodes_dir)]
 
     # count all of the barcodes present in the tile files
     log.info("reading barcodes in all tile files")
-    barcode_counts = defaultdict(lambda: 0)
-
-    def sum_reducer(accumulator, element):
-        for key, value in element.items():
-            accumulator[key] = accumulator.get(key, 0) + value
-        return accumulator
-
-    with concurrent.futures.ProcessPoolExecutor(max_workers=len(tile_barcode_files)) as executor:
-        futures = [executor.submit(util.file.count_occurrences_in_tsv, filePath, include_noise=includeNoise) for filePath in tile_barcode_files]
+    merged = (numpy.zeros(0, dtype=numpy.uint64), numpy.zeros(0, dtype=numpy.int64))
+    pending = []
+    other_counts = {}
+    workers = min(len(tile_barcode_files), util.misc.sanitize_thread_count(threads)) or 1
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_tally_barcode_file, filePath, include_noise=includeNoise,
+                                   max_distinct=maxDistinctBarcodes) for filePath in tile_barcode_files]
         for future in concurrent.futures.as_completed(futures):
-            barcode_counts = sum_reducer(barcode_counts, future.result())
-
-    # sort the counts, descending. Truncate the result if desired
+            tally, other = future.result()
+            pending.append(tally)
+            for barcode, count in other.items():
+                other_counts[barcode] = other_counts.get(barcode, 0) + count
+            other_counts = _prune_counts(other_counts, maxDistinctBarcodes)
+            if maxDistinctBarcodes and sum(len(t[0]) for t in pending) > maxDistinctBarcodes:
+                merged = _reduce_tallies([merged] + pending, maxDistinctBarcodes)
+                pending = []
+    codes, counts = _reduce_tallies([merged] + pending, maxDistinctBarcodes)
+
+    # sort the counts, descending (ties by barcode). Truncate the result if desired
     log.info("sorting counts")
-    illumina_reference = IlluminaIndexReference()
-    count_to_write = truncateToLength if truncateToLength else len(barcode_counts)
-    barcode_pairs_sorted_by_count = sorted(barcode_counts, key=barcode_counts.get, reverse=True)[:count_to_write]
+    barcodes = numpy.concatenate((_decode_barcodes(codes), numpy.array(list(other_counts.keys()), dtype=str)))
+    counts = numpy.concatenate((counts, numpy.array(list(other_counts.values()), dtype=numpy.int64)))
+    order = numpy.lexsort((barcodes, -counts))[:maxDistinctBarcodes or None][:truncateToLength or None]
+    barcodes, counts = barcodes[order].tolist(), counts[order].tolist()
 
-    mapped_counts = (   (k[:8], ",".join([x for x in illumina_reference.guess_index(k[:8], distance=1)] or ["Unknown"]), 
-                        k[8:], ",".join([x for x in illumina_reference.guess_index(k[8:], distance=1)] or ["Unknown"]), 
-                        barcode_counts[k]) 
-                    for k in barcode_pairs_sorted_by_count)
+    illumina_reference = IlluminaIndexReference()
+    guesses1 = illumina_reference.guess_indices([k[:8] for k in barcodes], distance=1)
+    guesses2 = illumina_reference.guess_indices([k[8:] for k in barcodes], distance=1)
+    mapped_counts = [   (k[:8], ",".join(guess1 or ["Unknown"]),
+                        k[8:], ",".join(guess2 or ["Unknown"]),
+                        count)
+                    for k, guess1, guess2, count in zip(barcodes, guesses1, guesses2, counts)]
 
     # write the barcodes and their corresponding counts
     log.info("writing output")
+    header = ("Barcode1", "Likely_Index_Names1", "Barcode2", "Likely_Index_Names2", "Count")
     with open(outSummary, 'w') as tsvfile:
         writer = csv.writer(tsvfile, delimiter='\t')
         # write the header unless the user has specified not to do so
         if not omitHeader:
-            writer.writerow(("Barcode1", "Likely_Index_Names1", "Barcode2", "Likely_Index_Names2", "Count"))
+            writer.writerow(header)
         writer.writerows(mapped_counts)
 
+    if picardMetrics and outGuessedBarcodes:
+        log.info("guessing barcodes for outlier samples")
+        bh = IlluminaBarcodeHelper([dict(zip(header, map(str, row))) for row in mapped_counts], picardMetrics, None)
+        bh.write_guessed_barcodes(outGuessedBarcodes, bh.find_uncertain_barcodes())
+
     log.info("done")
 
 # ======================================
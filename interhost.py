@@ -10,27 +10,19 @@ __commands__ = []
 import argparse
 import logging
 import os
-import array
-import bisect
 import json
-from itertools import permutations
 from collections import OrderedDict, Sequence
 
 from itertools import zip_longest # pylint: disable=E0611
 
 from collections import MutableMapping as DictMixin
 
-# third-party libraries
-import Bio.AlignIO
-from Bio import SeqIO
-
 # module-specific
 import tools.muscle
 import tools.snpeff
 import tools.mafft
 import util.cmd
 import util.file
-import util.vcf
 
 log = logging.getLogger(__name__)
 
@@ -150,9 +142,29 @@ class CoordMapper(DictMixin):
             toPos = toPos[0] if side < 0 else toPos[1]
         return (toChrom, toPos)
 
+    def map_positions(self, fromChrom, toChrom, positions, side=0):
+        """ Map an array of 1-based positions from seq "fromChrom" to seq
+            "toChrom" in one vectorized call (see mapChr).
+            Positions past either end of the other sequence map to 0.
+            If side is:
+                < 0, return an array of the left-most positions on toChrom
+                ==0, return a (left, right) pair of arrays, equal wherever a
+                     position maps to a unique position on toChrom
+                > 0, return an array of the right-most positions on toChrom
+        """
+        if fromChrom not in self.chrMaps:
+            raise KeyError("chr '%s' not found in CoordMapper relation map" % fromChrom)
+        if toChrom not in self.chrMaps[fromChrom].keys():
+            raise KeyError("chr '%s' not found in CoordMapper relation map" % toChrom)
+
+        return self.chrMaps[fromChrom][toChrom].map_positions(positions, 0, side)
+
     def load_alignments(self, aligned_files, a_idx=None, b_idx=None):
         """ Loads aligned sequences into a CoordMapper instance.
             Any number of sequences >1 may be read in.
+            Each sequence's alignment is stored once, as an array of
+            ungapped positions by alignment column, and the mapper for a pair
+            of sequences is derived from their two arrays when first used.
             Mappers may be accessed via CoordMapper.chrMaps where chrMaps may look like:
             ```
             {
@@ -162,57 +174,58 @@ class CoordMapper(DictMixin):
             }
             ```
         """
+        from Bio import SeqIO
         for alignOutFileName in aligned_files:
             with open(alignOutFileName, 'rt') as alignOutFile:
-                seqs = list(SeqIO.parse(alignOutFile, 'fasta'))
-
-                # if len(list(seqs)) <2:
-                #    raise Exception("Each aligned input file must contain >1 sequence.")
-
-                # if mapping between specific sequences is specified
-                if a_idx is not None and b_idx is not None:
-                    assert a_idx >= 0 and b_idx >= 0
-                    assert a_idx < len(seqs) and b_idx < len(seqs)
-
-                    mapper = CoordMapper2Seqs(seqs[a_idx].seq, seqs[b_idx].seq)
-                    self.chrMaps.setdefault(seqs[a_idx].id, OrderedDict())
-                    mapDict = OrderedDict()
-                    mapDict[seqs[b_idx].id] = mapper
-                    self.chrMaps[seqs[a_idx].id] = mapDict
-
-                    mapper = CoordMapper2Seqs(seqs[b_idx].seq, seqs[a_idx].seq)
-                    self.chrMaps.setdefault(seqs[b_idx].id, OrderedDict())
-                    mapDict = OrderedDict()
-                    mapDict[seqs[a_idx].id] = mapper
-                    self.chrMaps[seqs[b_idx].id] = mapDict
-                # otherwise, map all possible pairwise permutations
-                else:
-                    for (seq1, seq2) in permutations(seqs, 2):
-                        if (seq1.id == seq2.id):
-                            raise KeyError("duplicate sequence names '%s', '%s'" % (seq1.id, seq2.id))
-
-                        self.chrMaps.setdefault(seq1.id, OrderedDict())
-                        self.chrMapsUngapped.setdefault(seq1.id, OrderedDict())
-                        # if the sequence we are mapping onto is already in the map
-                        # raise an error
-                        # (could occur if same sequence is read in from multiple files)
-                        if (seq2.id in self.chrMaps[seq1.id]):
-                            raise KeyError(
-                                "duplicate sequence name '%s' already in chrMap for %s" % (seq2.id, seq1.id))
-
-                        mapper = CoordMapper2Seqs(seq1.seq, seq2.seq)
-                        mapDict = self.chrMaps[seq1.id]
-                        mapDict[seq2.id] = mapper
-                        self.chrMaps[seq1.id] = mapDict
-
-                        # ungapped strings
-                        #longerSeqLen = max( len(seq1.seq.ungap("-")), len(seq2.seq.ungap("-")) )
-                        #seq1UngappedPadded = str(seq1.seq.ungap("-")).ljust(longerSeqLen, "N")
-                        #seq2UngappedPadded = str(seq2.seq.ungap("-")).ljust(longerSeqLen, "N")
-                        #mapper = CoordMapper2Seqs(seq1UngappedPadded, seq2UngappedPadded)
-                        #mapDict = self.chrMapsUngapped[seq1.id]
-                        #mapDict[seq2.id] = mapper
-                        #self.chrMapsUngapped[seq1.id] = mapDict
+                self.load_aligned_seqs(list(SeqIO.parse(alignOutFile, 'fasta')), a_idx=a_idx, b_idx=b_idx)
+
+    def load_aligned_seqs(self, seqs, a_idx=None, b_idx=None):
+        """ Loads one alignment, already parsed into a list of SeqRecords,
+            into a CoordMapper instance (see load_alignments).
+        """
+        if len(set(len(seq) for seq in seqs)) > 1:
+            raise Exception('CoordMapper: aligned sequences must be same length.')
+
+        # if len(list(seqs)) <2:
+        #    raise Exception("Each aligned input file must contain >1 sequence.")
+
+        # if mapping between specific sequences is specified
+        if a_idx is not None and b_idx is not None:
+            assert a_idx >= 0 and b_idx >= 0
+            assert a_idx < len(seqs) and b_idx < len(seqs)
+
+            a_cols = AlignedSeqColumns(seqs[a_idx].seq)
+            b_cols = AlignedSeqColumns(seqs[b_idx].seq)
+
+            mapDict = AlignedPartnerMappers()
+            mapDict.add(seqs[b_idx].id, a_cols, b_cols)
+            self.chrMaps[seqs[a_idx].id] = mapDict
+
+            mapDict = AlignedPartnerMappers()
+            mapDict.add(seqs[a_idx].id, b_cols, a_cols)
+            self.chrMaps[seqs[b_idx].id] = mapDict
+        # otherwise, make all possible pairwise permutations mappable
+        else:
+            ids = [seq.id for seq in seqs]
+            if len(set(ids)) != len(ids):
+                dupes = sorted(set(i for i in ids if ids.count(i) > 1))
+                raise KeyError("duplicate sequence names '%s', '%s'" % (dupes[0], dupes[0]))
+
+            # one column -> ungapped position array per sequence; the
+            # mapper for each pair is derived from these on first use
+            columns = [AlignedSeqColumns(seq.seq) for seq in seqs] if len(seqs) > 1 else []
+            for seq1, cols1 in zip(seqs, columns):
+                mapDict = self.chrMaps.setdefault(seq1.id, AlignedPartnerMappers())
+                for seq2, cols2 in zip(seqs, columns):
+                    if seq2.id == seq1.id:
+                        continue
+                    # if the sequence we are mapping onto is already in the map
+                    # raise an error
+                    # (could occur if same sequence is read in from multiple files)
+                    if seq2.id in mapDict:
+                        raise KeyError(
+                            "duplicate sequence name '%s' already in chrMap for %s" % (seq2.id, seq1.id))
+                    mapDict.add(seq2.id, cols1, cols2)
 
     def align_and_load_sequences(self, unaligned_fasta_files, aligner=None):
         aligner = self.alignerTool if aligner is None else aligner
@@ -235,6 +248,60 @@ class CoordMapper(DictMixin):
             os.unlink(f)
 
 
+class AlignedSeqColumns(object):
+    """ The columns of one aligned sequence: ungapped[c] is the number of real
+        (non-gap) bases in columns 0..c, i.e. the 1-based position of the last
+        real base at or before alignment column c.
+    """
+
+    def __init__(self, seq):
+        import numpy
+        seq = numpy.frombuffer(str(seq).encode('ascii'), dtype=numpy.uint8)
+        self.real = seq != ord('-')
+        self.ungapped = numpy.cumsum(self.real, dtype=numpy.int64)
+
+    def __len__(self):
+        return len(self.real)
+
+
+class AlignedPartnerMappers(DictMixin):
+    """ The CoordMapper2Seqs from one aligned sequence to each of the other
+        sequences in its alignment. Each mapper is built from the two
+        sequences' AlignedSeqColumns on first use and then kept.
+    """
+
+    def __init__(self):
+        self._columns = OrderedDict()
+        self._mappers = {}
+
+    def add(self, partner, own_columns, partner_columns):
+        self._columns[partner] = (own_columns, partner_columns)
+        self._mappers.pop(partner, None)
+
+    def __getitem__(self, key):
+        if key not in self._mappers:
+            self._mappers[key] = CoordMapper2Seqs.from_columns(*self._columns[key])
+        return self._mappers[key]
+
+    def __setitem__(self, key, value):
+        raise TypeError("'%s' object does not support item assignment" % self.__class__.__name__)
+
+    def __delitem__(self, key):
+        raise TypeError("'%s' object does not support item deletion" % self.__class__.__name__)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __contains__(self, key):
+        return key in self._columns
+
+    def keys(self):
+        return self._columns.keys()
+
+
 class CoordMapper2Seqs(object):
     """ Map 1-based coordinates between two aligned sequences.
         Result is a coordinate or an interval, as described in CoordMapper main
@@ -258,37 +325,34 @@ class CoordMapper2Seqs(object):
     #     included are the first, the last, and the pair immediately following
     #     any gap. Pairs are in increasing order. Coordinate mapping
     #     requires binary search in one of the arrays.
-    #     Total space required, in bytes, is const + 8 * (number of indels).
+    #     Total space required, in bytes, is const + 16 * (number of indels).
     #     Time for a map in either direction is O(log(number of indels)).
+    #     The arrays are found with vectorized operations over the columns of
+    #     the two sequences (see AlignedSeqColumns).
     #
 
     def __init__(self, seq0, seq1):
-        self.mapArrays = [array.array('I'), array.array('I')]
-        baseCount0 = 0  # Number of real bases in seq0 up to and including cur pos
-        baseCount1 = 0  # Number of real bases in seq1 up to and including cur pos
-        beforeStart = True  # Haven't yet reached first pair of aligned real bases
-        gapSinceLast = False  # Have encounted a gap since last pair in mapArrays
-        for b0, b1 in zip_longest(seq0, seq1):
-            if b0 is None or b1 is None:
-                raise Exception('CoordMapper2Seqs: sequences must be same length.')
-            realBase0 = b0 != '-'
-            realBase1 = b1 != '-'
-            baseCount0 += realBase0
-            baseCount1 += realBase1
-            if realBase0 and realBase1:
-                if beforeStart or gapSinceLast:
-                    self.mapArrays[0].append(baseCount0)
-                    self.mapArrays[1].append(baseCount1)
-                    gapSinceLast = False
-                    beforeStart = False
-                finalPos0 = baseCount0  # Last pair of aligned real bases so far
-                finalPos1 = baseCount1  # Last pair of aligned real bases so far
-            else:
-                gapSinceLast = True
-        if len(self.mapArrays[0]) > 0:
-            if self.mapArrays[0][-1] != finalPos0:
-                self.mapArrays[0].append(finalPos0)
-                self.mapArrays[1].append(finalPos1)
+        self._init_from_columns(AlignedSeqColumns(seq0), AlignedSeqColumns(seq1))
+
+    @classmethod
+    def from_columns(cls, columns0, columns1):
+        """ Build a mapper from two sequences' AlignedSeqColumns. """
+        mapper = cls.__new__(cls)
+        mapper._init_from_columns(columns0, columns1)
+        return mapper
+
+    def _init_from_columns(self, columns0, columns1):
+        import numpy
+        if len(columns0) != len(columns1):
+            raise Exception('CoordMapper2Seqs: sequences must be same length.')
+        # columns with a pair of aligned real bases
+        paired = numpy.flatnonzero(columns0.real & columns1.real)
+        if len(paired):
+            # keep the first pair, each pair following a gap, and the last pair
+            keep = numpy.concatenate(([True], numpy.diff(paired) > 1))
+            keep[-1] = True
+            paired = paired[keep]
+        self.mapArrays = [columns0.ungapped[paired], columns1.ungapped[paired]]
 
     def __call__(self, fromPos, fromWhich):
         """ fromPos: 1-based coordinate
@@ -302,13 +366,13 @@ class CoordMapper2Seqs(object):
         if fromPos < fromArray[0] or fromPos > fromArray[-1]:
             result = None
         elif fromPos == fromArray[-1]:
-            result = toArray[-1]
+            result = int(toArray[-1])
         else:
-            insertInd = bisect.bisect(fromArray, fromPos)
-            prevFromPos = fromArray[insertInd - 1]
-            nextFromPos = fromArray[insertInd]
-            prevToPos = toArray[insertInd - 1]
-            nextToPos = toArray[insertInd]
+            insertInd = int(fromArray.searchsorted(fromPos, side='right'))
+            prevFromPos = int(fromArray[insertInd - 1])
+            nextFromPos = int(fromArray[insertInd])
+            prevToPos = int(toArray[insertInd - 1])
+            nextToPos = int(toArray[insertInd])
             assert (prevFromPos <= fromPos < nextFromPos)
             prevPlusOffset = prevToPos + (fromPos - prevFromPos)
             if fromPos == nextFromPos - 1 and prevPlusOffset < nextToPos - 1:
@@ -317,6 +381,47 @@ class CoordMapper2Seqs(object):
                 result = min(prevPlusOffset, nextToPos - 1)
         return result
 
+    def map_positions(self, fromPositions, fromWhich, side=0):
+        """ Vectorized __call__ over an array of 1-based positions.
+            Positions beyond either end map to 0. If side is < 0 or > 0,
+            return an array of the left-most or right-most mapped positions;
+            if side is 0, return a (left, right) pair of arrays.
+        """
+        import numpy
+        if len(self.mapArrays[0]) == 0:
+            raise Exception('CoordMapper2Seqs: no aligned bases.')
+        fromPositions = numpy.asarray(fromPositions)
+        if fromPositions.dtype.kind not in 'iu':
+            if numpy.any(fromPositions != numpy.floor(fromPositions)):
+                raise TypeError('CoordMapper2Seqs: positions must be integers')
+        fromPositions = fromPositions.astype(numpy.int64)
+        fromArray = self.mapArrays[fromWhich]
+        toArray = self.mapArrays[1 - fromWhich]
+        last = len(fromArray) - 1
+
+        insertInd = numpy.clip(numpy.searchsorted(fromArray, fromPositions, side='right'), 1, max(last, 1))
+        prevFromPos = fromArray[insertInd - 1]
+        nextFromPos = fromArray[numpy.minimum(insertInd, last)]
+        prevToPos = toArray[insertInd - 1]
+        nextToPos = toArray[numpy.minimum(insertInd, last)]
+        prevPlusOffset = prevToPos + (fromPositions - prevFromPos)
+        interval = (fromPositions == nextFromPos - 1) & (prevPlusOffset < nextToPos - 1)
+        left = numpy.where(interval, prevPlusOffset, numpy.minimum(prevPlusOffset, nextToPos - 1))
+        right = numpy.where(interval, nextToPos - 1, left)
+
+        atEnd = fromPositions == fromArray[-1]
+        left[atEnd] = toArray[-1]
+        right[atEnd] = toArray[-1]
+        outside = (fromPositions < fromArray[0]) | (fromPositions > fromArray[-1])
+        left[outside] = 0
+        right[outside] = 0
+
+        if side < 0:
+            return left
+        elif side > 0:
+            return right
+        return (left, right)
+
 # ========== snpEff annotation of VCF files ==================
 
 
@@ -491,6 +596,7 @@ __commands__.append(('multichr_mafft', parser_multichr_mafft))
 
 
 def call_snps_3(inFasta, outVcf, REF="KJ660346.2"):
+    import Bio.AlignIO
     a = Bio.AlignIO.read(inFasta, "fasta")
     ref_idx = find_ref(a, REF)
     with open(outVcf, 'wt') as outf:
@@ -554,6 +660,7 @@ def transposeChromosomeFiles(inputFilenamesList, sampleRelationFile=None, sample
                 in the genome.  Each file contains the same number of samples
                 in the same order.  Each output file is a tempfile.
     '''
+    from Bio import SeqIO
     outputFilenames = []
 
     # open all files
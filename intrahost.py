@@ -11,21 +11,16 @@ __commands__ = []
 import argparse
 import logging
 import itertools
+import heapq
 import re
 import os
 import collections
-
-# third-party
-import Bio.AlignIO
-import Bio.SeqIO
-import Bio.Data.IUPACData
-import pysam
+import concurrent.futures
 
 # module-specific
 import util.genbank
 import util.cmd
 import util.file
-import util.vcf
 import util.misc
 from util.stats import median, fisher_exact, chi2_contingency
 from interhost import CoordMapper
@@ -182,82 +177,158 @@ def compute_library_bias(isnvs, inBam, inConsFasta):
           library bias; append them to string for each variant.
         Format is allele:totalF:totalR:1stLibFCount:1stLibRCount:2ndLibFCount:...:p-val.
         Library counts are in alphabetical order of library IDs.
-        Note: Total was computed by vphaser, library counts by samtools mpileup,
+        Note: Total was computed by vphaser, library counts by LibraryPileupCounter,
           so total might not be sum of library counts.
     '''
     alleleCol = 7  # First column of output with allele counts
-    samtoolsTool = SamtoolsTool()
-    rgs_by_lib = sorted((rg['LB'], rg['ID']) for rg in samtoolsTool.getReadGroups(inBam).values())
-    rgs_by_lib = itertools.groupby(rgs_by_lib, lambda x: x[0])
-    libBams = []
-    header_sam = util.file.mkstempfname('.sam')
-    samtoolsTool.dumpHeader(inBam, header_sam)
-    for lib, rgs in rgs_by_lib:
-        rgs = list(idVal for lb, idVal in rgs)
-
-        # Create libBam containing all the readgroups in rgs.
-        # In samtools 1.1, this can be done by including -r multiple times on
-        # a single command line, but that doesn't work in 0.1.19, so instead
-        # extract readgroups one by one and then concatenate.
-        rgBams = []
-        for idVal in rgs:
-            rgBam = util.file.mkstempfname('.bam')
-            samtoolsTool.view(['-b', '-r', idVal], inBam, rgBam)
-            samtoolsTool.index(rgBam)
-            if samtoolsTool.count(rgBam) > 0:
-                rgBams.append(rgBam)
-            else:
-                # most samtools functions don't like empty input bams, so skip them
-                os.unlink(rgBam)
-        if rgBams:
-            if len(rgBams) > 1:
-                libBam = util.file.mkstempfname('.bam')
-                samtoolsTool.merge(rgBams, libBam, ['-f', '-1', '-h', header_sam])
-                for bam in rgBams:
-                    os.unlink(bam)
-            else:
-                # samtools merge cannot deal with only one (or zero) input bams
-                libBam = rgBams[0]
-            samtoolsTool.index(libBam)
-            n_reads = samtoolsTool.count(libBam)
-            log.debug("LB:%s has %s reads in %s read group(s) (%s)", lib, n_reads, len(rgs), ', '.join(rgs))
-            libBams.append(libBam)
+    with LibraryPileupCounter(inBam, inConsFasta) as counter:
+        for lib in counter.libraries():
+            log.debug("LB:%s has reads in read group(s) (%s)", lib, ', '.join(counter.lib_read_groups[lib]))
+        for row in isnvs:
+            consensusAllele = row[3]
+            pos = int(row[1]) if consensusAllele != 'i' else int(row[1]) - 1
+            chrom = row[0]
+            libCounts = counter.allele_counts(chrom, pos)
+            numAlleles = len(row) - alleleCol
+            countsMatrix = [[0] * numAlleles for lib in libCounts]
+            libCountsByAllele = []
+            for alleleInd in range(numAlleles):
+                allele = row[alleleCol + alleleInd].split(':')[0]
+                libCountsByAllele.append([])
+                for libAlleleCounts, countsRow in zip(libCounts, countsMatrix):
+                    f, r = libAlleleCounts.get(allele, [0, 0])
+                    libCountsByAllele[-1].append([f, r])
+                    countsRow[alleleInd] += f + r
+            for alleleInd in range(numAlleles):
+                contingencyTable = [
+                    [countsRow[alleleInd] for countsRow in countsMatrix], [sum(countsRow) - countsRow[alleleInd]
+                                                                           for countsRow in countsMatrix]
+                ]
+                rowSums = map(sum, contingencyTable)
+                dofs = len(libCounts) - 1
+                if dofs < 1:
+                    pval = 1.0
+                elif min(rowSums) ** dofs / dofs < 10000:
+                    # At this cutoff, fisher_exact should take <~ 0.1 sec
+                    pval = fisher_exact(contingencyTable)
+                else:
+                    pval = chi2_contingency(contingencyTable)
+                row[alleleCol + alleleInd] = str(AlleleFieldParser(None, *(row[alleleCol + alleleInd].split(':') +
+                                                                           [pval, libCountsByAllele[alleleInd]])))
+            yield row
 
-    for row in isnvs:
-        consensusAllele = row[3]
-        pos = int(row[1]) if consensusAllele != 'i' else int(row[1]) - 1
-        chrom = row[0]
-        libCounts = [get_mpileup_allele_counts(libBamItem, chrom, pos, inConsFasta, samtools=samtoolsTool) for libBamItem in libBams]
-        numAlleles = len(row) - alleleCol
-        countsMatrix = [[0] * numAlleles for lib in libBams]
-        libCountsByAllele = []
-        for alleleInd in range(numAlleles):
-            allele = row[alleleCol + alleleInd].split(':')[0]
-            libCountsByAllele.append([])
-            for libAlleleCounts, countsRow in zip(libCounts, countsMatrix):
-                f, r = libAlleleCounts.get(allele, [0, 0])
-                libCountsByAllele[-1].append([f, r])
-                countsRow[alleleInd] += f + r
-        for alleleInd in range(numAlleles):
-            contingencyTable = [
-                [countsRow[alleleInd] for countsRow in countsMatrix], [sum(countsRow) - countsRow[alleleInd]
-                                                                       for countsRow in countsMatrix]
-            ]
-            rowSums = map(sum, contingencyTable)
-            dofs = len(libCounts) - 1
-            if dofs < 1:
-                pval = 1.0
-            elif min(rowSums) ** dofs / dofs < 10000:
-                # At this cutoff, fisher_exact should take <~ 0.1 sec
-                pval = fisher_exact(contingencyTable)
-            else:
-                pval = chi2_contingency(contingencyTable)
-            row[alleleCol + alleleInd] = str(AlleleFieldParser(None, *(row[alleleCol + alleleInd].split(':') +
-                                                                       [pval, libCountsByAllele[alleleInd]])))
-        yield row
-    for bam in libBams:
-        os.unlink(bam)
-    os.unlink(header_sam)
+
+class LibraryPileupCounter(object):
+    ''' Counts strand-aware alleles at single positions of a BAM file, bucketed
+        by library (the LB of each read's read group). The BAM is opened once
+        and only the requested positions are visited, so no per-site
+        subprocesses or per-library BAMs are needed.
+
+        Counting mirrors get_mpileup_allele_counts, which runs
+        `samtools mpileup -A -B -Q 0 -d 50000` on one BAM per library:
+        unmapped, secondary, QC-fail and duplicate reads are skipped, orphan
+        reads are kept, and at most max_depth reads are counted per library
+        at each position.
+    '''
+
+    def __init__(self, inBam, inConsFasta, max_depth=50000):
+        import pysam
+        self.max_depth = max_depth
+        self.tmp_index = None
+        if any(os.path.isfile(fn) for fn in (inBam + '.bai', os.path.splitext(inBam)[0] + '.bai', inBam + '.csi')):
+            self.bam = pysam.AlignmentFile(inBam, 'rb')
+        else:
+            # write the index to a temp file so the input directory need not be writable
+            self.tmp_index = util.file.mkstempfname('.bai')
+            pysam.index(inBam, self.tmp_index)
+            self.bam = pysam.AlignmentFile(inBam, 'rb', index_filename=self.tmp_index)
+        self.fasta = pysam.FastaFile(inConsFasta)
+
+        self.lib_read_groups = collections.OrderedDict()
+        for rg in sorted(self.bam.header.to_dict().get('RG', []), key=lambda rg: (rg['LB'], rg['ID'])):
+            self.lib_read_groups.setdefault(rg['LB'], []).append(rg['ID'])
+        self._libs = None
+        self._rg_to_lib_idx = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def close(self):
+        self.bam.close()
+        self.fasta.close()
+        if self.tmp_index and os.path.isfile(self.tmp_index):
+            os.unlink(self.tmp_index)
+
+    def libraries(self):
+        ''' Return the libraries (sorted by LB) that contain at least one read.
+            Libraries with no reads at all are not reported, as with the
+            per-library BAMs of the former implementation.
+        '''
+        if self._libs is None:
+            rg_to_lib = dict((rg, lib) for lib, rgs in self.lib_read_groups.items() for rg in rgs)
+            seen = set()
+            if rg_to_lib:
+                for read in self.bam.fetch(until_eof=True):
+                    if read.has_tag('RG'):
+                        lib = rg_to_lib.get(read.get_tag('RG'))
+                        if lib is not None:
+                            seen.add(lib)
+                            if len(seen) == len(self.lib_read_groups):
+                                break
+            self._libs = [lib for lib in self.lib_read_groups if lib in seen]
+            lib_idx = dict((lib, i) for i, lib in enumerate(self._libs))
+            self._rg_to_lib_idx = dict((rg, lib_idx[lib]) for rg, lib in rg_to_lib.items() if lib in lib_idx)
+        return self._libs
+
+    def _ref_base(self, chrom, pos):
+        if chrom in self.fasta.references and pos <= self.fasta.get_reference_length(chrom):
+            return self.fasta.fetch(chrom, pos - 1, pos).upper()
+        return 'N'
+
+    def allele_counts(self, chrom, pos):
+        ''' Return a list (one per library, in the order of libraries()) of
+            {allele : [forwardCount, reverseCount], ...} at the 1-based
+            position pos, with alleles keyed as in get_mpileup_allele_counts.
+        '''
+        libs = self.libraries()
+        counts = [{} for lib in libs]
+        depths = [0] * len(libs)
+        refBase = self._ref_base(chrom, pos)
+        pileup = self.bam.pileup(chrom, pos - 1, pos, truncate=True, stepper='all', max_depth=self.max_depth * max(1, len(libs)),
+                                 min_base_quality=0, ignore_orphans=False, ignore_overlaps=False)
+        for column in pileup:
+            for pread in column.pileups:
+                read = pread.alignment
+                if not read.has_tag('RG'):
+                    continue
+                libIdx = self._rg_to_lib_idx.get(read.get_tag('RG'))
+                if libIdx is None or depths[libIdx] >= self.max_depth:
+                    continue
+                depths[libIdx] += 1
+                alleleCounts = counts[libIdx]
+                isRev = int(read.is_reverse)
+                if not pread.is_del and not pread.is_refskip:
+                    base = read.query_sequence[pread.query_position].upper()
+                    allele = '.' if base == refBase else base
+                    alleleCounts.setdefault(allele, [0, 0])[isRev] += 1
+                if pread.indel > 0:
+                    qpos = pread.query_position
+                    allele = 'I' + read.query_sequence[qpos + 1:qpos + 1 + pread.indel].upper()
+                    alleleCounts.setdefault(allele, [0, 0])[isRev] += 1
+                elif pread.indel < 0:
+                    alleleCounts.setdefault('D' + str(-pread.indel), [0, 0])[isRev] += 1
+
+        # '.' is the reference base at this position (which might be different
+        # from vphaser's consensus base). Report this count for the base
+        # itself and for what vphaser calls 'i' or 'd'.
+        for alleleCounts, depth in zip(counts, depths):
+            if depth:
+                alleleCounts['i'] = alleleCounts['d'] = alleleCounts[refBase] = alleleCounts.get('.', [0, 0])
+        return counts
 
 
 def parse_alleles_string(allelesStr):
@@ -454,31 +525,36 @@ def merge_to_vcf(
         alignments,
         strip_chr_version=False,
         naive_filter=False,
-        parse_accession=False):
+        parse_accession=False,
+        threads=None):
     ''' Combine and convert vPhaser2 parsed filtered output text files into VCF format.
         Assumption: consensus assemblies used in creating alignments do not extend beyond ends of reference.
                     the number of alignment files equals the number of chromosomes / segments
+        Each input file is parsed once into per-chromosome indexes; chromosomes
+        are then merged in parallel (up to threads at a time) and .vcf.gz output
+        is written directly as bgzip.
     '''
 
+    import Bio.SeqIO
+    import pysam
+    # use the output filepath specified if it is a .vcf or a .vcf.gz
+    if not (outVcf.endswith('.vcf.gz') or outVcf.endswith('.vcf')):
+        raise ValueError("outVcf must end in .vcf or .vcf.gz")
+
+    # read every input file exactly once
+    with util.file.open_or_gzopen(refFasta, 'r') as inf:
+        ref_seqs = list(Bio.SeqIO.parse(inf, 'fasta'))
+    aligned_seqs = []
+    for alignmentFile in alignments:
+        with util.file.open_or_gzopen(alignmentFile, 'r') as inf:
+            aligned_seqs.append(list(Bio.SeqIO.parse(inf, 'fasta')))
+    isnv_rows = list(list(util.file.read_tabfile(isnvs_file)) for isnvs_file in isnvs)
+
     guessed_samples = []
     if not samples:
-        samplenames_from_isnvs = []
-        for isnvs_file in isnvs:
-            for row in util.file.read_tabfile(isnvs_file):
-                guessed_sample_ID = sampleIDMatch(row[0])
-                if guessed_sample_ID not in samplenames_from_isnvs:
-                    samplenames_from_isnvs.append(guessed_sample_ID)
-        
-        samplenames_from_alignments = set()
-        for alignmentFile in alignments:
-            with util.file.open_or_gzopen(alignmentFile, 'r') as inf:
-                for seq in Bio.SeqIO.parse(inf, 'fasta'):
-                    samplenames_from_alignments.add(sampleIDMatch(seq.id))
-
-        refnames = set()
-        with util.file.open_or_gzopen(refFasta, 'r') as inf:
-            for seq in Bio.SeqIO.parse(inf, 'fasta'):
-                    refnames.add(sampleIDMatch(seq.id))
+        samplenames_from_isnvs = list(util.misc.unique(sampleIDMatch(row[0]) for rows in isnv_rows for row in rows))
+        samplenames_from_alignments = set(sampleIDMatch(seq.id) for seqs in aligned_seqs for seq in seqs)
+        refnames = set(sampleIDMatch(seq.id) for seq in ref_seqs)
 
         # sample names from the isnv files, in that order, 
         # followed by sample names seen in the alignments, minus the former and the reference IDs
@@ -487,402 +563,402 @@ def merge_to_vcf(
 
     samples = samples if samples is not None and len(samples)>0 else guessed_samples
 
-    samp_to_isnv = {}
     # if we had to guess sample names, match them up to isnv files
     if len(guessed_samples)>0:
+        isnv_sample_names = list(set(sampleIDMatch(row[0]) for row in rows) for rows in isnv_rows)
         matched_samples = []
         matched_isnv_files = []
         for sample in samples:
-            sample_found=False
-            for isnvs_file in isnvs:
-                for row in util.file.read_tabfile(isnvs_file):
-                    if sample==sampleIDMatch(row[0]):
-                        samp_to_isnv[sample] = isnvs_file
-                        sample_found=True
-                        matched_samples.append(sample)
-                        matched_isnv_files.append(isnvs_file)
-                        break
-                if sample_found:
+            for isnv_idx, names in enumerate(isnv_sample_names):
+                if sample in names:
+                    matched_samples.append(sample)
+                    matched_isnv_files.append(isnv_idx)
                     break
         samples = matched_samples
-        isnvs = matched_isnv_files
+        samp_to_isnv = dict(zip(samples, matched_isnv_files))
+        isnvs = [isnvs[isnv_idx] for isnv_idx in matched_isnv_files]
     else:
-        samp_to_isnv = dict(zip(samples, isnvs))
+        samp_to_isnv = dict(zip(samples, range(len(isnvs))))
 
-    log.info(samp_to_isnv)
+    log.info(dict((sample, isnv_idx) for sample, isnv_idx in samp_to_isnv.items()))
 
-    # get IDs and sequence lengths for reference sequence
-    with util.file.open_or_gzopen(refFasta, 'r') as inf:
-        ref_chrlens = list((seq.id, len(seq)) for seq in Bio.SeqIO.parse(inf, 'fasta'))
-
-    # use the output filepath specified if it is a .vcf, otherwise if it is gzipped we need
-    # to write to a temp VCF and then compress to vcf.gz later
-    if outVcf.endswith('.vcf.gz'):
-        tmpVcf = util.file.mkstempfname('.vcf')
-    elif outVcf.endswith('.vcf'):
-        tmpVcf = outVcf
-    else:
-        raise ValueError("outVcf must end in .vcf or .vcf.gz")
-
-    log.info("loaded CoordMapper for all genomes, starting VCF merge...")
+    # output chrom names for each reference sequence
+    out_chroms = []
+    for ref_sequence in ref_seqs:
+        c = ref_sequence.id
+        if parse_accession:
+            c = util.genbank.parse_accession_str(c)
+        if strip_chr_version:
+            c = strip_accession_version(c)
+        out_chroms.append(c)
 
     # write header
-    with open(tmpVcf, 'w') as outf:
-        # write header
-        outf.write('##fileformat=VCFv4.1\n')
-        outf.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
-        outf.write('##FORMAT=<ID=AF,Number=A,Type=Float,Description="Allele Frequency">\n')
-        outf.write('##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read Depth">\n')
-        outf.write('##FORMAT=<ID=NL,Number=R,Type=Integer,Description="Number of libraries observed per allele">\n')
-        outf.write(
-            '##FORMAT=<ID=LB,Number=R,Type=Float,Description="Library bias observed per allele (Fishers Exact P-value)">\n')
-        # write out the contig lengths present in the reference genome
-        for c, clen in ref_chrlens:
-            if parse_accession:
-                c = util.genbank.parse_accession_str(c)
-            if strip_chr_version:
-                c = strip_accession_version(c)
-            outf.write('##contig=<ID=%s,length=%d>\n' % (c, clen))
-        # write out the name of the reference file used to generate the VCF
-        outf.write('##reference=file://%s\n' % refFasta)
-        header = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + samples
-        outf.write('#' + '\t'.join(header) + '\n')
-
-    # compress output if requested
+    header_lines = [
+        '##fileformat=VCFv4.1\n',
+        '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n',
+        '##FORMAT=<ID=AF,Number=A,Type=Float,Description="Allele Frequency">\n',
+        '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read Depth">\n',
+        '##FORMAT=<ID=NL,Number=R,Type=Integer,Description="Number of libraries observed per allele">\n',
+        '##FORMAT=<ID=LB,Number=R,Type=Float,Description="Library bias observed per allele (Fishers Exact P-value)">\n']
+    # write out the contig lengths present in the reference genome
+    for ref_sequence, c in zip(ref_seqs, out_chroms):
+        header_lines.append('##contig=<ID=%s,length=%d>\n' % (c, len(ref_sequence)))
+    # write out the name of the reference file used to generate the VCF
+    header_lines.append('##reference=file://%s\n' % refFasta)
+    header = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + samples
+    header_lines.append('#' + '\t'.join(header) + '\n')
+
+    # compress output directly if requested
     if outVcf.endswith('.vcf.gz'):
-        pysam.tabix_compress(tmpVcf, outVcf, force=True)
-        pysam.tabix_index(outVcf, force=True, preset='vcf')
+        outf = pysam.BGZFile(outVcf, 'wb')
+    else:
+        outf = open(outVcf, 'wb')
+    try:
+        outf.write(''.join(header_lines).encode('utf-8'))
 
-    with open(tmpVcf, 'a') as outf:
-        if not len(ref_chrlens) == len(alignments):
+        if not len(ref_seqs) == len(alignments):
             raise LookupError("there must be an alignment file for each chromosome/segment present in the reference")
 
         # we are assuming that the reference sequences have the same IDs in the alignments and in the
         # reference fasta, but we need to relate each reference sequence (chromosome/segment) to a specific
-        # alignment file and index within the alignment
-        ref_seq_id_to_alignment_file = dict()
-        ref_seq_in_alignment_file = dict()
-
-        # copy the list of alignment files
-        alignmentFiles = list(alignments)
-
-        with util.file.open_or_gzopen(refFasta, 'r') as inf:
-            for refSeq in Bio.SeqIO.parse(inf, 'fasta'):
-                for alignmentFile in alignmentFiles:
-                    with util.file.open_or_gzopen(alignmentFile, 'r') as inf2:
-                        for seq in Bio.SeqIO.parse(inf2, 'fasta'):
-                            if refSeq.id == seq.id:
-                                ref_seq_id_to_alignment_file[seq.id] = alignmentFile
-                                ref_seq_in_alignment_file[seq.id] = seq.seq.ungap('-')
-
-        if len(ref_seq_id_to_alignment_file) < len(ref_chrlens):
+        # alignment file
+        ref_ids = set(seq.id for seq in ref_seqs)
+        ref_seq_id_to_alignment = dict()
+        for alignment_idx, seqs in enumerate(aligned_seqs):
+            for seq in seqs:
+                if seq.id in ref_ids:
+                    ref_seq_id_to_alignment[seq.id] = alignment_idx
+
+        if len(ref_seq_id_to_alignment) < len(ref_seqs):
             raise LookupError("Not all reference sequences found in alignments.")
 
         if len(guessed_samples)==0 and not (len(samples) == len(isnvs)):
             raise LookupError(
                 "There must be an isnv file for each sample. %s samples, %s isnv files" % (len(samples), len(isnvs)))
 
-        for fileName in alignments:
-            with util.file.open_or_gzopen(fileName, 'r') as inf:
-                # get two independent iterators into the alignment file
-                number_of_aligned_sequences = count_iter_items(Bio.SeqIO.parse(inf, 'fasta'))
-                num_isnv_files = len(isnvs)
-                # -1 is to account for inclusion of reference in the alignement in addition
-                # to the assemblies
-
-                # if we had to guess samples only check that the number of isnv files == number of alignments
-                if len(guessed_samples)==0:
-                    if not (number_of_aligned_sequences - 1) == num_isnv_files == len(samples):
-                        raise LookupError(
-                            """The number of isnv files provided (%s) and must equal the number of sequences
-                            seen in the alignment (%s) (plus an extra reference record in the alignment), 
-                            as well as the number of sample names provided (%s)
-                            %s does not have the right number of sequences""" % (num_isnv_files,number_of_aligned_sequences - 1,len(samples),fileName))
-
-        # one reference chrom at a time
-        with open(refFasta, 'r') as inf:
-            for ref_sequence in Bio.SeqIO.parse(inf, 'fasta'):
-                samp_to_seqIndex = dict()
-
-                #ref_sequence = ref_seq_in_alignment_file[refSequence.id]
-                # make a coordmapper to map all alignments to this reference sequence
-                cm = CoordMapper()
-                cm.load_alignments([ref_seq_id_to_alignment_file[ref_sequence.id]])
-
-                # ========================
-                # to map from ref->sample
-                # cm[ref_sequence.id][s]
-                # to map sample->ref
-                # cm[s][ref_sequence.id]
-
-                # read in all iSNVs for this chrom and map to reference coords
-                data = []
-
-                # use conditional matching to only include the sequences that match the sample basename provided
-                samplesToUse = [x for x in cm.chrMaps.keys() if sampleIDMatch(x) in samples]
-
-                alignmentFile = ref_seq_id_to_alignment_file[ref_sequence.id]
-                with util.file.open_or_gzopen(alignmentFile, 'r') as alignFileIn:
-                    for seq in Bio.SeqIO.parse(alignFileIn, 'fasta'):
-                        for sampleName in samplesToUse:
-                            if seq.id == sampleName:
-                                samp_to_seqIndex[sampleName] = seq.seq.ungap('-')
-                                break
+        for fileName, seqs in zip(alignments, aligned_seqs):
+            number_of_aligned_sequences = len(seqs)
+            num_isnv_files = len(isnvs)
+            # -1 is to account for inclusion of reference in the alignement in addition
+            # to the assemblies
 
-                if not len(samp_to_seqIndex) == len(samplesToUse):
+            # if we had to guess samples only check that the number of isnv files == number of alignments
+            if len(guessed_samples)==0:
+                if not (number_of_aligned_sequences - 1) == num_isnv_files == len(samples):
                     raise LookupError(
-                        "Sequence info not found in file %s for all sample names provided. Check alignment files." %
-                        alignmentFile)
-
-                for s in samplesToUse:
-                    isnv_filepath = samp_to_isnv[sampleIDMatch(s)]
-
-                    for row in util.file.read_tabfile(isnv_filepath):
-                        # map ref->sample
-                        s_chrom = cm.mapChr(ref_sequence.id, s)
-                        if row[0] == s_chrom:
-                            allele_fields = list(AlleleFieldParser(x) for x in row[7:] if x)
-                            row = {
-                                'sample': s,
-                                'CHROM': ref_sequence.id,
-                                's_chrom': s_chrom,
-                                's_pos': int(row[1]),
-                                's_alt': row[2],
-                                's_ref': row[3],
-                                'alleles': list(x.allele_and_strand_counts() for x in allele_fields),
-                                'n_libs': dict(
-                                    (x.allele(), sum(1 for f, r in x.lib_counts()
-                                                     if f + r > 0)) for x in allele_fields),
-                                'lib_bias': dict(
-                                    (x.allele(), x.lib_bias_pval()) for x in allele_fields),
-                            }
-                            # make a sorted allele list
-                            row['allele_counts'] = list(sorted(
-                                [(a, int(f) + int(r)) for a, f, r in row['alleles']],
-                                key=(lambda x: x[1]),
-                                reverse=True))
-                            # naive filter (quick and dirty)
-                            if naive_filter:
-                                # require 2 libraries for every allele call
-                                row['allele_counts'] = list((a, n) for a, n in row['allele_counts']
-                                                            if row['n_libs'][a] >= 2)
-                                # recompute total read counts for remaining
-                                tot_n = sum(n for a, n in row['allele_counts'])
-                                # require allele frequency >= 0.5%
-                                row['allele_counts'] = list((a, n) for a, n in row['allele_counts']
-                                                            if tot_n > 0 and float(n) / tot_n >= 0.005)
-                                # drop this position:sample if no variation left
-                                if len(row['allele_counts']) < 2:
-                                    log.info(
-                                        """dropping iSNV at %s:%s (%s)
-                                            because no variation remains after simple filtering""", row['s_chrom'],
-                                        row['s_pos'], row['sample'])
-                                    continue
-                            # reposition vphaser deletions minus one to be consistent with
-                            # VCF conventions
-                            if row['s_alt'].startswith('D'):
-                                for a, n in row['allele_counts']:
-                                    if a[0] not in ('D', 'i'):
-                                        log.error("allele_counts: " + str(row['allele_counts']))
-                                        raise Exception("deletion alleles must always start with D or i")
-                                row['s_pos'] = row['s_pos'] - 1
-                            # map position back to reference coordinates
-                            row['POS'] = cm.mapChr(s, ref_sequence.id, row['s_pos'], side=-1)[1]
-                            row['END'] = cm.mapChr(s, ref_sequence.id, row['s_pos'], side=1)[1]
-                            if row['POS'] == None or row['END'] == None:
-                                raise Exception('consensus extends beyond start or end of reference.')
-                            data.append(row)
-
-                # sort all iSNVs (across all samples) and group by position
-                data = sorted(data, key=(lambda row: row['POS']))
-                data = itertools.groupby(data, lambda row: row['POS'])
-
-                # process one reference position at a time from
-                for pos, rows in data:
-                    # each of the sample-specific variants for a given ref pos
-                    rows = list(rows)
-
-                    # define the length of this variation based on the largest deletion
-                    end = pos
-                    for row in rows:
-                        end = max(end, row['END'])
-                        for a, n in row['allele_counts']:
-                            if a.startswith('D'):
-                                # end of deletion in sample's coord space
-                                local_end = row['s_pos'] + int(a[1:])
-
-                                # end of deletion in reference coord space
-                                ref_end = cm.mapChr(row['s_chrom'], ref_sequence.id, local_end, side=1)[1]
-                                if ref_end is None:
-                                    raise Exception('consensus extends ' 'beyond start or end of reference.')
-                                end = max(end, ref_end)
-
-                    # find reference allele and consensus alleles
-                    refAllele = str(ref_sequence[pos - 1:end].seq)
-                    consAlleles = {}  # the full pos-to-end consensus assembly sequence for each sample
-                    samp_offsets = {}  # {sample : isnv's index in its consAllele string}
-                    for row in rows:
-                        s_pos = row['s_pos']
-                        sample = row['sample']
-                        if samp_offsets.get(sample, s_pos) != s_pos:
-                            raise NotImplementedError('Sample %s has variants at 2 '
-                                                      'positions %s mapped to same reference position (%s:%s)' %
-                                                      (sample, (s_pos, samp_offsets[sample]), ref_sequence.id, pos))
-                        samp_offsets[sample] = s_pos
-                    for s in samplesToUse:
-                        # map ref to s
-                        cons_start = cm.mapChr(ref_sequence.id, s, pos, side=-1)[1]
-                        cons_stop = cm.mapChr(ref_sequence.id, s, end, side=1)[1]
-                        if cons_start is None or cons_stop is None:
-                            log.info("variant is outside consensus assembly "
-                                     "for %s at %s:%s-%s.", s, ref_sequence.id, pos, end)
-                            continue
-
-                        cons = samp_to_seqIndex[s]  # .seq.ungap('-')#[ cm.mapChr(ref_sequence.id, s) ]
-
-                        allele = str(cons[cons_start - 1:cons_stop]).upper()
-                        if s in samp_offsets:
-                            samp_offsets[s] -= cons_start
-                        if all(a in set(('A', 'C', 'T', 'G')) for a in allele):
-                            consAlleles[s] = allele
-                        else:
-                            log.warning("dropping ambiguous consensus for %s at %s:%s-%s: %s", s, ref_sequence.id, pos,
-                                        end, allele)
-
-                    # define genotypes and fractions
-                    iSNVs = {}  # {sample : {allele : fraction, ...}, ...}
-                    iSNVs_read_depth = {}  # {sample: read depth}
-                    iSNVs_n_libs = {}  # {sample : {allele : n libraries > 0, ...}, ...}
-                    iSNVs_lib_bias = {}  # {sample : {allele : pval, ...}, ...}
-                    for s in samplesToUse:
-                        # get all rows for this sample and merge allele counts together
-                        acounts = dict(itertools.chain.from_iterable(row['allele_counts'] for row in rows if
-                                                                     row['sample'] == s))
-                        nlibs = dict(itertools.chain.from_iterable(row['n_libs'].items() for row in rows if
-                                                                   row['sample'] == s))
-                        libbias = dict(itertools.chain.from_iterable(row['lib_bias'].items() for row in rows if
-                                                                     row['sample'] == s))
-                        if 'i' in acounts and 'd' in acounts:
-                            # This sample has both an insertion line and a deletion line at the same spot!
-                            # To keep the reference allele from be counted twice, once as an i and once
-                            # as a d, average the counts and get rid of one of them.
-                            acounts['i'] = int(round((acounts['i'] + acounts['d']) / 2.0, 0))
-                            del acounts['d']
-                            nlibs['i'] = max(nlibs['i'], nlibs['d'])
-                            libbias['i'] = max(libbias['i'], libbias['d'])
-
-                        if acounts and s in consAlleles:
-                            # we have iSNV data on this sample
-                            consAllele = consAlleles[s]
-                            tot_n = sum(acounts.values())
-                            iSNVs[s] = {}  # {allele : fraction, ...}
-                            iSNVs_read_depth[s] = tot_n
-                            iSNVs_n_libs[s] = {}
-                            iSNVs_lib_bias[s] = {}
-                            for orig_a, n in acounts.items():
-                                f = float(n) / tot_n
-                                a = orig_a
-                                if a.startswith('I'):
-                                    # insertion point is relative to each sample
-                                    insert_point = samp_offsets[s] + 1
-                                    a = consAllele[:insert_point] + a[1:] + consAllele[insert_point:]
-                                elif a.startswith('D'):
-                                    # deletion is the first consensus base, plus remaining
-                                    # consensus seq with the first few positions dropped off
-                                    cut_left = samp_offsets[s] + 1
-                                    cut_right = samp_offsets[s] + 1 + int(a[1:])
-                                    a = consAllele[:cut_left] + consAllele[cut_right:]
-                                elif a in ('i', 'd'):
-                                    # this is vphaser's way of saying the "reference" (majority/consensus)
-                                    # allele, in the face of other indel variants
-                                    a = consAllele
-                                else:
-                                    # this is a SNP
-                                    if a not in set(('A', 'C', 'T', 'G')):
-                                        raise Exception()
-                                    if f > 0.5 and a != consAllele[samp_offsets[s]]:
-                                        log.warning("vPhaser and assembly pipelines mismatch at "
-                                                    "%s:%d (%s) - consensus %s, vPhaser %s, f %.3f", ref_sequence.id,
-                                                    pos, s, consAllele[samp_offsets[s]], a, f)
-                                    new_allele = list(consAllele)
-                                    new_allele[samp_offsets[s]] = a
-                                    a = ''.join(new_allele)
-                                if not (a and a == a.upper()):
-                                    raise Exception()
-                                iSNVs[s][a] = f
-                                iSNVs_n_libs[s][a] = nlibs[orig_a]
-                                iSNVs_lib_bias[s][a] = libbias[orig_a]
-                            if all(len(a) == 1 for a in iSNVs[s].keys()):
-                                if consAllele not in iSNVs[s]:
-                                    raise Exception(
-                                        """at %s:%s (%s), consensus allele %s
-                                            not among iSNV alleles %s -- other cons alleles: %s""" % (
-                                            ref_sequence.id, pos, s, consAllele, ', '.join(
-                                                iSNVs[s].keys()), ', '.join(
-                                                    consAlleles[s])))
-                        elif s in consAlleles:
-                            # there is no iSNV data for this sample, so substitute the consensus allele
-                            iSNVs[s] = {consAlleles[s]: 1.0}
-
-                    # get unique alleles list for this position, in this order:
-                    # first:   reference allele,
-                    # next:    consensus allele for each sample, in descending order of
-                    #          number of samples with that consensus,
-                    # finally: all other alleles, sorted first by number of containing samples,
-                    #          then by intrahost read frequency summed over the population,
-                    #          then by the allele string itself.
-                    alleles_cons = [alleleItem for alleleItem, n in sorted(util.misc.histogram(consAlleles.values()).items(),
-                                                         key=lambda x: x[1],
-                                                         reverse=True) if alleleItem != refAllele]
-                    alleles_isnv = list(itertools.chain.from_iterable(
-                        [iSNVs[s].items() for s in samplesToUse if s in iSNVs]))
-                    alleles_isnv2 = []
-                    for a in set(a for a, n in alleles_isnv):
-                        counts = list(x[1] for x in alleles_isnv if x[0] == a)
-                        if len(counts) > 0 and sum(counts) > 0:
-                            # if we filtered any alleles above, make sure to omit absent alleles
-                            alleles_isnv2.append((len(counts), sum(counts), a))
-                        else:
-                            log.info("dropped allele %s at position %s:%s", a, ref_sequence.id, pos)
-                    alleles_isnv = list(allele for n_samples, n_reads, allele in reversed(sorted(alleles_isnv2)))
-                    alleles = list(util.misc.unique([refAllele] + alleles_cons + alleles_isnv))
-
-                    # map alleles from strings to numeric indexes
-                    if not alleles:
-                        raise Exception()
-                    elif len(alleles) == 1:
-                        # if we filtered any alleles above, skip this position if there is no variation left here
-                        log.info("dropped position %s:%s due to lack of variation", ref_sequence.id, pos)
-                        continue
-                    alleleMap = dict((a, i) for i, a in enumerate(alleles))
-                    # GT col emitted below
-                    genos = [str(alleleMap.get(consAlleles.get(s), '.')) for s in samplesToUse]
-                    # AF col emitted below, everything excluding the ref allele (one float per non-ref allele)
-                    freqs = [(s in iSNVs) and ','.join(map(str, [iSNVs[s].get(a, 0.0) for a in alleles[1:]])) or '.'
-                             for s in samplesToUse]
-                    # DP col emitted below
-                    depths = [str(iSNVs_read_depth.get(s, '.')) for s in samplesToUse]
-                    # NL col, everything including the ref allele (one int per allele)
-                    nlibs = [(s in iSNVs_n_libs) and ','.join([str(iSNVs_n_libs[s].get(a, 0)) for a in alleles]) or '.'
-                             for s in samplesToUse]
-                    # LB col, everything including the ref allele (one float per allele)
-                    pvals = [(s in iSNVs_lib_bias) and ','.join([str(iSNVs_lib_bias[s].get(a, '.')) for a in alleles])
-                             or '.' for s in samplesToUse]
-
-                    # prepare output row and write to file
-                    c = ref_sequence.id
-                    if parse_accession:
-                        c = util.genbank.parse_accession_str(c)
-                    if strip_chr_version:
-                        c = strip_accession_version(c)
-                    out = [c, pos, '.', alleles[0], ','.join(alleles[1:]), '.', '.', '.', 'GT:AF:DP:NL:LB']
-                    out = out + list(map(':'.join, zip(genos, freqs, depths, nlibs, pvals)))
-                    outf.write('\t'.join(map(str, out)) + '\n')
-    # compress output if requested
+                        """The number of isnv files provided (%s) and must equal the number of sequences
+                        seen in the alignment (%s) (plus an extra reference record in the alignment), 
+                        as well as the number of sample names provided (%s)
+                        %s does not have the right number of sequences""" % (num_isnv_files,number_of_aligned_sequences - 1,len(samples),fileName))
+
+        # index each isnv file by chromosome
+        isnv_rows_by_chrom = []
+        for rows in isnv_rows:
+            by_chrom = {}
+            for row in rows:
+                by_chrom.setdefault(row[0], []).append(row)
+            isnv_rows_by_chrom.append(by_chrom)
+
+        # one job per reference chrom: its alignment and the isnv rows of each sample in it
+        sample_set = set(samples)
+        jobs = []
+        for ref_sequence, c in zip(ref_seqs, out_chroms):
+            seqs = aligned_seqs[ref_seq_id_to_alignment[ref_sequence.id]]
+            sample_rows = dict((seq.id, isnv_rows_by_chrom[samp_to_isnv[sampleIDMatch(seq.id)]].get(seq.id, []))
+                               for seq in seqs if sampleIDMatch(seq.id) in sample_set)
+            jobs.append((ref_sequence, seqs, sample_rows, c, naive_filter))
+
+        log.info("loaded alignments and iSNVs for all genomes, starting VCF merge...")
+        workers = min(util.misc.sanitize_thread_count(threads), len(jobs))
+        if workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                for out_rows in executor.map(_merge_to_vcf_chrom, *zip(*jobs)):
+                    outf.write(''.join(out_rows).encode('utf-8'))
+        else:
+            for job in jobs:
+                outf.write(''.join(_merge_to_vcf_chrom(*job)).encode('utf-8'))
+    finally:
+        outf.close()
     if outVcf.endswith('.vcf.gz'):
-        pysam.tabix_compress(tmpVcf, outVcf, force=True)
         pysam.tabix_index(outVcf, force=True, preset='vcf')
-        os.unlink(tmpVcf)
+
+
+def _merge_to_vcf_chrom(ref_sequence, aligned_seqs, sample_isnv_rows, out_chrom, naive_filter=False):
+    ''' Merge the iSNVs of all samples on one reference chrom (see merge_to_vcf)
+        and return the VCF data lines for it, in position order.
+        sample_isnv_rows maps each sample sequence name in the alignment to
+        its isnv rows on that sequence.
+    '''
+    # make a coordmapper to map all alignments to this reference sequence
+    cm = CoordMapper()
+    cm.load_aligned_seqs(aligned_seqs)
+
+    # ========================
+    # to map from ref->sample
+    # cm[ref_sequence.id][s]
+    # to map sample->ref
+    # cm[s][ref_sequence.id]
+
+    # use conditional matching to only include the sequences that match the sample basename provided
+    samplesToUse = [x for x in cm.chrMaps.keys() if x in sample_isnv_rows]
+
+    samp_to_seqIndex = dict((seq.id, seq.seq.ungap('-')) for seq in aligned_seqs if seq.id in sample_isnv_rows)
+
+    # read in all iSNVs for this chrom and map to reference coords, one sorted list per sample
+    per_sample_data = []
+    for s in samplesToUse:
+        data = []
+        for row in sample_isnv_rows[s]:
+            allele_fields = list(AlleleFieldParser(x) for x in row[7:] if x)
+            row = {
+                'sample': s,
+                'CHROM': ref_sequence.id,
+                's_chrom': s,
+                's_pos': int(row[1]),
+                's_alt': row[2],
+                's_ref': row[3],
+                'alleles': list(x.allele_and_strand_counts() for x in allele_fields),
+                'n_libs': dict(
+                    (x.allele(), sum(1 for f, r in x.lib_counts()
+                                     if f + r > 0)) for x in allele_fields),
+                'lib_bias': dict(
+                    (x.allele(), x.lib_bias_pval()) for x in allele_fields),
+            }
+            # make a sorted allele list
+            row['allele_counts'] = list(sorted(
+                [(a, int(f) + int(r)) for a, f, r in row['alleles']],
+                key=(lambda x: x[1]),
+                reverse=True))
+            # naive filter (quick and dirty)
+            if naive_filter:
+                # require 2 libraries for every allele call
+                row['allele_counts'] = list((a, n) for a, n in row['allele_counts']
+                                            if row['n_libs'][a] >= 2)
+                # recompute total read counts for remaining
+                tot_n = sum(n for a, n in row['allele_counts'])
+                # require allele frequency >= 0.5%
+                row['allele_counts'] = list((a, n) for a, n in row['allele_counts']
+                                            if tot_n > 0 and float(n) / tot_n >= 0.005)
+                # drop this position:sample if no variation left
+                if len(row['allele_counts']) < 2:
+                    log.info(
+                        """dropping iSNV at %s:%s (%s)
+                            because no variation remains after simple filtering""", row['s_chrom'],
+                        row['s_pos'], row['sample'])
+                    continue
+            # reposition vphaser deletions minus one to be consistent with
+            # VCF conventions
+            if row['s_alt'].startswith('D'):
+                for a, n in row['allele_counts']:
+                    if a[0] not in ('D', 'i'):
+                        log.error("allele_counts: " + str(row['allele_counts']))
+                        raise Exception("deletion alleles must always start with D or i")
+                row['s_pos'] = row['s_pos'] - 1
+            data.append(row)
+
+        # map positions back to reference coordinates
+        if data:
+            s_pos = [row['s_pos'] for row in data]
+            starts = cm.map_positions(s, ref_sequence.id, s_pos, side=-1)
+            ends = cm.map_positions(s, ref_sequence.id, s_pos, side=1)
+            if not (starts.all() and ends.all()):
+                raise Exception('consensus extends beyond start or end of reference.')
+            for row, start, end in zip(data, starts, ends):
+                row['POS'] = int(start)
+                row['END'] = int(end)
+        per_sample_data.append(sorted(data, key=(lambda row: row['POS'])))
+
+    # merge the sorted iSNVs (across all samples) and group by position
+    data = heapq.merge(*per_sample_data, key=(lambda row: row['POS']))
+    data = itertools.groupby(data, lambda row: row['POS'])
+
+    out_rows = []
+    # define the length of each variation based on the largest deletion
+    groups = []
+    for pos, rows in data:
+        # each of the sample-specific variants for a given ref pos
+        rows = list(rows)
+        end = pos
+        for row in rows:
+            end = max(end, row['END'])
+            for a, n in row['allele_counts']:
+                if a.startswith('D'):
+                    # end of deletion in sample's coord space
+                    local_end = row['s_pos'] + int(a[1:])
+
+                    # end of deletion in reference coord space
+                    ref_end = cm.mapChr(row['s_chrom'], ref_sequence.id, local_end, side=1)[1]
+                    if ref_end is None:
+                        raise Exception('consensus extends ' 'beyond start or end of reference.')
+                    end = max(end, ref_end)
+        groups.append((pos, end, rows))
+
+    # map every variant's extent to each sample's consensus in one batch per sample
+    cons_starts, cons_stops = {}, {}
+    if groups:
+        for s in samplesToUse:
+            cons_starts[s] = cm.map_positions(ref_sequence.id, s, [pos for pos, end, rows in groups], side=-1)
+            cons_stops[s] = cm.map_positions(ref_sequence.id, s, [end for pos, end, rows in groups], side=1)
+
+    # process one reference position at a time
+    for i, (pos, end, rows) in enumerate(groups):
+        # find reference allele and consensus alleles
+        refAllele = str(ref_sequence[pos - 1:end].seq)
+        consAlleles = {}  # the full pos-to-end consensus assembly sequence for each sample
+        samp_offsets = {}  # {sample : isnv's index in its consAllele string}
+        for row in rows:
+            s_pos = row['s_pos']
+            sample = row['sample']
+            if samp_offsets.get(sample, s_pos) != s_pos:
+                raise NotImplementedError('Sample %s has variants at 2 '
+                                          'positions %s mapped to same reference position (%s:%s)' %
+                                          (sample, (s_pos, samp_offsets[sample]), ref_sequence.id, pos))
+            samp_offsets[sample] = s_pos
+        for s in samplesToUse:
+            # map ref to s
+            cons_start = int(cons_starts[s][i])
+            cons_stop = int(cons_stops[s][i])
+            if cons_start == 0 or cons_stop == 0:
+                log.info("variant is outside consensus assembly "
+                         "for %s at %s:%s-%s.", s, ref_sequence.id, pos, end)
+                continue
+
+            cons = samp_to_seqIndex[s]  # .seq.ungap('-')#[ cm.mapChr(ref_sequence.id, s) ]
+
+            allele = str(cons[cons_start - 1:cons_stop]).upper()
+            if s in samp_offsets:
+                samp_offsets[s] -= cons_start
+            if all(a in set(('A', 'C', 'T', 'G')) for a in allele):
+                consAlleles[s] = allele
+            else:
+                log.warning("dropping ambiguous consensus for %s at %s:%s-%s: %s", s, ref_sequence.id, pos,
+                            end, allele)
+
+        # define genotypes and fractions
+        iSNVs = {}  # {sample : {allele : fraction, ...}, ...}
+        iSNVs_read_depth = {}  # {sample: read depth}
+        iSNVs_n_libs = {}  # {sample : {allele : n libraries > 0, ...}, ...}
+        iSNVs_lib_bias = {}  # {sample : {allele : pval, ...}, ...}
+        for s in samplesToUse:
+            # get all rows for this sample and merge allele counts together
+            acounts = dict(itertools.chain.from_iterable(row['allele_counts'] for row in rows if
+                                                         row['sample'] == s))
+            nlibs = dict(itertools.chain.from_iterable(row['n_libs'].items() for row in rows if
+                                                       row['sample'] == s))
+            libbias = dict(itertools.chain.from_iterable(row['lib_bias'].items() for row in rows if
+                                                         row['sample'] == s))
+            if 'i' in acounts and 'd' in acounts:
+                # This sample has both an insertion line and a deletion line at the same spot!
+                # To keep the reference allele from be counted twice, once as an i and once
+                # as a d, average the counts and get rid of one of them.
+                acounts['i'] = int(round((acounts['i'] + acounts['d']) / 2.0, 0))
+                del acounts['d']
+                nlibs['i'] = max(nlibs['i'], nlibs['d'])
+                libbias['i'] = max(libbias['i'], libbias['d'])
+
+            if acounts and s in consAlleles:
+                # we have iSNV data on this sample
+                consAllele = consAlleles[s]
+                tot_n = sum(acounts.values())
+                iSNVs[s] = {}  # {allele : fraction, ...}
+                iSNVs_read_depth[s] = tot_n
+                iSNVs_n_libs[s] = {}
+                iSNVs_lib_bias[s] = {}
+                for orig_a, n in acounts.items():
+                    f = float(n) / tot_n
+                    a = orig_a
+                    if a.startswith('I'):
+                        # insertion point is relative to each sample
+                        insert_point = samp_offsets[s] + 1
+                        a = consAllele[:insert_point] + a[1:] + consAllele[insert_point:]
+                    elif a.startswith('D'):
+                        # deletion is the first consensus base, plus remaining
+                        # consensus seq with the first few positions dropped off
+                        cut_left = samp_offsets[s] + 1
+                        cut_right = samp_offsets[s] + 1 + int(a[1:])
+                        a = consAllele[:cut_left] + consAllele[cut_right:]
+                    elif a in ('i', 'd'):
+                        # this is vphaser's way of saying the "reference" (majority/consensus)
+                        # allele, in the face of other indel variants
+                        a = consAllele
+                    else:
+                        # this is a SNP
+                        if a not in set(('A', 'C', 'T', 'G')):
+                            raise Exception()
+                        if f > 0.5 and a != consAllele[samp_offsets[s]]:
+                            log.warning("vPhaser and assembly pipelines mismatch at "
+                                        "%s:%d (%s) - consensus %s, vPhaser %s, f %.3f", ref_sequence.id,
+                                        pos, s, consAllele[samp_offsets[s]], a, f)
+                        new_allele = list(consAllele)
+                        new_allele[samp_offsets[s]] = a
+                        a = ''.join(new_allele)
+                    if not (a and a == a.upper()):
+                        raise Exception()
+                    iSNVs[s][a] = f
+                    iSNVs_n_libs[s][a] = nlibs[orig_a]
+                    iSNVs_lib_bias[s][a] = libbias[orig_a]
+                if all(len(a) == 1 for a in iSNVs[s].keys()):
+                    if consAllele not in iSNVs[s]:
+                        raise Exception(
+                            """at %s:%s (%s), consensus allele %s
+                                not among iSNV alleles %s -- other cons alleles: %s""" % (
+                                ref_sequence.id, pos, s, consAllele, ', '.join(
+                                    iSNVs[s].keys()), ', '.join(
+                                        consAlleles[s])))
+            elif s in consAlleles:
+                # there is no iSNV data for this sample, so substitute the consensus allele
+                iSNVs[s] = {consAlleles[s]: 1.0}
+
+        # get unique alleles list for this position, in this order:
+        # first:   reference allele,
+        # next:    consensus allele for each sample, in descending order of
+        #          number of samples with that consensus,
+        # finally: all other alleles, sorted first by number of containing samples,
+        #          then by intrahost read frequency summed over the population,
+        #          then by the allele string itself.
+        alleles_cons = [alleleItem for alleleItem, n in sorted(util.misc.histogram(consAlleles.values()).items(),
+                                             key=lambda x: x[1],
+                                             reverse=True) if alleleItem != refAllele]
+        alleles_isnv = list(itertools.chain.from_iterable(
+            [iSNVs[s].items() for s in samplesToUse if s in iSNVs]))
+        alleles_isnv2 = []
+        for a in set(a for a, n in alleles_isnv):
+            counts = list(x[1] for x in alleles_isnv if x[0] == a)
+            if len(counts) > 0 and sum(counts) > 0:
+                # if we filtered any alleles above, make sure to omit absent alleles
+                alleles_isnv2.append((len(counts), sum(counts), a))
+            else:
+                log.info("dropped allele %s at position %s:%s", a, ref_sequence.id, pos)
+        alleles_isnv = list(allele for n_samples, n_reads, allele in reversed(sorted(alleles_isnv2)))
+        alleles = list(util.misc.unique([refAllele] + alleles_cons + alleles_isnv))
+
+        # map alleles from strings to numeric indexes
+        if not alleles:
+            raise Exception()
+        elif len(alleles) == 1:
+            # if we filtered any alleles above, skip this position if there is no variation left here
+            log.info("dropped position %s:%s due to lack of variation", ref_sequence.id, pos)
+            continue
+        alleleMap = dict((a, i) for i, a in enumerate(alleles))
+        # GT col emitted below
+        genos = [str(alleleMap.get(consAlleles.get(s), '.')) for s in samplesToUse]
+        # AF col emitted below, everything excluding the ref allele (one float per non-ref allele)
+        freqs = [(s in iSNVs) and ','.join(map(str, [iSNVs[s].get(a, 0.0) for a in alleles[1:]])) or '.'
+                 for s in samplesToUse]
+        # DP col emitted below
+        depths = [str(iSNVs_read_depth.get(s, '.')) for s in samplesToUse]
+        # NL col, everything including the ref allele (one int per allele)
+        nlibs = [(s in iSNVs_n_libs) and ','.join([str(iSNVs_n_libs[s].get(a, 0)) for a in alleles]) or '.'
+                 for s in samplesToUse]
+        # LB col, everything including the ref allele (one float per allele)
+        pvals = [(s in iSNVs_lib_bias) and ','.join([str(iSNVs_lib_bias[s].get(a, '.')) for a in alleles])
+                 or '.' for s in samplesToUse]
+
+        # prepare output row
+        out = [out_chrom, pos, '.', alleles[0], ','.join(alleles[1:]), '.', '.', '.', 'GT:AF:DP:NL:LB']
+        out = out + list(map(':'.join, zip(genos, freqs, depths, nlibs, pvals)))
+        out_rows.append('\t'.join(map(str, out)) + '\n')
+    return out_rows
 
 
 def parser_merge_to_vcf(parser=argparse.ArgumentParser()):
@@ -927,7 +1003,7 @@ def parser_merge_to_vcf(parser=argparse.ArgumentParser()):
                         dest="parse_accession",
                         help="""If set, parse only the accession for the chromosome name.
         Helpful if snpEff has to create its own database""")
-    util.cmd.common_args(parser, (('loglevel', None), ('version', None)))
+    util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None)))
     util.cmd.attach_main(parser, merge_to_vcf, split_args=True)
     return parser
 
@@ -7,12 +7,16 @@ from __future__ import division
 __author__ = "yesimon@broadinstitute.org"
 
 import argparse
+import array
 import collections
+import collections.abc
 import csv
-import gzip
 import io
 import itertools
 import logging
+import mmap
+import multiprocessing
+import numbers
 import os.path
 from os.path import join
 import operator
@@ -23,14 +27,10 @@ import sys
 import tempfile
 import json
 
-from Bio import SeqIO
-from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
-import pysam
-
 import util.cmd
 import util.file
 import util.misc
+import read_utils
 import tools.kaiju
 import tools.kraken
 import tools.krona
@@ -61,6 +61,10 @@ class TaxonomyDb(object):
     """
         This class loads NCBI taxonomy information from:
         ftp://ftp.ncbi.nlm.nih.gov/pub/taxonomy/
+
+        If a binary index built by `taxonomy_index` exists alongside the
+        .dmp files (and is newer than them), it is memory-mapped instead
+        of parsing the .dmp files.
     """
 
     def __init__(
@@ -74,7 +78,8 @@ class TaxonomyDb(object):
         names_path=None,
         load_gis=False,
         load_nodes=False,
-        load_names=False
+        load_names=False,
+        index_dir=None
     ):
         if tax_dir:
             gis_paths = [maybe_compressed(join(tax_dir, 'gi_taxid_nucl.dmp')),
@@ -85,9 +90,18 @@ class TaxonomyDb(object):
         self.gis_paths = gis_paths
         self.nodes_path = nodes_path
         self.names_path = names_path
+        if index_dir is None:
+            if tax_dir:
+                index_dir = join(tax_dir, TAXONOMY_INDEX_DIR)
+            elif nodes_path or names_path:
+                index_dir = join(os.path.dirname(nodes_path or names_path), TAXONOMY_INDEX_DIR)
+        self.index = TaxonomyIndex(index_dir) if index_dir else None
         if load_gis:
             if gis:
                 self.gis = gis
+            elif gis_paths and self.index and self.index.is_current('gis', gis_paths):
+                log.info('Mapping taxonomy gis index: %s', self.index.index_dir)
+                self.gis = self.index.load_gis()
             elif gis_paths:
                 self.gis = {}
                 for gi_path in gis_paths:
@@ -96,12 +110,18 @@ class TaxonomyDb(object):
         if load_nodes:
             if nodes:
                 self.ranks, self.parents = nodes
+            elif nodes_path and self.index and self.index.is_current('nodes', [nodes_path]):
+                log.info('Mapping taxonomy nodes index: %s', self.index.index_dir)
+                self.ranks, self.parents = self.index.load_nodes()
             elif nodes_path:
                 log.info('Loading taxonomy nodes: %s', nodes_path)
                 self.ranks, self.parents = self.load_nodes(nodes_path)
         if load_names:
             if names:
                 self.names = names
+            elif names_path and self.index and self.index.is_current('names', [names_path]):
+                log.info('Mapping taxonomy names index: %s', self.index.index_dir)
+                self.names = self.index.load_names()
             elif names_path:
                 log.info('Loading taxonomy names: %s', names_path)
                 self.names = self.load_names(names_path)
@@ -154,6 +174,398 @@ class TaxonomyDb(object):
                 ranks[taxid] = rank
         return ranks, parents
 
+    @property
+    def lca(self):
+        '''TaxonomyLca engine over self.parents, built on first use.'''
+        if getattr(self, '_lca', None) is None or self._lca.parents is not self.parents:
+            self._lca = TaxonomyLca(self.parents)
+        return self._lca
+
+
+TAXONOMY_INDEX_DIR = 'index'
+
+
+class TaxonomyArrayMap(collections.abc.Mapping):
+    '''Read-only dict-like view of an array indexed by taxid.
+
+    Entries equal to `missing` are treated as absent keys. If `labels` is
+    given, array values are codes into that list.
+    '''
+
+    def __init__(self, values, missing=0, labels=None):
+        self.values = values
+        self.missing = missing
+        self.labels = labels
+
+    def __getitem__(self, taxid):
+        if not isinstance(taxid, numbers.Integral) or not 0 <= taxid < len(self.values):
+            raise KeyError(taxid)
+        value = self.values[taxid]
+        if value == self.missing:
+            raise KeyError(taxid)
+        return self.labels[value] if self.labels is not None else int(value)
+
+    def _present(self):
+        import numpy
+        return numpy.flatnonzero(self.values != self.missing)
+
+    def __iter__(self):
+        return iter(self._present().tolist())
+
+    def __len__(self):
+        import numpy
+        return int(numpy.count_nonzero(self.values != self.missing))
+
+    def items(self):
+        taxids = self._present()
+        values = self.values[taxids].tolist()
+        if self.labels is not None:
+            values = [self.labels[v] for v in values]
+        return zip(taxids.tolist(), values)
+
+
+class TaxonomyNamesMap(collections.abc.Mapping):
+    '''Read-only dict-like view of taxid -> scientific name, backed by an
+    offsets array (indexed by taxid) into a utf-8 names blob.
+    '''
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __getitem__(self, taxid):
+        if not isinstance(taxid, numbers.Integral) or not 0 <= taxid < len(self.offsets) - 1:
+            raise KeyError(taxid)
+        start, end = int(self.offsets[taxid]), int(self.offsets[taxid + 1])
+        if start == end:
+            raise KeyError(taxid)
+        return self.blob[start:end].decode('utf-8')
+
+    def _present(self):
+        import numpy
+        return numpy.flatnonzero(numpy.diff(self.offsets))
+
+    def __iter__(self):
+        return iter(self._present().tolist())
+
+    def __len__(self):
+        return len(self._present())
+
+
+class GiTaxidMap(collections.abc.Mapping):
+    '''Read-only dict-like view of gi -> taxid, backed by a sorted gi array
+    and a parallel taxid array.
+    '''
+
+    def __init__(self, gis, taxids):
+        self.gis = gis
+        self.taxids = taxids
+
+    def __getitem__(self, gi):
+        i = int(self.gis.searchsorted(gi))
+        if i < len(self.gis) and self.gis[i] == gi:
+            return int(self.taxids[i])
+        raise KeyError(gi)
+
+    def lookup(self, gis):
+        '''Vectorized lookup of an array of gis. Missing gis map to taxid 0.'''
+        import numpy
+        gis = numpy.asarray(gis, dtype=self.gis.dtype)
+        if not len(self.gis):
+            return numpy.zeros(len(gis), dtype=self.taxids.dtype)
+        idx = numpy.minimum(numpy.searchsorted(self.gis, gis), len(self.gis) - 1)
+        return numpy.where(self.gis[idx] == gis, self.taxids[idx], 0)
+
+    def __iter__(self):
+        return iter(self.gis.tolist())
+
+    def __len__(self):
+        return len(self.gis)
+
+
+class TaxonomyLca(object):
+    '''
+        Lowest common ancestor queries over a taxonomy tree.
+
+        Node depths and binary-lifting ancestor tables (the 2^k-th ancestor
+        of every node) are computed once from a parents mapping, as numpy
+        arrays indexed by taxid. An ancestor at any given depth is then
+        found in O(log depth) steps, and the exact LCA of a group of nodes
+        by a binary search over depth. Nodes whose parent chain does not
+        reach the root (taxid 1) have depth -1.
+    '''
+
+    # cap on table levels, only reached if the parents mapping has cycles
+    MAX_LEVELS = 32
+
+    def __init__(self, parents):
+        import numpy
+        self.parents = parents
+        if isinstance(parents, TaxonomyArrayMap):
+            parent_arr = numpy.array(parents.values, dtype=numpy.int32)
+        else:
+            taxids = numpy.fromiter(parents.keys(), dtype=numpy.int64, count=len(parents))
+            parent_taxids = numpy.fromiter(parents.values(), dtype=numpy.int64, count=len(parents))
+            size = max(int(taxids.max()) if len(taxids) else 0,
+                       int(parent_taxids.max()) if len(parent_taxids) else 0, 1) + 1
+            parent_arr = numpy.zeros(size, dtype=numpy.int32)
+            parent_arr[taxids] = parent_taxids
+        if len(parent_arr) < 2:
+            parent_arr = numpy.resize(parent_arr, 2)
+        # 0 is the sentinel for a missing parent; the root is its own parent
+        parent_arr[(parent_arr < 0) | (parent_arr >= len(parent_arr))] = 0
+        parent_arr[0] = 0
+        parent_arr[1] = 1
+
+        self.up = [parent_arr]
+        while len(self.up) < self.MAX_LEVELS:
+            last = self.up[-1]
+            nxt = last[last]
+            if numpy.array_equal(nxt, last):
+                break
+            self.up.append(nxt)
+
+        valid = self.up[-1] == 1
+        depth = numpy.zeros(len(parent_arr), dtype=numpy.int32)
+        cur = numpy.arange(len(parent_arr), dtype=numpy.int32)
+        for k in reversed(range(len(self.up))):
+            nxt = self.up[k][cur]
+            jump = nxt > 1
+            cur = numpy.where(jump, nxt, cur)
+            depth += jump.astype(numpy.int32) << k
+        depth += 1
+        depth[1] = 0
+        depth[~valid] = -1
+        self.depth = depth
+
+    def depths(self, taxids):
+        '''Depth of each taxid (the root has depth 0), -1 if unknown or not rooted.'''
+        import numpy
+        taxids = numpy.asarray(taxids, dtype=numpy.int64)
+        known = (taxids >= 0) & (taxids < len(self.depth))
+        return numpy.where(known, self.depth[numpy.where(known, taxids, 0)], -1)
+
+    def ancestors_at_depth(self, taxids, depth):
+        '''Ancestor of each (rooted) taxid at the given depth, which may be an
+        array parallel to taxids. Depth must not exceed each taxid's own depth.'''
+        import numpy
+        nodes = numpy.asarray(taxids, dtype=numpy.int64)
+        lift = self.depth[nodes] - depth
+        for k, table in enumerate(self.up):
+            jump = ((lift >> k) & 1).astype(bool)
+            nodes = numpy.where(jump, table[nodes], nodes)
+        return nodes
+
+    def lca(self, taxids):
+        '''Exact lowest common ancestor of rooted taxids, None if there are none.'''
+        import numpy
+        taxids = numpy.asarray(taxids, dtype=numpy.int64)
+        taxids = taxids[self.depths(taxids) >= 0]
+        if not len(taxids):
+            return None
+        return self._group_lcas(taxids, numpy.array([0]))[0]
+
+    def _group_lcas(self, nodes, starts):
+        '''Exact LCA of each group of rooted nodes; groups are the non-empty slices
+        of nodes beginning at each of the (increasing) starts offsets.'''
+        import numpy
+        group = numpy.repeat(numpy.arange(len(starts)), numpy.diff(numpy.append(starts, len(nodes))))
+        lo = numpy.zeros(len(starts), dtype=numpy.int64)
+        hi = numpy.minimum.reduceat(self.depth[nodes], starts).astype(numpy.int64)
+        # the deepest depth at which all ancestors of a group are the same node
+        while (lo < hi).any():
+            mid = (lo + hi + 1) // 2
+            anc = self.ancestors_at_depth(nodes, mid[group])
+            same = numpy.minimum.reduceat(anc, starts) == numpy.maximum.reduceat(anc, starts)
+            lo = numpy.where(same, mid, lo)
+            hi = numpy.where(same, hi, mid - 1)
+        return self.ancestors_at_depth(nodes[starts], lo).tolist()
+
+    def coverage_lca(self, query_ids, lca_percent=100):
+        '''See metagenomics.coverage_lca.'''
+        return self.coverage_lcas([query_ids], lca_percent=lca_percent)[0]
+
+    def coverage_lcas(self, groups, lca_percent=100):
+        '''coverage_lca of each of a list of query id groups, vectorized across groups.'''
+        import numpy
+        results = [None] * len(groups)
+        lengths = numpy.fromiter((len(g) for g in groups), dtype=numpy.int64, count=len(groups))
+        if not lengths.sum():
+            return results
+        nodes = numpy.fromiter(itertools.chain.from_iterable(groups), dtype=numpy.int64, count=int(lengths.sum()))
+        depths = self.depths(nodes)
+        for taxid in nodes[depths < 0].tolist():
+            log.warning('Parent for query id: {} missing'.format(taxid))
+        offsets = numpy.concatenate(([0], numpy.cumsum(lengths)))
+        group_ids = numpy.repeat(numpy.arange(len(groups)), lengths)
+
+        if lca_percent >= 100:
+            # a group is only covered beneath the root if every query in it is rooted
+            n_rooted = numpy.bincount(group_ids, weights=depths >= 0, minlength=len(groups)).astype(numpy.int64)
+            for i in numpy.flatnonzero((n_rooted > 0) & (n_rooted < lengths)).tolist():
+                results[i] = 1
+            exact = numpy.flatnonzero((n_rooted > 0) & (n_rooted == lengths))
+            if len(exact):
+                in_exact = numpy.zeros(len(groups), dtype=bool)
+                in_exact[exact] = True
+                starts = numpy.concatenate(([0], numpy.cumsum(lengths[exact])[:-1]))
+                for i, taxid in zip(exact.tolist(), self._group_lcas(nodes[in_exact[group_ids]], starts)):
+                    results[i] = taxid
+            return results
+
+        for i in range(len(groups)):
+            group_depths = depths[offsets[i]:offsets[i + 1]]
+            rooted = nodes[offsets[i]:offsets[i + 1]][group_depths >= 0]
+            group_depths = group_depths[group_depths >= 0]
+            if not len(rooted):
+                continue
+            lca_needed = lca_percent / 100 * lengths[i]
+            last_common = 1
+            for level in range(int(group_depths.max()) + 1):
+                level_nodes = rooted[group_depths >= level]
+                ancestors = self.ancestors_at_depth(level_nodes, level)
+                # most common ancestor at this level, ties going to the first seen
+                taxids, first, counts = numpy.unique(ancestors, return_index=True, return_counts=True)
+                best = numpy.flatnonzero(counts == counts.max())
+                best = best[numpy.argmin(first[best])]
+                if counts[best] >= lca_needed:
+                    last_common = int(taxids[best])
+                else:
+                    break
+            results[i] = last_common
+        return results
+
+
+class TaxonomyIndex(object):
+    '''
+        Compact, array-backed binary index of an NCBI taxonomy db directory.
+
+        The index consists of numpy arrays (parents and rank codes indexed
+        by taxid, sorted gi and parallel taxid arrays) plus an
+        offset-indexed blob of scientific names. Files are memory-mapped
+        on load, so concurrent processes share one page-cached copy.
+    '''
+
+    COMPONENTS = {
+        'nodes': ('parents.npy', 'ranks.npy', 'ranks.json'),
+        'names': ('names.npy', 'names.bin'),
+        'gis': ('gis.npy', 'gi_taxids.npy'),
+    }
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+
+    def path(self, fn):
+        return join(self.index_dir, fn)
+
+    def is_current(self, component, source_paths):
+        '''Whether the index files for this component exist and are at
+        least as new as all of the source files.'''
+        try:
+            index_mtime = min(os.path.getmtime(self.path(fn)) for fn in self.COMPONENTS[component])
+            source_mtime = max(os.path.getmtime(fn) for fn in source_paths)
+        except OSError:
+            return False
+        return index_mtime >= source_mtime
+
+    def _load_array(self, fn):
+        import numpy
+        return numpy.load(self.path(fn), mmap_mode='r')
+
+    def _save_array(self, fn, arr):
+        import numpy
+        # write to a temp file and rename so concurrent readers never see a partial file
+        tmp_path = self.path(fn) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            numpy.save(f, arr)
+        os.replace(tmp_path, self.path(fn))
+
+    def _save_bytes(self, fn, data):
+        tmp_path = self.path(fn) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path(fn))
+
+    def load_nodes(self):
+        '''Return (ranks, parents) mappings.'''
+        with open(self.path('ranks.json'), 'rt') as f:
+            rank_labels = json.load(f)
+        ranks = TaxonomyArrayMap(self._load_array('ranks.npy'), labels=rank_labels)
+        parents = TaxonomyArrayMap(self._load_array('parents.npy'))
+        return ranks, parents
+
+    def load_names(self):
+        offsets = self._load_array('names.npy')
+        if os.path.getsize(self.path('names.bin')):
+            with open(self.path('names.bin'), 'rb') as f:
+                blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            blob = b''
+        return TaxonomyNamesMap(offsets, blob)
+
+    def load_gis(self):
+        return GiTaxidMap(self._load_array('gis.npy'), self._load_array('gi_taxids.npy'))
+
+    def build_nodes(self, ranks, parents):
+        import numpy
+        max_taxid = max(parents) if parents else 0
+        parents_arr = numpy.zeros(max_taxid + 1, dtype=numpy.int32)
+        parents_arr[list(parents.keys())] = list(parents.values())
+
+        # code 0 is reserved for taxids not present in nodes.dmp
+        rank_labels = [None] + sorted(set(ranks.values()))
+        rank_codes = {rank: i for i, rank in enumerate(rank_labels)}
+        ranks_arr = numpy.zeros(max_taxid + 1, dtype=numpy.uint8 if len(rank_labels) < 256 else numpy.uint16)
+        ranks_arr[list(ranks.keys())] = [rank_codes[r] for r in ranks.values()]
+
+        self._save_array('parents.npy', parents_arr)
+        self._save_array('ranks.npy', ranks_arr)
+        with open(self.path('ranks.json.tmp'), 'wt') as f:
+            json.dump(rank_labels, f)
+        os.replace(self.path('ranks.json.tmp'), self.path('ranks.json'))
+
+    def build_names(self, names):
+        import numpy
+        encoded = {taxid: name.encode('utf-8') for taxid, name in names.items()}
+        max_taxid = max(encoded) if encoded else 0
+        lengths = numpy.zeros(max_taxid + 1, dtype=numpy.int64)
+        lengths[list(encoded.keys())] = [len(name) for name in encoded.values()]
+        offsets = numpy.zeros(max_taxid + 2, dtype=numpy.int64)
+        numpy.cumsum(lengths, out=offsets[1:])
+        self._save_bytes('names.bin', b''.join(encoded[taxid] for taxid in sorted(encoded)))
+        self._save_array('names.npy', offsets)
+
+    def build_gis(self, gis_paths):
+        import numpy
+        gis = array.array('q')
+        taxids = array.array('q')
+        for gi_path in gis_paths:
+            log.info('Indexing taxonomy gis: %s', gi_path)
+            with open_or_gzopen(gi_path, 'rt') as f:
+                for line in f:
+                    gi, taxid = line.split('\t')
+                    gis.append(int(gi))
+                    taxids.append(int(taxid))
+        gis = numpy.frombuffer(gis, dtype=numpy.int64) if gis else numpy.zeros(0, dtype=numpy.int64)
+        taxids = numpy.frombuffer(taxids, dtype=numpy.int64) if taxids else numpy.zeros(0, dtype=numpy.int64)
+        order = numpy.argsort(gis, kind='mergesort')
+        self._save_array('gis.npy', gis[order])
+        self._save_array('gi_taxids.npy', taxids[order].astype(numpy.int32))
+
+    def build(self, tax_dir, skip_gis=False):
+        '''Build the index from the .dmp files of a taxonomy db directory.'''
+        util.file.mkdir_p(self.index_dir)
+        db = TaxonomyDb(index_dir=False)
+        nodes_path = maybe_compressed(join(tax_dir, 'nodes.dmp'))
+        log.info('Indexing taxonomy nodes: %s', nodes_path)
+        self.build_nodes(*db.load_nodes(nodes_path))
+        names_path = maybe_compressed(join(tax_dir, 'names.dmp'))
+        log.info('Indexing taxonomy names: %s', names_path)
+        self.build_names(db.load_names(names_path))
+        if not skip_gis:
+            self.build_gis([maybe_compressed(join(tax_dir, 'gi_taxid_nucl.dmp')),
+                            maybe_compressed(join(tax_dir, 'gi_taxid_prot.dmp'))])
+
 
 BlastRecord = collections.namedtuple(
     'BlastRecord', [
@@ -213,7 +625,7 @@ def extract_tax_id(sam1):
         raise TaxIdError(parts)
 
 
-def sam_lca(db, sam_file, output=None, top_percent=10, unique_only=True):
+def sam_lca(db, sam_file, output=None, top_percent=10, unique_only=True, threads=None):
     ''' Calculate the LCA taxonomy id for multi-mapped reads in a samfile.
 
     Assumes the sam is sorted by query name. Writes tsv output: query_id \t tax_id.
@@ -224,32 +636,35 @@ def sam_lca(db, sam_file, output=None, top_percent=10, unique_only=True):
       output: (io) Output file.
       top_percent: (float) Only this percent within top hit are used.
       unique_only: (bool) If true, only output assignments for unique, mapped reads. If False, set unmapped or duplicate reads as unclassified.
+      threads: (int) Number of worker processes computing LCAs.
 
     Return:
       (collections.Counter) Counter of taxid hits
     '''
 
-    c = collections.Counter()
-    with pysam.AlignmentFile(sam_file, 'rb') as sam:
+    import pysam
+    def queries(sam):
         seg_groups = (v for k, v in itertools.groupby(sam, operator.attrgetter('query_name')))
         for seg_group in seg_groups:
             segs = list(seg_group)
-            query_name = segs[0].query_name
             # 0x4 is unmapped, 0x400 is duplicate
             mapped_segs = [seg for seg in segs if seg.flag & 0x4 == 0 and seg.flag & 0x400 == 0]
-            if unique_only and not mapped_segs:
-                continue
-
             if mapped_segs:
-                tax_id = process_sam_hits(db, mapped_segs, top_percent)
-                if tax_id is None:
-                    log.warning('Query: {} has no valid taxonomy paths.'.format(query_name))
-                    if unique_only:
-                        continue
-                    else:
-                        tax_id = 0
-            else:
+                yield segs[0].query_name, sam_hits_tax_ids(mapped_segs, top_percent)
+            elif not unique_only:
+                yield segs[0].query_name, None
+
+    c = collections.Counter()
+    with pysam.AlignmentFile(sam_file, 'rb') as sam:
+        for query_name, tax_ids, tax_id in batch_coverage_lca(db, queries(sam), threads=threads):
+            if tax_ids is None:
                 tax_id = 0
+            elif tax_id is None:
+                log.warning('Query: {} has no valid taxonomy paths.'.format(query_name))
+                if unique_only:
+                    continue
+                else:
+                    tax_id = 0
 
             if output:
                 classified = 'C' if tax_id else 'U'
@@ -264,7 +679,8 @@ def blast_lca(db,
               paired=False,
               min_bit_score=50,
               max_expected_value=0.01,
-              top_percent=10,):
+              top_percent=10,
+              threads=None):
     '''Calculate the LCA taxonomy id for groups of blast hits.
 
     Writes tsv output: query_id \t tax_id
@@ -277,23 +693,55 @@ def blast_lca(db,
       min_bit_score: (float) Minimum bit score or discard.
       max_expected_value: (float) Maximum e-val or discard.
       top_percent: (float) Only this percent within top hit are used.
+      threads: (int) Number of worker processes computing LCAs.
     '''
     records = blast_records(m8_file)
     records = (r for r in records if r.e_val <= max_expected_value)
     records = (r for r in records if r.bit_score >= min_bit_score)
     if paired:
         records = (paired_query_id(rec) for rec in records)
-    blast_groups = (v for k, v in itertools.groupby(records, operator.attrgetter('query_id')))
-    for blast_group in blast_groups:
-        blast_group = list(blast_group)
-        tax_id = process_blast_hits(db, blast_group, top_percent)
-        query_id = blast_group[0].query_id
+    blast_groups = (list(v) for k, v in itertools.groupby(records, operator.attrgetter('query_id')))
+    queries = ((blast_group[0].query_id, blast_hits_tax_ids(db, blast_group, top_percent))
+               for blast_group in blast_groups)
+    for query_id, tax_ids, tax_id in batch_coverage_lca(db, queries, threads=threads):
         if not tax_id:
             log.debug('Query: {} has no valid taxonomy paths.'.format(query_id))
         classified = 'C' if tax_id else 'U'
         output.write('{}\t{}\t{}\n'.format(classified, query_id, tax_id))
 
 
+def sam_hits_tax_ids(sam_hits, top_percent):
+    '''Tax ids of the sam hits within top_percent of the best alignment score,
+    best first.'''
+    best_score = max(hit.get_tag('AS') for hit in sam_hits)
+    cutoff_alignment_score = (100 - top_percent) / 100 * best_score
+    valid_hits = (hit for hit in sam_hits if hit.get_tag('AS') >= cutoff_alignment_score)
+    valid_hits = list(valid_hits)
+    # Sort requires realized list
+    valid_hits.sort(key=lambda sam1: sam1.get_tag('AS'), reverse=True)
+
+    return [extract_tax_id(hit) for hit in valid_hits]
+
+
+def blast_hits_tax_ids(db, hits, top_percent):
+    '''Tax ids of the blast hits within top_percent of the best bit score,
+    best first, or None if no hit has a known taxonomy.'''
+    hits = (translate_gi_to_tax_id(db, hit) for hit in hits)
+
+    hits = [hit for hit in hits if hit.subject_id != 0]
+    if len(hits) == 0:
+        return
+
+    best_score = max(hit.bit_score for hit in hits)
+    cutoff_bit_score = (100 - top_percent) / 100 * best_score
+    valid_hits = (hit for hit in hits if hit.bit_score >= cutoff_bit_score)
+    valid_hits = list(valid_hits)
+    # Sort requires realized list
+    valid_hits.sort(key=operator.attrgetter('bit_score'), reverse=True)
+    if valid_hits:
+        return tuple(itertools.chain(*(blast_m8_taxids(hit) for hit in valid_hits)))
+
+
 def process_sam_hits(db, sam_hits, top_percent):
     '''Filter groups of blast hits and perform lca.
 
@@ -305,15 +753,7 @@ def process_sam_hits(db, sam_hits, top_percent):
     Return:
       (int) Tax id of LCA.
     '''
-    best_score = max(hit.get_tag('AS') for hit in sam_hits)
-    cutoff_alignment_score = (100 - top_percent) / 100 * best_score
-    valid_hits = (hit for hit in sam_hits if hit.get_tag('AS') >= cutoff_alignment_score)
-    valid_hits = list(valid_hits)
-    # Sort requires realized list
-    valid_hits.sort(key=lambda sam1: sam1.get_tag('AS'), reverse=True)
-
-    tax_ids = [extract_tax_id(hit) for hit in valid_hits]
-    return coverage_lca(tax_ids, db.parents)
+    return coverage_lca(sam_hits_tax_ids(sam_hits, top_percent), db.lca)
 
 
 def process_blast_hits(db, hits, top_percent):
@@ -327,21 +767,9 @@ def process_blast_hits(db, hits, top_percent):
     Return:
       (int) Tax id of LCA.
     '''
-    hits = (translate_gi_to_tax_id(db, hit) for hit in hits)
-
-    hits = [hit for hit in hits if hit.subject_id != 0]
-    if len(hits) == 0:
-        return
-
-    best_score = max(hit.bit_score for hit in hits)
-    cutoff_bit_score = (100 - top_percent) / 100 * best_score
-    valid_hits = (hit for hit in hits if hit.bit_score >= cutoff_bit_score)
-    valid_hits = list(valid_hits)
-    # Sort requires realized list
-    valid_hits.sort(key=operator.attrgetter('bit_score'), reverse=True)
-    if valid_hits:
-        tax_ids = tuple(itertools.chain(*(blast_m8_taxids(hit) for hit in valid_hits)))
-        return coverage_lca(tax_ids, db.parents)
+    tax_ids = blast_hits_tax_ids(db, hits, top_percent)
+    if tax_ids:
+        return coverage_lca(tax_ids, db.lca)
 
 
 def coverage_lca(query_ids, parents, lca_percent=100):
@@ -349,39 +777,71 @@ def coverage_lca(query_ids, parents, lca_percent=100):
 
     Args:
       query_ids: []int list of nodes.
-      parents: []int array of parents.
+      parents: (TaxonomyLca) LCA engine, e.g. TaxonomyDb.lca. A mapping of
+        parents is also accepted, but an engine is then built on every call.
       lca_percent: (float) Cover at least this percent of queries.
 
     Return:
       (int) LCA
     '''
-    lca_needed = lca_percent / 100 * len(query_ids)
-    paths = []
-    for query_id in query_ids:
-        path = []
-        while query_id != 1:
-            path.append(query_id)
-            if parents.get(query_id, 0) == 0:
-                log.warning('Parent for query id: {} missing'.format(query_id))
-                break
-            query_id = parents[query_id]
-        if query_id == 1:
-            path.append(1)
-            path = list(reversed(path))
-            paths.append(path)
-    if not paths:
+    if not isinstance(parents, TaxonomyLca):
+        parents = TaxonomyLca(parents)
+    return parents.coverage_lca(query_ids, lca_percent=lca_percent)
+
+
+LCA_BATCH_SIZE = 10000
+
+# per-process LCA engine of the batch_coverage_lca worker pool
+_worker_lca = None
+
+
+def _init_lca_worker(lca):
+    global _worker_lca
+    _worker_lca = lca
+
+
+def _lca_worker_batch(groups, lca_percent):
+    return _worker_lca.coverage_lcas(groups, lca_percent=lca_percent)
+
+
+def batch_coverage_lca(db, queries, lca_percent=100, threads=None, batch_size=LCA_BATCH_SIZE):
+    '''Calculate coverage_lca for a stream of (query_id, tax_ids) pairs.
+
+    Queries are processed in batches, vectorized within a batch and spread
+    across worker processes (each holding one copy of the LCA engine).
+    Yields (query_id, tax_ids, lca) in input order; queries whose tax_ids
+    are empty or None yield an lca of None.
+    '''
+    threads = util.misc.sanitize_thread_count(threads)
+    batches = util.misc.batch_iterator(queries, batch_size)
+
+    def results(batch, lcas):
+        for (query_id, tax_ids), tax_id in zip(batch, lcas):
+            yield query_id, tax_ids, tax_id
+
+    if threads == 1:
+        for batch in batches:
+            for result in results(batch, db.lca.coverage_lcas([tax_ids or () for _, tax_ids in batch], lca_percent)):
+                yield result
         return
 
-    last_common = 1
-    max_path_length = max(len(path) for path in paths)
-    for level in range(max_path_length):
-        valid_paths = (path for path in paths if len(path) > level)
-        max_query_id, hits_covered = collections.Counter(path[level] for path in valid_paths).most_common(1)[0]
-        if hits_covered >= lca_needed:
-            last_common = max_query_id
-        else:
-            break
-    return last_common
+    # bound the number of batches in flight so the input is not read ahead without limit
+    pool = multiprocessing.Pool(threads, initializer=_init_lca_worker, initargs=(db.lca,))
+    try:
+        pending = collections.deque()
+        for batch in batches:
+            pending.append((batch, pool.apply_async(_lca_worker_batch,
+                                                    ([tax_ids or () for _, tax_ids in batch], lca_percent))))
+            if len(pending) >= 2 * threads:
+                batch, lcas = pending.popleft()
+                for result in results(batch, lcas.get()):
+                    yield result
+        while pending:
+            batch, lcas = pending.popleft()
+            for result in results(batch, lcas.get()):
+                yield result
+    finally:
+        pool.terminate()
 
 
 def tree_level_lookup(parents, node, level_cache):
@@ -649,6 +1109,34 @@ def subset_taxonomy(taxDb, outputDb, whitelistTaxids=None, whitelistTaxidFile=No
 __commands__.append(('subset_taxonomy', parser_subset_taxonomy))
 
 
+def parser_taxonomy_index(parser=argparse.ArgumentParser()):
+    parser.add_argument(
+        "taxDb",
+        help="Taxonomy database directory (containing nodes.dmp, names.dmp etc.)",
+    )
+    parser.add_argument(
+        "--outDir",
+        help="Output index directory (default: the '{}' subdirectory of taxDb, where it is found automatically)".format(TAXONOMY_INDEX_DIR),
+    )
+    parser.add_argument(
+        "--skipGi", action='store_true',
+        help="Skip GI to taxid mapping files"
+    )
+    util.cmd.common_args(parser, (('loglevel', None), ('version', None)))
+    util.cmd.attach_main(parser, taxonomy_index, split_args=True)
+    return parser
+def taxonomy_index(taxDb, outDir=None, skipGi=False):
+    '''
+    Build a binary, memory-mappable index of a taxonomy db directory. This is
+    a one-time step: when the index exists in the default location and is
+    newer than the .dmp files, TaxonomyDb maps it instead of re-parsing
+    nodes.dmp, names.dmp and the gi_taxid_*.dmp files, so concurrent jobs
+    share one page-cached copy.
+    '''
+    TaxonomyIndex(outDir or join(taxDb, TAXONOMY_INDEX_DIR)).build(taxDb, skip_gis=skipGi)
+__commands__.append(('taxonomy_index', parser_taxonomy_index))
+
+
 def rank_code(rank):
     '''Get the short 1 letter rank code for named ranks.'''
     if rank == "species":
@@ -775,7 +1263,7 @@ def krona(inReport, db, outHtml, queryColumn=None, taxidColumn=None, scoreColumn
         root_name = os.path.basename(inReport)
         if inReport.endswith('.gz'):
             tmp_tsv = util.file.mkstempfname('.tsv')
-            with gzip.open(inReport, 'rb') as f_in:
+            with util.file.open_or_gzopen(inReport, 'rb') as f_in:
                 with open(tmp_tsv, 'wb') as f_out:
                     shutil.copyfileobj(f_in, f_out)
                     to_import = [tmp_tsv]
@@ -861,7 +1349,7 @@ def kaiju(inBam, db, taxDb, outReport, outReads=None, threads=None):
 __commands__.append(('kaiju', parser_kaiju))
 
 
-def sam_lca_report(tax_db, bam_aligned, outReport, outReads=None, unique_only=None):
+def sam_lca_report(tax_db, bam_aligned, outReport, outReads=None, unique_only=None, threads=None):
 
     if outReads:
         lca_tsv = outReads
@@ -869,7 +1357,7 @@ def sam_lca_report(tax_db, bam_aligned, outReport, outReads=None, unique_only=No
         lca_tsv = util.file.mkstempfname('.tsv')
 
     with util.file.open_or_gzopen(lca_tsv, 'wt') as lca:
-        hits = sam_lca(tax_db, bam_aligned, lca, top_percent=10, unique_only=unique_only)
+        hits = sam_lca(tax_db, bam_aligned, lca, top_percent=10, unique_only=unique_only, threads=threads)
 
     with open(outReport, 'w') as f:
 
@@ -953,6 +1441,7 @@ __commands__.append(('report_merge', parser_metagenomic_report_merge))
 
 def fasta_library_accessions(library):
     '''Parse accession from ids of fasta files in library directory. '''
+    from Bio import SeqIO
     library_accessions = set()
     for dirpath, dirnames, filenames in os.walk(library, followlinks=True):
         for filename in filenames:
@@ -1045,36 +1534,29 @@ def filter_bam_to_taxa(in_bam, read_IDs_to_tax_IDs, out_bam,
 
     tax_ids_to_include = frozenset(tax_ids_to_include) # frozenset membership check slightly faster
 
-    # perform the actual filtering to return a list of read IDs, writeen to a temp file
-    with util.file.tempfname(".txt.gz") as temp_read_list:
-        with open_or_gzopen(temp_read_list, "wt") as read_IDs_file:
-            read_ids_written = 0
-            for row in util.file.read_tabfile(read_IDs_to_tax_IDs):
-                assert tax_id_col<len(row), "tax_id_col does not appear to be in range for number of columns present in mapping file"
-                assert read_id_col<len(row), "read_id_col does not appear to be in range for number of columns present in mapping file"
-                read_id = row[read_id_col]
-                read_tax_id = int(row[tax_id_col])
-
-                # transform read ID to take read pairs into account
-                read_id_match = re.match(paired_read_base_pattern,read_id)
-                if (read_id_match and
-                    read_tax_id in tax_ids_to_include):
-                    log.debug("Found matching read ID: %s", read_id_match.group(1))
-                    read_IDs_file.write(read_id_match.group(1)+"\n")
-                    read_ids_written+=1
-
-        # if we found reads matching the taxNames requested,
-        if read_ids_written > 0:
-            # filter the input bam to include only these
-            tools.picard.FilterSamReadsTool().execute(in_bam,
-                                                        False,
-                                                        temp_read_list,
-                                                        out_bam,
-                                                        JVMmemory=JVMmemory)
-        else:
-            # otherwise, "touch" the output bam to contain the
-            # header of the input bam (no matching reads)
-            tools.samtools.SamtoolsTool().dumpHeader(in_bam,out_bam)
+    # perform the actual filtering to collect the matching read IDs
+    read_IDs = set()
+    for row in util.file.read_tabfile(read_IDs_to_tax_IDs):
+        assert tax_id_col<len(row), "tax_id_col does not appear to be in range for number of columns present in mapping file"
+        assert read_id_col<len(row), "read_id_col does not appear to be in range for number of columns present in mapping file"
+        read_id = row[read_id_col]
+        read_tax_id = int(row[tax_id_col])
+
+        # transform read ID to take read pairs into account
+        read_id_match = re.match(paired_read_base_pattern,read_id)
+        if (read_id_match and
+            read_tax_id in tax_ids_to_include):
+            log.debug("Found matching read ID: %s", read_id_match.group(1))
+            read_IDs.add(read_id_match.group(1))
+
+    # if we found reads matching the taxNames requested,
+    if read_IDs:
+        # filter the input bam to include only these
+        read_utils.filter_bam_by_read_ids(in_bam, read_utils.ReadIdSet(read_IDs), out_bam)
+    else:
+        # otherwise, "touch" the output bam to contain the
+        # header of the input bam (no matching reads)
+        tools.samtools.SamtoolsTool().dumpHeader(in_bam,out_bam)
 __commands__.append(('filter_bam_to_taxa', parser_filter_bam_to_taxa))
 
 
@@ -13,8 +13,6 @@ import shutil
 import os
 import os.path
 
-import Bio.SeqIO
-
 import util.cmd
 import util.file
 import util.version
@@ -27,6 +25,7 @@ log = logging.getLogger(__name__)
 
 
 def fasta_chrlens(fasta):
+    import Bio.SeqIO
     out = collections.OrderedDict()
     with open(fasta, 'rt') as inf:
         for seq in Bio.SeqIO.parse(inf, 'fasta'):
@@ -184,6 +183,7 @@ def tbl_transfer_prealigned(inputFasta, refFasta, refAnnotTblFiles, outputDir, o
         created by tbl_transfer_common.
     """
 
+    import Bio.SeqIO
     ref_tbl = ""  # must be identified in list of tables
     ref_fasta_filename = ""
     matchingRefSeq = None
@@ -457,6 +457,7 @@ def prep_genbank_files(templateFile, fasta_files, annotDir,
         as well as numerous other metadata files for the submission.  Creates a
         directory full of files (.sqn in particular) that can be sent to GenBank.
     '''
+    import Bio.SeqIO
     # get coverage map
     coverage = {}
     if coverage_table:
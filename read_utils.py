@@ -9,8 +9,9 @@ __author__ = "irwin@broadinstitute.org, dpark@broadinstitute.org"
 __commands__ = []
 
 import argparse
+import collections
 import logging
-import math
+import itertools
 import os
 import tempfile
 import shutil
@@ -19,9 +20,6 @@ import concurrent.futures
 from contextlib import contextmanager
 import functools
 
-from Bio import SeqIO
-import pysam
-
 import util.cmd
 import util.file
 import util.misc
@@ -256,6 +254,7 @@ def revert_bam_if_aligned(inBam, revert_bam=None, clear_tags=True, tags_to_clear
         If a revertBam file path is specified, it is used, otherwise a temp file is created.
     '''
 
+    import pysam
     revertBamOut = revert_bam if revert_bam else util.file.mkstempfname('.bam')
     picardOptions = picardOptions or []
     tags_to_clear = tags_to_clear or []
@@ -537,6 +536,106 @@ def main_merge_bams(args):
 
 __commands__.append(('merge_bams', parser_merge_bams))
 
+class ReadIdSet(object):
+    ''' A compact, read-only set of read IDs for filtering BAM files by read
+        name. Small lists are held in a hashed set; lists longer than
+        max_hashed are held as a sorted numpy byte-string array and looked up
+        by binary search, which uses a fraction of the memory. Past
+        max_hashed, IDs are streamed into numpy chunks of chunk_size IDs that
+        are merged and sorted in place at the end, so the full list is never
+        held as Python objects.
+    '''
+
+    def __init__(self, read_ids, max_hashed=5000000, chunk_size=100000):
+        import numpy
+        hashed = set()
+        chunks = []
+        buffer = []
+        for r in read_ids:
+            r = r if isinstance(r, bytes) else r.encode('utf-8')
+            if hashed is None:
+                buffer.append(r)
+                if len(buffer) >= chunk_size:
+                    chunks.append(numpy.array(buffer, dtype=bytes))
+                    buffer = []
+            else:
+                hashed.add(r)
+                if len(hashed) > max_hashed:
+                    chunks.append(numpy.array(list(hashed), dtype=bytes))
+                    hashed = None
+        if hashed is None:
+            if buffer:
+                chunks.append(numpy.array(buffer, dtype=bytes))
+            self._sorted = self._merge_chunks(chunks)
+            self._hashed = None
+        else:
+            self._sorted = None
+            self._hashed = frozenset(hashed)
+
+    @staticmethod
+    def _merge_chunks(chunks):
+        ''' Merge byte-string arrays into one sorted array without duplicates,
+            freeing each chunk as it is copied. '''
+        import numpy
+        merged = numpy.empty(sum(len(c) for c in chunks), dtype='S{}'.format(max(c.dtype.itemsize for c in chunks)))
+        start = 0
+        for i, chunk in enumerate(chunks):
+            merged[start:start + len(chunk)] = chunk
+            start += len(chunk)
+            chunks[i] = None
+        merged.sort()
+        if len(merged) > 1:
+            distinct = numpy.empty(len(merged), dtype=bool)
+            distinct[0] = True
+            distinct[1:] = merged[1:] != merged[:-1]
+            if not distinct.all():
+                merged = merged[distinct]
+        return merged
+
+    @classmethod
+    def from_file(cls, read_list, max_hashed=5000000):
+        ''' Load read IDs from a text file (optionally gzipped), one per line. '''
+        with util.file.open_or_gzopen(read_list, 'rt') as inf:
+            return cls((line.strip() for line in inf if line.strip()), max_hashed=max_hashed)
+
+    def __len__(self):
+        return len(self._hashed) if self._hashed is not None else len(self._sorted)
+
+    def __contains__(self, read_id):
+        if not isinstance(read_id, bytes):
+            read_id = read_id.encode('utf-8')
+        if self._hashed is not None:
+            return read_id in self._hashed
+        i = self._sorted.searchsorted(read_id)
+        return i < len(self._sorted) and self._sorted[i] == read_id
+
+
+def filter_bam_by_read_ids(inBam, readIds, outBam, exclude=False, threads=None):
+    ''' Stream inBam once through pysam and write to outBam only the reads
+        whose names are in readIds (or, if exclude is set, are not in readIds).
+        readIds may be a ReadIdSet, any iterable of read names, or the path
+        of a read list file. Mates share a read name, so pairs are always
+        kept or removed together. Output is compressed with multithreaded
+        BGZF. Returns the number of reads written.
+    '''
+    import pysam
+    if isinstance(readIds, str):
+        readIds = ReadIdSet.from_file(readIds)
+    elif not isinstance(readIds, ReadIdSet):
+        readIds = ReadIdSet(readIds)
+    threads = util.misc.sanitize_thread_count(threads)
+
+    n_written = 0
+    with pysam.AlignmentFile(inBam, 'r', check_sq=False) as inb:
+        with pysam.AlignmentFile(outBam, 'w' if outBam.endswith('.sam') else 'wb',
+                                 template=inb, threads=threads) as outb:
+            for read in inb.fetch(until_eof=True):
+                if (read.query_name in readIds) != exclude:
+                    outb.write(read)
+                    n_written += 1
+    return n_written
+
+
 # ====================
 # ***  filter_bam  ***
 # ====================
@@ -667,6 +766,7 @@ def join_paired_fastq(
 ):
     ''' Join paired fastq reads into single reads with Ns
     '''
+    from Bio import SeqIO
     inFastqs = list(inFastqs)
     if output == '-':
         output = sys.stdout
@@ -693,59 +793,76 @@ defaultMaxReads = 1000
 defaultFormat = 'fastq'
 
 
-def split_bam(inBam, outBams):
-    '''Split BAM file equally into several output BAM files. '''
-    samtools = tools.samtools.SamtoolsTool()
-    picard = tools.picard.PicardTools()
-
-    # get totalReadCount and maxReads
-    # maxReads = totalReadCount / num files, but round up to the nearest
-    # even number in order to keep read pairs together (assuming the input
-    # is sorted in query order and has no unmated reads, which can be
-    # accomplished by Picard RevertSam with SANITIZE=true)
-    totalReadCount = samtools.count(inBam)
-    maxReads = int(math.ceil(float(totalReadCount) / len(outBams) / 2) * 2)
-    log.info("splitting %d reads into %d files of %d reads each", totalReadCount, len(outBams), maxReads)
-
-    # load BAM header into memory
-    header = samtools.getHeader(inBam)
-    if 'SO:queryname' not in header[0]:
-        raise Exception('Input BAM file must be sorted in queryame order')
-
-    # dump to bigsam
-    bigsam = mkstempfname('.sam')
-    samtools.view(['-@', '3'], inBam, bigsam)
-
-    # split bigsam into little ones
-    with util.file.open_or_gzopen(bigsam, 'rt') as inf:
-        for outBam in outBams:
-            log.info("preparing file " + outBam)
-            tmp_sam_reads = mkstempfname('.sam')
-            with open(tmp_sam_reads, 'wt') as outf:
-                for row in header:
-                    outf.write('\t'.join(row) + '\n')
-                for _ in range(maxReads):
-                    line = inf.readline()
-                    if not line:
-                        break
-                    outf.write(line)
-                if outBam == outBams[-1]:
-                    for line in inf:
-                        outf.write(line)
-            picard.execute(
-                "SamFormatConverter", [
-                    'INPUT=' + tmp_sam_reads, 'OUTPUT=' + outBam, 'VERBOSITY=WARNING'
-                ],
-                JVMmemory='512m'
-            )
-            os.unlink(tmp_sam_reads)
-    os.unlink(bigsam)
+SPLIT_BAM_MODES = ('roundrobin', 'balanced', 'readgroup')
+
+
+def split_bam(inBam, outBams, mode='roundrobin', threads=None):
+    '''Split a BAM file into several output BAM files in a single streaming pass.
+        All records sharing a read name (mates, secondary and supplementary
+        alignments) are kept together in the same output file.
+        mode:
+          roundrobin: templates are dealt to the outputs in turn
+          balanced: each template goes to the output with the fewest bases so far
+          readgroup: every read group is written whole to one output; read groups
+                     are dealt to the outputs in header order
+        The first two modes require input sorted in queryname order (which each
+        output then retains). Returns the number of reads written to each output.
+    '''
+    import pysam
+    if mode not in SPLIT_BAM_MODES:
+        raise ValueError("mode must be one of %s" % ', '.join(SPLIT_BAM_MODES))
+    threads = util.misc.sanitize_thread_count(threads)
+    out_threads = max(1, threads // len(outBams))
+
+    with pysam.AlignmentFile(inBam, 'rb', check_sq=False) as inb:
+        if mode != 'readgroup' and inb.header.to_dict().get('HD', {}).get('SO') != 'queryname':
+            raise Exception('Input BAM file must be sorted in queryame order')
+
+        outbs = [pysam.AlignmentFile(outBam, 'wb', template=inb, threads=out_threads) for outBam in outBams]
+        n_reads = [0] * len(outBams)
+        try:
+            if mode == 'readgroup':
+                # read groups seen in the header come first, others as they are encountered
+                rg_to_out = {}
+                for rg in inb.header.to_dict().get('RG', []):
+                    rg_to_out.setdefault(rg['ID'], len(rg_to_out) % len(outbs))
+                for read in inb.fetch(until_eof=True):
+                    rg = read.get_tag('RG') if read.has_tag('RG') else None
+                    idx = rg_to_out.setdefault(rg, len(rg_to_out) % len(outbs))
+                    outbs[idx].write(read)
+                    n_reads[idx] += 1
+            else:
+                n_bases = [0] * len(outBams)
+                for i, (_, reads) in enumerate(itertools.groupby(inb.fetch(until_eof=True),
+                                                                  key=lambda read: read.query_name)):
+                    if mode == 'roundrobin':
+                        idx = i % len(outbs)
+                    else:
+                        idx = min(range(len(outbs)), key=lambda j: (n_bases[j], n_reads[j]))
+                    for read in reads:
+                        outbs[idx].write(read)
+                        n_reads[idx] += 1
+                        n_bases[idx] += read.query_length
+        finally:
+            for outb in outbs:
+                outb.close()
+
+    log.info("split %d reads into %d files: %s", sum(n_reads), len(outBams), n_reads)
+    return n_reads
 
 
 def parser_split_bam(parser=argparse.ArgumentParser()):
     parser.add_argument('inBam', help='Input BAM file.')
     parser.add_argument('outBams', nargs='+', help='Output BAM files')
-    util.cmd.common_args(parser, (('loglevel', None), ('version', None), ('tmp_dir', None)))
+    parser.add_argument(
+        '--mode',
+        choices=SPLIT_BAM_MODES,
+        default='roundrobin',
+        help="""How reads are distributed among the output files: dealt out by template
+            (roundrobin), to the output with the fewest bases so far (balanced), or
+            by whole read group (readgroup). (default: %(default)s)"""
+    )
+    util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None), ('tmp_dir', None)))
     util.cmd.attach_main(parser, split_bam, split_args=True)
     return parser
 
@@ -922,90 +1039,210 @@ def parser_rmdup_cdhit_bam(parser=argparse.ArgumentParser()):
 
 __commands__.append(('rmdup_cdhit_bam', parser_rmdup_cdhit_bam))
 
-def _merge_fastqs_and_mvicuna(lb, files):
-    readList = mkstempfname('.keep_reads.txt')
-    log.info("executing M-Vicuna DupRm on library " + lb)
-
-    # create merged FASTQs per library
-    infastqs = (mkstempfname('.1.fastq'), mkstempfname('.2.fastq'))
-    for d in range(2):
-        with open(infastqs[d], 'wt') as outf:
-            for fprefix in files:
-                fn = '%s_%d.fastq' % (fprefix, d + 1)
-
-                if os.path.isfile(fn):
-                    with open(fn, 'rt') as inf:
-                        for line in inf:
-                            outf.write(line)
-                    os.unlink(fn)
-                else:
-                    log.warning(
-                        """no reads found in %s,
-                                assuming that's because there's no reads in that read group""", fn
-                    )
-
-    # M-Vicuna DupRm to see what we should keep (append IDs to running file)
-    if os.path.getsize(infastqs[0]) > 0 or os.path.getsize(infastqs[1]) > 0:
-        mvicuna_fastqs_to_readlist(infastqs[0], infastqs[1], readList)
-    for fn in infastqs:
-        os.unlink(fn)
-
-    return readList
-
-def rmdup_mvicuna_bam(inBam, outBam, JVMmemory=None):
-    ''' Remove duplicate reads from BAM file using M-Vicuna. The
-        primary advantage to this approach over Picard's MarkDuplicates tool
-        is that Picard requires that input reads are aligned to a reference,
-        and M-Vicuna can operate on unaligned reads.
+class DuplicateKeyIndex(object):
+    ''' Index of read pair keys (sequence prefixes) seen so far, each mapped
+        to the template that first had it (its duplicate cluster's
+        representative). At most max_hashed keys are held in memory; past
+        that, the in-memory table is spilled to disk as sorted arrays of the
+        keys themselves that are memory-mapped for lookups, so distinct keys
+        never collide. With max_mismatches > 0, keys within that Hamming
+        distance of any earlier key also match, found via pigeonhole segment
+        tables that are spilled alongside the keys. Spilling changes only
+        where keys are held, never which earlier key a key matches.
     '''
 
-    # Convert BAM -> FASTQ pairs per read group and load all read groups
-    tempDir = tempfile.mkdtemp()
-    tools.picard.SamToFastqTool().per_read_group(inBam, tempDir, picardOptions=['VALIDATION_STRINGENCY=LENIENT'], JVMmemory=JVMmemory)
-    read_groups = [x[1:] for x in tools.samtools.SamtoolsTool().getHeader(inBam) if x[0] == '@RG']
-    read_groups = [dict(pair.split(':', 1) for pair in rg) for rg in read_groups]
-
-    # Collect FASTQ pairs for each library
-    lb_to_files = {}
-    for rg in read_groups:
-        lb_to_files.setdefault(rg.get('LB', 'none'), set())
-        fname = rg['ID']
-        lb_to_files[rg.get('LB', 'none')].add(os.path.join(tempDir, fname))
-    log.info("found %d distinct libraries and %d read groups", len(lb_to_files), len(read_groups))
-
-    # For each library, merge FASTQs and run rmdup for entire library
-    readListAll = mkstempfname('.keep_reads_all.txt')
-    per_lb_read_lists = []
-    with concurrent.futures.ProcessPoolExecutor(max_workers=util.misc.available_cpu_count()) as executor:
-        futures = [executor.submit(_merge_fastqs_and_mvicuna, lb, files) for lb, files in lb_to_files.items()]
-        for future in concurrent.futures.as_completed(futures):
-            log.info("mvicuna finished processing library")
-            try:
-                readList = future.result()
-                per_lb_read_lists.append(readList)
-            except Exception as exc:
-                log.error('mvicuna process call generated an exception: %s' % (exc))
-
-    # merge per-library read lists together
-    util.file.concat(per_lb_read_lists, readListAll)
-    # remove per-library read lists
-    for fl in per_lb_read_lists:
-        os.unlink(fl)
-
-    # Filter original input BAM against keep-list
-    tools.picard.FilterSamReadsTool().execute(inBam, False, readListAll, outBam, JVMmemory=JVMmemory)
+    def __init__(self, max_mismatches=0, max_hashed=5000000):
+        self.max_mismatches = max_mismatches
+        self.max_hashed = max_hashed
+        self._runs = []
+        self._reset()
+
+    def _reset(self):
+        self._hashed = {}
+        self._segments = [{} for _ in range(self.max_mismatches + 1)] if self.max_mismatches else []
+
+    def _segment_bounds(self, key_len):
+        n = self.max_mismatches + 1
+        return [(i * key_len // n, (i + 1) * key_len // n) for i in range(n)]
+
+    def _is_near(self, key, other):
+        return len(other) == len(key) and sum(1 for x, y in zip(key, other) if x != y) <= self.max_mismatches
+
+    def find_or_add(self, key, template_id):
+        ''' Return the representative template id of key's duplicate cluster.
+            If key matches no earlier key, it starts a new cluster represented
+            by template_id, which is returned.
+        '''
+        rep = self._hashed.get(key)
+        if rep is not None:
+            return rep
+        key_bytes = key.encode('latin-1')
+        for run in self._runs:
+            i = run['keys'].searchsorted(key_bytes)
+            if i < len(run['keys']) and run['keys'][i] == key_bytes:
+                return int(run['reps'][i])
+
+        if self.max_mismatches:
+            # earlier keys are tried in the order they were added: runs oldest first, then memory
+            for seg_i, (start, end) in enumerate(self._segment_bounds(len(key))):
+                segment_bytes = key_bytes[start:end]
+                for run in self._runs:
+                    segs, idx = run['segments'][seg_i]
+                    lo = segs.searchsorted(segment_bytes, side='left')
+                    hi = segs.searchsorted(segment_bytes, side='right')
+                    for j in idx[lo:hi]:
+                        if self._is_near(key_bytes, run['keys'][j]):
+                            return int(run['reps'][j])
+                for other, candidate in self._segments[seg_i].get(key[start:end], ()):
+                    if self._is_near(key, other):
+                        return candidate
+
+        if len(self._hashed) >= self.max_hashed:
+            self._spill()
+        self._hashed[key] = template_id
+        for segment, (start, end) in zip(self._segments, self._segment_bounds(len(key))):
+            segment.setdefault(key[start:end], []).append((key, template_id))
+        return template_id
+
+    def _save_mmap(self, arr):
+        import numpy
+        fn = mkstempfname('.npy')
+        numpy.save(fn, arr)
+        arr = numpy.load(fn, mmap_mode='r')
+        os.unlink(fn)
+        return arr
+
+    def _spill(self):
+        import numpy
+        keys = numpy.array([key.encode('latin-1') for key in self._hashed.keys()], dtype=bytes)
+        reps = numpy.fromiter(self._hashed.values(), dtype=numpy.int64, count=len(self._hashed))
+        order = numpy.argsort(keys, kind='mergesort')
+        keys, reps = keys[order], reps[order]
+        run = {'keys': self._save_mmap(keys), 'reps': self._save_mmap(reps), 'segments': []}
+        for seg_i in range(len(self._segments)):
+            segs = numpy.array([key[slice(*self._segment_bounds(len(key))[seg_i])] for key in keys], dtype=bytes)
+            # ties on a segment are ordered by representative, ie the order keys were added
+            idx = numpy.lexsort((reps, segs))
+            run['segments'].append((self._save_mmap(segs[idx]), self._save_mmap(idx.astype(numpy.int64))))
+        log.debug("spilled %d duplicate keys to disk", len(keys))
+        self._runs.append(run)
+        self._reset()
+
+
+def rmdup_mvicuna_bam(inBam, outBam, JVMmemory=None, prefixLength=20, maxMismatches=0,
+                      maxNFraction=0.5, maxHashed=5000000, outStats=None, threads=None):
+    ''' Remove duplicate reads from an unaligned (or aligned) BAM file in a
+        single streaming pass, in the manner of M-Vicuna's DupRm. The primary
+        advantage to this approach over Picard's MarkDuplicates tool is that
+        Picard requires that input reads are aligned to a reference.
+
+        Read pairs are keyed on the first prefixLength bases of each mate (as
+        sequenced) and deduplicated within each library; the first pair seen
+        of each cluster is kept. Pairs whose keys differ at no more than
+        maxMismatches positions are also counted as duplicates. Pairs where
+        either mate is more than maxNFraction N are dropped. Mates are kept
+        or dropped together. JVMmemory is accepted for compatibility and
+        ignored.
+    '''
+    import pysam
+    threads = util.misc.sanitize_thread_count(threads)
+    stat_fields = ('templates', 'filtered', 'unique', 'duplicates', 'duplicate_clusters', 'largest_cluster')
+    lib_stats = collections.OrderedDict()
+    lib_index = {}
+    lib_clusters = {}
+
+    with pysam.AlignmentFile(inBam, 'rb', check_sq=False) as inb:
+        rg_to_lb = dict((rg['ID'], rg.get('LB', 'none')) for rg in inb.header.to_dict().get('RG', []))
+        log.info("found %d distinct libraries and %d read groups", len(set(rg_to_lb.values())), len(rg_to_lb))
+
+        with pysam.AlignmentFile(outBam, 'wb', template=inb, threads=threads) as outb:
+            pending = {}
+            template_id = 0
+            for read in inb.fetch(until_eof=True):
+                if read.is_secondary or read.is_supplementary:
+                    continue
+                if read.is_paired:
+                    mates = pending.setdefault(read.query_name, [None, None])
+                    mates[0 if read.is_read1 else 1] = read
+                    if mates[0] is None or mates[1] is None:
+                        continue
+                    del pending[read.query_name]
+                else:
+                    mates = [read]
+
+                # key this template within its library
+                lb = rg_to_lb.get(read.get_tag('RG'), 'none') if read.has_tag('RG') else 'none'
+                if lb not in lib_index:
+                    lib_index[lb] = DuplicateKeyIndex(max_mismatches=maxMismatches, max_hashed=maxHashed)
+                    lib_stats[lb] = dict((f, 0) for f in stat_fields)
+                    lib_clusters[lb] = {}
+                stats = lib_stats[lb]
+                stats['templates'] += 1
+                seqs = [mate.get_forward_sequence() or '' for mate in mates]
+                if any(seq.upper().count('N') > maxNFraction * len(seq) for seq in seqs):
+                    stats['filtered'] += 1
+                    continue
+
+                template_id += 1
+                rep = lib_index[lb].find_or_add('\t'.join(seq[:prefixLength].upper() for seq in seqs), template_id)
+                if rep != template_id:
+                    stats['duplicates'] += 1
+                    lib_clusters[lb][rep] = lib_clusters[lb].get(rep, 1) + 1
+                    continue
+                stats['unique'] += 1
+                for mate in mates:
+                    outb.write(mate)
+
+            if pending:
+                log.warning("dropped %d reads whose mates were not found", len(pending))
+
+    # summarize duplicate clusters per library
+    for lb, stats in lib_stats.items():
+        stats['duplicate_clusters'] = len(lib_clusters[lb])
+        stats['largest_cluster'] = max(lib_clusters[lb].values()) if lib_clusters[lb] else min(stats['unique'], 1)
+        log.info("library %s: %s", lb, ', '.join('%s=%d' % (f, stats[f]) for f in stat_fields))
+    if outStats:
+        with open(outStats, 'wt') as outf:
+            outf.write('\t'.join(('library',) + stat_fields) + '\n')
+            for lb, stats in lib_stats.items():
+                outf.write('\t'.join([lb] + [str(stats[f]) for f in stat_fields]) + '\n')
     return 0
 
 
 def parser_rmdup_mvicuna_bam(parser=argparse.ArgumentParser()):
     parser.add_argument('inBam', help='Input reads, BAM format.')
     parser.add_argument('outBam', help='Output reads, BAM format.')
+    parser.add_argument(
+        '--prefixLength',
+        type=int,
+        default=20,
+        help='Number of leading bases of each mate compared between read pairs (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--maxMismatches',
+        type=int,
+        default=0,
+        help='Read pairs whose prefixes differ at no more than this many positions are duplicates (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--maxNFraction',
+        type=float,
+        default=0.5,
+        help='Drop read pairs where either mate has more than this fraction of Ns (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--maxHashed',
+        type=int,
+        default=5000000,
+        help='Distinct read pair keys held in memory per library before spilling to disk (default: %(default)s)'
+    )
+    parser.add_argument('--outStats', default=None, help='Output per-library duplicate cluster statistics, TSV format.')
     parser.add_argument(
         '--JVMmemory',
         default=tools.picard.FilterSamReadsTool.jvmMemDefault,
-        help='JVM virtual memory size (default: %(default)s)'
+        help='Ignored; kept for compatibility (default: %(default)s)'
     )
-    util.cmd.common_args(parser, (('loglevel', None), ('version', None), ('tmp_dir', None)))
+    util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None), ('tmp_dir', None)))
     util.cmd.attach_main(parser, rmdup_mvicuna_bam, split_args=True)
     return parser
 
@@ -6,6 +6,9 @@ __author__ = "dpark@broadinstitute.org"
 __commands__ = []
 
 import argparse
+import array
+import concurrent.futures
+import functools
 import logging
 import glob
 import os
@@ -15,14 +18,8 @@ import csv
 import math
 import shutil
 
-import pysam
-from pybedtools import BedTool
-import Bio.SeqIO
-import Bio.AlignIO
-from Bio.Alphabet.IUPAC import IUPACUnambiguousDNA
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+# numpy, pysam, Bio, matplotlib and pybedtools are imported by the commands
+# that use them when they run (see _pyplot), not at startup
 
 import util.cmd
 import util.file
@@ -30,9 +27,9 @@ import util.misc
 import tools.samtools
 import tools.bwa
 import tools.fastqc
+import tools.muscle
 import assembly
 import interhost
-from util.stats import mean, median
 
 log = logging.getLogger(__name__)
 
@@ -43,6 +40,7 @@ def get_assembly_stats(sample,
                        align_dir='data/02_align_to_self', reads_dir='data/01_per_sample',
                        raw_reads_dir='data/00_raw'):
     ''' Fetch assembly-level statistics for a given sample '''
+    import Bio.SeqIO
     out = {'sample': sample}
     samtools = tools.samtools.SamtoolsTool()
     header = ['sample',
@@ -121,44 +119,95 @@ def get_assembly_stats(sample,
     # genome coverage stats
     bam_fname = os.path.join(align_dir, sample + '.mapped.bam')
     if os.path.isfile(bam_fname):
-        with pysam.AlignmentFile(bam_fname, 'rb') as bam:
-            coverages = list([pcol.nsegments for pcol in bam.pileup()])
-        if coverages:
-            out['aln2self_cov_median'] = median(coverages)
-            out['aln2self_cov_mean'] = "%0.3f" % mean(coverages)
-            out['aln2self_cov_mean_non0'] = "%0.3f" % mean([n for n in coverages if n > 0])
-            for thresh in cov_thresholds:
-                out['aln2self_cov_%dX' % thresh] = sum(1 for n in coverages if n >= thresh)
+        out.update(coverage_stats(list(bam_coverage_depths(bam_fname).values()), cov_thresholds))
 
     return (header, out)
 
 
-def genome_coverage_stats_only(mapped_bam, chr_name=None, cov_thresholds=(1, 5, 20, 100)):
-    out = {}
+# reads skipped by the default pysam/samtools pileup: unmapped, secondary, QC fail, duplicate
+_PILEUP_SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+
+
+def bam_coverage_depths(mapped_bam, chunk_size=1000000):
+    ''' Compute read depth at every position of every contig of a BAM file in
+        a single streaming pass (no index required). Depth counts the reads
+        whose aligned span covers a position, including deletions and skips,
+        using the same read filters as a default pysam pileup (unmapped,
+        secondary, QC-fail, duplicate and orphan reads are ignored).
+
+        Returns an OrderedDict of contig name -> numpy int array of depths.
+    '''
+    import numpy
+    import pysam
     with pysam.AlignmentFile(mapped_bam, 'rb') as bam:
-        coverages = list([pcol.nsegments for pcol in bam.pileup(chr_name)])
-    if coverages:
-        out['aln2self_cov_median'] = median(coverages)
-        out['aln2self_cov_mean'] = "%0.3f" % mean(coverages)
-        out['aln2self_cov_mean_non0'] = "%0.3f" % mean([n for n in coverages if n > 0])
+        lengths = OrderedDict(zip(bam.references, bam.lengths))
+        # read-interval deltas: +1 at each aligned start, -1 past each aligned end
+        deltas = OrderedDict((c, numpy.zeros(l + 1, dtype=numpy.int64)) for c, l in lengths.items())
+        starts = dict((c, array.array('l')) for c in lengths)
+        ends = dict((c, array.array('l')) for c in lengths)
+
+        def flush(c):
+            if starts[c]:
+                deltas[c] += numpy.bincount(numpy.frombuffer(starts[c], dtype=numpy.int_), minlength=lengths[c] + 1)
+                deltas[c] -= numpy.bincount(numpy.frombuffer(ends[c], dtype=numpy.int_), minlength=lengths[c] + 1)
+                starts[c] = array.array('l')
+                ends[c] = array.array('l')
+
+        for read in bam.fetch(until_eof=True):
+            if read.flag & _PILEUP_SKIP_FLAGS or (read.is_paired and not read.is_proper_pair):
+                continue
+            c = read.reference_name
+            starts[c].append(read.reference_start)
+            ends[c].append(read.reference_end)
+            if len(starts[c]) >= chunk_size:
+                flush(c)
+        for c in lengths:
+            flush(c)
+    return OrderedDict((c, numpy.cumsum(d[:-1])) for c, d in deltas.items())
+
+
+def coverage_stats(depths, cov_thresholds=(1, 5, 20, 100)):
+    ''' Compute the aln2self_cov_* report fields from one or more depth arrays
+        (see bam_coverage_depths). As with a pileup, only covered positions
+        contribute to the median and means.
+    '''
+    import numpy
+    out = {}
+    coverages = numpy.concatenate([d[d > 0] for d in depths]) if len(depths) else numpy.zeros(0, dtype=numpy.int64)
+    n = len(coverages)
+    if n:
+        # match statistics.median: the middle value, or the mean of the two middle values
+        mid = coverages[numpy.argpartition(coverages, [(n - 1) // 2, n // 2])[[(n - 1) // 2, n // 2]]]
+        out['aln2self_cov_median'] = int(mid[0]) if n % 2 else (int(mid[0]) + int(mid[1])) / 2
+        cov_mean = "%0.3f" % (int(coverages.sum()) / n)
+        out['aln2self_cov_mean'] = cov_mean
+        out['aln2self_cov_mean_non0'] = cov_mean
         for thresh in cov_thresholds:
-            out['aln2self_cov_%dX' % thresh] = sum(1 for n in coverages if n >= thresh)
+            out['aln2self_cov_%dX' % thresh] = int(numpy.count_nonzero(coverages >= thresh))
     return out
 
 
-def assembly_stats(samples, outFile, cov_thresholds, assembly_dir, assembly_tmp, align_dir, reads_dir, raw_reads_dir):
+def genome_coverage_stats_only(mapped_bam, chr_name=None, cov_thresholds=(1, 5, 20, 100)):
+    depths = bam_coverage_depths(mapped_bam)
+    if chr_name is not None:
+        return coverage_stats([depths[chr_name]], cov_thresholds)
+    return coverage_stats(list(depths.values()), cov_thresholds)
+
+
+def assembly_stats(samples, outFile, cov_thresholds, assembly_dir, assembly_tmp, align_dir, reads_dir, raw_reads_dir, threads=None):
     ''' Fetch assembly-level statistics for a given sample '''
     header_written = False
-    with open(outFile, 'wt') as outf:
-        for sample in samples:
-            log.info("fetching stats on " + sample)
-            header, out = get_assembly_stats(sample,
-                                             cov_thresholds=cov_thresholds,
-                                             assembly_dir=assembly_dir,
-                                             assembly_tmp=assembly_tmp,
-                                             align_dir=align_dir,
-                                             reads_dir=reads_dir,
-                                             raw_reads_dir=raw_reads_dir)
+    workers = min(len(samples), util.misc.sanitize_thread_count(threads)) or 1
+    with open(outFile, 'wt') as outf, concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        log.info("fetching stats on %s", ', '.join(samples))
+        results = executor.map(functools.partial(get_assembly_stats,
+                                                 cov_thresholds=cov_thresholds,
+                                                 assembly_dir=assembly_dir,
+                                                 assembly_tmp=assembly_tmp,
+                                                 align_dir=align_dir,
+                                                 reads_dir=reads_dir,
+                                                 raw_reads_dir=raw_reads_dir), samples)
+        for header, out in results:
             if not header_written:
                 outf.write('\t'.join(map(str, header)) + '\n')
                 header_written = True
@@ -189,7 +238,7 @@ def parser_assembly_stats(parser=argparse.ArgumentParser()):
     parser.add_argument('--raw_reads_dir',
                         default='data/00_raw',
                         help='Directory with unaligned raw read BAMs. (default: %(default)s)')
-    util.cmd.common_args(parser, (('loglevel', None), ('version', None), ('tmp_dir', None)))
+    util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None), ('tmp_dir', None)))
     util.cmd.attach_main(parser, assembly_stats, split_args=True)
     return parser
 
@@ -198,9 +247,11 @@ __commands__.append(('assembly_stats', parser_assembly_stats))
 
 
 def _get_samples_from_bam(bam):
+    import pysam
     with pysam.AlignmentFile(bam) as af:
         return set(rg['SM'] for rg in af.header['RG'])
 def _get_chrs_from_bam(bam):
+    import pysam
     with pysam.AlignmentFile(bam) as af:
         return list(sq['SN'] for sq in af.header['SQ'])
 
@@ -212,138 +263,117 @@ def parser_coverage_only(parser=argparse.ArgumentParser()):
                         type=int,
                         default=(1, 5, 20, 100),
                         help='Genome coverage thresholds to report on. (default: %(default)s)')
-    util.cmd.common_args(parser, (('loglevel', None), ('version', None), ('tmp_dir', None)))
+    util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None), ('tmp_dir', None)))
     util.cmd.attach_main(parser, coverage_only, split_args=True)
     return parser
-def coverage_only(mapped_bams, out_report, cov_thresholds=(1, 5, 20, 100)):
+def _coverage_only_rows(bam, cov_thresholds):
+    # get unique sample name
+    samples = _get_samples_from_bam(bam)
+    if len(samples) != 1:
+        raise Exception("input bam file {} has {} unique samples: {} (require one unique sample)".format(bam, len(samples), str(samples)))
+    sample_name = samples.pop()
+    # get coverage stats from a single pass over the bam
+    depths = bam_coverage_depths(bam)
+    row = coverage_stats(list(depths.values()), cov_thresholds)
+    row['sample'] = sample_name
+    rows = [row]
+    # for multi-seg genomes, also do per-chr stats
+    if len(depths) > 1:
+        for i, chr_depths in enumerate(depths.values()):
+            row = coverage_stats([chr_depths], cov_thresholds)
+            row['sample'] = "{}-{}".format(sample_name, i+1)
+            rows.append(row)
+    return rows
+def coverage_only(mapped_bams, out_report, cov_thresholds=(1, 5, 20, 100), threads=None):
     header = ['sample','aln2self_cov_median', 'aln2self_cov_mean', 'aln2self_cov_mean_non0']
     header += ['aln2self_cov_%dX' % thresh for thresh in cov_thresholds]
-    with open(out_report, 'wt') as outf:
+    workers = min(len(mapped_bams), util.misc.sanitize_thread_count(threads)) or 1
+    with open(out_report, 'wt') as outf, concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
         outf.write('\t'.join(header)+'\n')
-        for bam in mapped_bams:
-            # check for index and auto-create if needed
-            with pysam.AlignmentFile(bam) as af:
-                is_indexed = af.has_index()
-            if not is_indexed:
-                pysam.index(bam)
-            # get unique sample name
-            samples = _get_samples_from_bam(bam)
-            if len(samples) != 1:
-                raise Exception("input bam file {} has {} unique samples: {} (require one unique sample)".format(bam, len(samples), str(samples)))
-            sample_name = samples.pop()
-            # get and write coverage stats
-            row = genome_coverage_stats_only(bam, cov_thresholds=cov_thresholds)
-            row['sample'] = sample_name
-            outf.write('\t'.join([str(row.get(h,'')) for h in header])+'\n')
-            # for multi-seg genomes, also do per-chr stats
-            chrs = _get_chrs_from_bam(bam)
-            if len(chrs) > 1:
-                for i in range(len(chrs)):
-                    row = genome_coverage_stats_only(bam, chr_name=chrs[i], cov_thresholds=cov_thresholds)
-                    row['sample'] = "{}-{}".format(sample_name, i+1)
-                    outf.write('\t'.join([str(row.get(h,'')) for h in header])+'\n')
+        for rows in executor.map(functools.partial(_coverage_only_rows, cov_thresholds=cov_thresholds), mapped_bams):
+            for row in rows:
+                outf.write('\t'.join([str(row.get(h,'')) for h in header])+'\n')
 __commands__.append(('coverage_only', parser_coverage_only))
 
 
-def alignment_summary(inFastaFileOne, inFastaFileTwo, outfileName=None, printCounts=False):
+ALIGNMENT_SUMMARY_FIELDS = ('same_unambig', 'snp_unambig', 'indel_unambig', 'indel_ambig',
+                            'ambig_one', 'ambig_two', 'ambig_both', 'unambig_both')
+
+
+def alignment_column_counts(seqOne, seqTwo, gap='-', ambiguous='N'):
+    """ Classify every column of a pairwise alignment (two equal-length aligned
+        sequence strings) as same/SNP/indel/ambiguous, returning an OrderedDict
+        of ALIGNMENT_SUMMARY_FIELDS to column counts.
+    """
+    import numpy
+    from Bio.Alphabet.IUPAC import IUPACUnambiguousDNA
+    if len(seqOne) != len(seqTwo):
+        raise ValueError("aligned sequences differ in length: {} vs {}".format(len(seqOne), len(seqTwo)))
+    c1 = numpy.frombuffer(seqOne.encode('latin-1'), dtype=numpy.uint8)
+    c2 = numpy.frombuffer(seqTwo.encode('latin-1'), dtype=numpy.uint8)
+    unambig_letters = numpy.frombuffer(IUPACUnambiguousDNA().letters.encode('latin-1'), dtype=numpy.uint8)
+
+    unambig1, unambig2 = numpy.isin(c1, unambig_letters), numpy.isin(c2, unambig_letters)
+    ambig1, ambig2 = c1 == ord(ambiguous), c2 == ord(ambiguous)
+    gap1, gap2 = c1 == ord(gap), c2 == ord(gap)
+    unambig_both = unambig1 & unambig2
+
+    counts = OrderedDict()
+    counts["same_unambig"]  = numpy.count_nonzero(unambig_both & (c1 == c2))
+    counts["snp_unambig"]   = numpy.count_nonzero(unambig_both & (c1 != c2))
+    counts["indel_unambig"] = numpy.count_nonzero((gap1 & unambig2) | (gap2 & unambig1))
+    counts["indel_ambig"]   = numpy.count_nonzero((gap1 & ambig2) | (gap2 & ambig1))
+    counts["ambig_one"]     = numpy.count_nonzero(ambig1 & ~ambig2)
+    counts["ambig_two"]     = numpy.count_nonzero(ambig2 & ~ambig1)
+    counts["ambig_both"]    = numpy.count_nonzero(ambig1 & ambig2)
+    counts["unambig_both"]  = numpy.count_nonzero(unambig_both)
+    return OrderedDict((k, int(v)) for k, v in counts.items())
+
+
+def _align_chr_and_count(chr_fasta):
+    """ Align a two-sequence FASTA with MUSCLE and classify its columns. """
+    import Bio.AlignIO
+    alignOutFileName = util.file.mkstempfname('.fasta')
+    try:
+        tools.muscle.MuscleTool().execute(chr_fasta, alignOutFileName, fmt="clw")
+        with open(alignOutFileName, "r") as f:
+            alignment = Bio.AlignIO.read(f, "clustal")
+        return alignment_column_counts(str(alignment[0].seq), str(alignment[1].seq))
+    finally:
+        os.unlink(alignOutFileName)
+        os.unlink(chr_fasta)
+
+
+def _sum_alignment_counts(per_chr_counts):
+    return OrderedDict((k, sum(counts[k] for counts in per_chr_counts)) for k in ALIGNMENT_SUMMARY_FIELDS)
+
+
+def _print_alignment_counts(counts):
+    for k, v in counts.items():
+        print(k.ljust(13), v)
+
+
+def alignment_summary(inFastaFileOne, inFastaFileTwo, outfileName=None, printCounts=False, threads=None):
     """ Write or print pairwise alignment summary information for sequences in two FASTA
         files, including SNPs, ambiguous bases, and indels.
     """
-    gap = '-'
-    ambiguous = 'N'
-    aligner = tools.muscle.MuscleTool()
-
     per_chr_fastas = interhost.transposeChromosomeFiles([inFastaFileOne, inFastaFileTwo])
 
-    results = OrderedDict()
-    results["same_unambig"]  = 0
-    results["snp_unambig"]   = 0
-    results["indel_unambig"] = 0
-    results["indel_ambig"]   = 0
-    results["ambig_one"]     = 0
-    results["ambig_two"]     = 0
-    results["ambig_both"]    = 0
-    results["unambig_both"]  = 0
-
-    for chr_fasta in per_chr_fastas:
-        same_unambig  = 0
-        snp_unambig   = 0
-        indel_unambig = 0
-        indel_ambig   = 0
-        ambig_one     = 0
-        ambig_two     = 0
-        ambig_both    = 0
-        unambig_both  = 0
-
-        alignOutFileName = util.file.mkstempfname('.fasta')
-        aligner.execute(chr_fasta, alignOutFileName, fmt="clw")
+    # align each segment/chromosome concurrently (MUSCLE runs out of process)
+    workers = min(len(per_chr_fastas), util.misc.sanitize_thread_count(threads)) or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        per_chr_counts = list(executor.map(_align_chr_and_count, per_chr_fastas))
 
-        with open(alignOutFileName, "r") as f:
-            alignment = Bio.AlignIO.read(f, "clustal")
-
-            for col_idx in range(0, alignment.get_alignment_length()):
-                col = alignment[:, col_idx]
-                c1 = col[0]
-                c2 = col[1]
-
-                if (c1 in ambiguous
-                   and c2 in ambiguous):
-                    ambig_both +=1
-                elif c1 in ambiguous:
-                    ambig_one += 1
-                elif c2 in ambiguous:
-                    ambig_two += 1
-
-                if (c1 in IUPACUnambiguousDNA().letters
-                   and c2 in IUPACUnambiguousDNA().letters):
-                    unambig_both += 1
-                    if c1 == c2:
-                        same_unambig += 1
-                    else:
-                        snp_unambig += 1
-
-                if ((c1 == gap and
-                    c2 in IUPACUnambiguousDNA().letters) or
-                   (c2 == gap and
-                    c1 in IUPACUnambiguousDNA().letters)):
-                    indel_unambig += 1
-
-                if ((c1 == gap and
-                    c2 in ambiguous) or
-                   (c2 == gap and
-                    c1 in ambiguous)):
-                    indel_ambig += 1
-
-        if printCounts:
+    if printCounts:
+        for counts in per_chr_counts:
             print("Counts for this segment/chromosome:")
-            print("same_unambig ", same_unambig)
-            print("snp_unambig  ", snp_unambig)
-            print("indel_unambig", indel_unambig)
-            print("indel_ambig  ", indel_ambig)
-            print("ambig_one    ", ambig_one)
-            print("ambig_two    ", ambig_two)
-            print("ambig_both   ", ambig_both)
-            print("unambig_both ", unambig_both)
-
-        results["same_unambig"]  += same_unambig
-        results["snp_unambig"]   += snp_unambig
-        results["indel_unambig"] += indel_unambig
-        results["indel_ambig"]   += indel_ambig
-        results["ambig_one"]     += ambig_one
-        results["ambig_two"]     += ambig_two
-        results["ambig_both"]    += ambig_both
-        results["unambig_both"]  += unambig_both
+            _print_alignment_counts(counts)
+
+    results = _sum_alignment_counts(per_chr_counts)
 
     if printCounts:
         print("\nCounts for this sample:")
-        print("same_unambig ", results["same_unambig"])
-        print("snp_unambig  ", results["snp_unambig"])
-        print("indel_unambig", results["indel_unambig"])
-        print("indel_ambig  ", results["indel_ambig"])
-        print("ambig_one    ", results["ambig_one"])
-        print("ambig_two    ", results["ambig_two"])
-        print("ambig_both   ", results["ambig_both"])
-        print("unambig_both ", results["unambig_both"])
+        _print_alignment_counts(results)
 
     if outfileName:
         with open(outfileName, "wt") as of:
@@ -356,12 +386,42 @@ def parser_alignment_summary(parser=argparse.ArgumentParser()):
     parser.add_argument('inFastaFileTwo', help='First fasta file for an alignment')
     parser.add_argument('--outfileName', help='Output file for counts in TSV format')
     parser.add_argument('--printCounts', help='', action='store_true')
-    util.cmd.common_args(parser, (('loglevel', None), ('version', None), ('tmp_dir', None)))
+    util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None), ('tmp_dir', None)))
     util.cmd.attach_main(parser, alignment_summary, split_args=True)
     return parser
 __commands__.append(('alignment_summary', parser_alignment_summary))
 
 
+def alignment_summary_batch(inFastaRef, inFastas, outfileName, threads=None):
+    """ Write pairwise alignment summary information (as in alignment_summary)
+        of each of many sample FASTA files against one reference FASTA, one
+        TSV row per sample. The reference is sequence one of every pair.
+    """
+    workers = util.misc.sanitize_thread_count(threads)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        # all segments of all samples share one pool of aligners
+        per_sample_futures = [
+            [executor.submit(_align_chr_and_count, chr_fasta)
+             for chr_fasta in interhost.transposeChromosomeFiles([inFastaRef, inFasta])]
+            for inFasta in inFastas]
+
+        with open(outfileName, "wt") as of:
+            csvout = csv.writer(of, delimiter='\t')
+            csvout.writerow(['sample'] + list(ALIGNMENT_SUMMARY_FIELDS))
+            for inFasta, futures in zip(inFastas, per_sample_futures):
+                results = _sum_alignment_counts([f.result() for f in futures])
+                csvout.writerow([os.path.basename(inFasta).replace(".fasta", "")] + list(results.values()))
+
+def parser_alignment_summary_batch(parser=argparse.ArgumentParser()):
+    parser.add_argument('inFastaRef', help='Reference fasta file every sample is aligned against')
+    parser.add_argument('inFastas', nargs='+', help='Sample fasta files')
+    parser.add_argument('outfileName', help='Output file for per-sample counts in TSV format')
+    util.cmd.common_args(parser, (('threads', None), ('loglevel', None), ('version', None), ('tmp_dir', None)))
+    util.cmd.attach_main(parser, alignment_summary_batch, split_args=True)
+    return parser
+__commands__.append(('alignment_summary_batch', parser_alignment_summary_batch))
+
+
 def consolidate_fastqc(inDirs, outFile):
     '''Consolidate multiple FASTQC reports into one.'''
     with util.file.open_or_gzopen(outFile, 'wt') as outf:
@@ -503,7 +563,15 @@ __commands__.append(('aggregate_spike_count', parser_aggregate_spike_count))
 # =========================
 
 
+def _pyplot():
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
 def parser_plot_coverage_common(parser=argparse.ArgumentParser()):    # parser needs add_help=False?
+    plt = _pyplot()
     parser.add_argument('in_bam', help='Input reads, BAM format.')
     parser.add_argument('out_plot_file', help='The generated chart file')
     parser.add_argument(
@@ -650,6 +718,7 @@ def plot_coverage(
     ''' 
         Generate a coverage plot from an aligned bam file
     '''
+    plt = _pyplot()
     samtools = tools.samtools.SamtoolsTool()
 
     # check if in_bam is aligned, if not raise an error
@@ -721,6 +790,7 @@ def plot_coverage(
     #   samtools depth -aa mapped-to-ref.with-dups.tmp.bam
     #   bedtools genomecov -ibam mapped-to-ref.with-dups.tmp.bam -d
     if not plot_only_non_duplicates:
+        from pybedtools import BedTool
         bt = BedTool(bam_sorted)
         # "d=True" is the equivalent of passing "-d" to the bedtools CLI
         bt.genome_coverage(d=True).saveas(coverage_tsv_file)
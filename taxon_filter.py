@@ -10,18 +10,18 @@ __commands__ = []
 
 import argparse
 import glob
+import hashlib
+import itertools
 import logging
 import subprocess
 import os
 import math
 import tempfile
 import shutil
+import threading
 import concurrent.futures
 import contextlib
 
-from Bio import SeqIO
-import pysam
-
 import util.cmd
 import util.file
 import util.misc
@@ -74,6 +74,20 @@ def parser_deplete(parser=argparse.ArgumentParser()):
     )
     parser.add_argument('--srprismMemory', dest="srprism_memory", type=int, default=7168, help='Memory for srprism.')
     parser.add_argument("--chunkSize", type=int, default=1000000, help='blastn chunk size (default: %(default)s)')
+    parser.add_argument(
+        '--singlePass',
+        default=False,
+        action='store_true',
+        help="""Find the hits of every database on the shrinking set of surviving reads and filter
+                the input only once per depletion stage, instead of writing a BAM per database."""
+    )
+    parser.add_argument(
+        '--concurrentDbs',
+        default=False,
+        action='store_true',
+        help='With --singlePass, run the databases of each depletion method concurrently.'
+    )
+    parser.add_argument('--hitCountsOut', default=None, help='With --singlePass, write the number of reads hit by each database to this file.')
     parser.add_argument(
         '--JVMmemory',
         default=tools.picard.FilterSamReadsTool.jvmMemDefault,
@@ -103,6 +117,9 @@ def main_deplete(args):
 
     # if the user has requested a revertBam
 
+    if args.singlePass:
+        return main_deplete_single_pass(args)
+
     with read_utils.revert_bam_if_aligned(              args.inBam,
                                         revert_bam    = args.revertBam,
                                         clear_tags    = args.clear_tags,
@@ -145,6 +162,39 @@ def main_deplete(args):
     )
     return 0
 
+def main_deplete_single_pass(args):
+    ''' main_deplete, with each group of depletion databases applied in a
+        single pass (see deplete_single_pass).
+    '''
+    with read_utils.revert_bam_if_aligned(              args.inBam,
+                                        revert_bam    = args.revertBam,
+                                        clear_tags    = args.clear_tags,
+                                        tags_to_clear = args.tags_to_clear,
+                                        picardOptions = ['MAX_DISCARD_FRACTION=0.5'],
+                                        JVMmemory     = args.JVMmemory,
+                                        sanitize      = not args.do_not_sanitize) as bamToDeplete:
+        hit_counts = deplete_single_pass(
+            bamToDeplete,
+            [('bwa', args.bwaDbs, {}),
+             ('bmtagger', args.bmtaggerDbs, {'srprism_memory': args.srprism_memory})],
+            [args.bwaBam, args.bmtaggerBam],
+            threads=args.threads,
+            concurrentDbs=args.concurrentDbs
+        )
+
+    read_utils.rmdup_mvicuna_bam(args.bmtaggerBam, args.rmdupBam, JVMmemory=args.JVMmemory)
+    hit_counts += deplete_single_pass(
+        args.rmdupBam,
+        [('blastn', args.blastDbs, {'chunkSize': args.chunkSize})],
+        [args.blastnBam],
+        threads=args.threads,
+        concurrentDbs=args.concurrentDbs
+    )
+
+    if args.hitCountsOut:
+        write_hit_counts(hit_counts, args.hitCountsOut)
+    return 0
+
 __commands__.append(('deplete', parser_deplete))
 
 
@@ -189,31 +239,30 @@ def filter_lastal_bam(
         if not lastdb.is_indexed(db):
             db = lastdb.build_database(db, os.path.join(tmp_db_dir, 'lastdb'))
 
-        with util.file.tempfname('.read_ids.txt') as hitList:
-            number_of_hits=0
-
-            # look for lastal hits in BAM and write to temp file
-            with open(hitList, 'wt') as outf:
-                for read_id in tools.last.Lastal().get_hits(
-                        inBam, db,
-                        max_gapless_alignments_per_position,
-                        min_length_for_initial_matches,
-                        max_length_for_initial_matches,
-                        max_initial_matches_per_position,
-                        threads=threads
-                    ):
-                    number_of_hits+=1
-                    outf.write(read_id + '\n')
-
-            if error_on_reads_in_neg_control:
-                sample_name=os.path.basename(inBam)
-                if any(sample_name.lower().startswith(prefix.lower()) for prefix in neg_control_prefixes):
-                    if number_of_hits > max(0,negative_control_reads_threshold):
-                        log.warning("Error raised due to reads in negative control; re-run this without '--errorOnReadsInNegControl' if this execution should succeed.")
-                        raise QCError("The sample '{}' appears to be a negative control, but it contains {} reads after filtering to desired taxa.".format(sample_name,number_of_hits))
-
-            # filter original BAM file against keep list
-            tools.picard.FilterSamReadsTool().execute(inBam, False, hitList, outBam, JVMmemory=JVMmemory)
+        number_of_hits=0
+
+        # look for lastal hits in BAM and collect them in memory
+        hitList = []
+        for read_id in tools.last.Lastal().get_hits(
+                inBam, db,
+                max_gapless_alignments_per_position,
+                min_length_for_initial_matches,
+                max_length_for_initial_matches,
+                max_initial_matches_per_position,
+                threads=threads
+            ):
+            number_of_hits+=1
+            hitList.append(read_id)
+
+        if error_on_reads_in_neg_control:
+            sample_name=os.path.basename(inBam)
+            if any(sample_name.lower().startswith(prefix.lower()) for prefix in neg_control_prefixes):
+                if number_of_hits > max(0,negative_control_reads_threshold):
+                    log.warning("Error raised due to reads in negative control; re-run this without '--errorOnReadsInNegControl' if this execution should succeed.")
+                    raise QCError("The sample '{}' appears to be a negative control, but it contains {} reads after filtering to desired taxa.".format(sample_name,number_of_hits))
+
+        # filter original BAM file against keep list
+        read_utils.filter_bam_by_read_ids(inBam, read_utils.ReadIdSet(hitList), outBam, threads=threads)
 
 
 def parser_filter_lastal_bam(parser=argparse.ArgumentParser()):
@@ -286,16 +335,11 @@ __commands__.append(('filter_lastal_bam', parser_filter_lastal_bam))
 # ==============================
 
 
-def deplete_bmtagger_bam(inBam, db, outBam, srprism_memory=7168, JVMmemory=None):
+def bmtagger_hits(inBam, db, srprism_memory=7168, exclude=None, threads=None):
     """
-    Use bmtagger to partition the input reads into ones that match at least one
-        of the databases and ones that don't match any of the databases.
-    inBam: paired-end input reads in BAM format.
-    db: bmtagger expects files
-        db.bitmask created by bmtool, and
-        db.srprism.idx, db.srprism.map, etc. created by srprism mkindex
-    outBam: the output BAM files to hold the unmatched reads.
-    srprism_memory: srprism memory in megabytes.
+    Use bmtagger to find the reads in inBam that match the database, and
+    return the set of their read IDs. Reads whose IDs are in exclude are
+    skipped. See deplete_bmtagger_bam for the database files expected.
     """
     bmtaggerPath = tools.bmtagger.BmtaggerShTool().install_and_get_path()
 
@@ -311,7 +355,9 @@ def deplete_bmtagger_bam(inBam, db, outBam, srprism_memory=7168, JVMmemory=None)
     os.environ['PATH'] = path
 
     with util.file.tempfname('.1.fastq') as inReads1:
-        tools.samtools.SamtoolsTool().bam2fq(inBam, inReads1)
+        with open(inReads1, 'wt') as outf:
+            for record in _bam_to_fastq_records(inBam, exclude=exclude):
+                outf.write(record)
 
         with util.file.tempfname('.bmtagger.conf') as bmtaggerConf:
             with open(bmtaggerConf, 'w') as f:
@@ -319,15 +365,31 @@ def deplete_bmtagger_bam(inBam, db, outBam, srprism_memory=7168, JVMmemory=None)
                 print('srprismopts="-b 100000000 -n 5 -R 0 -r 1 -M {srprism_memory} --paired false"'.format(srprism_memory=srprism_memory), file=f)
 
             with extract_build_or_use_database(db, bmtagger_build_db, 'bitmask', tmp_suffix="-bmtagger", db_prefix="bmtagger") as (db_prefix,tempDir):
-                matchesFile = mkstempfname('.txt')
-                cmdline = [
-                    bmtaggerPath, '-b', db_prefix + '.bitmask', '-C', bmtaggerConf, '-x', db_prefix + '.srprism', '-T', tempDir, '-q1',
-                    '-1', inReads1, '-o', matchesFile
-                ]
-                log.debug(' '.join(cmdline))
-                util.misc.run_and_print(cmdline, check=True)
+                with util.file.tempfname('.txt') as matchesFile:
+                    cmdline = [
+                        bmtaggerPath, '-b', db_prefix + '.bitmask', '-C', bmtaggerConf, '-x', db_prefix + '.srprism', '-T', tempDir, '-q1',
+                        '-1', inReads1, '-o', matchesFile
+                    ]
+                    log.debug(' '.join(cmdline))
+                    util.misc.run_and_print(cmdline, check=True)
+
+                    with open(matchesFile, 'rt') as inf:
+                        return set(line.rstrip('\r\n') for line in inf if line.strip())
 
-    tools.picard.FilterSamReadsTool().execute(inBam, True, matchesFile, outBam, JVMmemory=JVMmemory)
+
+def deplete_bmtagger_bam(inBam, db, outBam, srprism_memory=7168, JVMmemory=None):
+    """
+    Use bmtagger to partition the input reads into ones that match at least one
+        of the databases and ones that don't match any of the databases.
+    inBam: paired-end input reads in BAM format.
+    db: bmtagger expects files
+        db.bitmask created by bmtool, and
+        db.srprism.idx, db.srprism.map, etc. created by srprism mkindex
+    outBam: the output BAM files to hold the unmatched reads.
+    srprism_memory: srprism memory in megabytes.
+    """
+    hits = bmtagger_hits(inBam, db, srprism_memory=srprism_memory)
+    read_utils.filter_bam_by_read_ids(inBam, read_utils.ReadIdSet(hits), outBam, exclude=True)
 
 def parser_deplete_bam_bmtagger(parser=argparse.ArgumentParser()):
     parser.add_argument('inBam', help='Input BAM file.')
@@ -404,6 +466,84 @@ def multi_db_deplete_bam(inBam, refDbs, deplete_method, outBam, **kwargs):
         os.unlink(tmpDb)
 
 
+def deplete_single_pass(inBam, stages, outBams, threads=None, concurrentDbs=False):
+    """
+    Deplete inBam against several databases, and several depletion methods,
+    without writing any intermediate BAM files. Each database's hit finder
+    runs on the reads that survived all previous databases (so later, slower
+    databases see a shrinking input), and the original BAM is filtered only
+    once at the end.
+
+    stages: list of (method, refDbs, kwargs) tuples, where method is a key of
+        DEPLETION_HIT_FINDERS and kwargs are extra arguments for its hit finder.
+    outBams: one output BAM per stage (or None to skip one), each holding the
+        reads that survive that stage and all the stages before it. All
+        outputs are written in the same pass.
+    concurrentDbs: run the databases within a stage concurrently on the same
+        survivor reads, instead of one after another.
+
+    Returns a list of (method, db, hit_count) tuples: the number of read IDs
+    removed by each database (mates share an ID).
+    """
+    import pysam
+    assert len(stages) == len(outBams)
+    threads = util.misc.sanitize_thread_count(threads)
+
+    # read ID -> index of the first stage that removed it
+    hit_stage = {}
+    hit_counts = []
+    for stage_idx, (method, refDbs, kwargs) in enumerate(stages):
+        find_hits = DEPLETION_HIT_FINDERS[method]
+        if concurrentDbs and len(refDbs) > 1:
+            db_threads = max(1, threads // len(refDbs))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(refDbs)) as executor:
+                futures = [executor.submit(find_hits, inBam, db, exclude=hit_stage, threads=db_threads, **kwargs)
+                           for db in refDbs]
+                results = [future.result() for future in futures]
+        else:
+            results = None
+        for i, db in enumerate(refDbs):
+            if results is None:
+                log.info("finding %s hits in %s against %s", method, inBam, db)
+                db_hits = find_hits(inBam, db, exclude=hit_stage, threads=threads, **kwargs)
+            else:
+                db_hits = results[i]
+            n_new = 0
+            for read_id in db_hits:
+                if read_id not in hit_stage:
+                    hit_stage[read_id] = stage_idx
+                    n_new += 1
+            log.info("%s: %d read IDs hit %s", method, n_new, db)
+            hit_counts.append((method, db, n_new))
+
+    # filter the original BAM once, writing every stage's output together
+    outputs = list((stage_idx, outBam) for stage_idx, outBam in enumerate(outBams) if outBam)
+    with pysam.AlignmentFile(inBam, 'rb', check_sq=False) as inb:
+        out_files = list((stage_idx, pysam.AlignmentFile(outBam, 'wb', template=inb, threads=threads))
+                         for stage_idx, outBam in outputs)
+        try:
+            for read in inb.fetch(until_eof=True):
+                first_hit = hit_stage.get(read.query_name, len(stages))
+                for stage_idx, outb in out_files:
+                    if first_hit > stage_idx:
+                        outb.write(read)
+        finally:
+            for _, outb in out_files:
+                outb.close()
+
+    return hit_counts
+
+
+def write_hit_counts(hit_counts, outFile):
+    ''' Write the per-database hit counts from deplete_single_pass as a
+        tab-delimited report.
+    '''
+    with open(outFile, 'wt') as outf:
+        outf.write('\t'.join(('method', 'db', 'hits')) + '\n')
+        for method, db, n in hit_counts:
+            outf.write('\t'.join((method, db, str(n))) + '\n')
+
+
 # ========================
 # ***  deplete_blastn  ***
 # ========================
@@ -424,6 +564,7 @@ def blastn_chunked_fasta(fasta, db, out_hits, chunkSize=1000000, threads=None):
     and running a new blastn process on each chunk. Return a list of output
     filenames containing hits
     """
+    from Bio import SeqIO
     # the lower bound of how small a fasta chunk can be.
     # too small and the overhead of spawning a new blast process
     # will be detrimental relative to actual computation time
@@ -503,29 +644,240 @@ def blastn_chunked_fasta(fasta, db, out_hits, chunkSize=1000000, threads=None):
         os.unlink(hits_files[i])
 
 
-def deplete_blastn_bam(inBam, db, outBam, threads=None, chunkSize=1000000, JVMmemory=None):
-#def deplete_blastn_bam(inBam, db, outBam, threads, chunkSize=0, JVMmemory=None):
-    'Use blastn to remove reads that match at least one of the databases.'
+def _run_blastn_chunk_str(db, fasta_str, blast_threads):
+    """ run blastn on a batch of FASTA-formatted reads passed in memory and
+        return the hit read IDs. this is intended to be run in parallel
+        by blastn_chunked_bam
+    """
+    return tools.blast.BlastnTool().get_hits_fasta_str(fasta_str, db, threads=blast_threads)
 
-    blast_hits = mkstempfname('.blast_hits.txt')
+def _bam_to_fasta_records(inBam, exclude=None):
+    """ stream reads from a BAM as FASTA text records, one per read,
+        matching the output of samtools fasta -n. Reads whose IDs are
+        in exclude are skipped.
+    """
+    import pysam
+    with pysam.AlignmentFile(inBam, 'rb', check_sq=False) as bam:
+        for read in bam.fetch(until_eof=True):
+            if read.is_secondary or read.is_supplementary:
+                continue
+            if exclude and read.query_name in exclude:
+                continue
+            seq = read.get_forward_sequence()
+            if seq:
+                yield '>{}\n{}\n'.format(read.query_name, seq)
+
+def _bam_to_fastq_records(inBam, exclude=None):
+    """ stream reads from a BAM as FASTQ text records, one per read,
+        matching the output of samtools bam2fq -n. Reads whose IDs are
+        in exclude are skipped.
+    """
+    import pysam
+    with pysam.AlignmentFile(inBam, 'rb', check_sq=False) as bam:
+        for read in bam.fetch(until_eof=True):
+            if read.is_secondary or read.is_supplementary:
+                continue
+            if exclude and read.query_name in exclude:
+                continue
+            seq = read.get_forward_sequence()
+            if seq:
+                quals = read.get_forward_qualities()
+                qual = ''.join(chr(q + 33) for q in quals) if quals is not None else 'I' * len(seq)
+                yield '@{}\n{}\n+\n{}\n'.format(read.query_name, seq, qual)
+
+@contextlib.contextmanager
+def _records_pipe(records):
+    """ feed text records to a pipe from a background thread, and yield
+        the read end of the pipe (e.g. for use as a subprocess stdin)
+    """
+    read_fd, write_fd = os.pipe()
+    def writer():
+        with os.fdopen(write_fd, 'wt') as outf:
+            try:
+                for record in records:
+                    outf.write(record)
+            except BrokenPipeError:
+                pass
+    thread = threading.Thread(target=writer)
+    thread.daemon = True
+    thread.start()
+    with os.fdopen(read_fd, 'rb') as inf:
+        yield inf
+    thread.join()
+
+def _files_identity(paths):
+    """ Describe files by resolved path, size and mtime, so that a change to
+        any of them can be detected. Each path may be a file, a directory
+        (all files beneath it) or a file name prefix (such as a blast
+        database prefix, for all files named <prefix>.*).
+    """
+    rows = []
+    for path in paths:
+        if os.path.isdir(path):
+            fns = sorted(os.path.join(root, fn) for root, dirs, files in os.walk(path) for fn in files)
+        elif os.path.isfile(path):
+            fns = [path]
+        else:
+            fns = sorted(glob.glob(glob.escape(path) + '.*'))
+        for fn in fns:
+            stat = os.stat(fn)
+            rows.append('{}\t{}\t{}'.format(os.path.realpath(fn), stat.st_size, stat.st_mtime_ns))
+    return '\n'.join(rows)
+
+def blastn_chunked_bam(inBam, db, out_hits, chunkSize=1000000, threads=None, resumeDir=None, maxRetries=2, exclude=None,
+                       dbIdentity=None):
+    """
+    Helper function: blastn the reads of a BAM file in chunks, like
+    blastn_chunked_fasta, but without any intermediate FASTA files. The BAM
+    is read once and fixed-size batches of reads are fed over pipes to a
+    bounded pool of blastn worker processes. Hit read IDs are written to
+    out_hits as each chunk finishes.
+
+    A chunk whose blastn process fails is retried up to maxRetries times.
+    If resumeDir is given, the hits of every finished chunk are also saved
+    there under a digest of the chunk's reads and of the database, and a
+    later call with the same resumeDir only runs blastn on chunks with no
+    saved hits for the same reads and database. The database is identified
+    by the path, size and mtime of its files, or by dbIdentity if given
+    (e.g. when db is a temporary unpacked copy).
+
+    Reads whose IDs are in exclude are skipped.
+    """
+    # the lower bound of how small a fasta chunk can be.
+    # too small and the overhead of spawning a new blast process
+    # will be detrimental relative to actual computation time
+    MIN_CHUNK_SIZE = 20000
 
+    # just in case blast is not installed, install it once, not many times in parallel!
+    tools.blast.BlastnTool().install()
+
+    # clamp threadcount to number of CPU cores
+    threads = util.misc.sanitize_thread_count(threads)
+
+    # divide (max, single-thread) chunksize by thread count
+    # to find the absolute max chunk size per thread
+    chunkSize = max(chunkSize // threads, MIN_CHUNK_SIZE)
+    log.debug("blastn chunk size %s" % chunkSize)
+    log.debug("blastn parallel instances %s" % threads)
+
+    if resumeDir:
+        util.file.mkdir_p(resumeDir)
+        db_digest = hashlib.sha1((dbIdentity if dbIdentity is not None else _files_identity([db])).encode('utf-8'))
+
+    def chunk_hits_file(i, fasta_str):
+        digest = db_digest.copy()
+        digest.update(fasta_str.encode('utf-8'))
+        return os.path.join(resumeDir, 'chunk_{:06d}.{}.hits.txt'.format(i, digest.hexdigest()))
+
+    def save_chunk_hits(i, fasta_str, hits):
+        for fn in glob.glob(os.path.join(resumeDir, 'chunk_{:06d}.*.hits.txt'.format(i))):
+            os.unlink(fn)
+        hits_file = chunk_hits_file(i, fasta_str)
+        with open(hits_file + '.tmp', 'wt') as chunkf:
+            for read_id in hits:
+                chunkf.write(read_id + '\n')
+        os.replace(hits_file + '.tmp', hits_file)
+
+    chunks = enumerate(''.join(batch)
+                       for batch in util.misc.batch_iterator(_bam_to_fasta_records(inBam, exclude=exclude), chunkSize))
+
+    with open(out_hits, 'wt') as outf:
+        n_resumed = [0]
+        def next_chunks(n):
+            # the next n chunks that need blastn, copying saved hits of the others
+            for i, fasta_str in chunks:
+                if resumeDir and os.path.isfile(chunk_hits_file(i, fasta_str)):
+                    with open(chunk_hits_file(i, fasta_str), 'rt') as inf:
+                        shutil.copyfileobj(inf, outf)
+                    n_resumed[0] += 1
+                    continue
+                yield i, fasta_str
+                n -= 1
+                if n <= 0:
+                    return
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
+            # hold at most one chunk per worker in memory. If we have so few
+            # chunks that there are cpus left over, divide extra cpus evenly
+            # among chunks where possible rounding to 1 if there are more
+            # chunks than extra threads. Then double up this number to better
+            # maximize CPU usage.
+            queued = list(next_chunks(threads))
+            if len(queued) < threads:
+                blast_threads = 2*max(1, int((threads - len(queued)) / max(1, len(queued))))
+            else:
+                blast_threads = 2
+
+            pending = {}
+            def submit(i, fasta_str, attempt):
+                future = executor.submit(_run_blastn_chunk_str, db, fasta_str, blast_threads)
+                pending[future] = (i, fasta_str, attempt)
+
+            for i, fasta_str in queued:
+                submit(i, fasta_str, 0)
+            queued = None
+
+            while pending:
+                finished, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    i, fasta_str, attempt = pending.pop(future)
+                    try:
+                        hits = future.result()
+                    except subprocess.CalledProcessError:
+                        if attempt >= maxRetries:
+                            raise
+                        log.warning("blastn failed on chunk %d, retrying (attempt %d of %d)", i, attempt + 1, maxRetries)
+                        submit(i, fasta_str, attempt + 1)
+                        continue
+                    for read_id in hits:
+                        outf.write(read_id + '\n')
+                    outf.flush()
+                    if resumeDir:
+                        save_chunk_hits(i, fasta_str, hits)
+                    # keep the pool busy with the next chunk from the stream
+                    for next_i, next_fasta_str in next_chunks(1):
+                        submit(next_i, next_fasta_str, 0)
+        if n_resumed[0]:
+            log.info("resumed blastn: reused the saved hits of %d chunks in %s", n_resumed[0], resumeDir)
+
+
+def blastn_hits(inBam, db, threads=None, chunkSize=1000000, resumeDir=None, exclude=None):
+    ''' Use blastn to find the reads in inBam that match the database, and
+        return the set of their read IDs. Reads whose IDs are in exclude
+        are skipped.
+    '''
     with extract_build_or_use_database(db, blastn_build_db, 'nin', tmp_suffix="-blastn_db_unpack", db_prefix="blastn") as (db_prefix,tempDir):
         if chunkSize:
-            ## chunk up input and perform blastn in several parallel threads
-            with util.file.tempfname('.fasta') as reads_fasta:
-                tools.samtools.SamtoolsTool().bam2fa(inBam, reads_fasta)
-                log.info("running blastn on %s against %s", inBam, db)
-                blastn_chunked_fasta(reads_fasta, db_prefix, blast_hits, chunkSize, threads)
+            ## stream chunks of input to blastn in several parallel processes
+            log.info("running blastn on %s against %s", inBam, db)
+            dbIdentity = None
+            if resumeDir:
+                # keep finished chunks from each database separately
+                db_path = os.path.realpath(db)
+                resumeDir = os.path.join(resumeDir, '{}-{}'.format(
+                    os.path.basename(db_path), hashlib.sha1(db_path.encode('utf-8')).hexdigest()[:12]))
+                # identify the database as given, not its temporary unpacked copy
+                dbIdentity = _files_identity([db])
+            with util.file.tempfname('.blast_hits.txt') as blast_hits:
+                blastn_chunked_bam(inBam, db_prefix, blast_hits, chunkSize, threads, resumeDir=resumeDir, exclude=exclude,
+                                   dbIdentity=dbIdentity)
+                with open(blast_hits, 'rt') as inf:
+                    return set(line.rstrip('\r\n') for line in inf)
 
         else:
             ## pipe tools together and run blastn multithreaded
-            with open(blast_hits, 'wt') as outf:
-                for read_id in tools.blast.BlastnTool().get_hits_bam(inBam, db_prefix, threads=threads):
-                    outf.write(read_id + '\n')
+            with _records_pipe(_bam_to_fasta_records(inBam, exclude=exclude)) as fasta_pipe:
+                return set(tools.blast.BlastnTool().get_hits_pipe(fasta_pipe, db_prefix, threads=threads))
+
+
+def deplete_blastn_bam(inBam, db, outBam, threads=None, chunkSize=1000000, JVMmemory=None, resumeDir=None):
+#def deplete_blastn_bam(inBam, db, outBam, threads, chunkSize=0, JVMmemory=None):
+    'Use blastn to remove reads that match at least one of the databases.'
+
+    hits = blastn_hits(inBam, db, threads=threads, chunkSize=chunkSize, resumeDir=resumeDir)
 
     # Deplete BAM of hits
-    tools.picard.FilterSamReadsTool().execute(inBam, True, blast_hits, outBam, JVMmemory=JVMmemory)
-    os.unlink(blast_hits)
+    read_utils.filter_bam_by_read_ids(inBam, read_utils.ReadIdSet(hits), outBam, exclude=True, threads=threads)
 
 
 def parser_deplete_blastn_bam(parser=argparse.ArgumentParser()):
@@ -534,6 +886,9 @@ def parser_deplete_blastn_bam(parser=argparse.ArgumentParser()):
                          'An ephemeral database will be created if a fasta file is provided.')
     parser.add_argument('outBam', help='Output BAM file with matching reads removed.')
     parser.add_argument("--chunkSize", type=int, default=1000000, help='FASTA chunk size (default: %(default)s)')
+    parser.add_argument("--resumeDir", default=None,
+                        help="""Directory in which to save the blastn hits of each finished chunk. Re-running
+                                with the same input and resumeDir only re-runs unfinished chunks.""")
     parser.add_argument(
         '--JVMmemory',
         default=tools.picard.FilterSamReadsTool.jvmMemDefault,
@@ -549,7 +904,7 @@ def main_deplete_blastn_bam(args):
     '''Use blastn to remove reads that match at least one of the specified databases.'''
 
     def wrapper(inBam, db, outBam, threads, JVMmemory=None):
-        return deplete_blastn_bam(inBam, db, outBam, threads=threads, chunkSize=args.chunkSize, JVMmemory=JVMmemory)
+        return deplete_blastn_bam(inBam, db, outBam, threads=threads, chunkSize=args.chunkSize, JVMmemory=JVMmemory, resumeDir=args.resumeDir)
 
     with read_utils.revert_bam_if_aligned(              args.inBam,
                                         clear_tags    = args.clear_tags,
@@ -603,6 +958,29 @@ def extract_build_or_use_database(db, db_build_command, db_extension_to_expect,
 # ***  deplete_bwa  ***
 # ========================
 
+def bwa_hits(inBam, db, threads=None, exclude=None):
+    ''' Use bwa to find the reads in inBam that align to the database in
+        proper pairs (the reads deplete_bwa_bam removes), and return the set
+        of their read IDs. Reads whose IDs are in exclude are skipped.
+    '''
+    threads = util.misc.sanitize_thread_count(threads)
+    hits = set()
+    with extract_build_or_use_database(db, bwa_build_db, 'bwt', tmp_suffix="-bwa_db_unpack", db_prefix="bwa") as (db_prefix,tempDbDir):
+        cmd = [tools.bwa.Bwa().install_and_get_path(), 'mem', '-t', str(threads), '-p', db_prefix, '-']
+        log.debug(' '.join(cmd))
+        with _records_pipe(_bam_to_fastq_records(inBam, exclude=exclude)) as fastq_pipe:
+            bwa_proc = subprocess.Popen(cmd, stdin=fastq_pipe, stdout=subprocess.PIPE)
+            for line in bwa_proc.stdout:
+                if line.startswith(b'@'):
+                    continue
+                fields = line.split(b'\t', 2)
+                if int(fields[1]) & 0x2:
+                    hits.add(fields[0].decode('UTF-8'))
+            if bwa_proc.wait():
+                raise subprocess.CalledProcessError(bwa_proc.returncode, cmd)
+    return hits
+
+
 def deplete_bwa_bam(inBam, db, outBam, threads=None, clear_tags=True, tags_to_clear=None, JVMmemory=None):
     'Use bwa to remove reads from an unaligned bam that match at least one of the databases.'
     tags_to_clear = tags_to_clear or []
@@ -657,6 +1035,14 @@ def main_deplete_bwa_bam(args):
 __commands__.append(('deplete_bwa_bam', parser_deplete_bwa_bam))
 
 
+# hit finders used by deplete_single_pass, by depletion method name
+DEPLETION_HIT_FINDERS = {
+    'bwa': bwa_hits,
+    'bmtagger': bmtagger_hits,
+    'blastn': blastn_hits,
+}
+
+
 # ========================
 # ***  lastal_build_db  ***
 # ========================
@@ -5,10 +5,13 @@ __author__ = "dpark@broadinstitute.org"
 import assembly
 import util.cmd
 import util.file
+import Bio.AlignIO
 import Bio.SeqIO
 import Bio.Data.IUPACData
 import unittest
 import argparse
+import csv
+import io
 import os
 import os.path
 import shutil
@@ -16,6 +19,8 @@ import tempfile
 import argparse
 import itertools
 import pytest
+import pysam
+from mock import patch
 import tools.mummer
 import tools.novoalign
 import tools.picard
@@ -241,6 +246,88 @@ class TestTrimRmdupSubsamp(TestCaseWithTmp):
         os.unlink(outBam)
         self.assertEqual(read_stats, (18710, 16310, 16310, 500, 500, 0))
 
+    def test_subsamp_reproducible(self):
+        inDir = util.file.get_test_input_path()
+        inBam = os.path.join(inDir, 'G5012.3.testreads.bam')
+        clipDb = os.path.join(inDir, 'TestAssembleTrinity', 'clipDb.fasta')
+        outs = []
+        for _ in range(2):
+            outBam = util.file.mkstempfname('.out.bam')
+            assembly.trim_rmdup_subsamp_reads(inBam, clipDb, outBam, n_reads=500, seed=3)
+            outs.append(bam_reads(outBam))
+        self.assertEqual(outs[0], outs[1])
+
+
+def bam_reads(inBam):
+    with pysam.AlignmentFile(inBam, 'rb', check_sq=False) as inb:
+        return [(read.query_name, read.flag, read.query_sequence, read.qual) for read in inb.fetch(until_eof=True)]
+
+
+def fake_trimmomatic(inFastq1, inFastq2, pairedOutFastq1, pairedOutFastq2, clipFasta,
+                     unpairedOutFastq1=None, unpairedOutFastq2=None, **kwargs):
+    ''' Stands in for Trimmomatic: every third pair loses read 2, the next
+        loses read 1, and the rest pass through. '''
+    def records(inf):
+        while True:
+            record = ''.join(inf.readline() for _ in range(4))
+            if not record:
+                return
+            yield record
+    with open(inFastq1, 'rt') as in1, open(inFastq2, 'rt') as in2, \
+            open(pairedOutFastq1, 'wt') as out1, open(pairedOutFastq2, 'wt') as out2, \
+            open(unpairedOutFastq1, 'wt') as unpaired1, open(unpairedOutFastq2, 'wt') as unpaired2:
+        for i, (read1, read2) in enumerate(zip(records(in1), records(in2))):
+            if i % 3 == 0:
+                unpaired1.write(read1)
+            elif i % 3 == 1:
+                unpaired2.write(read2)
+            else:
+                out1.write(read1)
+                out2.write(read2)
+
+
+class TestTrimRmdupSubsampStreaming(TestCaseWithTmp):
+    ''' Test the streaming and sampling of trim_rmdup_subsamp_reads
+        around a stand-in for Trimmomatic '''
+
+    def test_reproducible_with_unpaired_reads(self):
+        inBam = os.path.join(util.file.get_test_input_path(), 'G5012.3.testreads.bam')
+        outs = []
+        with patch('tools.trimmomatic.TrimmomaticTool') as trimmomatic:
+            trimmomatic.return_value.execute.side_effect = fake_trimmomatic
+            for _ in range(3):
+                outBam = util.file.mkstempfname('.out.bam')
+                read_stats = assembly.trim_rmdup_subsamp_reads(inBam, None, outBam, n_reads=8000, seed=5)
+                outs.append(bam_reads(outBam))
+        self.assertEqual(outs[0], outs[1])
+        self.assertEqual(outs[0], outs[2])
+        self.assertEqual(read_stats[0], 18710)
+        n_unpaired = sum(1 for read in outs[0] if not read[1] & 0x1)
+        self.assertGreater(n_unpaired, 0)
+        self.assertEqual(len(outs[0]), 8000)
+
+
+class TestReadReservoir(unittest.TestCase):
+
+    def test_keeps_everything_under_capacity(self):
+        reservoir = assembly.ReadReservoir(10)
+        for i in range(5):
+            reservoir.add(i)
+        self.assertEqual(reservoir.sample(), [0, 1, 2, 3, 4])
+        self.assertEqual(len(reservoir.sample(3)), 3)
+
+    def test_sample_is_reproducible(self):
+        samples = []
+        for _ in range(2):
+            reservoir = assembly.ReadReservoir(20, seed=7)
+            for i in range(1000):
+                reservoir.add(i)
+            samples.append(reservoir.sample())
+        self.assertEqual(samples[0], samples[1])
+        self.assertEqual(len(samples[0]), 20)
+        self.assertEqual(samples[0], sorted(samples[0]))
+        self.assertEqual(reservoir.n_seen, 1000)
+
 
 class TestAmbiguityBases(unittest.TestCase):
 
@@ -296,6 +383,32 @@ class TestOrderAndOrient(TestCaseWithTmp):
             self.assertEqualFasta(outReference, refs[0])
             self.assertEqualContents(outStats, expectedStats)
 
+    def test_lassa_multisegment_refsel_top_refs(self):
+        with util.file.tempfnames(('.out.fasta', '.out_ref.fasta', '.stats.tsv')) \
+             as (outFasta, outReference, outStats):
+            contigs, expected = self.inputs('contigs.lasv.fasta', 'expected.lasv.fasta')
+            refs = [self.input('ref.lasv.{}.fasta'.format(strain))
+                    for strain in ('josiah', 'pinneo', 'KGH_G502', 'BNI_Nig08_A19', 'nomatch')]
+            assembly.order_and_orient(contigs, refs, outFasta,
+                                      outReference=outReference, outStats=outStats, top_refs=2)
+            self.assertEqualContents(outFasta, expected)
+            self.assertEqualFasta(outReference, refs[0])
+            with open(outStats) as stats_f:
+                stats = list(csv.DictReader(stats_f, delimiter='\t'))
+            self.assertEqual([row['scaffolded'] for row in stats], ['1', '0', '1', '0', '0'])
+            self.assertEqual([row['base_count'] for row in stats], ['10671', '0', '10655', '0', '0'])
+            self.assertEqual(stats[4]['kmer_containment'], '0.0000')
+
+    def test_kmer_containment_screen(self):
+        contigs = self.input('contigs.lasv.fasta')
+        contigs_sketch = assembly._kmer_sketch(seq.seq for seq in Bio.SeqIO.parse(contigs, 'fasta'))
+        containments = []
+        for strain in ('josiah', 'pinneo', 'KGH_G502', 'BNI_Nig08_A19', 'nomatch'):
+            ref_sketch = assembly._kmer_sketch(seq.seq for seq in Bio.SeqIO.parse(self.input('ref.lasv.{}.fasta'.format(strain)), 'fasta'))
+            containments.append(assembly._kmer_containment(contigs_sketch, ref_sketch))
+        self.assertEqual(sorted(range(5), key=lambda i: -containments[i])[:2], [0, 2])
+        self.assertEqual(containments[4], 0.0)
+
     def test_influenza_multisegment(self):
         inDir = util.file.get_test_input_path(self)
         outFasta = util.file.mkstempfname('.fasta')
@@ -538,6 +651,42 @@ class TestImputeFromReference(TestCaseWithTmp):
             str(Bio.SeqIO.read(expected, 'fasta').seq))
 
 
+class TestContigModifier(unittest.TestCase):
+    ''' Test the ContigModifier class and modified_contig '''
+
+    def test_call_reference_ns_and_ambiguous(self):
+        mc = assembly.ContigModifier('ACGTACGT', 'ANGTRCGT')
+        mc.call_reference_ns()
+        self.assertEqual(mc.get_stripped_consensus(), 'ACGTRCGT')
+        mc.call_reference_ambiguous()
+        self.assertEqual(mc.get_stripped_consensus(), 'ACGTACGT')
+
+    def test_trim_and_replace_ends(self):
+        mc = assembly.ContigModifier('--ACGTACGT--', 'TTACCTACGGAA')
+        mc.trim_ends()
+        self.assertEqual(mc.get_stripped_consensus(), 'ACCTACGG')
+        mc.replace_5ends(2)
+        mc.replace_3ends(2)
+        self.assertEqual(mc.get_stripped_consensus(), 'ACCTACGT')
+
+    def test_replace_end_gaps_and_remove_end_ns(self):
+        mc = assembly.ContigModifier('ACGTACGTAC', '--NTACG-NN')
+        mc.remove_end_ns()
+        self.assertEqual(mc.get_stripped_consensus(), 'TACG')
+        mc.replace_end_gaps()
+        self.assertEqual(mc.get_stripped_consensus(), 'ACGTACGTAC')
+
+    def test_modified_contig_names(self):
+        aln = Bio.AlignIO.read(io.StringIO('>ref\nACGTACGT\n>contig\nACNTAC-T\n'), 'fasta')
+        self.assertEqual(
+            assembly.modified_contig(aln, 'ref', call_reference_ns=True),
+            ('contig', 'ACGTACT'))
+        self.assertEqual(
+            assembly.modified_contig(aln, 'ref', name='renamed'),
+            ('renamed', 'ACNTACT'))
+        self.assertRaises(NameError, assembly.modified_contig, aln, 'missing')
+
+
 class TestMutableSequence(unittest.TestCase):
     ''' Test the MutableSequence class '''
 
@@ -726,6 +875,30 @@ class TestManualSnpCaller(unittest.TestCase):
         self.assertEqual(actual, expected)
 
 
+    def test_vcf_to_seqs_pysam_records(self):
+        myInputDir = util.file.get_test_input_path(self)
+        input = os.path.join(myInputDir, 'indel.vcf.gz')
+        chrlens = {'EBOV_2014_G6060.1': 18962}
+        samples = ['G6060.1']
+        expected = list(assembly.vcf_to_seqs(util.file.read_tabfile(input), chrlens, samples, min_dp=2))
+        with pysam.VariantFile(input) as vcf:
+            actual = list(assembly.vcf_to_seqs(vcf, chrlens, samples, min_dp=2))
+        self.assertEqual(actual, expected)
+
+    def test_vcf_to_seqs_multisample(self):
+        rows = [
+            ['c1', '1', '.', 'A', 'G', '.', '.', '.', 'GT:AD', '0/1:5,0', '0/1:0,5', '0/1:3,3'],
+            ['c1', '3', '.', 'CT', 'C', '.', '.', '.', 'GT:AD', '0/1:0,5', '0/1:5,0', '0/1:0,0'],
+            ['c1', '4', '.', 'T', '.', '.', '.', '.', 'GT:DP', '0/0:5', '0/0:5', '0/0:1'],
+            ['c2', '2', '.', 'G', 'GA', '.', '.', '.', 'GT:AD', '0/1:5,0', '0/1:0,5', '0/1:3,3'],
+        ]
+        actual = list(assembly.vcf_to_seqs(rows, {'c1': 5, 'c2': 3}, ['s1', 's2', 's3'], min_dp=2))
+        self.assertEqual(actual, [
+            ('c1-s1', 'ANCN'), ('c1-s2', 'GNCTN'), ('c1-s3', 'RNNNN'),
+            ('c2-s1', 'NGN'), ('c2-s2', 'NGAN'), ('c2-s3', 'NGAN'),
+        ])
+
+
 class TestDeambigAndTrimFasta(TestCaseWithTmp):
     ''' Test the deambig_fasta and trim_fasta commands. '''
 
@@ -12,6 +12,7 @@ import filecmp
 import util
 import util.file
 import illumina
+import util.illumina_indices
 import tools.samtools
 from test import TestCaseWithTmp
 
@@ -235,6 +236,99 @@ class TestDifficultSampleNames(TestCaseWithTmp):
             assert util.file.string_to_file_name(sample_name) in sample_names
 
 
+class TestIlluminaIndexReference(unittest.TestCase):
+    def setUp(self):
+        self.ref = util.illumina_indices.IlluminaIndexReference()
+
+    def _neighbor_walk(self, seq, distance, kit=None):
+        # the exhaustive lookup that the precomputed neighborhoods replace
+        possible_indices = set()
+        for neighbor_seq in self.ref.neighbors(seq, distance=distance):
+            possible_indices |= set(self.ref.index_for_seq(neighbor_seq, kit=kit))
+        return sorted(possible_indices)
+
+    def test_index_for_seq(self):
+        self.assertIn("N701", self.ref.index_for_seq("TAAGGCGA", kit="nextera"))
+        self.assertEqual(self.ref.index_for_seq("TAAGGCGA", kit="nextera", instrument="NoSuchInstrument"), [])
+        self.assertEqual(self.ref.index_for_seq("TCGCCTTA", kit="nextera"), [])
+        self.assertIn("N701", self.ref.index_for_seq("TCGCCTTA", kit="nextera", reverse_complement=True))
+
+    def test_seq_for_index(self):
+        self.assertEqual(self.ref.seq_for_index("N701", kit="nextera"), ["TAAGGCGA"])
+        # index names may be patterns, like [N|S|E]501
+        self.assertTrue(len(self.ref.seq_for_index("S501")))
+
+    def test_guess_index_matches_neighbor_walk(self):
+        for seq in ("TAAGGCGA", "TAAGGCGT", "TAAGGCNN", "TATGGCGT", "GGGGGGGG", "TAAGGCG"):
+            for distance in (1, 2):
+                expected = self.ref.index_for_seq(seq) or self._neighbor_walk(seq, distance)
+                self.assertEqual(self.ref.guess_index(seq, distance=distance), expected)
+        self.assertEqual(self.ref.guess_index("TAAGGCGT", kit="nextera"), self._neighbor_walk("TAAGGCGT", 1, kit="nextera"))
+
+    def test_guess_indices(self):
+        seqs = ["TAAGGCGT", "GGGGGGGG", "TAAGGCGT", "TAAGGCGA"]
+        self.assertEqual(self.ref.guess_indices(seqs, distance=1), [self.ref.guess_index(s) for s in seqs])
+        self.assertEqual(self.ref.guess_indices([]), [])
+
+
+class TestCountAndSortBarcodes(TestCaseWithTmp):
+    def _write_tiles(self, barcodes_dir, tiles):
+        for i, tile in enumerate(tiles):
+            with open(os.path.join(barcodes_dir, 's_1_{}_barcode.txt'.format(1101 + i)), 'wt') as outf:
+                for barcode in tile:
+                    outf.write('\t'.join((barcode, 'Y', barcode, '0', '1')) + '\n')
+
+    def _read_counts(self, summary):
+        with open(summary, 'rt') as inf:
+            rows = [line.rstrip('\n').split('\t') for line in inf][1:]
+        return [(row[0] + row[2], int(row[4])) for row in rows]
+
+    def test_counts_sorted(self):
+        barcodes_dir = tempfile.mkdtemp()
+        tiles = [['TAAGGCGATAGATCGC'] * 5 + ['CGTACTAGCTCTCTAT'] * 2 + ['TAAGGCGA.AGATCGC', 'AAAA'],
+                 ['CGTACTAGCTCTCTAT'] * 4 + ['TAAGGCGATAGATCGC', 'GGGGGGGGGGGGGGGGGGGGGGGGG', 'AAAA']]
+        self._write_tiles(barcodes_dir, tiles)
+        summary = util.file.mkstempfname('.txt')
+
+        illumina.count_and_sort_barcodes(barcodes_dir, summary)
+        # ties are listed in barcode order; barcodes too long to pack are still counted
+        self.assertEqual(self._read_counts(summary),
+            [('CGTACTAGCTCTCTAT', 6), ('TAAGGCGATAGATCGC', 6), ('AAAA', 2), ('GGGGGGGGGGGGGGGGGGGGGGGGG', 1)])
+
+        # capping the distinct barcodes held only prunes the rarest ones
+        illumina.count_and_sort_barcodes(barcodes_dir, summary, truncateToLength=3, includeNoise=True, maxDistinctBarcodes=4)
+        self.assertEqual(self._read_counts(summary),
+            [('CGTACTAGCTCTCTAT', 6), ('TAAGGCGATAGATCGC', 6), ('AAAA', 2)])
+
+    def test_long_barcodes_capped(self):
+        # 12+12 dual indexes are too long to pack, but are pruned the same way
+        barcodes_dir = tempfile.mkdtemp()
+        common = ['AAAACCCCGGGGTTTTACGTACGT'] * 3 + ['CCCCGGGGTTTTAAAACGTACGTA'] * 2
+        tiles = [common + ['ACGTACGTACGT' + 'ACGTAC' + 'ACGTAC'[:i] + 'T' * (6 - i) for i in range(6)],
+                 common + ['GGGGGGGGGGGG' + 'ACGTAC' + 'ACGTAC'[:i] + 'T' * (6 - i) for i in range(6)]]
+        self._write_tiles(barcodes_dir, tiles)
+        summary = util.file.mkstempfname('.txt')
+
+        tally, other = illumina._tally_barcode_file(os.path.join(barcodes_dir, 's_1_1101_barcode.txt'), max_distinct=2)
+        self.assertEqual(len(tally[0]), 0)
+        self.assertEqual(other, {'AAAACCCCGGGGTTTTACGTACGT': 3, 'CCCCGGGGTTTTAAAACGTACGTA': 2})
+
+        illumina.count_and_sort_barcodes(barcodes_dir, summary, maxDistinctBarcodes=2)
+        self.assertEqual(self._read_counts(summary),
+            [('AAAACCCCGGGGTTTTACGTACGT', 6), ('CCCCGGGGTTTTAAAACGTACGTA', 4)])
+
+    def test_barcode_helper_from_rows(self):
+        in_dir = os.path.join(util.file.get_test_input_path(), 'TestIlluminaBarcodeHelper', 'one_correction')
+        in_barcodes = os.path.join(in_dir, 'barcodes.txt')
+        with open(in_barcodes, 'rt') as inf:
+            header = inf.readline().rstrip('\n').split('\t')
+            rows = [dict(zip(header, line.rstrip('\n').split('\t'))) for line in inf]
+        bh = util.illumina_indices.IlluminaBarcodeHelper(rows, os.path.join(in_dir, 'metrics.txt'), None)
+        out_report = util.file.mkstempfname('.txt')
+        bh.write_guessed_barcodes(out_report, bh.find_uncertain_barcodes())
+        self.assertEqualContents(out_report, os.path.join(in_dir, 'expected.txt'))
+
+
 class TestIlluminaBarcodeHelper(TestCaseWithTmp):
     def test_one_correction(self):
         dir_prefix = "one_correction"
@@ -9,6 +9,8 @@ import unittest
 import argparse
 import itertools
 
+import numpy
+
 
 class TestCommandHelp(unittest.TestCase):
 
@@ -287,6 +289,27 @@ class TestSpecificAlignments(test.TestCaseWithTmp):
                 self.assertEqual(cm.mapChr(a, b, i), (b, i))
                 self.assertEqual(cm.mapChr(b, a, i), (a, i))
 
+    def test_map_positions(self):
+        alignment = makeTempFasta([
+            ('s1', 'ATCTG'),
+            ('s2', 'AC--G'),
+            ('s3', 'A-TTG'),
+        ])
+        cm = interhost.CoordMapper()
+        cm.load_alignments([alignment])
+        for a, b in itertools.permutations(('s1', 's2', 's3'), 2):
+            positions = numpy.arange(-1, 8)
+            expected = [cm.mapChr(a, b, int(i))[1] for i in positions]
+            left, right = cm.map_positions(a, b, positions)
+            self.assertEqual(list(left), [0 if e is None else e[0] if isinstance(e, list) else e for e in expected])
+            self.assertEqual(list(right), [0 if e is None else e[1] if isinstance(e, list) else e for e in expected])
+            self.assertEqual(list(cm.map_positions(a, b, positions, side=-1)), list(left))
+            self.assertEqual(list(cm.map_positions(a, b, positions, side=1)), list(right))
+        with self.assertRaises(TypeError):
+            cm.map_positions('s1', 's2', [1.5])
+        with self.assertRaises(KeyError):
+            cm.map_positions('s1', 'nonexistentchr', [1])
+
     def test_one_real_base(self):
         alignment = makeTempFasta([('s1', 'AC-'), ('s2', '-CA'),])
         cm = interhost.CoordMapper()
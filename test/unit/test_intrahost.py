@@ -11,11 +11,13 @@ import tempfile
 import itertools
 import argparse
 import unittest
+from mock import patch
 
 # third-party
 import Bio
 import Bio.SeqRecord
 import Bio.Seq
+import pysam
 
 # module-specific
 import intrahost
@@ -182,6 +184,34 @@ class TestPerSample(test.TestCaseWithTmp):
         self.assertEqualContents(outTab, expected)
 
 
+class TestLibraryBias(test.TestCaseWithTmp):
+    ''' Replays the V-Phaser 2 allele calls from the TestPerSample expected
+        outputs through compute_library_bias and checks that the per-library
+        counts and p-values are reproduced.
+    '''
+
+    def _replay(self, inBam, refFasta, expected):
+        myInputDir = os.path.join(util.file.get_test_input_path(), 'TestPerSample')
+        expected_rows = list(util.file.read_tabfile(os.path.join(myInputDir, expected)))
+        # strip library counts and p-values, leaving allele:totalF:totalR
+        vphaser_rows = [row[:7] + [':'.join(field.split(':')[:3]) for field in row[7:]] for row in expected_rows]
+        output = list(intrahost.compute_library_bias(
+            vphaser_rows, os.path.join(myInputDir, inBam), os.path.join(myInputDir, refFasta)))
+        self.assertEqual(output, expected_rows)
+
+    def test_one_lib(self):
+        self._replay('in.bam', 'ref.fasta', 'vphaser_one_sample_expected.txt')
+
+    def test_2libs(self):
+        self._replay('in.2libs.bam', 'ref.fasta', 'vphaser_one_sample_2libs_expected.txt')
+
+    def test_3libs(self):
+        self._replay('in.3libs.bam', 'ref.fasta', 'vphaser_one_sample_3libs_expected.txt')
+
+    def test_indels(self):
+        self._replay('in.indels.bam', 'ref.indels.fasta', 'vphaser_one_sample_indels_expected.txt')
+
+
 class VcfMergeRunner:
     ''' This creates test data and feeds it to intrahost.merge_to_vcf
     '''
@@ -229,17 +259,17 @@ class VcfMergeRunner:
                 outf.write('\t'.join(map(str, row)) + '\n')
         return fn
 
-    def run_and_get_vcf_rows(self, retree=1, omit_samplenames=False):
+    def run_and_get_vcf_rows(self, retree=1, omit_samplenames=False, threads=1):
         outVcf = util.file.mkstempfname('.vcf.gz')
 
         self.multi_align_samples(retree=retree)
 
         if not omit_samplenames:
             intrahost.merge_to_vcf(self.ref, outVcf, self.sample_order, list(self.dump_isnv_tmp_file(s) for s in self.sample_order),
-                              self.alignedFastas)
+                              self.alignedFastas, threads=threads)
         else:
             intrahost.merge_to_vcf(self.ref, outVcf, [], list(self.dump_isnv_tmp_file(s) for s in self.sample_order),
-                              self.alignedFastas)
+                              self.alignedFastas, threads=threads)
 
 
         with util.vcf.VcfReader(outVcf) as vcf:
@@ -316,6 +346,21 @@ class TestVcfMerge(test.TestCaseWithTmp):
             for line in inf:
                 self.assertTrue(line.startswith('#'))
 
+    def test_failed_merge_not_indexed(self):
+        ref = makeTempFasta([('ref1', 'ATCGCA')])
+        aligned = makeTempFasta([('ref1', 'ATCGCA'), ('s1-1', 'ATCGCA')])
+        isnvs = MockVphaserOutput()
+        isnvs.add_snp('s1-1', 3, [('C', 80, 80), ('A', 20, 20)])
+        isnv_file = util.file.mkstempfname('.txt')
+        with open(isnv_file, 'wt') as outf:
+            for row in isnvs:
+                outf.write('\t'.join(map(str, row)) + '\n')
+        outVcf = util.file.mkstempfname('.vcf.gz')
+        with patch('intrahost._merge_to_vcf_chrom', side_effect=RuntimeError('merge failed')):
+            self.assertRaisesRegex(RuntimeError, 'merge failed', intrahost.merge_to_vcf,
+                                   ref, outVcf, ['s1'], [isnv_file], [aligned])
+        self.assertFalse(os.path.exists(outVcf + '.tbi'))
+
     def test_headers_with_two_samps(self):
         ref = makeTempFasta([('ref1', 'ATCGTTCA'), ('ref2', 'GGCCC')])
         s1 = makeTempFasta([('s1-1', 'ATCGCA'), ('s1-2', 'GGCCC')])
@@ -330,9 +375,12 @@ class TestVcfMerge(test.TestCaseWithTmp):
             ], [
                 s1, s2
             ])
-        with util.vcf.VcfReader(outVcf) as vcf:
-            self.assertEqual(vcf.samples(), ['s1', 's2'])
-            self.assertEqual(vcf.chrlens(), {'ref1': 8, 'ref2': 5})
+        # the header is written even though the merge failed, but the
+        # output is not indexed
+        self.assertFalse(os.path.exists(outVcf + '.tbi'))
+        with pysam.VariantFile(outVcf) as vcf:
+            self.assertEqual(list(vcf.header.samples), ['s1', 's2'])
+            self.assertEqual(dict((c.name, c.length) for c in vcf.header.contigs.values()), {'ref1': 8, 'ref2': 5})
 
     def test_simple_snps(self):
         merger = VcfMergeRunner([('ref1', 'ATCGGACT')])
@@ -390,6 +438,20 @@ class TestVcfMerge(test.TestCaseWithTmp):
         self.assertEqual(':'.join(rows[1][1].split(':')[:2]), '0:0.0')
         self.assertEqual(':'.join(rows[1][2].split(':')[:2]), '0:0.3')
 
+    def test_snps_multiple_segments_threaded(self):
+        merger = VcfMergeRunner([('ref1', 'ATCGGACT'), ('ref2', 'GGCCTTAA')])
+        merger.add_genome('s1', [('s1-1', 'ATCGGAC'), ('s1-2', 'GGCCTTAA')])
+        merger.add_genome('s2', [('s2-1', 'TCGGACT'), ('s2-2', 'GGCCTTAA')])
+        merger.add_snp('s1', 's1-1', 3, [('C', 80, 80), ('A', 20, 20)])
+        merger.add_snp('s2', 's2-2', 5, [('T', 90, 90), ('G', 10, 10)])
+        merger.add_snp('s1', 's1-2', 2, [('G', 70, 70), ('A', 30, 30)])
+        rows = merger.run_and_get_vcf_rows(threads=2)
+        self.assertEqual([(row.contig, row.pos + 1, row.ref, row.alt) for row in rows],
+                         [('ref1', 3, 'C', 'A'), ('ref2', 2, 'G', 'A'), ('ref2', 5, 'T', 'G')])
+        self.assertEqual(':'.join(rows[0][0].split(':')[:2]), '0:0.2')
+        self.assertEqual(':'.join(rows[1][0].split(':')[:2]), '0:0.3')
+        self.assertEqual(':'.join(rows[2][1].split(':')[:2]), '0:0.1')
+
     def test_snps_with_varying_read_depth(self):
         merger = VcfMergeRunner([('ref1', 'ATCGGACT')])
         merger.add_genome('s1', [('s1-1', 'ATCGGAC')])
@@ -10,6 +10,7 @@ import tempfile
 import textwrap
 import unittest
 import pytest
+import numpy
 
 import mock
 from mock import patch
@@ -252,6 +253,31 @@ def test_coverage_lca(taxa_db):
     assert metagenomics.coverage_lca([9], taxa_db.parents) is None
 
 
+def test_taxonomy_lca(parents):
+    lca = metagenomics.TaxonomyLca(parents)
+    assert list(lca.depths([1, 3, 12, 13, 9, 2, 100])) == [0, 1, 5, 6, -1, -1, -1]
+    assert list(lca.ancestors_at_depth([13, 11, 3], [2, 2, 1])) == [6, 6, 3]
+    assert lca.lca([10, 11, 12]) == 6
+    assert lca.lca([13, 12]) == 12
+    assert lca.lca([9]) is None
+
+
+def test_taxonomy_lca_array_parents(parents):
+    values = numpy.zeros(max(parents) + 1, dtype=numpy.int32)
+    values[list(parents.keys())] = list(parents.values())
+    lca = metagenomics.TaxonomyLca(metagenomics.TaxonomyArrayMap(values))
+    assert lca.coverage_lcas([[10, 11, 12], [1, 3], [6, 7, 8], [9], [], [3, 9]]) == [6, 1, 6, None, None, 1]
+    assert lca.coverage_lcas([[10, 11, 12], [13, 12, 11, 10]], 50) == [7, 12]
+
+
+def test_batch_coverage_lca(taxa_db):
+    queries = [('q{}'.format(i), ids) for i, ids in
+               enumerate([[10, 11, 12], [1, 3], None, [6, 7, 8], [9], [13, 12]] * 5)]
+    expected = [(q, ids, metagenomics.coverage_lca(ids, taxa_db.parents) if ids else None) for q, ids in queries]
+    assert list(metagenomics.batch_coverage_lca(taxa_db, iter(queries), threads=1, batch_size=4)) == expected
+    assert list(metagenomics.batch_coverage_lca(taxa_db, iter(queries), threads=2, batch_size=4)) == expected
+
+
 def test_krakenuniq(mocker):
     p = mocker.patch('tools.kraken.KrakenUniq.pipeline')
     args = [
@@ -7,6 +7,9 @@ import argparse
 import filecmp
 import os
 import glob
+import random
+
+import pysam
 
 import read_utils
 import shutil
@@ -141,6 +144,112 @@ class TestFastqBam(TestCaseWithTmp):
         args.func_main(args)
 
 
+class TestFilterBamByReadIds(TestCaseWithTmp):
+
+    def setUp(self):
+        TestCaseWithTmp.setUp(self)
+        self.inBam = os.path.join(util.file.get_test_input_path(), 'TestDepleteHuman', 'test-reads.bam')
+        with pysam.AlignmentFile(self.inBam, 'rb', check_sq=False) as inb:
+            self.names = [read.query_name for read in inb.fetch(until_eof=True)]
+        self.wanted = set(self.names[::3])
+
+    def _out_names(self, outBam):
+        with pysam.AlignmentFile(outBam, 'rb', check_sq=False) as outb:
+            return [read.query_name for read in outb.fetch(until_eof=True)]
+
+    def test_include_and_exclude(self):
+        readList = util.file.mkstempfname('.txt')
+        with open(readList, 'wt') as outf:
+            for name in self.wanted:
+                outf.write(name + '\n')
+        outBam = util.file.mkstempfname('.bam')
+        n = read_utils.filter_bam_by_read_ids(self.inBam, readList, outBam)
+        self.assertEqual(self._out_names(outBam), [name for name in self.names if name in self.wanted])
+        self.assertEqual(n, len(self._out_names(outBam)))
+        n = read_utils.filter_bam_by_read_ids(self.inBam, readList, outBam, exclude=True)
+        self.assertEqual(self._out_names(outBam), [name for name in self.names if name not in self.wanted])
+
+    def test_sorted_id_array(self):
+        readIds = read_utils.ReadIdSet(self.wanted, max_hashed=1)
+        self.assertEqual(len(readIds), len(self.wanted))
+        self.assertNotIn('not-a-read', readIds)
+        outBam = util.file.mkstempfname('.bam')
+        read_utils.filter_bam_by_read_ids(self.inBam, readIds, outBam, threads=2)
+        self.assertEqual(self._out_names(outBam), [name for name in self.names if name in self.wanted])
+
+    def test_streamed_id_chunks(self):
+        # a generator with repeated IDs, merged from many small chunks
+        readIds = read_utils.ReadIdSet((name for name in self.names[::3] * 2), max_hashed=5, chunk_size=7)
+        self.assertEqual(len(readIds), len(self.wanted))
+        self.assertTrue(all(name in readIds for name in self.wanted))
+        self.assertFalse(any(name in readIds for name in set(self.names) - self.wanted))
+
+    def test_empty_list(self):
+        outBam = util.file.mkstempfname('.bam')
+        self.assertEqual(read_utils.filter_bam_by_read_ids(self.inBam, [], outBam), 0)
+        self.assertEqual(self._out_names(outBam), [])
+        read_utils.filter_bam_by_read_ids(self.inBam, [], outBam, exclude=True)
+        self.assertEqual(self._out_names(outBam), self.names)
+
+
+class TestSplitBam(TestCaseWithTmp):
+
+    def setUp(self):
+        TestCaseWithTmp.setUp(self)
+        self.inBam = util.file.mkstempfname('.bam')
+        header = {'HD': {'VN': '1.4', 'SO': 'queryname'},
+                  'RG': [{'ID': 'rg1', 'SM': 's1'}, {'ID': 'rg2', 'SM': 's1'}]}
+        with pysam.AlignmentFile(self.inBam, 'wb', header=header) as outb:
+            for i in range(10):
+                for mate in (0x40, 0x80):
+                    read = pysam.AlignedSegment()
+                    read.query_name = 'read%02d' % i
+                    read.flag = 0x1 | 0x4 | 0x8 | mate
+                    read.query_sequence = 'ACGT' * (i + 1)
+                    read.query_qualities = pysam.qualitystring_to_array('I' * 4 * (i + 1))
+                    read.set_tag('RG', 'rg1' if i < 3 else 'rg2')
+                    outb.write(read)
+
+    def _out_reads(self, outBam):
+        with pysam.AlignmentFile(outBam, 'rb', check_sq=False) as inb:
+            return [(read.query_name, read.get_tag('RG'), read.query_length) for read in inb.fetch(until_eof=True)]
+
+    def _split(self, mode, n_out=3):
+        outBams = [util.file.mkstempfname('.bam') for _ in range(n_out)]
+        counts = read_utils.split_bam(self.inBam, outBams, mode=mode)
+        outs = [self._out_reads(outBam) for outBam in outBams]
+        self.assertEqual(counts, [len(out) for out in outs])
+        self.assertEqual(sorted(sum(outs, [])), self._out_reads(self.inBam))
+        return outs
+
+    def test_roundrobin(self):
+        outs = self._split('roundrobin')
+        self.assertEqual([len(out) for out in outs], [8, 6, 6])
+        for out in outs:
+            # mates stay together, and each output stays queryname sorted
+            self.assertEqual(out, sorted(out))
+            self.assertTrue(all(out[i][0] == out[i + 1][0] for i in range(0, len(out), 2)))
+
+    def test_balanced(self):
+        outs = self._split('balanced')
+        bases = [sum(length for name, rg, length in out) for out in outs]
+        self.assertLessEqual(max(bases) - min(bases), 2 * 4 * 10)
+        for out in outs:
+            self.assertTrue(all(out[i][0] == out[i + 1][0] for i in range(0, len(out), 2)))
+
+    def test_readgroup(self):
+        outs = self._split('readgroup')
+        self.assertEqual(set(rg for name, rg, length in outs[0]), set(['rg1']))
+        self.assertEqual(set(rg for name, rg, length in outs[1]), set(['rg2']))
+        self.assertEqual(outs[2], [])
+
+    def test_requires_queryname_sort(self):
+        unsorted = util.file.mkstempfname('.bam')
+        with pysam.AlignmentFile(unsorted, 'wb', header={'HD': {'VN': '1.4', 'SO': 'unsorted'}}) as outb:
+            pass
+        self.assertRaises(Exception, read_utils.split_bam, unsorted, [util.file.mkstempfname('.bam')])
+
+
 class TestRmdupUnaligned(TestCaseWithTmp):
     def test_mvicuna_canned_input(self):
         samtools = tools.samtools.SamtoolsTool()
@@ -165,6 +274,41 @@ class TestRmdupUnaligned(TestCaseWithTmp):
         )
         self.assertEqual(samtools.count(output_bam), 0)
 
+    def test_rmdup_mismatches_and_stats(self):
+        inBam = util.file.mkstempfname('.bam')
+        header = {'HD': {'VN': '1.4', 'SO': 'queryname'},
+                  'RG': [{'ID': 'rg1', 'LB': 'lib1'}, {'ID': 'rg2', 'LB': 'lib2'}]}
+        pairs = [('a', 'rg1', 'ACGTACGTACGTACGTACGTAA', 'TTTTGGGGCCCCAAAATTTTGG'),
+                 ('b', 'rg1', 'ACGTACGTACGTACGTACGTCC', 'TTTTGGGGCCCCAAAATTTTCC'),   # same prefixes as a
+                 ('c', 'rg1', 'ACGTACGTACGTACCTACGTAA', 'TTTTGGGGCCCCAAAATTTTGG'),   # 1 mismatch from a
+                 ('d', 'rg2', 'ACGTACGTACGTACGTACGTAA', 'TTTTGGGGCCCCAAAATTTTGG'),   # other library
+                 ('e', 'rg1', 'NNNNNNNNNNNNNNNNNNNNNN', 'TTTTGGGGCCCCAAAATTTTGG')]   # mostly N
+        with pysam.AlignmentFile(inBam, 'wb', header=header) as outb:
+            for name, rg, seq1, seq2 in pairs:
+                for mate, seq in ((0x40, seq1), (0x80, seq2)):
+                    read = pysam.AlignedSegment()
+                    read.query_name = name
+                    read.flag = 0x1 | 0x4 | 0x8 | mate
+                    read.query_sequence = seq
+                    read.query_qualities = pysam.qualitystring_to_array('I' * len(seq))
+                    read.set_tag('RG', rg)
+                    outb.write(read)
+
+        def out_names(**kwargs):
+            outBam = util.file.mkstempfname('.bam')
+            read_utils.rmdup_mvicuna_bam(inBam, outBam, **kwargs)
+            with pysam.AlignmentFile(outBam, 'rb', check_sq=False) as inb:
+                return [read.query_name for read in inb.fetch(until_eof=True)]
+
+        self.assertEqual(out_names(), ['a', 'a', 'c', 'c', 'd', 'd'])
+        self.assertEqual(out_names(maxHashed=1), ['a', 'a', 'c', 'c', 'd', 'd'])
+        outStats = util.file.mkstempfname('.txt')
+        self.assertEqual(out_names(maxMismatches=1, outStats=outStats), ['a', 'a', 'd', 'd'])
+        stats = list(util.file.read_tabfile_dict(outStats))
+        self.assertEqual([(row['library'], row['templates'], row['filtered'], row['unique'],
+                           row['duplicates'], row['largest_cluster']) for row in stats],
+                         [('lib1', '4', '1', '1', '2', '3'), ('lib2', '1', '0', '1', '0', '1')])
+
     def test_cdhit_canned_input(self):
         samtools = tools.samtools.SamtoolsTool()
 
@@ -189,6 +333,28 @@ class TestRmdupUnaligned(TestCaseWithTmp):
         self.assertEqual(samtools.count(output_bam), 0)
 
 
+class TestDuplicateKeyIndex(TestCaseWithTmp):
+
+    def _clusters(self, keys, **kwargs):
+        index = read_utils.DuplicateKeyIndex(**kwargs)
+        return [index.find_or_add(key, i + 1) for i, key in enumerate(keys)]
+
+    def test_distinct_keys_never_merged(self):
+        keys = ['%08d\t%08d' % (i, i * 7) for i in range(500)]
+        self.assertEqual(self._clusters(keys, max_hashed=16), list(range(1, 501)))
+        self.assertEqual(self._clusters(keys + keys[::-1], max_hashed=16), list(range(1, 501)) + list(range(500, 0, -1)))
+
+    def test_spilling_does_not_change_matches(self):
+        rng = random.Random(3)
+        keys = [''.join(rng.choice('AC') for _ in range(rng.choice((6, 7)))) + '\t' + rng.choice(('A', 'C', 'AC'))
+                for _ in range(400)]
+        for max_mismatches in (0, 1, 2):
+            expected = self._clusters(keys, max_mismatches=max_mismatches)
+            for max_hashed in (1, 7, 50):
+                self.assertEqual(self._clusters(keys, max_mismatches=max_mismatches, max_hashed=max_hashed),
+                                 expected)
+
+
 class TestMvicuna(TestCaseWithTmp):
     """
     Input consists of 3 read pairs.
@@ -0,0 +1,104 @@
+# Unit tests for reports.py
+
+__author__ = "dpark@broadinstitute.org"
+
+# built-ins
+import os
+import os.path
+import random
+import argparse
+import unittest
+
+# third-party
+import pysam
+
+# module-specific
+import reports
+import util.file
+import util.stats
+import test
+
+
+class TestCommandHelp(unittest.TestCase):
+
+    def test_help_parser_for_each_command(self):
+        for cmd_name, parser_fun in reports.__commands__:
+            parser = parser_fun(argparse.ArgumentParser())
+            helpstring = parser.format_help()
+
+
+class TestCoverageStats(test.TestCaseWithTmp):
+    ''' Checks the single-pass depth arrays against a pysam pileup. '''
+
+    def _pileup_stats(self, inBam, chr_name=None, cov_thresholds=(1, 5, 20, 100)):
+        bai = util.file.mkstempfname('.bai')
+        pysam.index(inBam, bai)
+        with pysam.AlignmentFile(inBam, 'rb', index_filename=bai) as bam:
+            coverages = [pcol.nsegments for pcol in bam.pileup(chr_name)]
+        out = {}
+        if coverages:
+            out['aln2self_cov_median'] = util.stats.median(coverages)
+            out['aln2self_cov_mean'] = "%0.3f" % util.stats.mean(coverages)
+            out['aln2self_cov_mean_non0'] = "%0.3f" % util.stats.mean([n for n in coverages if n > 0])
+            for thresh in cov_thresholds:
+                out['aln2self_cov_%dX' % thresh] = sum(1 for n in coverages if n >= thresh)
+        return out
+
+    def test_matches_pileup(self):
+        myInputDir = util.file.get_test_input_path()
+        for inBam in (os.path.join(myInputDir, 'TestPerSample', 'in.bam'),
+                      os.path.join(myInputDir, 'TestPerSample', 'in.indels.bam'),
+                      os.path.join(myInputDir, 'TestPerSample', 'in.oneunmapped.bam'),
+                      os.path.join(myInputDir, 'TestDepleteHuman', 'test-reads-aligned.bam')):
+            self.assertEqual(reports.genome_coverage_stats_only(inBam), self._pileup_stats(inBam))
+
+    def test_per_chr(self):
+        inBam = os.path.join(util.file.get_test_input_path(), 'TestPerSample', 'in.bam')
+        depths = reports.bam_coverage_depths(inBam)
+        for chr_name, chr_depths in depths.items():
+            self.assertEqual(reports.coverage_stats([chr_depths]), self._pileup_stats(inBam, chr_name))
+            self.assertEqual(reports.genome_coverage_stats_only(inBam, chr_name), self._pileup_stats(inBam, chr_name))
+
+    def test_empty(self):
+        inBam = os.path.join(util.file.get_test_input_path(), 'TestPerSample', 'in.bam')
+        depths = reports.bam_coverage_depths(inBam)
+        self.assertEqual(reports.coverage_stats([d[:0] for d in depths.values()]), {})
+        self.assertEqual(reports.coverage_stats([]), {})
+
+
+class TestAlignmentColumnCounts(unittest.TestCase):
+    ''' Checks the vectorized column classification against a per-column loop. '''
+
+    def _column_loop(self, seqOne, seqTwo):
+        out = dict((k, 0) for k in reports.ALIGNMENT_SUMMARY_FIELDS)
+        for c1, c2 in zip(seqOne, seqTwo):
+            if c1 == 'N' and c2 == 'N':
+                out['ambig_both'] += 1
+            elif c1 == 'N':
+                out['ambig_one'] += 1
+            elif c2 == 'N':
+                out['ambig_two'] += 1
+            if c1 in 'ACGT' and c2 in 'ACGT':
+                out['unambig_both'] += 1
+                out['same_unambig' if c1 == c2 else 'snp_unambig'] += 1
+            if (c1 == '-' and c2 in 'ACGT') or (c2 == '-' and c1 in 'ACGT'):
+                out['indel_unambig'] += 1
+            if (c1 == '-' and c2 == 'N') or (c2 == '-' and c1 == 'N'):
+                out['indel_ambig'] += 1
+        return out
+
+    def test_simple(self):
+        counts = reports.alignment_column_counts('ACGTN-NA-R', 'ACCTNNA-GR')
+        self.assertEqual(list(counts.keys()), list(reports.ALIGNMENT_SUMMARY_FIELDS))
+        self.assertEqual(dict(counts), self._column_loop('ACGTN-NA-R', 'ACCTNNA-GR'))
+
+    def test_random_alignments(self):
+        rng = random.Random(7)
+        for _ in range(50):
+            n = rng.randint(0, 200)
+            seqOne = ''.join(rng.choice('ACGTNRY-a') for _ in range(n))
+            seqTwo = ''.join(rng.choice('ACGTNRY-a') for _ in range(n))
+            self.assertEqual(dict(reports.alignment_column_counts(seqOne, seqTwo)), self._column_loop(seqOne, seqTwo))
+
+    def test_unequal_lengths(self):
+        self.assertRaises(ValueError, reports.alignment_column_counts, 'ACGT', 'ACG')
@@ -9,9 +9,14 @@ import tempfile
 import shutil
 import filecmp
 import subprocess
+import concurrent.futures
+import random
 
 import argparse
 
+import mock
+import pysam
+
 import read_utils
 import taxon_filter
 import util.file
@@ -19,6 +24,9 @@ import util.misc
 import tools.last
 import tools.bmtagger
 import tools.blast
+import tools.bwa
+import tools.picard
+import tools.samtools
 from test import assert_equal_bam_reads, assert_equal_contents, assert_equal_bam_reads, assert_md5_equal_to_line_in_file, TestCaseWithTmp
 
 class TestCommandHelp(unittest.TestCase):
@@ -409,6 +417,33 @@ class TestDepleteBlastnBam(TestCaseWithTmp):
             outSam,
             os.path.join(myInputDir, 'expected.sam'))
 
+    def test_deplete_blastn_bam_resume(self):
+        tempDir = tempfile.mkdtemp()
+        myInputDir = util.file.get_test_input_path(self)
+        resumeDir = os.path.join(tempDir, 'chunks')
+
+        # Run deplete_blastn_bam twice, the second time from saved chunks
+        inBam = os.path.join(myInputDir, 'in.bam')
+        for attempt, outBam in enumerate((os.path.join(tempDir, 'out1.bam'), os.path.join(tempDir, 'out2.bam'))):
+            args = taxon_filter.parser_deplete_blastn_bam(argparse.ArgumentParser()).parse_args(
+                [inBam] + self.blastdbs_multi + [outBam, "--chunkSize", "1", "--resumeDir", resumeDir]
+            )
+            if attempt == 0:
+                args.func_main(args)
+            else:
+                # every chunk finished the first time, so blastn must not run again
+                with mock.patch('taxon_filter._run_blastn_chunk_str', side_effect=AssertionError('blastn re-run')), \
+                        mock.patch('concurrent.futures.ProcessPoolExecutor', concurrent.futures.ThreadPoolExecutor):
+                    args.func_main(args)
+            self.assertTrue(os.listdir(resumeDir))
+
+            # samtools view for out.sam and compare to expected
+            outSam = util.file.mkstempfname('.sam')
+            tools.samtools.SamtoolsTool().view(['-h'], outBam, outSam)
+            assert_equal_bam_reads(self,
+                outSam,
+                os.path.join(myInputDir, 'expected.sam'))
+
     def test_blastn_empty_input(self):
         empty_bam = os.path.join(util.file.get_test_input_path(), 'empty.bam')
         out_bam = util.file.mkstempfname('-out.bam')
@@ -430,3 +465,246 @@ class TestDepleteBlastnBam(TestCaseWithTmp):
             out_bam
         )
         self.assertEqual(0, tools.samtools.SamtoolsTool().count(out_bam))
+
+
+class TestBlastnChunkedResume(TestCaseWithTmp):
+    ''' Test the resumeDir of blastn_chunked_bam with a stand-in for blastn
+        that reports the reads starting with the base stored in the database '''
+
+    def setUp(self):
+        TestCaseWithTmp.setUp(self)
+        self.tempDir = tempfile.mkdtemp()
+        self.resumeDir = os.path.join(self.tempDir, 'resume')
+        self.inBam = os.path.join(self.tempDir, 'in.bam')
+        self.make_bam(45000, seed=1)
+        self.blastn_calls = []
+        for patcher in (mock.patch('tools.blast.BlastnTool'),
+                        mock.patch('concurrent.futures.ProcessPoolExecutor', concurrent.futures.ThreadPoolExecutor),
+                        mock.patch('taxon_filter._run_blastn_chunk_str', side_effect=self.fake_blastn)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def fake_blastn(self, db, fasta_str, blast_threads):
+        self.blastn_calls.append(db)
+        base = util.file.slurp_file(db + '.nin').strip()
+        lines = fasta_str.splitlines()
+        return [name[1:] for name, seq in zip(lines[::2], lines[1::2]) if seq.startswith(base)]
+
+    def make_bam(self, n_reads, seed):
+        # 20000 reads per chunk
+        rng = random.Random(seed)
+        with pysam.AlignmentFile(self.inBam, 'wb', header={'HD': {'VN': '1.4', 'SO': 'unsorted'}}) as outb:
+            for i in range(n_reads):
+                read = pysam.AlignedSegment()
+                read.query_name = 'read{:05d}'.format(i)
+                read.flag = 0x4
+                read.query_sequence = ''.join(rng.choice('ACGT') for _ in range(8))
+                read.query_qualities = pysam.qualitystring_to_array('I' * 8)
+                outb.write(read)
+
+    def make_db(self, db, base):
+        util.file.mkdir_p(os.path.dirname(db))
+        util.file.dump_file(db + '.nin', base)
+        return db
+
+    def expected_hits(self, inBam, base):
+        with pysam.AlignmentFile(inBam, 'rb', check_sq=False) as bam:
+            return set(read.query_name for read in bam.fetch(until_eof=True)
+                       if (read.get_forward_sequence() or '').startswith(base))
+
+    def hits(self, db, **kwargs):
+        outHits = util.file.mkstempfname('.txt')
+        taxon_filter.blastn_chunked_bam(self.inBam, db, outHits, chunkSize=20000, threads=1,
+                                        resumeDir=self.resumeDir, **kwargs)
+        with open(outHits, 'rt') as inf:
+            return set(line.rstrip('\n') for line in inf)
+
+    def test_finished_chunks_not_rerun(self):
+        db = self.make_db(os.path.join(self.tempDir, 'db1', 'db'), 'A')
+        self.assertEqual(self.hits(db), self.expected_hits(self.inBam, 'A'))
+        self.assertEqual(len(self.blastn_calls), 3)
+        self.assertEqual(self.hits(db), self.expected_hits(self.inBam, 'A'))
+        self.assertEqual(len(self.blastn_calls), 3)
+
+    def test_changed_inputs_not_reused(self):
+        db = self.make_db(os.path.join(self.tempDir, 'db1', 'db'), 'A')
+        self.hits(db)
+        self.assertEqual(len(self.blastn_calls), 3)
+        # a different input BAM at the same path
+        self.make_bam(45000, seed=2)
+        self.assertEqual(self.hits(db), self.expected_hits(self.inBam, 'A'))
+        self.assertEqual(len(self.blastn_calls), 6)
+        # a changed database
+        self.make_db(db, 'C')
+        self.assertEqual(self.hits(db), self.expected_hits(self.inBam, 'C'))
+        self.assertEqual(len(self.blastn_calls), 9)
+        # reads excluded from the last chunk
+        exclude = set('read{:05d}'.format(i) for i in range(44000, 45000))
+        self.assertEqual(self.hits(db, exclude=exclude), self.expected_hits(self.inBam, 'C') - exclude)
+        self.assertEqual(len(self.blastn_calls), 10)
+
+    def test_databases_with_same_name_kept_apart(self):
+        dbs = [self.make_db(os.path.join(self.tempDir, d, 'db'), base) for d, base in (('db1', 'A'), ('db2', 'G'))]
+        for _ in range(2):
+            for db, base in zip(dbs, ('A', 'G')):
+                self.assertEqual(taxon_filter.blastn_hits(self.inBam, db, threads=1, chunkSize=20000,
+                                                          resumeDir=self.resumeDir),
+                                 self.expected_hits(self.inBam, base))
+        self.assertEqual(len(os.listdir(self.resumeDir)), 2)
+        self.assertEqual(len(self.blastn_calls), 6)
+
+
+class TestDepleteSinglePass(TestCaseWithTmp):
+    ''' Checks the bookkeeping of deplete_single_pass with stand-in hit finders. '''
+
+    def setUp(self):
+        TestCaseWithTmp.setUp(self)
+        self.tempDir = tempfile.mkdtemp()
+        self.inBam = os.path.join(util.file.get_test_input_path(), 'TestDepleteHuman', 'test-reads.bam')
+        with pysam.AlignmentFile(self.inBam, 'rb', check_sq=False) as inb:
+            self.names = list(read.query_name for read in inb.fetch(until_eof=True))
+        self.seen = []
+
+    def _finder(self, inBam, db, exclude=None, threads=None, step=2):
+        # record which reads each "database" was shown, and hit every step'th one
+        survivors = list(n for n in sorted(set(self.names)) if n not in exclude)
+        self.seen.append((db, len(survivors)))
+        return set(survivors[::step])
+
+    def _out_names(self, outBam):
+        with pysam.AlignmentFile(outBam, 'rb', check_sq=False) as inb:
+            return list(read.query_name for read in inb.fetch(until_eof=True))
+
+    def test_single_pass(self):
+        outBams = [util.file.mkstempfname('.1.bam'), util.file.mkstempfname('.2.bam')]
+        with mock.patch.dict(taxon_filter.DEPLETION_HIT_FINDERS, {'fake': self._finder}):
+            hit_counts = taxon_filter.deplete_single_pass(self.inBam,
+                [('fake', ['db1', 'db2'], {}), ('fake', ['db3'], {'step': 3})], outBams)
+
+        # each database only sees the survivors of the previous ones
+        n = len(set(self.names))
+        self.assertEqual(self.seen[0], ('db1', n))
+        self.assertEqual(self.seen[1], ('db2', n - hit_counts[0][2]))
+        self.assertEqual(self.seen[2], ('db3', n - hit_counts[0][2] - hit_counts[1][2]))
+        self.assertEqual([db for method, db, hits in hit_counts], ['db1', 'db2', 'db3'])
+
+        out1, out2 = (self._out_names(outBam) for outBam in outBams)
+        self.assertEqual(len(set(self.names)) - len(set(out1)), hit_counts[0][2] + hit_counts[1][2])
+        self.assertEqual(len(set(out1)) - len(set(out2)), hit_counts[2][2])
+        self.assertTrue(set(out2) <= set(out1))
+        self.assertEqual(out1, [name for name in self.names if name in set(out1)])
+
+    def test_concurrent_dbs(self):
+        outBam = util.file.mkstempfname('.bam')
+        with mock.patch.dict(taxon_filter.DEPLETION_HIT_FINDERS, {'fake': self._finder}):
+            hit_counts = taxon_filter.deplete_single_pass(self.inBam,
+                [('fake', ['db1', 'db2'], {})], [outBam], concurrentDbs=True)
+        # both databases see the same input, so the second adds no new hits
+        self.assertEqual(sorted(self.seen), [('db1', len(set(self.names))), ('db2', len(set(self.names)))])
+        self.assertEqual(hit_counts[1][2], 0)
+        self.assertEqual(len(set(self._out_names(outBam))), len(set(self.names)) - hit_counts[0][2])
+
+    def test_main_deplete_single_pass(self):
+        calls = []
+
+        def finder(method):
+            def find_hits(inBam, db, exclude=None, threads=None, **kwargs):
+                # hit every third read of inBam that has not been hit yet
+                calls.append((method, db, kwargs))
+                survivors = sorted(set(self._out_names(inBam)) - set(exclude))
+                return set(survivors[::3])
+            return find_hits
+
+        def fake_rmdup(inBam, outBam, JVMmemory=None):
+            shutil.copyfile(inBam, outBam)
+
+        outs = [os.path.join(self.tempDir, name + '.bam') for name in ('revert', 'bwa', 'bmtagger', 'rmdup', 'blastn')]
+        hitCountsOut = os.path.join(self.tempDir, 'hits.txt')
+        args = taxon_filter.parser_deplete(argparse.ArgumentParser()).parse_args(
+            [self.inBam] + outs + [
+                '--bwaDbs', 'bwa_db',
+                '--bmtaggerDbs', 'bmtagger_db',
+                '--blastDbs', 'blast_db1', 'blast_db2',
+                '--chunkSize', '0',
+                '--srprismMemory', '1500',
+                '--hitCountsOut', hitCountsOut,
+                '--singlePass',
+            ])
+        finders = dict((method, finder(method)) for method in ('bwa', 'bmtagger', 'blastn'))
+        with mock.patch.dict(taxon_filter.DEPLETION_HIT_FINDERS, finders), \
+                mock.patch('read_utils.rmdup_mvicuna_bam', side_effect=fake_rmdup):
+            self.assertEqual(args.func_main(args), 0)
+
+        self.assertEqual(calls, [('bwa', 'bwa_db', {}),
+                                 ('bmtagger', 'bmtagger_db', {'srprism_memory': 1500}),
+                                 ('blastn', 'blast_db1', {'chunkSize': 0}),
+                                 ('blastn', 'blast_db2', {'chunkSize': 0})])
+        # the input is unaligned, so revertBam is only touched
+        self.assertEqual(os.path.getsize(outs[0]), 0)
+        bwa, bmtagger, rmdup, blastn = (set(self._out_names(outBam)) for outBam in outs[1:])
+        self.assertTrue(blastn < bmtagger < bwa < set(self.names))
+        self.assertEqual(rmdup, bmtagger)
+
+        with open(hitCountsOut, 'rt') as inf:
+            rows = list(line.rstrip('\n').split('\t') for line in inf)
+        self.assertEqual(rows[0], ['method', 'db', 'hits'])
+        self.assertEqual([row[:2] for row in rows[1:]],
+                         [['bwa', 'bwa_db'], ['bmtagger', 'bmtagger_db'], ['blastn', 'blast_db1'], ['blastn', 'blast_db2']])
+        self.assertEqual(sum(int(row[2]) for row in rows[1:]), len(set(self.names)) - len(blastn))
+
+
+def _skip_unless_installed(testcase, *tool_classes):
+    ''' Skip the test case unless the binary of every one of the tools exists. '''
+    for tool_class in tool_classes:
+        try:
+            path = tool_class().install_and_get_path()
+        except Exception:
+            # resolving a missing conda tool can fail outright
+            path = None
+        if not (path and shutil.which(path)):
+            testcase.skipTest('{} is not installed'.format(tool_class.__name__))
+
+
+class TestDepleteSinglePassHitFinders(TestCaseWithTmp):
+    ''' Runs deplete_single_pass with the real hit finders, and checks that
+        it removes the same reads as the per-database depletion commands.
+    '''
+
+    def setUp(self):
+        TestCaseWithTmp.setUp(self)
+        self.tempDir = tempfile.mkdtemp()
+
+    def read_names(self, inBam):
+        with pysam.AlignmentFile(inBam, 'r', check_sq=False) as inb:
+            return set(read.query_name for read in inb.fetch(until_eof=True))
+
+    def test_blastn_hits(self):
+        _skip_unless_installed(self, tools.blast.BlastnTool, tools.blast.MakeblastdbTool)
+        myInputDir = os.path.join(util.file.get_test_input_path(), 'TestDepleteBlastnBam')
+        dbs = [tools.blast.MakeblastdbTool().build_database(os.path.join(myInputDir, db),
+                                                          os.path.join(self.tempDir, db[:-3]))
+               for db in ('humanChr1Subset.fa', 'humanChr9Subset.fa')]
+        inBam = os.path.join(myInputDir, 'in.bam')
+
+        for chunkSize in (0, 1000000):
+            outBam = util.file.mkstempfname('.bam')
+            hit_counts = taxon_filter.deplete_single_pass(inBam, [('blastn', dbs, {'chunkSize': chunkSize})], [outBam])
+            self.assertEqual(self.read_names(outBam), self.read_names(os.path.join(myInputDir, 'expected.sam')))
+            self.assertEqual(sum(n for method, db, n in hit_counts),
+                             len(self.read_names(inBam)) - len(self.read_names(outBam)))
+
+    def test_bwa_hits(self):
+        _skip_unless_installed(self, tools.bwa.Bwa, tools.samtools.SamtoolsTool, tools.picard.RevertSamTool)
+        ref_fasta = os.path.join(util.file.get_test_input_path(), '5kb_human_from_chr6.fasta')
+        taxon_filter.bwa_build_db(ref_fasta, self.tempDir, '5kb_human_from_chr6')
+        db = os.path.join(self.tempDir, '5kb_human_from_chr6')
+        inBam = os.path.join(util.file.get_test_input_path(), 'TestDepleteHuman', 'test-reads.bam')
+
+        singlePassBam = util.file.mkstempfname('.bam')
+        hit_counts = taxon_filter.deplete_single_pass(inBam, [('bwa', [db], {})], [singlePassBam])
+        depletedBam = util.file.mkstempfname('.bam')
+        taxon_filter.deplete_bwa_bam(inBam, db, depletedBam)
+
+        self.assertEqual(self.read_names(singlePassBam), self.read_names(depletedBam))
+        self.assertEqual(hit_counts, [('bwa', db, len(self.read_names(inBam)) - len(self.read_names(depletedBam)))])
+        self.assertGreater(hit_counts[0][2], 0)
@@ -1,4 +1,6 @@
+import os
 import os.path
+import shutil
 from os.path import join
 
 import util.file
@@ -16,3 +18,35 @@ def test_taxonomy_subset_zaire(request, tmpdir_factory):
     assert 186538 in tax_db.parents  # Zaire species
     assert 186540 not in tax_db.parents  # Sudan species
     assert 2 not in tax_db.parents  # Bacteria
+
+
+def test_taxonomy_index(request, tmpdir_factory):
+    data_dir = join(util.file.get_test_input_path(), 'TestMetagenomicsSimple')
+    db_dir = join(data_dir, 'db', 'taxonomy')
+    index_db_dir = str(tmpdir_factory.mktemp('taxonomy_index'))
+    for fn in ('nodes.dmp', 'names.dmp', 'gi_taxid_nucl.dmp', 'gi_taxid_prot.dmp'):
+        shutil.copy(join(db_dir, fn), index_db_dir)
+    metagenomics.taxonomy_index(index_db_dir)
+
+    dict_db = metagenomics.TaxonomyDb(db_dir, load_gis=True, load_nodes=True, load_names=True)
+    index_db = metagenomics.TaxonomyDb(index_db_dir, load_gis=True, load_nodes=True, load_names=True)
+    assert isinstance(index_db.parents, metagenomics.TaxonomyArrayMap)
+    assert isinstance(index_db.names, metagenomics.TaxonomyNamesMap)
+    assert isinstance(index_db.gis, metagenomics.GiTaxidMap)
+
+    assert dict(index_db.parents.items()) == dict_db.parents
+    assert dict(index_db.ranks.items()) == dict_db.ranks
+    assert dict(index_db.names.items()) == dict_db.names
+    assert dict(index_db.gis.items()) == dict_db.gis
+    assert index_db.parents.get(186538) == dict_db.parents[186538]
+    assert 2 not in index_db.parents
+    assert index_db.parents.get(-1) is None
+    for gi, taxid in dict_db.gis.items():
+        assert index_db.gis[gi] == taxid
+    assert list(index_db.gis.lookup(list(dict_db.gis) + [0])) == list(dict_db.gis.values()) + [0]
+
+    # a stale index is ignored in favor of the .dmp files
+    os.utime(join(index_db_dir, 'nodes.dmp'))
+    os.utime(join(index_db_dir, 'index', 'parents.npy'), (0, 0))
+    stale_db = metagenomics.TaxonomyDb(index_db_dir, load_nodes=True)
+    assert isinstance(stale_db.parents, dict)
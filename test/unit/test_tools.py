@@ -2,6 +2,7 @@
 
 __author__ = "yesimon@broadinstitute.org"
 
+import os
 import pytest
 import tools
 from tools import *
@@ -20,3 +21,36 @@ def test_tool_install(tool_class):
     t = tool_class()
     t.install()
     assert t.is_installed()
+
+
+def test_tool_resolution_cache(tmpdir):
+    env_path = str(tmpdir.mkdir('env'))
+    os.mkdir(os.path.join(env_path, 'conda-meta'))
+    cache_path = str(tmpdir.join('cache.json'))
+    cache = tools.ToolResolutionCache(cache_path)
+
+    assert cache.get(env_path, 'samtools') is None
+    cache.put(env_path, 'samtools', version='1.9', build_type='h8571acd_11', executable='samtools')
+    assert cache.get(env_path, 'samtools')['version'] == '1.9'
+
+    # another process sees the same entries
+    assert tools.ToolResolutionCache(cache_path).get(env_path, 'samtools')['build_type'] == 'h8571acd_11'
+
+    # installing or removing a package changes conda-meta and stales the entry
+    meta_mtime = os.stat(os.path.join(env_path, 'conda-meta')).st_mtime
+    os.utime(os.path.join(env_path, 'conda-meta'), (meta_mtime + 10, meta_mtime + 10))
+    assert cache.get(env_path, 'samtools') is None
+
+
+def test_tool_resolution_cache_invalidate(tmpdir):
+    env_paths = [str(tmpdir.mkdir(name)) for name in ('env1', 'env2')]
+    cache = tools.ToolResolutionCache(str(tmpdir.join('cache.json')))
+    for env_path in env_paths:
+        os.mkdir(os.path.join(env_path, 'conda-meta'))
+        cache.put(env_path, 'bwa', version='0.7.17', build_type=None, executable='bwa')
+
+    cache.invalidate(env_paths[0])
+    assert cache.get(env_paths[0], 'bwa') is None
+    assert cache.get(env_paths[1], 'bwa') is not None
+    cache.invalidate()
+    assert cache.get(env_paths[1], 'bwa') is None
@@ -5,6 +5,7 @@ __author__ = "tomkinsc@broadinstitute.org"
 import os.path
 import tempfile
 import subprocess
+import unittest
 import util.file
 import tools.bwa
 import tools.samtools
@@ -46,3 +47,20 @@ class TestToolBwa(TestCaseWithTmp):
         self.assertRaises(subprocess.CalledProcessError, self.bwa.mem, in_bam, self.bwadb_path, outfile, options=['-a'])
 
         os.unlink(outfile)
+
+
+class TestFilterSamLinesOnAlignmentScore(unittest.TestCase):
+
+    def test_filter_summed_scores(self):
+        fields = '\t'.join(['0', 'chr1', '1', '60', '4M', '*', '0', '0', 'ACGT', 'IIII'])
+        in_sam = [
+            '@SQ\tSN:chr1\tLN:100\n',
+            'a\t' + fields + '\tNM:i:0\tAS:i:20\tRG:Z:lib:1\n',
+            'a\t' + fields + '\tAS:i:15\n',
+            'b\t' + fields + '\tAS:i:30\n',
+            'c\t' + fields + '\tAS:i:10\n',
+        ]
+        kept = list(tools.bwa.filter_sam_lines_on_alignment_score(in_sam, 30, []))
+        self.assertEqual(kept, in_sam[:4])
+        dropped = list(tools.bwa.filter_sam_lines_on_alignment_score(in_sam, 30, [], invert_filter=True))
+        self.assertEqual(dropped, [in_sam[0], in_sam[4]])
@@ -7,6 +7,7 @@ import os, os.path
 import tempfile
 import shutil
 import Bio.SeqIO, Bio.SeqRecord, Bio.Seq
+import pysam
 import util
 import util.file
 import tools
@@ -21,6 +22,50 @@ class TestToolSamtools(TestCaseWithTmp):
         n = tools.samtools.SamtoolsTool().count(sam, ['-S'])
         self.assertEqual(n, 2)
 
+    def test_count_indexed_bam(self):
+        in_bam = os.path.join(util.file.get_test_input_path(), 'TestPerSample', 'in.bam')
+        sorted_bam = util.file.mkstempfname('.bam')
+        pysam.sort('-o', sorted_bam, in_bam)
+        pysam.index(sorted_bam)
+        with pysam.AlignmentFile(sorted_bam) as inb:
+            reads = list(inb.fetch(until_eof=True))
+        samtools = tools.samtools.SamtoolsTool()
+        # index statistics and filtered scans agree with a plain count
+        self.assertEqual(samtools.count(sorted_bam), len(reads))
+        self.assertEqual(samtools.count(sorted_bam, ['-F', '4']), sum(1 for r in reads if not r.is_unmapped))
+        self.assertEqual(samtools.count(sorted_bam, ['-F', '1028']),
+            sum(1 for r in reads if not (r.is_unmapped or r.is_duplicate)))
+        self.assertEqual(samtools.count(sorted_bam, ['-q', '30']),
+            sum(1 for r in reads if r.mapping_quality >= 30))
+
+    def test_metadata_cache_invalidated_by_rewrite(self):
+        samtools = tools.samtools.SamtoolsTool()
+        bam = util.file.mkstempfname('.bam')
+        shutil.copyfile(os.path.join(util.file.get_test_input_path(), 'empty.bam'), bam)
+        self.assertTrue(samtools.isEmpty(bam))
+        self.assertEqual(samtools.count(bam), 0)
+        shutil.copyfile(os.path.join(util.file.get_test_input_path(), 'almost-empty.bam'), bam)
+        os.utime(bam, ns=(os.stat(bam).st_atime_ns, os.stat(bam).st_mtime_ns + 10**9))
+        self.assertFalse(samtools.isEmpty(bam))
+        self.assertGreater(samtools.count(bam), 0)
+        self.assertEqual(list(samtools.getReadGroups(bam).keys()), ['APCLT.1'])
+
+        # a BAM rewritten in place next to its old index is counted by a scan,
+        # not from the stale index statistics
+        sorted_bam = util.file.mkstempfname('.bam')
+        pysam.sort('-o', sorted_bam, os.path.join(util.file.get_test_input_path(), 'TestPerSample', 'in.bam'))
+        pysam.index(sorted_bam)
+        n = samtools.count(sorted_bam)
+        with pysam.AlignmentFile(sorted_bam) as inb:
+            header = inb.header.to_dict()
+            reads = list(inb.fetch(until_eof=True))
+        with pysam.AlignmentFile(sorted_bam, 'wb', header=header) as outb:
+            for read in reads[:n // 2]:
+                outb.write(read)
+        os.utime(sorted_bam, ns=(os.stat(sorted_bam).st_atime_ns, os.stat(sorted_bam + '.bai').st_mtime_ns + 10**9))
+        self.assertEqual(samtools.count(sorted_bam), n // 2)
+        self.assertEqual(samtools.count(sorted_bam, ['-F', '4']), sum(1 for r in reads[:n // 2] if not r.is_unmapped))
+
     def test_fasta_index(self):
         orig_ref = os.path.join(util.file.get_test_input_path(self), 'in.fasta')
         expected_fai = os.path.join(util.file.get_test_input_path(self), 'in.fasta.fai')
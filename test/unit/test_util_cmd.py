@@ -0,0 +1,145 @@
+# Unit tests for util.cmd.py
+
+__author__ = "dpark@broadinstitute.org"
+
+import argparse
+import logging
+import subprocess
+import sys
+import textwrap
+import time
+import unittest
+
+from mock import patch
+import pytest
+
+import util.cmd
+import util.version
+
+log = logging.getLogger(__name__)
+
+
+class TestLazyParsers(unittest.TestCase):
+
+    def setUp(self):
+        self.built = []
+
+        def parser_fn(name):
+            def parser_cmd(parser=argparse.ArgumentParser()):
+                self.built.append(name)
+                parser.add_argument('--flag', action='store_true')
+                util.cmd.common_args(parser, (('loglevel', None), ('version', None)))
+                util.cmd.attach_main(parser, lambda args: 0)
+                return parser
+            return parser_cmd
+        self.commands = [(name, parser_fn(name)) for name in ('one', 'two', 'three')]
+
+    def test_all_parsers_built_by_default(self):
+        util.cmd.make_parser(self.commands, 'test commands')
+        self.assertEqual(self.built, ['one', 'two', 'three'])
+
+    def test_only_selected_parser_built(self):
+        parser = util.cmd.make_parser(self.commands, 'test commands', only_command='two')
+        self.assertEqual(self.built, ['two'])
+        args = parser.parse_args(['two', '--flag'])
+        self.assertEqual(args.command, 'two')
+        self.assertTrue(args.flag)
+
+    def test_version_looked_up_only_when_requested(self):
+        with patch('util.version.get_version', return_value='1.2.3') as get_version:
+            parser = util.cmd.make_parser(self.commands, 'test commands', only_command='one')
+            parser.parse_args(['one'])
+            self.assertFalse(get_version.called)
+            with patch('sys.stdout'):
+                with self.assertRaises(SystemExit):
+                    parser.parse_args(['one', '--version'])
+            self.assertTrue(get_version.called)
+
+
+    def test_version_logged_when_command_runs(self):
+        root = logging.getLogger()
+        self.addCleanup(setattr, root, 'handlers', list(root.handlers))
+        self.addCleanup(root.setLevel, root.level)
+        with patch('util.version.get_version', return_value='1.2.3'):
+            with patch('sys.argv', ['test.py', 'two', '--loglevel', 'INFO']):
+                with self.assertLogs(level='INFO') as logs:
+                    self.assertEqual(util.cmd.main_argparse(self.commands, 'test commands'), 0)
+        self.assertTrue(any('software version: 1.2.3' in line for line in logs.output))
+
+
+class TestVersionCache(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('util.version.__version__', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_git_described_once_per_process(self):
+        with patch('util.version.is_git_checkout', return_value=True), \
+                patch('util.version.call_git_describe', return_value='v1.2.3') as describe, \
+                patch('util.version.read_release_version', return_value='v1.2.3'):
+            self.assertEqual(util.version.get_version(), 'v1.2.3')
+            self.assertEqual(util.version.get_version(), 'v1.2.3')
+        self.assertEqual(describe.call_count, 1)
+
+    def test_release_uses_version_file(self):
+        with patch('util.version.is_git_checkout', return_value=False), \
+                patch('util.version.call_git_describe') as describe, \
+                patch('util.version.read_release_version', return_value='v1.2.3'):
+            self.assertEqual(util.version.get_version(), 'v1.2.3')
+        self.assertFalse(describe.called)
+
+
+class TestStartupImports(unittest.TestCase):
+    ''' Building the parser and printing help should not import the heavy
+        modules that only the command implementations need. '''
+
+    HEAVY_MODULES = ('numpy', 'pysam', 'Bio', 'matplotlib', 'pybedtools')
+
+    def loaded_modules(self, script, *args):
+        code = textwrap.dedent('''
+            import runpy, sys
+            sys.argv = {argv!r}
+            try:
+                runpy.run_path(sys.argv[0], run_name='__main__')
+            except SystemExit:
+                pass
+            print(' '.join(['loaded:'] + [m for m in {modules!r} if m in sys.modules]))
+            ''').format(argv=[script] + list(args), modules=self.HEAVY_MODULES)
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=util.version.get_project_path())
+        return set(out.decode('utf-8').strip().splitlines()[-1].split()[1:])
+
+    def test_command_help(self):
+        for script, cmd in (('read_utils.py', 'read_names'), ('metagenomics.py', 'krona'),
+                            ('assembly.py', 'vcf_to_fasta'), ('reports.py', 'alignment_summary'),
+                            ('taxon_filter.py', 'deplete'),
+                            ('illumina.py', 'common_barcodes'), ('interhost.py', 'snpEff'),
+                            ('intrahost.py', 'merge_to_vcf'), ('ncbi.py', 'tbl_transfer'),
+                            ('file_utils.py', 'merge_tarballs')):
+            self.assertEqual(self.loaded_modules(script, cmd, '--help'), set(), '{} {}'.format(script, cmd))
+
+    def test_version_flag(self):
+        self.assertEqual(self.loaded_modules('read_utils.py', '--version'), set())
+
+
+@pytest.mark.slow
+class TestStartupTime(unittest.TestCase):
+    ''' A benchmark of running one subcommand from a cold interpreter '''
+
+    def best_time(self, args, repeat=3):
+        times = []
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.check_call([sys.executable] + args, cwd=util.version.get_project_path(),
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            times.append(time.time() - start)
+        return min(times)
+
+    def test_startup_benchmark(self):
+        heavy_imports = self.best_time(['-c', 'import numpy, pysam, Bio.SeqIO'])
+        log.info("time to import numpy, pysam and Bio.SeqIO: %0.3fs (best of 3)", heavy_imports)
+        for script, cmd in (('read_utils.py', 'read_names'), ('file_utils.py', 'merge_tarballs')):
+            startup = self.best_time([script, cmd, '--help'])
+            log.info("startup time for %s %s --help: %0.3fs (best of 3)", script, cmd, startup)
+            # printing help should cost less than importing what the commands use
+            self.assertLess(startup, heavy_imports)
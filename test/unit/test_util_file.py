@@ -4,6 +4,7 @@ __author__ = "ilya@broadinstitute.org"
 
 import os, os.path
 import builtins
+import gzip
 import util.file
 import pytest
 
@@ -84,6 +85,129 @@ def test_uncompressed_file_type():
     assert uft('/a/b/c/test.fasta') == '.fasta'
     assert uft('/a/test.gz') == ''
 
+@pytest.mark.parametrize("compression,threads,in_process",
+                         [('gz', 1, False), ('gz', 1, True), ('gz', 2, True),
+                          ('zst', None, False), ('zst', None, True), ('lz4', None, False), ('lz4', None, True)])
+def test_open_compressed_round_trip(tmpdir, monkeypatch, compression, threads, in_process):
+    """Test util.file.open_or_gzopen() on compressed files, with and without external tools"""
+    lines = ['read{}\t{}\n'.format(i, 'ACGT' * (i % 50)) for i in range(30000)]
+    fname = os.path.join(str(tmpdir), 'test.txt.' + compression)
+    if in_process:
+        monkeypatch.setattr(util.file, '_compression_command', lambda *args, **kwargs: None)
+    elif not util.file._compression_command(compression, 'w'):
+        pytest.skip('no external {} compressor installed'.format(compression))
+    try:
+        with util.file.open_or_gzopen(fname, 'wt', threads=threads) as outf:
+            outf.writelines(lines)
+    except IOError:
+        pytest.skip('no {} module installed'.format(compression))
+    with util.file.open_or_gzopen(fname, 'rt', threads=threads) as inf:
+        assert inf.readlines() == lines
+    with util.file.open_or_gzopen(fname, threads=threads) as inf:
+        assert inf.read() == ''.join(lines).encode('utf-8')
+    assert util.file.count_str_in_file(fname, 'read', starts_with=True) == len(lines)
+
+def test_bgzf_written_in_process(tmpdir, monkeypatch):
+    """Multithreaded in-process gzip output is BGZF, which is read back in parallel"""
+    monkeypatch.setattr(util.file, '_compression_command', lambda *args, **kwargs: None)
+    monkeypatch.setattr(util.file.util.misc, 'sanitize_thread_count', lambda threads=None, **kwargs: threads or 1)
+    data = os.urandom(200000) + b'A' * 300000
+    fname = os.path.join(str(tmpdir), 'test.bin.gz')
+    with util.file.open_or_gzopen(fname, 'wb', threads=3) as outf:
+        outf.write(data)
+    assert util.file.is_bgzf(fname)
+    with gzip.open(fname, 'rb') as inf:
+        assert inf.read() == data
+    with util.file.open_or_gzopen(fname, 'rb', threads=3) as inf:
+        assert isinstance(inf.raw, util.file._BgzfReader)
+        assert inf.read() == data
+
+def test_gzip_single_threaded_by_default(tmpdir, monkeypatch):
+    """Without a threads argument, gzip output is a plain level 9 stream, even with many CPUs"""
+    monkeypatch.setattr(util.file, '_compression_command', lambda *args, **kwargs: None)
+    monkeypatch.setattr(util.file.util.misc, 'sanitize_thread_count', lambda threads=None, **kwargs: 8)
+    data = b'ACGT' * 100000
+    fname = os.path.join(str(tmpdir), 'test.bin.gz')
+    with util.file.open_or_gzopen(fname, 'wb') as outf:
+        outf.write(data)
+    assert not util.file.is_bgzf(fname)
+    with open(fname, 'rb') as inf:
+        # the XFL header byte is 2 for maximum compression
+        assert inf.read(10)[8] == 2
+    with util.file.open_or_gzopen(fname, 'rb') as inf:
+        assert isinstance(inf, gzip.GzipFile)
+        assert inf.read() == data
+
+def test_compression_command_options(monkeypatch):
+    """External tools get one thread unless asked for more, and their own level syntax"""
+    monkeypatch.setattr(util.file.shutil, 'which', lambda exe: exe if exe == 'bgzip' else None)
+    monkeypatch.setattr(util.file.util.misc, 'sanitize_thread_count', lambda threads=None, **kwargs: threads or 8)
+    assert util.file._compression_command('gz', 'r') == ['bgzip', '-dc', '-@', '1']
+    assert util.file._compression_command('gz', 'w', threads=4, compresslevel=9) == \
+        ['bgzip', '-c', '-@', '4', '-l', '9']
+
+@pytest.mark.parametrize("text", ['', '\n', 'A', '>a\nAC\n>b\nGT\n', '>a\nAC\n\n>b\nGT', 'A>\n>\n>>\n'])
+@pytest.mark.parametrize("ext", ['.txt', '.txt.gz'])
+def test_line_count(tmpdir, monkeypatch, text, ext):
+    """Test util.file.line_count() and count_str_in_file() against line iteration"""
+    monkeypatch.setattr(util.file, '_COUNT_BLOCK_SIZE', 3)
+    fname = os.path.join(str(tmpdir), 'test' + ext)
+    with util.file.open_or_gzopen(fname, 'wt') as outf:
+        outf.write(text)
+    lines = text.splitlines()
+    assert util.file.line_count(fname) == len(lines)
+    assert util.file.line_count(fname, prefix='>') == sum(1 for line in lines if line.startswith('>'))
+    assert util.file.fasta_length(fname) == sum(1 for line in lines if line.startswith('>'))
+
+def test_line_count_line_endings(tmpdir):
+    """Only LF ends a line: CRLF counts once and a lone CR does not count"""
+    fname = os.path.join(str(tmpdir), 'test.txt')
+    with open(fname, 'wb') as outf:
+        outf.write(b'>a\r\nAC\r\n>b\rGT\n>c')
+    assert util.file.line_count(fname) == 4
+    assert util.file.line_count(fname, prefix='>') == 3
+
+def test_line_count_parallel(tmpdir, monkeypatch):
+    """Large uncompressed files are counted in byte ranges by several processes"""
+    monkeypatch.setattr(util.file, '_COUNT_PARALLEL_MIN_SIZE', 0)
+    monkeypatch.setattr(util.file.util.misc, 'sanitize_thread_count', lambda threads=None, **kwargs: threads or 8)
+    fname = os.path.join(str(tmpdir), 'test.fastq')
+    with open(fname, 'wt') as outf:
+        for i in range(1000):
+            outf.write('@read{}\n{}\n+\n{}\n'.format(i, 'ACGT' * (i % 7), 'I' * 4 * (i % 7)))
+    ranges = []
+    count_pattern_in_range = util.file._count_pattern_in_range
+    monkeypatch.setattr(util.file.concurrent.futures, 'ProcessPoolExecutor',
+                        util.file.concurrent.futures.ThreadPoolExecutor)
+    def counting(*args, **kwargs):
+        ranges.append(args)
+        return count_pattern_in_range(*args, **kwargs)
+    monkeypatch.setattr(util.file, '_count_pattern_in_range', counting)
+    assert util.file.count_fastq_reads(fname, threads=3) == 1000
+    assert len(ranges) == 3
+    assert util.file.line_count(fname, prefix='@read1') == 111
+    assert len(ranges) == 4
+
+def test_count_cache(tmpdir, monkeypatch):
+    """Counts are cached in a sidecar file until the input changes"""
+    monkeypatch.setattr(util.file, '_COUNT_CACHE_MIN_SIZE', 0)
+    fname = os.path.join(str(tmpdir), 'test.txt')
+    util.file.dump_file(fname, 'a\nb\n')
+    assert util.file.line_count(fname) == 2
+    assert os.path.isfile(os.path.join(str(tmpdir), '.test.txt.counts.json'))
+
+    counted = []
+    count_line_starts = util.file._count_line_starts
+    def counting(*args, **kwargs):
+        counted.append(args)
+        return count_line_starts(*args, **kwargs)
+    monkeypatch.setattr(util.file, '_count_line_starts', counting)
+    assert util.file.line_count(fname) == 2
+    assert not counted
+    util.file.dump_file(fname, 'a\nb\nc\n')
+    assert util.file.line_count(fname) == 3
+    assert len(counted) == 1
+
 def test_string_to_file_name():
     """Test util.file.string_to_file_name()"""
 
@@ -180,6 +180,21 @@ class TestFeatureSorter(unittest.TestCase):
             ]
         )
 
+    def testRandomIntervalsMatchBruteForce(self):
+        rng = random.Random(11)
+        features = []
+        for _ in range(200):
+            start = rng.randint(1, 1000)
+            features.append(('abca', start, start + rng.randint(0, 150), rng.choice('+-'), None))
+        fs = util.misc.FeatureSorter(features)
+        intervals = list(fs.get_intervals())
+        for c, left, right, n_features, overlapping in intervals:
+            expected = sorted(f for f in features if f[1] <= left and f[2] >= right)
+            self.assertEqual(overlapping, expected)
+            self.assertEqual(n_features, len(expected))
+        for prev, cur in zip(intervals, intervals[1:]):
+            self.assertEqual(prev[2] + 1, cur[1])
+
 
 class TestConfigIncludes(unittest.TestCase):
 
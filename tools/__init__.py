@@ -3,6 +3,7 @@
 __author__ = "dpark@broadinstitute.org,irwin@broadinstitute.org"
 
 import collections
+import fcntl
 import json
 import operator
 import os
@@ -180,6 +181,96 @@ class PrexistingUnixCommand(InstallMethod):
         return self.installed and self.path or None
 
 
+class ToolResolutionCache(object):
+    ''' A persistent record of resolved conda packages (installed version and
+        executable path), shared between processes through a JSON file so that
+        a Tool can be resolved without shelling out to conda.
+
+        Entries are keyed on the conda env path and package name, and are only
+        valid while the mtime of the env's conda-meta directory (which changes
+        whenever a package is installed or removed) matches the one recorded.
+        The file is rewritten atomically under an exclusive lock.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get('VIRAL_NGS_TOOL_CACHE') or os.path.join(
+            util.file.get_project_path(), 'tools', 'conda-cache', 'tool_resolution_cache.json')
+        self._entries = {}
+        self._loaded_stamp = None
+
+    @staticmethod
+    def _key(env_path, package):
+        return '{}::{}'.format(env_path, package)
+
+    @staticmethod
+    def _conda_meta_mtime(env_path):
+        try:
+            return os.stat(os.path.join(env_path, 'conda-meta')).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load(self):
+        ''' The cached entries, re-read only if the file changed since last read. '''
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self._entries, self._loaded_stamp = {}, None
+            return self._entries
+        stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if stamp != self._loaded_stamp:
+            try:
+                with open(self.path, 'rt') as inf:
+                    self._entries = json.load(inf)
+            except (OSError, ValueError):
+                self._entries = {}
+            self._loaded_stamp = stamp
+        return self._entries
+
+    def get(self, env_path, package):
+        entry = self._load().get(self._key(env_path, package))
+        if entry is None or entry.get('conda_meta_mtime') != self._conda_meta_mtime(env_path):
+            return None
+        return entry
+
+    def put(self, env_path, package, **values):
+        values['conda_meta_mtime'] = self._conda_meta_mtime(env_path)
+        if values['conda_meta_mtime'] is None:
+            return
+        key = self._key(env_path, package)
+        self._update(lambda entries: entries.__setitem__(key, values))
+
+    def invalidate(self, env_path=None):
+        ''' Drop the entries for one conda env, or all entries if env_path is None. '''
+        prefix = None if env_path is None else self._key(env_path, '')
+
+        def drop(entries):
+            for key in list(entries):
+                if prefix is None or key.startswith(prefix):
+                    del entries[key]
+        self._update(drop)
+
+    def _update(self, modify):
+        try:
+            util.file.mkdir_p(os.path.dirname(self.path))
+            with open(self.path + '.lock', 'a') as lockf:
+                fcntl.flock(lockf, fcntl.LOCK_EX)
+                entries = dict(self._load())
+                modify(entries)
+                tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+                with open(tmp_path, 'wt') as outf:
+                    json.dump(entries, outf, indent=1, sort_keys=True)
+                os.replace(tmp_path, self.path)
+        except OSError as e:
+            # the cache is only an optimization; carry on without it
+            _log.debug("Unable to update tool resolution cache %s: %s", self.path, e)
+
+
+resolution_cache = ToolResolutionCache()
+
+# conda env names already resolved to paths in this process
+_conda_env_paths = {}
+
+
 class CondaPackageVersion(object):
 
     def __init__(self, version, build_type=None):
@@ -307,6 +398,8 @@ class CondaPackage(InstallMethod):
                     conda_env_path = os.path.abspath(conda_env_path)
                     last_path_component = os.path.basename(os.path.normpath(conda_env_path))
                     self.env_path = os.path.dirname(last_path_component) if last_path_component == "bin" else conda_env_path
+                elif conda_env_path in _conda_env_paths:
+                    self.env_path = _conda_env_paths[conda_env_path]
                 else: # if conda env is an environment name, infer the path
                     #_log.debug('Conda env found is specified by name: %s' % conda_env_path)
                     result = util.misc.run_and_print(["conda", "env", "list", "--json"], silent=True, env=os.environ)
@@ -319,6 +412,7 @@ class CondaPackage(InstallMethod):
                                     if os.path.basename(os.path.realpath(item)) == conda_env_path:
                                         self.env_path = os.path.realpath(item)
                                         break
+                    _conda_env_paths[conda_env_path] = self.env_path
 
         # if the env is being overridden, or if we could not find an active conda env
         if env_root_path or env or not self.env_path:
@@ -412,9 +506,13 @@ class CondaPackage(InstallMethod):
         if os.access(self.executable_path(), (os.X_OK | os.R_OK) if self.require_executability else os.R_OK):
             # optionally use the verify command, if specified
             if self.verifycmd:
-                if os.system(self.verifycmd) == self.verifycode:
+                cached = resolution_cache.get(self.env_path, self.package)
+                if cached and cached.get('verified'):
+                    self.installed = installed_version
+                elif os.system(self.verifycmd) == self.verifycode:
                     _log.debug("Validating with cmd: {}".format(self.verifycmd))
                     self.installed = installed_version
+                    self._cache_resolution(installed_version, verified=True)
             else:
                 self.installed = installed_version
         else:
@@ -480,9 +578,19 @@ class CondaPackage(InstallMethod):
         self.verify_install()
         self.post_install()
 
+    def _cache_resolution(self, installed_version, verified=False):
+        resolution_cache.put(self.env_path, self.package,
+                             version=installed_version.version,
+                             build_type=installed_version.build_type,
+                             executable=self.executable_path(),
+                             verified=verified)
+
     def get_installed_version(self):
-        # If we ever use conda to install pip packages as tools, "-c" needs to be removed
+        cached = resolution_cache.get(self.env_path, self.package)
+        if cached is not None and cached.get('executable') == self.executable_path():
+            return CondaPackageVersion(cached['version'], cached['build_type'])
 
+        # If we ever use conda to install pip packages as tools, "-c" needs to be removed
         data = self.execute(["list", "-c", "--json", "-f", "-p", self.env_path, self.package], check=True, silent=True)
         if data is None or not len(data):
             return
@@ -497,7 +605,9 @@ class CondaPackage(InstallMethod):
             installed_version = matches.group("version")
             installed_package = matches.group("package_name")
             installed_build_type = matches.group("build_type")
-            return CondaPackageVersion(installed_version, installed_build_type)
+            installed_version = CondaPackageVersion(installed_version, installed_build_type)
+            self._cache_resolution(installed_version)
+            return installed_version
 
     def package_available(self):
         # If we ever use conda to install pip packages as tools, "-c" needs to be removed
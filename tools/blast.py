@@ -39,9 +39,7 @@ class BlastnTool(BlastTools):
     """ Tool wrapper for blastn """
     subtool_name = 'blastn'
 
-    def get_hits_pipe(self, inPipe, db, threads=None):
-
-        # run blastn and emit list of read IDs
+    def _get_hits_cmd(self, db, threads=None):
         threads = util.misc.sanitize_thread_count(threads)
         cmd = [self.install_and_get_path(),
             '-db', db,
@@ -51,23 +49,46 @@ class BlastnTool(BlastTools):
             '-outfmt', 6,
             '-max_target_seqs', 1,
         ]
-        cmd = [str(x) for x in cmd]
-        _log.debug('| ' + ' '.join(cmd) + ' |')
-        blast_pipe = subprocess.Popen(cmd, stdin=inPipe, stdout=subprocess.PIPE)
+        return [str(x) for x in cmd]
 
+    @staticmethod
+    def _read_ids_from_hits(lines):
         # strip tab output to just query read ID names and emit
         last_read_id = None
-        for line in blast_pipe.stdout:
-            line = line.decode('UTF-8').rstrip('\n\r')
-            read_id = line.split('\t')[0]
+        for line in lines:
+            if isinstance(line, bytes):
+                line = line.decode('UTF-8')
+            read_id = line.rstrip('\n\r').split('\t')[0]
             # only emit if it is not a duplicate of the previous read ID
             if read_id != last_read_id:
                 last_read_id = read_id
                 yield read_id
 
+    def get_hits_pipe(self, inPipe, db, threads=None):
+
+        # run blastn and emit list of read IDs
+        cmd = self._get_hits_cmd(db, threads=threads)
+        _log.debug('| ' + ' '.join(cmd) + ' |')
+        blast_pipe = subprocess.Popen(cmd, stdin=inPipe, stdout=subprocess.PIPE)
+
+        for read_id in self._read_ids_from_hits(blast_pipe.stdout):
+            yield read_id
+
         if blast_pipe.poll():
             raise subprocess.CalledProcessError(blast_pipe.returncode, cmd)
 
+    def get_hits_fasta_str(self, fasta_str, db, threads=None):
+        """ run blastn on FASTA-formatted text fed over stdin (no intermediate
+            files) and return the list of read IDs with hits
+        """
+        cmd = self._get_hits_cmd(db, threads=threads)
+        _log.debug('| ' + ' '.join(cmd) + ' |')
+        blast_pipe = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out, _ = blast_pipe.communicate(fasta_str.encode('UTF-8'))
+        if blast_pipe.returncode:
+            raise subprocess.CalledProcessError(blast_pipe.returncode, cmd)
+        return list(self._read_ids_from_hits(out.splitlines()))
+
     def get_hits_bam(self, inBam, db, threads=None):
         return self.get_hits_pipe(
             tools.samtools.SamtoolsTool().bam2fa_pipe(inBam),
@@ -4,12 +4,14 @@
 '''
 
 from collections import defaultdict
+import io
+import itertools
 import logging
 import os
 import os.path
 import subprocess
 import shutil
-import concurrent.futures
+import tempfile
 
 import tools
 import tools.samtools
@@ -78,56 +80,62 @@ class Bwa(tools.Tool):
                                   threads=threads, invert_filter=invert_filter)
 
         else:
-            # Multiple RGs, align one at a time and merge
-            align_bams = []
-
-            threads_for_chunk = int(round(min(max(threads / len(rgs),1),threads),0))+1
-            # worker count limited to 1 for now to reduce in-memory index size resulting from
-            # running multiple copies of bwa in parallel
-            workers = 1 #len(rgs) if len(rgs)<threads else threads
-            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-                futures = []# executor.submit(util.file.count_occurrences_in_tsv, filePath, include_noise=includeNoise) for rg in rgs]
-
-                for rg in rgs:
-                    tmp_bam = util.file.mkstempfname('.{}.bam'.format(rg))
-                    futures.append(executor.submit(
-                        self.align_mem_one_rg,
-                        inBam,
-                        refDb,
-                        tmp_bam,
-                        rgid=rg,
-                        options=options,
-                        min_score_to_filter=min_score_to_filter,
-                        threads=threads_for_chunk, 
-                        invert_filter=invert_filter
-                    ))
-
-                for future in concurrent.futures.as_completed(futures):
-                    if future.result():
-                        rg, aln_bam = future.result()
-                        if os.path.getsize(aln_bam) > 0:
-                            align_bams.append(aln_bam)
-                        else:
-                            log.warning("No alignment output for RG %s in file %s against %s", rg, inBam, refDb)
-
-            if len(align_bams) == 0:
-                util.file.touch(outBam)
+            # Multiple RGs, align them all at once with one copy of the index in memory
+            self.align_mem_all_rgs(inBam, refDb, outBam, options=options,
+                                   min_score_to_filter=min_score_to_filter,
+                                   threads=threads, invert_filter=invert_filter, should_index=should_index)
+
+    def align_mem_all_rgs(self, inBam, refDb, outBam, options=None,
+                          min_score_to_filter=None, threads=None, invert_filter=False, should_index=True):
+        """
+            Aligns every read group in a bam file to a reference in a single bwa mem
+            process, so the index is loaded once and all read groups share all threads.
+
+            Each read's RG tag is carried through bwa as a fastq comment (bwa mem -C)
+            and the @RG header lines of inBam are passed to bwa (bwa mem -H). The
+            alignments stream straight into one samtools sort, without intermediate
+            SAM files or a per-RG merge step.
+        """
+        options = list(options or [])
+
+        samtools = tools.samtools.SamtoolsTool()
+        threads = util.misc.sanitize_thread_count(threads)
+        if '-t' not in options:
+            options.extend(('-t', str(threads)))
+
+        with util.file.tempfname('.rg_header.txt') as headerFile:
+            with open(headerFile, 'wt') as outf:
+                for row in samtools.getHeader(inBam):
+                    if len(row) > 0 and row[0] == '@RG':
+                        outf.write('\t'.join(row) + '\n')
+
+            fastq_pipe = samtools.bam2fq_pipe(inBam, tags=['RG'])
+            bwa_cmd = [self.install_and_get_path(), 'mem'] + options + ['-C', '-H', headerFile, '-p', refDb, '-']
+            log.debug(' '.join(bwa_cmd))
+            bwa_proc = subprocess.Popen(bwa_cmd, stdin=fastq_pipe.stdout, stdout=subprocess.PIPE)
+            fastq_pipe.stdout.close()
+
+            sort_cmd = [samtools.install_and_get_path(), 'sort', '-@', str(threads)]
+            if os.path.isdir(tempfile.tempdir):
+                sort_cmd.extend(('-T', tempfile.tempdir))
+            sort_cmd.extend(('-o', outBam, '-'))
+            log.debug(' '.join(sort_cmd))
+            if min_score_to_filter:
+                sort_proc = subprocess.Popen(sort_cmd, stdin=subprocess.PIPE)
+                with io.TextIOWrapper(bwa_proc.stdout) as in_sam, io.TextIOWrapper(sort_proc.stdin) as out_sam:
+                    for line in filter_sam_lines_on_alignment_score(in_sam, min_score_to_filter,
+                                                                    options, invert_filter=invert_filter):
+                        out_sam.write(line)
             else:
-                # Merge BAMs, sort, and index
-                picardOptions = ['SORT_ORDER=coordinate', 'USE_THREADING=true']
-                if should_index:
-                    picardOptions.append('CREATE_INDEX=true')
-                tools.picard.MergeSamFilesTool().execute(
-                    align_bams,
-                    outBam,
-                    picardOptions=picardOptions,
-                    JVMmemory=JVMmemory
-                )
-                # no longer required since MergeSamFiles creates the index
-                #if outBam.endswith(".bam") or outBam.endswith(".cram"):
-                #    samtools.index(outBam)
-                for bam in align_bams:
-                    os.unlink(bam)
+                sort_proc = subprocess.Popen(sort_cmd, stdin=bwa_proc.stdout)
+                bwa_proc.stdout.close()
+
+            for proc, name in ((sort_proc, 'samtools sort'), (bwa_proc, 'bwa mem'), (fastq_pipe, 'samtools bam2fq')):
+                if proc.wait():
+                    raise subprocess.CalledProcessError(proc.returncode, "{} for {}".format(name, inBam))
+
+        if should_index and (outBam.endswith(".bam") or outBam.endswith(".cram")):
+            samtools.index(outBam)
 
     def align_mem_one_rg(self, inBam, refDb, outBam, rgid=None, options=None,
                          min_score_to_filter=None, threads=None, JVMmemory=None, invert_filter=False, should_index=True):
@@ -311,3 +319,49 @@ class Bwa(tools.Tool):
                         (qname_alignment_scores[qname] < min_score_to_filter and invert_filter)):
                         # Write this query name
                         out_sam_f.write(line + '\n')
+
+
+def filter_sam_lines_on_alignment_score(in_sam_lines, min_score_to_filter, bwa_options, invert_filter=False):
+    """Streaming version of Bwa.filter_sam_on_alignment_score.
+
+    Yields the header lines of in_sam_lines and the alignment lines of each
+    query name whose alignment score, summed across its alignments, passes
+    min_score_to_filter. All alignments of a query name must be adjacent,
+    as they are in bwa mem output, so only one query is held in memory.
+    """
+    if '-a' in bwa_options:
+        log.warning(("'bwa mem -a' will output secondary alignments, "
+                     "and the filter on alignment score will use "
+                     "a score that is summed across the primary and "
+                     "secondary alignments for each read; this might "
+                     "not be desired"))
+
+    qname, score, lines = None, 0, []
+    for line in itertools.chain(in_sam_lines, [None]):
+        if line is not None and line.startswith('@'):
+            yield line
+            continue
+        ls = line.rstrip('\r\n').split('\t') if line is not None else None
+        if ls is None or ls[0] != qname:
+            if lines and ((score >= min_score_to_filter) != invert_filter):
+                for out_line in lines:
+                    yield out_line
+            if ls is None:
+                break
+            qname, score, lines = ls[0], 0, []
+
+        # bwa's output should have optional fields for all alignments
+        assert len(ls) >= 12
+        aln_score = None
+        for opt_field in ls[11:]:
+            opt_field_tag, opt_field_type, opt_field_val = opt_field.split(':', 2)
+            if opt_field_tag == 'AS':
+                # The alignment score output by bwa should be a signed integer
+                assert opt_field_type == 'i'
+                aln_score = int(opt_field_val)
+                break
+        if aln_score is None:
+            raise Exception(("Unknown alignment score for query "
+                            "name %s") % qname)
+        score += aln_score
+        lines.append(line if line.endswith('\n') else line + '\n')
@@ -14,8 +14,6 @@ import shutil
 import tempfile
 import time
 
-import Bio.Seq
-
 import tools
 import tools.samtools
 import util.file
@@ -84,6 +82,7 @@ class Gap2SeqTool(tools.Tool):
             random_seed: random seed for choosing random paths (0 to use current time)
         
         """
+        import Bio.SeqIO
         solid_kmer_thresholds = sorted(util.misc.make_seq(solid_kmer_thresholds), reverse=True)
         kmer_sizes = sorted(util.misc.make_seq(kmer_sizes), reverse=True)
         stop_time = time.time() + 60*time_soft_limit_minutes
@@ -12,8 +12,6 @@ import shutil
 import subprocess
 import tools
 
-from Bio import SeqIO
-
 import util.file
 
 TOOL_VERSION = '1.6.3_yesimon'
@@ -60,6 +58,7 @@ class Kaiju(tools.Tool):
           translate_accessions: If fasta IDs are accessions, translate to
             <accession>_<taxid> format kaiju expects.
         '''
+        from Bio import SeqIO
         assert len(protein_fastas), ('Kaiju requires input files to create a database.')
         options = options or {}
         options['-a'] = 'protein'
@@ -14,12 +14,9 @@ import shutil
 import re
 import collections
 
-import Bio.SeqIO
-
 import read_utils
 import tools
 import tools.samtools
-import tools.picard
 import util.file
 import util.misc
 
@@ -220,6 +217,7 @@ class KmcTool(tools.Tool):
           hard_mask: if True, in the output reads, kmers not passing the filter are replaced by Ns
           threads: use this many threads
         """
+        import Bio.SeqIO
         _log.debug('FILTER_READS: locals=%s dbinfo=%s', locals(), self.get_kmer_db_info(kmer_db))
 
         abs_thresholds = (read_min_occs, read_max_occs) != (0, util.misc.MAX_INT32)
@@ -276,8 +274,7 @@ class KmcTool(tools.Tool):
                 _chk(out_reads.endswith('.bam'), 'output from .bam to non-.bam not yet supported')
                 passing_read_names = os.path.join(t_dir, 'passing_read_names.txt')
                 read_utils.fasta_read_names(_out_reads, passing_read_names)
-                tools.picard.FilterSamReadsTool().execute(inBam=in_reads, exclude=False,
-                                                          readList=passing_read_names, outBam=out_reads)
+                read_utils.filter_bam_by_read_ids(in_reads, passing_read_names, out_reads, threads=threads)
         # end: with util.file.tmp_dir(suffix='kmcfilt') as t_dir
     # end: def filter_reads(self, kmer_db, in_reads, out_reads, db_min_occs=1, db_max_occs=util.misc.MAX_INT32, ...)
 
@@ -5,7 +5,6 @@
 
 __author__ = "tomkinsc@broadinstitute.org"
 
-from Bio import SeqIO
 import logging
 import tools
 import util.file
@@ -32,6 +31,7 @@ class MafftTool(tools.Tool):
         return TOOL_VERSION
 
     def __seqIdsAreAllUnique(self, filePath, inputFormat="fasta"):
+        from Bio import SeqIO
         seqIds = []
         with open(filePath, "r") as inFile:
             fastaFile = SeqIO.parse(inFile, inputFormat)
@@ -3,6 +3,8 @@
     http://mummer.sourceforge.net/
 '''
 
+import bisect
+import itertools
 import logging
 import tools
 import util.file
@@ -11,7 +13,6 @@ import os
 import os.path
 import random
 import subprocess
-import Bio.SeqIO
 
 TOOL_NAME = "mummer4"
 tool_version = '4.0.0beta2'
@@ -135,6 +136,7 @@ class MummerTool(tools.Tool):
             min_pct_id=0.6, min_pct_contig_aligned=0.5, min_contig_len=200):
         ''' Align contigs with MUMmer and trim off the unused portions.
         '''
+        import Bio.SeqIO
         # run MUMmer to get best alignments
         if aligner=='nucmer':
             aligner = self.nucmer
@@ -215,6 +217,7 @@ class MummerTool(tools.Tool):
             feature to scaffold contigs onto a reference genome.
         '''
 
+        import Bio.SeqIO
         # create tiling path with nucmer/promer and show-tiling
         if aligner=='nucmer':
             aligner = self.nucmer
@@ -340,6 +343,7 @@ class MummerTool(tools.Tool):
             an aligned-fasta file of the two based on show-aligns
             output.
         '''
+        import Bio.SeqIO
         # grab seq_ids (very inefficient, but whatever)
         ref_id = Bio.SeqIO.read(refFasta, 'fasta').id
         query_id = Bio.SeqIO.read(otherFasta, 'fasta').id
@@ -462,6 +466,7 @@ class AlignsReader(object):
         self.seq_ids = []
         self._load_align()
         self._load_fastas()
+        self._index_alignments()
 
     def _load_align(self):
         with open(self.aligns_file, 'rt') as inf:
@@ -520,9 +525,32 @@ class AlignsReader(object):
                     align_lines += 1
 
     def _load_fastas(self):
+        import Bio.SeqIO
         assert self.ref_fasta and self.seq_ids
         self.reference_seq = Bio.SeqIO.index(self.ref_fasta, 'fasta')[self.seq_ids[0]]
 
+    def _index_alignments(self):
+        ''' Index alignments by reference start, with a running maximum of
+            reference stops, so the alignments containing a reference window
+            are found without scanning every alignment. Also record where the
+            reference bases fall in each gapped alignment row.
+        '''
+        self._by_start = sorted(range(len(self.alignments)), key=lambda i: self.alignments[i][1])
+        self._starts = [self.alignments[i][1] for i in self._by_start]
+        self._max_stops = list(itertools.accumulate(
+            (self.alignments[i][2] for i in self._by_start), max))
+        self._ref_base_positions = {}
+
+    def _alignments_containing(self, start, stop):
+        ''' Alignments whose reference span contains start-stop, in file order. '''
+        hits = []
+        i = bisect.bisect_right(self._starts, start) - 1
+        while i >= 0 and self._max_stops[i] >= stop:
+            if self.alignments[self._by_start[i]][2] >= stop:
+                hits.append(self._by_start[i])
+            i -= 1
+        return [self.alignments[j] for j in sorted(hits)]
+
     def get_alignments(self):
         for a in self.alignments:
             yield a
@@ -569,7 +597,7 @@ class AlignsReader(object):
         '''
 
         # grab the one alignment that contains this window
-        alns = list(a for a in self.alignments if a[1]<=start and a[2]>=stop)
+        alns = self._alignments_containing(start, stop)
         if aln_start is not None and aln_stop is not None:
             # if specified, restrict to a specific alignment that comes from show-tiling
             # (sometimes show-aligns is more promiscuous than show-tiling)
@@ -600,27 +628,17 @@ class AlignsReader(object):
         aln_start = start - ref_l
         aln_stop = stop - ref_l
 
-        # travel down alignment until we've reached the left edge
-        #  (because of gaps, you must check each position one by one)
-        #  end loop when ref_seq[:i_left] contains {aln_start} bases
-        n_ref_bases = 0
-        i_left = 0
-        while n_ref_bases < aln_start:
-            if ref_seq[i_left] != '-':
-                n_ref_bases += 1
-            i_left += 1
-
-        # travel down alignment until we've reached the right edge
-        #  (because of gaps, you must check each position one by one)
-        #  end loop when ref_seq[:i_right] contains {aln_stop} bases
-        i_right = i_left
-        while n_ref_bases < aln_stop:
-            if ref_seq[i_right] != '-':
-                n_ref_bases += 1
-            i_right += 1
-        # consume and include any trailing gaps
-        while i_right < len(ref_seq) and ref_seq[i_right] == '-':
-            i_right += 1
+        # column of each (non-gap) reference base in the alignment row
+        ref_base_positions = self._ref_base_positions.get(id(ref_seq))
+        if ref_base_positions is None:
+            ref_base_positions = [i for i, base in enumerate(ref_seq) if base != '-']
+            self._ref_base_positions[id(ref_seq)] = ref_base_positions
+
+        # left edge: just past the {aln_start}th reference base
+        i_left = ref_base_positions[aln_start-1] + 1 if aln_start > 0 else 0
+        # right edge: just past the {aln_stop}th reference base, including
+        #  any trailing gaps (i.e. the column of the next reference base)
+        i_right = ref_base_positions[aln_stop] if aln_stop < len(ref_base_positions) else len(ref_seq)
 
         # grab the alternate sequence and strip gaps
         return alt_seq[i_left:i_right+1].replace('-','')
@@ -11,8 +11,6 @@ import subprocess
 import contextlib
 from decimal import *
 
-import pysam
-
 import tools
 import tools.samtools
 import util.file
@@ -357,6 +355,7 @@ class FilterSamReadsTool(PicardTools):
     jvmMemDefault = '4g'
 
     def execute(self, inBam, exclude, readList, outBam, picardOptions=None, JVMmemory=None):    # pylint: disable=W0221
+        import pysam
         picardOptions = picardOptions or []
 
         if tools.samtools.SamtoolsTool().isEmpty(inBam):
@@ -23,11 +23,10 @@ import os.path
 import subprocess
 import tempfile
 import contextlib
+import threading
 from collections import OrderedDict
 from decimal import *
 
-import pysam
-
 import tools
 import util.file
 import util.misc
@@ -37,6 +36,54 @@ TOOL_VERSION = '1.9'
 
 log = logging.getLogger(__name__)
 
+# In-process memo of BAM metadata (headers, emptiness, counts), keyed on
+# (path, mtime, size, query) so rewritten files are never served stale.
+_bam_metadata_cache = {}
+_bam_metadata_lock = threading.Lock()
+
+
+def _cached_bam_metadata(inBam, query, compute):
+    st = os.stat(inBam)
+    key = (os.path.realpath(inBam), st.st_mtime_ns, st.st_size, query)
+    with _bam_metadata_lock:
+        if key in _bam_metadata_cache:
+            return _bam_metadata_cache[key]
+    val = compute()
+    with _bam_metadata_lock:
+        _bam_metadata_cache[key] = val
+    return val
+
+
+def _index_is_current(inBam):
+    ''' True if inBam has a .bai/.csi index written no earlier than the BAM
+        itself, so that its statistics still describe the BAM's reads.
+    '''
+    bam_mtime = os.stat(inBam).st_mtime_ns
+    return any(os.path.isfile(fn) and os.stat(fn).st_mtime_ns >= bam_mtime
+               for fn in (inBam + '.bai', os.path.splitext(inBam)[0] + '.bai', inBam + '.csi'))
+
+
+def _parse_count_opts(opts):
+    ''' Translate the samtools view filter options understood in-process
+        (-f, -F, -q, -r; -c and -S are no-ops) into a dict. Returns None if
+        any other option is present.
+    '''
+    filters = {'require': 0, 'exclude': 0, 'min_mapq': 0, 'read_group': None}
+    opts = list(opts)
+    while opts:
+        opt = opts.pop(0)
+        if opt in ('-c', '-S'):
+            continue
+        elif opt in ('-f', '-F', '-q', '-r') and opts:
+            val = opts.pop(0)
+            if opt == '-r':
+                filters['read_group'] = val
+            else:
+                filters[{'-f': 'require', '-F': 'exclude', '-q': 'min_mapq'}[opt]] = int(val, 0)
+        else:
+            return None
+    return filters
+
 
 class SamtoolsTool(tools.Tool):
 
@@ -93,8 +140,13 @@ class SamtoolsTool(tools.Tool):
         else:
             self.execute('bam2fq', ['-1', outFq1, '-2', outFq2, inBam])
 
-    def bam2fq_pipe(self, inBam):
-        tool_cmd = [self.install_and_get_path(), 'bam2fq', '-n', inBam]
+    def bam2fq_pipe(self, inBam, tags=None):
+        ''' Stream inBam as (interleaved) fastq. Any aux tags listed in tags
+            (e.g. ['RG']) are copied into the fastq comment of each read. '''
+        tool_cmd = [self.install_and_get_path(), 'bam2fq', '-n']
+        if tags:
+            tool_cmd += ['-T', ','.join(tags)]
+        tool_cmd.append(inBam)
         log.debug(' '.join(tool_cmd) + ' |')
         p = subprocess.Popen(tool_cmd, stdout=subprocess.PIPE)
         return p
@@ -203,6 +255,7 @@ class SamtoolsTool(tools.Tool):
               '^((?:[0-9]+[ID]){1}(?:[0-9]+[MNIDSHPX=])+)|((?:[0-9]+[MNIDSHPX=])+(?:[0-9]+[ID]){1})$'
 
         '''
+        import pysam
         regex = re.compile(regexToMatchForRemoval)
         with pysam.AlignmentFile(inBam, 'rb', check_sq=False) as inb:
             with pysam.AlignmentFile(outBam, 'wb', header=inb.header) as outf:
@@ -246,12 +299,12 @@ class SamtoolsTool(tools.Tool):
 
     def getHeader(self, inBam):
         ''' fetch BAM header as a list of tuples (already split on tabs) '''
-        tmpf = util.file.mkstempfname('.txt')
-        self.dumpHeader(inBam, tmpf)
-        with open(tmpf, 'rb') as inf:
-            header = list(line.decode("latin-1").rstrip('\n').split('\t') for line in inf)
-        os.unlink(tmpf)
-        return header
+        import pysam
+        def read_header():
+            with pysam.AlignmentFile(inBam, check_sq=False) as inb:
+                text = str(inb.header)
+            return tuple(tuple(line.split('\t')) for line in text.splitlines() if line)
+        return [list(row) for row in _cached_bam_metadata(inBam, ('header',), read_header)]
 
     def getReadGroups(self, inBam):
         ''' fetch all read groups from the BAM header as an OrderedDict of
@@ -265,16 +318,58 @@ class SamtoolsTool(tools.Tool):
         ]
         return OrderedDict((rg['ID'], rg) for rg in rgs)
 
-    def count(self, inBam, opts=None, regions=None):
-        opts = opts or []
-        regions = regions or []
-
-        cmd = [self.install_and_get_path(), 'view', '-c'] + opts + [inBam] + regions
-        return int(subprocess.check_output(cmd).strip())
-        #if inBam.endswith('.sam') and '-S' not in opts:
-        #    opts = ['-S'] + opts
-        #cmd = ['-c'] + opts + [inBam] + regions
-        #return int(pysam.view(*cmd)[0].strip())
+    def count(self, inBam, opts=None, regions=None, threads=None):
+        ''' Count the reads in inBam, as samtools view -c would.
+            Unfiltered and -F 4 / -f 4 counts of indexed BAMs come straight
+            from the index (idxstats); other -f/-F/-q/-r filters are applied
+            in a (BGZF-threaded) pysam scan. Any other samtools view option
+            is handed to samtools itself.
+        '''
+        opts = list(opts or [])
+        regions = list(regions or [])
+        filters = _parse_count_opts(opts)
+
+        def count_reads():
+            if filters is not None:
+                n = self._count_in_process(inBam, filters, regions, threads)
+                if n is not None:
+                    return n
+            cmd = [self.install_and_get_path(), 'view', '-c'] + opts + [inBam] + regions
+            return int(subprocess.check_output(cmd).strip())
+        return _cached_bam_metadata(inBam, ('count', tuple(opts), tuple(regions)), count_reads)
+
+    def _count_in_process(self, inBam, filters, regions, threads=None):
+        import pysam
+        with pysam.AlignmentFile(inBam, check_sq=False,
+                                 threads=util.misc.sanitize_thread_count(threads)) as inb:
+            index_ok = inb.is_bam and inb.has_index()
+            if regions and not index_ok:
+                return None
+
+            # index statistics answer unfiltered and mapped/unmapped counts,
+            # unless the BAM was rewritten after it was indexed
+            if (index_ok and not regions and filters['min_mapq'] == 0 and filters['read_group'] is None
+                    and _index_is_current(inBam)):
+                flags = (filters['require'], filters['exclude'])
+                if flags == (0, 0):
+                    return inb.mapped + inb.unmapped
+                elif flags == (0, 4):
+                    return inb.mapped
+                elif flags == (4, 0):
+                    return inb.unmapped
+
+            require, exclude = filters['require'], filters['exclude']
+            min_mapq, read_group = filters['min_mapq'], filters['read_group']
+
+            def keep(read):
+                return ((read.flag & require) == require and not (read.flag & exclude)
+                        and read.mapping_quality >= min_mapq
+                        and (read_group is None or
+                             (read.has_tag('RG') and read.get_tag('RG') == read_group)))
+
+            if regions:
+                return sum(1 for region in regions for read in inb.fetch(region=region) if keep(read))
+            return sum(1 for read in inb.fetch(until_eof=True) if keep(read))
 
     def mpileup(self, inBam, outPileup, opts=None):
         opts = opts or []
@@ -282,17 +377,11 @@ class SamtoolsTool(tools.Tool):
         self.execute('mpileup', opts + [inBam], stdout=outPileup, stderr='/dev/null')    # Suppress info messages
 
     def isEmpty(self, inBam):
+        import pysam
         if not os.path.isfile(inBam):
             return True
-        else:
-            tmpf = util.file.mkstempfname('.txt')
-            self.dumpHeader(inBam, tmpf)
-            header_size = os.path.getsize(tmpf)
-            if (os.path.getsize(inBam) > (100 + 5 * header_size)):
-                # large BAM file: assume it is not empty
-                # a BAM file definitely has reads in it if its filesize is larger
-                # than just the header itself
-                return False
-            else:
-                # small BAM file: just count and see if it's non-zero
-                return (0 == self.count(inBam))
+
+        def has_no_reads():
+            with pysam.AlignmentFile(inBam, check_sq=False) as inb:
+                return next(inb.fetch(until_eof=True), None) is None
+        return _cached_bam_metadata(inBam, ('isEmpty',), has_no_reads)
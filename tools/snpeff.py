@@ -11,9 +11,6 @@ import logging
 import subprocess
 import shutil
 
-# third-party
-import pysam
-
 # module-specific
 import tools
 import util.file
@@ -165,6 +162,7 @@ class SnpEff(tools.Tool):
         """
         Annotate variants in VCF file with translation consequences using snpEff.
         """
+        import pysam
         if outVcf.endswith('.vcf.gz'):
             tmpVcf = util.file.mkstempfname(prefix='vcf_snpEff-', suffix='.vcf')
         elif outVcf.endswith('.vcf'):
@@ -11,8 +11,6 @@ import random
 import shlex
 import tempfile
 
-import Bio.SeqIO
-
 import tools
 import tools.samtools
 import tools.picard
@@ -72,6 +70,7 @@ class SpadesTool(tools.Tool):
                 http://cab.spbu.ru/files/release3.11.1/rnaspades_manual.html#sec2.4 .
         '''
 
+        import Bio.SeqIO
         threads = util.misc.sanitize_thread_count(threads)
 
         util.file.make_empty(contigs_out)
@@ -2,6 +2,7 @@
 
 import logging
 import os
+import stat
 import subprocess
 import tools
 import util.file
@@ -42,7 +43,8 @@ class TrimmomaticTool(tools.Tool):
         unpairedFastq2 = unpairedOutFastq2 or util.file.mkstempfname()
         javaCmd = [trimmomaticPath]
 
-        if inFastq2 is None or os.path.getsize(inFastq2) < 10:
+        # a named pipe has no size until it is read, so treat it as paired input
+        if inFastq2 is None or (not stat.S_ISFIFO(os.stat(inFastq2).st_mode) and os.path.getsize(inFastq2) < 10):
             # Unpaired reads
             javaCmd.extend([
                     'SE', '-phred33',
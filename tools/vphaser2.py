@@ -7,7 +7,6 @@ import subprocess
 import os
 import tempfile
 import shutil
-import pysam
 import tools
 import util.file
 
@@ -56,6 +55,7 @@ class Vphaser2Tool(tools.Tool):
          [CHROM, Ref_Pos, Var, Cons, Strd_bias_pval, Type, Var_perc,
           SNP_or_LP_Profile1, SNP_or_LP_Profile2, ...]
         """
+        import pysam
         outdir = tempfile.mkdtemp('vphaser2')
         try:
             self.execute(inBam, outdir, numThreads)
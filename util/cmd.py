@@ -19,7 +19,6 @@ import util.version
 import util.file
 
 __author__ = "dpark@broadinstitute.org"
-__version__ = util.version.get_version()
 
 log = logging.getLogger()
 tmp_dir = None
@@ -86,14 +85,23 @@ def common_args(parser, arglist=(('tmp_dir', None), ('loglevel', None))):
                                 help="Number of threads (default: {})".format(text_default),
                                 default=v)
         elif k == 'version':
-            if not v:
-                v = __version__
-            parser.add_argument('--version', '-V', action='version', version=v)
+            parser.add_argument('--version', '-V', action=_VersionAction, version=v)
         else:
             raise Exception("unrecognized argument %s" % k)
     return parser
 
 
+class _VersionAction(argparse._VersionAction):
+    ''' A --version action that only looks up the software version (which
+        may mean calling git) if the option is actually given.
+    '''
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        if not self.version:
+            self.version = util.version.get_version()
+        super(_VersionAction, self).__call__(parser, namespace, values, option_string)
+
+
 def main_command(mainfunc):
     ''' This wraps a python method in another method that can be called
         with an argparse.Namespace object. When called, it will pass all
@@ -152,7 +160,7 @@ class _HelpAction(argparse._HelpAction):
         parser.exit()
 
 
-def make_parser(commands, description):
+def make_parser(commands, description, only_command=None):
     ''' commands: a list of pairs containing the following:
             1. name of command (string, no whitespace)
             2. method to call (no arguments) that returns an argparse parser.
@@ -161,6 +169,8 @@ def make_parser(commands, description):
             thing and just present the options for that one function.
         description: a long string to present as a description of your script
             as a whole if the script is run with no arguments
+        only_command: if given, only the subparser for this command is
+            built (the command parsers are called lazily, by name).
     '''
     if len(commands) == 1 and commands[0][0] == None:
         # only one (nameless) command in this script, simplify
@@ -170,9 +180,11 @@ def make_parser(commands, description):
         # multiple commands available
         parser = argparse.ArgumentParser(description=description, usage='%(prog)s subcommand', add_help=False)
         parser.add_argument('--help', '-h', action=_HelpAction, help=argparse.SUPPRESS)
-        parser.add_argument('--version', '-V', action='version', version=__version__, help=argparse.SUPPRESS)
+        parser.add_argument('--version', '-V', action=_VersionAction, version=None, help=argparse.SUPPRESS)
         subparsers = parser.add_subparsers(title='subcommands', dest='command', metavar='\033[F') # \033[F moves cursor up
         for cmd_name, cmd_parser in commands:
+            if only_command is not None and cmd_name != only_command:
+                continue
             help_str = cmd_parser.__doc__ if cmd_parser.__doc__ and len(cmd_parser.__doc__) else None
             # give a blank string for help if the parser docstring is null
             # so sphinx-argparse doesnt't render "Undocumented"
@@ -184,7 +196,12 @@ def make_parser(commands, description):
 
 
 def main_argparse(commands, description):
-    parser = make_parser(commands, description)
+    # Build only the parser of the subcommand being run, if it is named:
+    # some command parsers are costly to build (tool lookups, plotting
+    # backends) and scatter jobs run many short commands.
+    command_names = set(cmd_name for cmd_name, cmd_parser in commands if cmd_name is not None)
+    only_command = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] in command_names else None
+    parser = make_parser(commands, description, only_command=only_command)
 
     # if called with no arguments, print help
     if len(sys.argv) == 1:
@@ -194,7 +211,7 @@ def main_argparse(commands, description):
     args = parser.parse_args()
 
     setup_logger(not hasattr(args, 'loglevel') and 'DEBUG' or args.loglevel)
-    log.info("software version: %s, python version: %s", __version__, sys.version)
+    log.info("software version: %s, python version: %s", util.version.get_version(), sys.version)
     log.info("command: %s %s %s", sys.argv[0], sys.argv[1],
              ' '.join(["%s=%s" % (k, v) for k, v in vars(args).items() if k not in ('command', 'func_main')]))
 
@@ -6,6 +6,7 @@ general file-handling routines.
 __author__ = "dpark@broadinstitute.org"
 
 import codecs
+import concurrent.futures
 import contextlib
 import os
 import gzip
@@ -18,24 +19,19 @@ import logging
 import json
 import sys
 import io
-import csv
 import inspect
 import tarfile
+import struct
+import zlib
 
 import util.cmd
 import util.misc
 
-from Bio import SeqIO
-from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
-from Bio.SeqIO import FastaIO
-
 # imports needed for download_file() and webfile_readlines()
 import re
 
-from urllib.request import urlopen # pylint: disable=E0611
-
-import pysam
+# Bio, pysam and urllib.request are imported by the few functions that need
+# them: every script imports this module, so it is kept quick to load.
 
 log = logging.getLogger(__name__)
 
@@ -326,7 +322,286 @@ def touch_p(path, times=None):
     touch(path, times=times)
 
 
+# Compressed files are recognized by extension. Each format is read and written
+# through the first available external (de)compressor, which runs in its own
+# process and (for pigz, bgzip and zstd) with as many threads as the caller
+# asks for; otherwise an in-process implementation is used. The last element
+# of each tool entry is how it takes a compression level.
+_COMPRESSION_EXTENSIONS = {'.gz': 'gz', '.bgz': 'gz', '.zst': 'zst', '.zstd': 'zst', '.lz4': 'lz4'}
+_COMPRESSION_TOOLS = {
+    'gz': {
+        'r': (('pigz', ['-dc', '-p', '{threads}'], None), ('bgzip', ['-dc', '-@', '{threads}'], None)),
+        'w': (('pigz', ['-c', '-p', '{threads}'], ['-{level}']),
+              ('bgzip', ['-c', '-@', '{threads}'], ['-l', '{level}'])),
+    },
+    'zst': {
+        'r': (('zstd', ['-dcq'], None),),
+        'w': (('zstd', ['-cq', '-T{threads}'], ['-{level}']),),
+    },
+    'lz4': {
+        'r': (('lz4', ['-dcq'], None),),
+        'w': (('lz4', ['-cq'], ['-{level}']),),
+    },
+}
+
+
+def compression_type(fname):
+    ''' Return the compression format ('gz', 'zst' or 'lz4') implied by the
+        extension of fname, or None for uncompressed files.
+    '''
+    return _COMPRESSION_EXTENSIONS.get(os.path.splitext(fname)[1].lower())
+
+
+def _compression_threads(threads):
+    ''' The number of (de)compression threads to use: one unless the caller
+        asks for more, since callers often already run in parallel.
+    '''
+    return 1 if threads is None else util.misc.sanitize_thread_count(threads)
+
+
+def _compression_command(compression, mode, threads=None, compresslevel=None):
+    ''' Return the command line of the first installed tool that (de)compresses
+        the given format between stdin and stdout, or None.
+    '''
+    for executable, opts, level_opts in _COMPRESSION_TOOLS[compression]['r' if mode == 'r' else 'w']:
+        path = shutil.which(executable)
+        if path:
+            cmd = [path] + [opt.format(threads=_compression_threads(threads)) for opt in opts]
+            if compresslevel is not None and level_opts:
+                cmd.extend(opt.format(level=compresslevel) for opt in level_opts)
+            return cmd
+    return None
+
+
+class _ProcessPipe(io.RawIOBase):
+    ''' A binary stream that reads from or writes to fname through a
+        (de)compressor subprocess. Closing the stream waits for the process
+        and raises CalledProcessError if it failed.
+    '''
+
+    def __init__(self, cmd, fname, mode):
+        super(_ProcessPipe, self).__init__()
+        self._cmd = cmd
+        self._mode = mode
+        self._eof = False
+        if mode == 'r':
+            self._file = open(fname, 'rb')
+            self._proc = subprocess.Popen(cmd, stdin=self._file, stdout=subprocess.PIPE)
+            self._pipe = self._proc.stdout
+        else:
+            self._file = open(fname, mode + 'b')
+            self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=self._file)
+            self._pipe = self._proc.stdin
+
+    def readable(self):
+        return self._mode == 'r'
+
+    def writable(self):
+        return self._mode != 'r'
+
+    def readinto(self, b):
+        n = self._pipe.readinto(b)
+        if not n:
+            self._eof = True
+        return n
+
+    def write(self, b):
+        self._pipe.write(b)
+        return len(b)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._pipe.close()
+            returncode = self._proc.wait()
+        finally:
+            self._file.close()
+            super(_ProcessPipe, self).close()
+        # a reader closed before the end of the stream leaves the process to die of SIGPIPE
+        if returncode and (self._mode != 'r' or self._eof):
+            raise subprocess.CalledProcessError(returncode, self._cmd)
+
+
+# BGZF (the blocked gzip of bgzip and samtools) is a series of gzip members of
+# at most 64 KiB, each recording its own size, so blocks can be inflated or
+# deflated independently of each other.
+_BGZF_HEADER = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+_BGZF_EOF = _BGZF_HEADER + b'\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+_BGZF_BLOCK_DATA = 0xff00
+_BGZF_BATCH_PER_THREAD = 4
+
+
+def is_bgzf(fname):
+    ''' Return True if fname starts with a BGZF block header. '''
+    with open(fname, 'rb') as inf:
+        return inf.read(len(_BGZF_HEADER)) == _BGZF_HEADER
+
+
+def _bgzf_inflate(block):
+    data = zlib.decompress(block[18:-8], -15)
+    crc, size = struct.unpack('<II', block[-8:])
+    if size != len(data) or crc != zlib.crc32(data):
+        raise IOError('BGZF block failed its integrity check')
+    return data
+
+
+def _bgzf_deflate(data, compresslevel):
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    return b''.join((_BGZF_HEADER, struct.pack('<H', len(cdata) + 25), cdata,
+                     struct.pack('<II', zlib.crc32(data), len(data))))
+
+
+class _BgzfReader(io.RawIOBase):
+    ''' Inflates a BGZF file with a pool of threads (zlib releases the GIL). '''
+
+    def __init__(self, fname, threads=None):
+        super(_BgzfReader, self).__init__()
+        self._file = open(fname, 'rb')
+        self._threads = util.misc.sanitize_thread_count(threads)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._threads)
+        self._buffer = b''
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def _read_blocks(self):
+        blocks = []
+        while len(blocks) < self._threads * _BGZF_BATCH_PER_THREAD:
+            header = self._file.read(18)
+            if not header:
+                break
+            if len(header) < 18 or header[:4] != _BGZF_HEADER[:4] or header[12:14] != b'BC':
+                raise IOError('{} is not a BGZF file'.format(self._file.name))
+            block = header + self._file.read(struct.unpack('<H', header[16:18])[0] - 17)
+            blocks.append(block)
+        return b''.join(self._executor.map(_bgzf_inflate, blocks))
+
+    def readinto(self, b):
+        while self._offset == len(self._buffer):
+            self._buffer, self._offset = self._read_blocks(), 0
+            if not self._buffer and self._file.tell() == os.fstat(self._file.fileno()).st_size:
+                return 0
+        n = min(len(b), len(self._buffer) - self._offset)
+        b[:n] = self._buffer[self._offset:self._offset + n]
+        self._offset += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._executor.shutdown()
+            self._file.close()
+        super(_BgzfReader, self).close()
+
+
+class _BgzfWriter(io.RawIOBase):
+    ''' Writes a BGZF file, deflating batches of blocks with a pool of threads.
+        The output is a valid gzip file.
+    '''
+
+    def __init__(self, fname, mode='w', threads=None, compresslevel=6):
+        super(_BgzfWriter, self).__init__()
+        self._file = open(fname, mode + 'b')
+        self._threads = util.misc.sanitize_thread_count(threads)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._threads)
+        self._compresslevel = compresslevel
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def _write_blocks(self, final=False):
+        n_blocks = len(self._buffer) // _BGZF_BLOCK_DATA
+        if final and len(self._buffer) % _BGZF_BLOCK_DATA:
+            n_blocks += 1
+        blocks = [bytes(self._buffer[i * _BGZF_BLOCK_DATA:(i + 1) * _BGZF_BLOCK_DATA]) for i in range(n_blocks)]
+        del self._buffer[:n_blocks * _BGZF_BLOCK_DATA]
+        for block in self._executor.map(_bgzf_deflate, blocks, [self._compresslevel] * len(blocks)):
+            self._file.write(block)
+
+    def write(self, b):
+        self._buffer.extend(b)
+        if len(self._buffer) >= self._threads * _BGZF_BATCH_PER_THREAD * _BGZF_BLOCK_DATA:
+            self._write_blocks()
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._write_blocks(final=True)
+                self._file.write(_BGZF_EOF)
+            finally:
+                self._executor.shutdown()
+                self._file.close()
+        super(_BgzfWriter, self).close()
+
+
+def _open_in_process(fname, mode, compression, threads=None, compresslevel=None):
+    ''' Open a compressed file as a binary stream without external tools. '''
+    threads = _compression_threads(threads)
+    if compression == 'gz':
+        if mode == 'r' and threads > 1 and is_bgzf(fname):
+            return io.BufferedReader(_BgzfReader(fname, threads=threads))
+        if mode != 'r' and threads > 1:
+            return io.BufferedWriter(_BgzfWriter(fname, mode, threads=threads,
+                                                 compresslevel=6 if compresslevel is None else compresslevel))
+        return gzip.open(fname, mode + 'b', 9 if compresslevel is None else compresslevel)
+    try:
+        if compression == 'zst':
+            import zstandard
+            if mode == 'r':
+                return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(fname, 'rb'),
+                                                                                   closefd=True))
+            return zstandard.ZstdCompressor(level=3 if compresslevel is None else compresslevel,
+                                            threads=threads).stream_writer(open(fname, mode + 'b'),
+                                                                           closefd=True)
+        elif compression == 'lz4':
+            import lz4.frame
+            return lz4.frame.open(fname, mode + 'b', compression_level=compresslevel or 0)
+    except ImportError:
+        raise IOError('cannot open {}: no {} (de)compressor is installed'.format(fname, compression))
+    raise ValueError('unsupported compression: {}'.format(compression))
+
+
+def open_compressed(fname, mode='rb', compresslevel=None, encoding=None, errors=None, newline=None,
+                    compression=None, threads=None):
+    ''' Open a gzip, zstd or lz4 compressed file, with the same arguments and
+        text/binary mode semantics as gzip.open (binary unless 't' is in mode).
+        compression defaults to the type implied by the file extension.
+
+        Data is passed through pigz/bgzip, zstd or lz4 in a subprocess where
+        installed; otherwise gzip is handled in-process. (De)compression uses
+        a single thread unless threads is given; with more than one thread,
+        in-process gzip reads BGZF input and writes BGZF output in parallel,
+        and plain gzip (level 9 by default) is used otherwise.
+    '''
+    compression = compression or compression_type(fname) or 'gz'
+    base_mode = mode.replace('t', '').replace('b', '')
+    if base_mode not in ('r', 'w', 'a', 'x'):
+        raise ValueError('invalid mode: {}'.format(mode))
+    if 't' not in mode and (encoding is not None or errors is not None or newline is not None):
+        raise ValueError('encoding, errors and newline are only valid in text mode')
+
+    cmd = _compression_command(compression, base_mode, threads=threads, compresslevel=compresslevel)
+    if cmd:
+        raw = _ProcessPipe(cmd, fname, base_mode)
+        binary_file = io.BufferedReader(raw) if base_mode == 'r' else io.BufferedWriter(raw)
+    else:
+        binary_file = _open_in_process(fname, base_mode, compression, threads=threads, compresslevel=compresslevel)
+
+    if 't' in mode:
+        return io.TextIOWrapper(binary_file, encoding, errors, newline)
+    return binary_file
+
+
 def open_or_gzopen(fname, *opts, **kwargs):
+    ''' Open fname like the builtin open(), or like gzip.open() if it is a
+        gzip, zstd or lz4 compressed file (see open_compressed). The number
+        of (de)compression threads may be given as the threads keyword.
+    '''
+    threads = kwargs.pop('threads', None)
     mode = 'r'
     open_opts = list(opts)
     assert type(mode) == str, "open mode must be of type str"
@@ -340,14 +615,14 @@ def open_or_gzopen(fname, *opts, **kwargs):
                 kwargs['newline'] = None
             open_opts[0] = mode.replace("U","")
 
-    # if this is a gzip file
-    if fname.endswith('.gz'):
+    # if this is a compressed file
+    if compression_type(fname):
         # if 't' for text mode is not explicitly included,
         # replace "U" with "t" since under gzip "rb" is the
         # default and "U" depends on "rt"
         gz_mode = str(mode).replace("U","" if "t" in mode else "t")
         gz_opts = [gz_mode]+list(opts)[1:]
-        return gzip.open(fname, *gz_opts, **kwargs)
+        return open_compressed(fname, *gz_opts, threads=threads, **kwargs)
     else:
         return open(fname, *open_opts, **kwargs)
 
@@ -508,6 +783,7 @@ def makeFastaFile(seqs, outFasta):
 
 def bam_is_sorted(bam_file_path):
     # Should perhaps be in samtools.py once it moves to pysam
+    import pysam
     samfile = pysam.AlignmentFile(bam_file_path, "rb", check_sq=False)
     if "HD" in samfile.header and "SO" in samfile.header["HD"]:
         return samfile.header["HD"]["SO"] in ("coordinate") # also: "queryname"
@@ -530,6 +806,7 @@ def concat(inputFilePaths, outputFilePath, append=False):
 
 
 def download_file(uriToGet, dest, destFileName=None):
+    from urllib.request import urlopen # pylint: disable=E0611
     destDir = os.path.realpath(os.path.expanduser(dest))
 
     req = urlopen(uriToGet)
@@ -555,6 +832,7 @@ def download_file(uriToGet, dest, destFileName=None):
 
 
 def webfile_readlines(uriToGet):
+    from urllib.request import urlopen # pylint: disable=E0611
 
     for line in urlopen(uriToGet):  # .readlines():
         cleanedLine = line.decode("utf-8").strip()
@@ -633,6 +911,8 @@ def sanitize_id_for_sam_rname(string_in):
     return string_value
 
 def write_fasta_with_sanitized_ids(fasta_in, out_filepath):
+    from Bio import SeqIO
+    from Bio.SeqIO import FastaIO
     with open(out_filepath, "w") as handle:
         fasta_out = FastaIO.FastaWriter(handle, wrap=None)
         fasta_out.write_header()
@@ -774,22 +1054,112 @@ def grep_count(file_path, to_match, additional_flags=None, fixed_mode=True, star
     number_of_seqs = util.misc.run_and_print(cmd, silent=False, check=True, env=env)
     return int(number_of_seqs.stdout.decode("utf-8").rstrip(os.linesep))
 
-# used by count_and_sort_barcodes
-def count_occurrences_in_tsv(filePath, col=0, noise_chr='.', delimiter='\t', include_noise=False):
-    file_occurrence_counts = {}
-    with open(filePath) as infile:
-        for row in csv.reader(infile, delimiter=delimiter):
-            if noise_chr not in row[col] or include_noise:
-                file_occurrence_counts[row[col]] = file_occurrence_counts.get(row[col], 0) + 1
-    return file_occurrence_counts
+# Record counts are taken by counting byte patterns over large binary blocks
+# rather than by iterating lines. Uncompressed files of at least
+# _COUNT_PARALLEL_MIN_SIZE are split into byte ranges counted by separate
+# processes. Counts of files of at least _COUNT_CACHE_MIN_SIZE are remembered
+# in a hidden sidecar file next to the input, keyed on its size and mtime.
+_COUNT_BLOCK_SIZE = 1 << 23
+_COUNT_PARALLEL_MIN_SIZE = 1 << 28
+_COUNT_CACHE_MIN_SIZE = 1 << 20
+
+
+def _count_pattern_in_stream(inf, pattern, limit=None, carry=b''):
+    ''' Count the occurrences of pattern in carry followed by the next limit
+        bytes of a binary stream (or up to EOF if limit is None), including
+        matches that start within those bytes but run past them. Returns the
+        count and the last byte read.
+    '''
+    n = carry.count(pattern)
+    last = carry[-1:]
+    carry = carry[len(carry) - len(pattern) + 1:] if len(pattern) > 1 else b''
+    remaining = None if limit is None else limit + len(pattern) - 1
+    while remaining is None or remaining > 0:
+        block = inf.read(_COUNT_BLOCK_SIZE if remaining is None else min(_COUNT_BLOCK_SIZE, remaining))
+        if not block:
+            break
+        if remaining is not None:
+            remaining -= len(block)
+        last = block[-1:]
+        block = carry + block
+        n += block.count(pattern)
+        carry = block[len(block) - len(pattern) + 1:] if len(pattern) > 1 else b''
+    return n, last
+
+
+def _count_pattern_in_range(fname, pattern, start, end, carry=b''):
+    with open(fname, 'rb') as inf:
+        inf.seek(start)
+        return _count_pattern_in_stream(inf, pattern, end - start, carry=carry)
+
+
+def _count_line_starts(fname, prefix=b'', threads=None):
+    ''' Count the lines of fname (possibly compressed) that start with prefix,
+        or all lines if prefix is empty.
+    '''
+    # a virtual newline before the first byte makes the first line like any other
+    pattern = b'\n' + prefix
+    threads = _compression_threads(threads)
+    if compression_type(fname):
+        with open_or_gzopen(fname, 'rb', threads=threads) as inf:
+            n, last = _count_pattern_in_stream(inf, pattern, carry=b'\n')
+    else:
+        size = os.path.getsize(fname)
+        if threads > 1 and size >= _COUNT_PARALLEL_MIN_SIZE:
+            bounds = [size * i // threads for i in range(threads + 1)]
+            with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
+                counts = executor.map(_count_pattern_in_range, [fname] * threads, [pattern] * threads,
+                                      bounds[:-1], bounds[1:], [b'\n'] + [b''] * (threads - 1))
+                n = sum(count for count, _ in counts)
+            with open(fname, 'rb') as inf:
+                inf.seek(-1, os.SEEK_END)
+                last = inf.read(1)
+        else:
+            n, last = _count_pattern_in_range(fname, pattern, 0, size, carry=b'\n')
+    if not prefix and last == b'\n':
+        # the newline ending the last line is not the start of another line
+        n -= 1
+    return n
+
+
+def _cached_count(fname, key, compute):
+    ''' Return compute(), the count named key for fname, reusing the value
+        stored in the sidecar of fname if its size and mtime are unchanged.
+    '''
+    stat = os.stat(fname)
+    if stat.st_size < _COUNT_CACHE_MIN_SIZE:
+        return compute()
+    sidecar = os.path.join(os.path.dirname(fname), '.{}.counts.json'.format(os.path.basename(fname)))
+    stamp = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    try:
+        with open(sidecar, 'rt') as inf:
+            cached = json.load(inf)
+        if not (isinstance(cached, dict) and isinstance(cached.get('counts'), dict)
+                and all(cached.get(k) == v for k, v in stamp.items())):
+            raise ValueError('stale count cache')
+    except (IOError, OSError, ValueError):
+        cached = dict(stamp, counts={})
+    if key not in cached['counts']:
+        cached['counts'][key] = compute()
+        try:
+            tmp_sidecar = '{}.{}.tmp'.format(sidecar, os.getpid())
+            with open(tmp_sidecar, 'wt') as outf:
+                json.dump(cached, outf)
+            os.replace(tmp_sidecar, sidecar)
+        except (IOError, OSError) as e:
+            log.debug("could not write count cache %s: %s", sidecar, e)
+    return cached['counts'][key]
+
 
 def count_str_in_file(in_file, query_str, starts_with=False):
     if not os.path.isfile(in_file) or os.path.getsize(in_file)==0:
         return 0
 
-    if in_file.endswith('.gz'):
+    if starts_with and '\n' not in query_str:
+        return line_count(in_file, prefix=query_str)
+    elif compression_type(in_file):
         n = 0
-        with gzip.open(in_file, 'rt') as inf:
+        with open_or_gzopen(in_file, 'rt') as inf:
             if starts_with:
                 n = sum(1 for line in inf if line.startswith(query_str))
             else:
@@ -805,11 +1175,11 @@ def fasta_length(fasta_path):
     '''
     return count_str_in_file(fasta_path, '>', starts_with=True)
 
-def count_fastq_reads(inFastq):
+def count_fastq_reads(inFastq, threads=None):
     '''
         Count number of reads in fastq file
     '''
-    n = line_count(inFastq)
+    n = line_count(inFastq, threads=threads)
     if n % 4 != 0:
         raise Exception("cannot count reads in a fastq with wrapped lines")
     return n // 4
@@ -817,12 +1187,15 @@ def count_fastq_reads(inFastq):
     # fastq counting approach....
     #return count_str_in_file(inFastq, '@', starts_with=True)
 
-def line_count(infname):
-    n = 0
-    with open_or_gzopen(infname, 'rt') as inf:
-        for line in inf:
-            n += 1
-    return n
+def line_count(infname, prefix='', threads=None):
+    '''
+        Count number of lines in a (possibly compressed) text file, or
+        only those starting with prefix. Lines end at '\\n' (so '\\r\\n' line
+        endings count the same); unlike text-mode iteration, a lone '\\r' is
+        not a line break.
+    '''
+    return _cached_count(infname, 'lines:' + prefix,
+                         lambda: _count_line_starts(infname, prefix.encode('utf-8'), threads=threads))
 
 def touch(fname, times=None):
     with open(fname, 'a'):
@@ -887,7 +1260,7 @@ def find_broken_symlinks(rootdir, followlinks=False):
 def uncompressed_file_type(fname):
     """Return the original file extension of either a compressed or an uncompressed file."""
     base, ext = os.path.splitext(fname)
-    if ext in ('.gz', '.bz2'):
+    if ext in ('.gz', '.bz2', '.zst', '.lz4'):
         base, ext = os.path.splitext(base)
     return ext
 
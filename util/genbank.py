@@ -6,9 +6,6 @@ import os
 import re
 import logging
 
-# third-party
-from Bio import Entrez
-
 log = logging.getLogger(__name__)
 
 
@@ -56,6 +53,7 @@ def _fetch_from_nuccore(accessionList, destinationDir, emailAddress,
     """
         This function downloads and saves files from NCBI nuccore.
     """
+    from Bio import Entrez
     db = "nuccore"
     Entrez.email = emailAddress
     if api_key is not None:
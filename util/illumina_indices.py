@@ -11,6 +11,7 @@
 import re, functools
 import csv
 import copy
+import itertools
 import math
 import logging
 from collections import OrderedDict, defaultdict
@@ -1556,54 +1557,135 @@ class IlluminaIndexReference(object):
                 instruments |= set(ins_for_barcode)
         return sorted(list(instruments))
 
-    @memoize
-    def index_for_seq(self, seq, kit=None, instrument=None):
+    # Lookup tables over _kits, shared by all instances and built lazily on
+    # first use: sequence -> barcode entries, literal index name -> barcode
+    # entries, (compiled pattern, entries) for index names that are regular
+    # expressions, and per-distance Hamming neighborhoods of all sequences.
+    _seq_index = None
+    _name_index = None
+    _name_patterns = None
+    _neighborhoods = {}
+
+    _neighbor_letters = "ACGTN"
+    _regex_chars = set("[]|().*+?^$\\{}")
+
+    @classmethod
+    def _build_indices(cls):
+        if cls._seq_index is not None:
+            return
+        seq_index = defaultdict(list)
+        name_index = defaultdict(list)
+        name_patterns = OrderedDict()
+        for kit_name,kit_value in cls._kits.items():
+            for item_key,item_value in kit_value.items():
+                if type(item_value) == dict:
+                    for index_name,index_value in item_value.items():
+                        for barcode_meta in index_value:
+                            # (index name, kit name, kit short name, seq, instruments)
+                            entry = (index_name, kit_name, kit_value["_short_name"], barcode_meta["seq"],
+                                     frozenset(barcode_meta["instruments"]))
+                            seq_index[barcode_meta["seq"]].append(entry)
+                            if cls._regex_chars.intersection(index_name):
+                                name_patterns.setdefault(index_name, []).append(entry)
+                            else:
+                                name_index[index_name].append(entry)
+        cls._name_patterns = [(re.compile("(?P<index>"+index_name+")"), entries)
+                              for index_name, entries in name_patterns.items()]
+        cls._name_index = dict(name_index)
+        cls._seq_index = dict(seq_index)
+
+    @classmethod
+    def _hamming_ball(cls, seq, distance):
+        ''' Yields every sequence 1..distance substitutions (over ACGTN) away
+            from seq, each exactly once '''
+        for n_subs in range(1, distance + 1):
+            for positions in itertools.combinations(range(len(seq)), n_subs):
+                choices = [[j for j in cls._neighbor_letters if j != seq[i]] for i in positions]
+                for letters in itertools.product(*choices):
+                    neighbor = list(seq)
+                    for i, j in zip(positions, letters):
+                        neighbor[i] = j
+                    yield "".join(neighbor)
+
+    @classmethod
+    def _neighborhood(cls, distance):
+        ''' neighbor seq -> known barcode seqs within the given Hamming distance '''
+        if distance not in cls._neighborhoods:
+            cls._build_indices()
+            table = defaultdict(list)
+            for known_seq in cls._seq_index:
+                for neighbor_seq in cls._hamming_ball(known_seq, distance):
+                    table[neighbor_seq].append(known_seq)
+            cls._neighborhoods[distance] = dict(table)
+        return cls._neighborhoods[distance]
+
+    @staticmethod
+    def _index_names(entries, kit=None, instrument=None):
+        return sorted(set(index_name for index_name, kit_name, kit_short_name, seq, instruments in entries
+                          if (not kit or kit_name == kit or kit_short_name == kit)
+                          and (not instrument or instrument in instruments)))
+
+    def index_for_seq(self, seq, kit=None, instrument=None, reverse_complement=False):
         # use kit/instrument passed in if present
         # value forinstrument, if present, if neither return list of options
-        possible_indices = set()
-        for kit_name,kit_value in self._kits.items():
-            if not kit or (kit_name == kit) or (kit_value["_short_name"]==kit):
-                for item_key,item_value in kit_value.items():
-                    if type(item_value) == dict:
-                        for index_name,index_value in item_value.items():
-                            for barcode_meta in index_value:
-                                if barcode_meta["seq"] == seq:
-                                    if not instrument or instrument in barcode_meta["instruments"]:
-                                        possible_indices |= set([index_name])
-        return sorted(list(possible_indices))
+        # if reverse_complement, barcodes whose reverse complement is seq also match
+        self._build_indices()
+        entries = self._seq_index.get(seq, [])
+        if reverse_complement:
+            entries = entries + self._seq_index.get(self.reverse_complement(seq), [])
+        return self._index_names(entries, kit=kit, instrument=instrument)
 
-    @memoize
     def seq_for_index(self, index, kit=None, instrument=None):
         # use kit/instrument passed in if present
         # value forinstrument, if present, if neither return list of options
-        possible_seqs = set()
-        for kit_name,kit_value in self._kits.items():
-            if not kit or (kit_name == kit) or (kit_value["_short_name"]==kit):
-                for item_key,item_value in kit_value.items():
-                    if type(item_value) == dict:
-                        for index_name,index_value in item_value.items():
-                            matches = re.match("(?P<index>"+index_name+")", index)
-                            if matches:
-                                for barcode_meta in index_value:
-                                    if not instrument or instrument in barcode_meta["instruments"]:
-                                        possible_seqs |= set([barcode_meta["seq"]])
-        return sorted(list(possible_seqs))
-
-    @memoize
-    def guess_index(self, seq, distance=1, kit=None, instrument=None):
-        # using neighbors()...
+        # (index names are matched as regular expressions anchored at the start of index)
+        self._build_indices()
+        entries = []
+        for i in range(1, len(index) + 1):
+            entries.extend(self._name_index.get(index[:i], []))
+        for pattern, pattern_entries in self._name_patterns:
+            if pattern.match(index):
+                entries.extend(pattern_entries)
+        return sorted(set(seq for index_name, kit_name, kit_short_name, seq, instruments in entries
+                          if (not kit or kit_name == kit or kit_short_name == kit)
+                          and (not instrument or instrument in instruments)))
+
+    def guess_index(self, seq, distance=1, kit=None, instrument=None, reverse_complement=False):
         # use kit/instrument if present
-        possible_indices = set()
         # first include exact matches
-        exact_matches = self.index_for_seq(seq, kit=kit, instrument=instrument)
+        exact_matches = self.index_for_seq(seq, kit=kit, instrument=instrument, reverse_complement=reverse_complement)
         if len(exact_matches):
-            possible_indices |= set(exact_matches)
-        else:
-            # then include barcodes _distance_ away
-            for neighbor_seq in self.neighbors(seq, distance=distance):
+            return exact_matches
+
+        # then include barcodes _distance_ away
+        query_seqs = [seq, self.reverse_complement(seq)] if reverse_complement else [seq]
+        possible_indices = set()
+        for query_seq in query_seqs:
+            if distance in (1, 2) and set(query_seq) <= set(self._neighbor_letters):
+                # Hamming distance is symmetric, so the precomputed
+                # neighborhoods of the known barcodes answer this directly
+                neighbor_seqs = self._neighborhood(distance).get(query_seq, [])
+            else:
+                neighbor_seqs = self.neighbors(query_seq, distance=distance)
+            for neighbor_seq in neighbor_seqs:
                 possible_indices |= set(self.index_for_seq(neighbor_seq, kit=kit, instrument=instrument))
         return sorted(list(possible_indices))
 
+    def guess_indices(self, seqs, distance=1, kit=None, instrument=None, reverse_complement=False):
+        ''' guess_index for each barcode in an array of barcodes, returning a
+            list of results in the same order. Each distinct barcode is looked
+            up only once.
+        '''
+        import numpy
+        seqs = numpy.asarray(seqs, dtype=str)
+        if not seqs.size:
+            return []
+        distinct_seqs, inverse = numpy.unique(seqs, return_inverse=True)
+        guesses = [self.guess_index(str(seq), distance=distance, kit=kit, instrument=instrument,
+                                    reverse_complement=reverse_complement)
+                   for seq in distinct_seqs]
+        return [guesses[i] for i in inverse]
+
 class UncertainSamplesheetError(Exception):
     pass
 
@@ -1637,7 +1719,12 @@ class IlluminaBarcodeHelper(object):
         # read barcodes seen in the file, in the format:
         #Barcode1   Likely_Index_Names1 Barcode2    Likely_Index_Names2 Count
         #CTCTCTAC   N707    AAGGAGTA    S507,[N|S|E]507 40324834
-        for row in util.file.read_tabfile_dict(barcode_counts, rowcount_limit=rows_limit):
+        # (barcode_counts may also be an iterable of such rows, as dicts)
+        if isinstance(barcode_counts, str):
+            barcode_rows = util.file.read_tabfile_dict(barcode_counts, rowcount_limit=rows_limit)
+        else:
+            barcode_rows = itertools.islice(barcode_counts, rows_limit)
+        for row in barcode_rows:
             if (row["Barcode1"],row.get("Barcode2",None)) not in self.barcodes_seen:
                 self.barcodes_seen[(row["Barcode1"],row.get("Barcode2",None))] = int(row["Count"])
             self.barcode_name_map[row["Barcode1"]] = row["Likely_Index_Names1"]
@@ -25,6 +25,12 @@ def get_project_path():
     return path
 
 
+def is_git_checkout():
+    ''' True if the project is a git working copy (and not, e.g., an
+        installed release), in which case git describe is authoritative. '''
+    return os.path.exists(os.path.join(get_project_path(), '.git'))
+
+
 def call_git_describe():
     cwd = os.getcwd()
     try:
@@ -109,7 +115,9 @@ def approx_version_number():
 def get_version():
     global __version__
     if __version__ is None:
-        from_git = call_git_describe()
+        # outside a git working copy, skip spawning git and use the VERSION
+        # file cached by an earlier run (or written at release time)
+        from_git = call_git_describe() if is_git_checkout() else None
         from_file = read_release_version()
 
         if from_git: